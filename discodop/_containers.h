@@ -252,10 +252,11 @@ public:
         return lexical[a].lhs < lexical[b].lhs;
     }
 };
+// likewise, with a pointer to an array of LexicalRules, to search for a label.
 class LexLabelCmp {
-	std::vector<LexicalRule>& lexical;
+	LexicalRule *lexical;
 public:
-    LexLabelCmp(std::vector<LexicalRule>& v): lexical(v) {}
+    LexLabelCmp(LexicalRule *v): lexical(v) {}
     bool operator()(uint32_t a, Label b) {
         return lexical[a].lhs < b;
     }
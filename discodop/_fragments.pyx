@@ -414,7 +414,8 @@ cpdef exactcounts(list bitsets, Ctrees trees1, Ctrees trees2,
 
 
 cpdef exactcountsslice(list bitsets, Ctrees trees1, Ctrees trees2,
-		int indices=0, maxnodes=None, start=None, end=None, maxresults=None):
+		int indices=0, maxnodes=None, start=None, end=None, maxresults=None,
+		list prefilter=None, list stats=None):
 	"""Get counts of fragments in a slice of the treebank.
 
 	Variant of exactcounts() that releases the GIL in the inner loop and is
@@ -423,6 +424,11 @@ cpdef exactcountsslice(list bitsets, Ctrees trees1, Ctrees trees2,
 	:param start, end: only search through this interval of trees from
 		``trees2`` (defaults to all trees).
 	:param maxresults: stop searching after this number of matchs.
+	:param prefilter: optionally, a list with for each bitset a RoaringBitmap
+		of candidate trees (or None); trees not in it are not searched.
+	:param stats: if a list is given, a pair is appended for each bitset
+		with the number of candidates selected with the production index,
+		and the number that remains after applying ``prefilter``.
 	:returns: depending on ``indices``:
 
 		:0: an array of counts, corresponding to ``bitsets``.
@@ -437,7 +443,7 @@ cpdef exactcountsslice(list bitsets, Ctrees trees1, Ctrees trees2,
 		list theindices = None
 		object candidates  # RoaringBitmap
 		short i, SLOTS
-		size_t nummatches = 0, allocated = 1024
+		size_t nummatches = 0, allocated = 1024, numprod
 		size_t maxresults_ = maxresults or SIZE_MAX
 		long cnt = 0
 		uint32_t n, numcandidates
@@ -476,6 +482,13 @@ cpdef exactcountsslice(list bitsets, Ctrees trees1, Ctrees trees2,
 		anodes = &trees1.nodes[a.offset]
 		candidates = getcandidates(anodes, bitset, trees2, a.len,
 				start_, end_, SLOTS)
+		numprod = 0 if candidates is None else len(candidates)
+		if (candidates is not None and prefilter is not None
+				and prefilter[n] is not None):
+			candidates = candidates & prefilter[n]
+		if stats is not None:
+			stats.append((numprod,
+					0 if candidates is None else len(candidates)))
 		if candidates is None:  # ran across unseen production
 			continue
 		candidatesarray.extend(candidates)
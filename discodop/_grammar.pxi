@@ -23,6 +23,12 @@ REMOVESTATESPLITS = re.compile(
 		r'(?:\^[^|:\s]+?)?'  # ^name
 		r'(_[0-9]+(\*[0-9]+)?)?$')  # _2*1
 
+# Identifies files produced by Grammar.tobinfile(); the version should be
+# incremented whenever the layout changes.
+cdef bytes BINFILEMAGIC = b'DISCOGRM'
+cdef uint64_t BINFILEVERSION = 3
+cdef size_t BINFILEHEADER = 27  # number of uint64_t fields in header
+
 # comparison functions for sorting rules on LHS/RHS labels.
 cdef bool lt0(const ProbRule &a, const ProbRule &b) nogil:
 	return a.no < b.no if a.lhs == b.lhs else a.lhs < b.lhs
@@ -113,67 +119,129 @@ cdef class Grammar:
 		del rules, lexicon
 
 	def tobinfile(self, filename):
-		"""Store grammar in a binary format for faster loading."""
+		"""Store grammar in a binary format for faster loading.
+
+		The file starts with a header of counts and section offsets, followed
+		by sections aligned to 8 bytes: frequency mass and fan-out of labels;
+		rule counts; the rules sorted by lhs, unary rules by rhs1, and binary
+		rules by rhs1 and rhs2, each followed by a sentinel rule; for each
+		label, the index of its first rule in each of these arrays; the
+		position of each rule number in the rules sorted by lhs; lexical
+		counts, rules, and POS tags; a table of labels; a sorted table of
+		words, with the lexical rules for each word; a pickle of
+		``tblabelmapping``. Probabilities are stored as log probabilities of
+		the default model, so that the file can be used without parsing,
+		normalization, sorting, or indexing."""
 		cdef array buf
 		cdef char *ptr
 		cdef ProbRule *ruleptr
+		cdef LexicalRule *lexruleptr
 		cdef uint64_t *header
-		cdef size_t idx, n
-		cdef string word
-		cdef size_t buflen = (4 * sizeof(uint64_t)  # header
-				+ sum(label.size() + 1 for label in self.tolabel.ob)
-				+ (self.freqmass.size()) * sizeof(Prob)  # freqmass
-				+ self.numrules * sizeof(ProbRule)
-				+ self.lexical.size() * sizeof(LexicalRule)
-				+ sum(it.first.size() + 1
-					+ (it.second.size() + 1) * sizeof(uint32_t)
-					for it in self.lexicalbyword))
-		buf = clone(chararray, buflen,
-				False)
+		cdef uint64_t *offsets
+		cdef uint64_t *ruleindex
+		cdef uint64_t *lexruleoffsets
+		cdef uint32_t *lexrulenos
+		cdef uint32_t *lexrules
+		cdef uint32_t *lexlhsptr
+		cdef size_t n, m, idx, numlexrules = 0
+		cdef size_t numrules[4]
+		cdef size_t nts = self.nonterminals
+		cdef list labels = [label for label in self.tolabel.ob]
+		cdef list words = self._words()
+		cdef list lexlhs = sorted([lhs for lhs in self.lexicallhs])
+		cdef bytes tblabelmapping = pickle.dumps(self.tblabelmapping)
+		cdef list sizes = [
+				nts * sizeof(Prob),  # freqmass
+				nts * sizeof(uint8_t),  # fanout
+				self.numrules * sizeof(Prob),  # rulecounts
+				(self.numrules + 1) * sizeof(ProbRule),  # bylhs
+				(self.numunary + 1) * sizeof(ProbRule),  # unary
+				(self.numbinary + 1) * sizeof(ProbRule),  # lbinary
+				(self.numbinary + 1) * sizeof(ProbRule),  # rbinary
+				4 * nts * sizeof(uint64_t),  # index of the rule arrays
+				self.numrules * sizeof(uint32_t),  # revrulemap
+				self.numlex * sizeof(Prob),  # lexcounts
+				self.numlex * sizeof(LexicalRule),  # lexical
+				len(lexlhs) * sizeof(uint32_t),  # lexicallhs
+				(len(labels) + 1) * sizeof(uint64_t)  # labels
+					+ sum(len(a) + 1 for a in labels),
+				(len(words) + 1) * sizeof(uint64_t)  # words
+					+ sum(len(a) + 1 for a in words),
+				(len(words) + 1) * sizeof(uint64_t)  # lexical rules of words
+					+ self.numlex * sizeof(uint32_t),
+				len(tblabelmapping)]
+		numrules[:] = [self.numrules, self.numunary, self.numbinary,
+				self.numbinary]
+		# turn sizes into offsets of sections aligned to 8 bytes
+		idx = BINFILEHEADER * sizeof(uint64_t)
+		for n in range(len(sizes)):
+			m = sizes[n]
+			sizes[n] = idx
+			idx += (m + 7) & ~7
+		buf = clone(chararray, idx, True)
 		ptr = buf.data.as_chars
 		header = <uint64_t *>ptr
-		# header: numlabels, numrules, numlex
-		header[0] = self.tolabel.ob.size()
-		header[1] = self.numrules
-		header[2] = self.lexical.size()
-		header[3] = self.lexicalbyword.size()
-		idx = 4 * sizeof(uint64_t)
-		# copy freq mass
-		memcpy(&ptr[idx], &self.freqmass[0],
-				self.freqmass.size() * sizeof(Prob))
-		idx += self.freqmass.size() * sizeof(Prob)
-		# copy bylhs; change prob to freq
-		memcpy(&ptr[idx], &self._bylhs[0], self.numrules * sizeof(ProbRule))
-		ruleptr = <ProbRule *>&ptr[idx]
-		for n in range(self.numrules):
-			ruleptr[n].prob = self.rulecounts[ruleptr[n].no]
-		idx += self.numrules * sizeof(ProbRule)
-		# copy lexicon; change prob to freq; add word
-		# flat list of lexical prods
-		memcpy(&ptr[idx], &self.lexical[0],
-				self.lexical.size() * sizeof(LexicalRule))
-		lexruleptr = <LexicalRule *>&ptr[idx]
-		for n in range(self.lexical.size()):
-			lexruleptr[n].prob = self.lexcounts[n]
-		idx += self.lexical.size() * sizeof(LexicalRule)
-		# copy labels
-		for label in self.tolabel.ob:
-			memcpy(&ptr[idx], label.c_str(), label.size() + 1)
-			idx += label.size() + 1
-		# list of words
-		for it in self.lexicalbyword:
-			word = it.first
-			memcpy(&ptr[idx], word.c_str(), word.size() + 1)
-			idx += word.size() + 1
-		# for each word #rules, lex rulenos
-		for it in self.lexicalbyword:
-			(<uint32_t *>&ptr[idx])[0] = it.second.size()
-			idx += sizeof(uint32_t)
-			for n in it.second:
-				(<uint32_t *>&ptr[idx])[0] = n
-				idx += sizeof(uint32_t)
-		assert idx == buflen, (idx, buflen)
-		buf.frombytes(pickle.dumps(self.tblabelmapping))
+		memcpy(ptr, <char *>BINFILEMAGIC, sizeof(uint64_t))
+		header[1] = BINFILEVERSION
+		header[2] = nts
+		header[3] = self.numrules
+		header[4] = self.numunary
+		header[5] = self.numbinary
+		header[6] = self.numlex
+		header[7] = len(words)
+		header[8] = self.maxfanout
+		header[9] = len(lexlhs)
+		offsets = &header[10]
+		for n in range(len(sizes)):
+			offsets[n] = sizes[n]
+		header[BINFILEHEADER - 1] = idx
+		memcpy(&ptr[offsets[0]], &self.freqmass[0], nts * sizeof(Prob))
+		memcpy(&ptr[offsets[1]], &self.fanout[0], nts * sizeof(uint8_t))
+		memcpy(&ptr[offsets[2]], self.rulecounts,
+				self.numrules * sizeof(Prob))
+		memcpy(&ptr[offsets[3]], self.bylhs[0],
+				(self.numrules + 1) * sizeof(ProbRule))
+		memcpy(&ptr[offsets[4]], self.unary[0],
+				(self.numunary + 1) * sizeof(ProbRule))
+		memcpy(&ptr[offsets[5]], self.lbinary[0],
+				(self.numbinary + 1) * sizeof(ProbRule))
+		memcpy(&ptr[offsets[6]], self.rbinary[0],
+				(self.numbinary + 1) * sizeof(ProbRule))
+		for m in range(4):
+			ruleptr = <ProbRule *>&ptr[offsets[3 + m]]
+			for n in range(numrules[m]):
+				ruleptr[n].prob = fabs(log(self.rulecounts[ruleptr[n].no]
+						/ self.freqmass[ruleptr[n].lhs]))
+		ruleindex = <uint64_t *>&ptr[offsets[7]]
+		writeruleindex(ruleindex, self.bylhs, nts)
+		writeruleindex(&ruleindex[nts], self.unary, nts)
+		writeruleindex(&ruleindex[2 * nts], self.lbinary, nts)
+		writeruleindex(&ruleindex[3 * nts], self.rbinary, nts)
+		memcpy(&ptr[offsets[8]], self.revrulemap,
+				self.numrules * sizeof(uint32_t))
+		memcpy(&ptr[offsets[9]], self.lexcounts, self.numlex * sizeof(Prob))
+		memcpy(&ptr[offsets[10]], self.lexical,
+				self.numlex * sizeof(LexicalRule))
+		lexruleptr = <LexicalRule *>&ptr[offsets[10]]
+		for n in range(self.numlex):
+			lexruleptr[n].prob = fabs(log(self.lexcounts[n]
+					/ self.freqmass[lexruleptr[n].lhs]))
+		lexlhsptr = <uint32_t *>&ptr[offsets[11]]
+		for n, lhs in enumerate(lexlhs):
+			lexlhsptr[n] = lhs
+		writestringtable(&ptr[offsets[12]], labels)
+		writestringtable(&ptr[offsets[13]], words)
+		lexruleoffsets = <uint64_t *>&ptr[offsets[14]]
+		lexrulenos = <uint32_t *>&lexruleoffsets[len(words) + 1]
+		m = 0
+		for n, word in enumerate(words):
+			lexruleoffsets[n] = m
+			lexrules = self.lexrules(word, &numlexrules)
+			memcpy(&lexrulenos[m], lexrules, numlexrules * sizeof(uint32_t))
+			m += numlexrules
+		lexruleoffsets[len(words)] = m
+		memcpy(&ptr[offsets[15]], <char *>tblabelmapping,
+				len(tblabelmapping))
 		with open(filename, 'wb') as outfile:
 			buf.tofile(outfile)
 
@@ -181,18 +249,29 @@ cdef class Grammar:
 	def frombinfile(cls, filename, rulesfile, lexiconfile, backtransform=None):
 		"""Load grammar from cached binary file.
 
+		The file is memory mapped, and the rules, counts, and lexical rules
+		are used directly from the mapping, without copying; the lexical
+		rules of a word are found by binary search in the sorted table of
+		words. Only the labels are read into hash tables. Processes that
+		load the same file share its pages; the mapping is private, so pages
+		changed by switch() are copied, and the file is not modified. The
+		sections are copied when rules are added with addrules().
+
 		:param filename: file produced by tobinfile() method; format subject to
-			change, recreate as needed.
+			change, a ValueError is raised for files with another version;
+			recreate as needed.
 		:param rulesfile: original grammar file, used only when pickling."""
 		cdef Grammar ob = Grammar.__new__(Grammar)
-		cdef bytes data
-		cdef char *ptr
+		cdef Py_buffer buffer
+		cdef Py_ssize_t size = 0
+		cdef char *ptr = NULL
 		cdef uint64_t *header
-		cdef size_t idx, n
-		cdef string word
-		cdef ProbRule cur
-		cdef Rule key
-		cdef vector[string] words
+		cdef uint64_t *offsets
+		cdef uint64_t *stroffsets
+		cdef uint64_t *ruleindex
+		cdef uint32_t *lexlhs
+		cdef size_t n, nts
+		cdef int result
 
 		# initialization
 		ob.rulesfile = rulesfile
@@ -200,115 +279,176 @@ cdef class Grammar:
 		ob.backtransform = backtransform
 		ob.toid = StringIntDict()
 		ob.tolabel = StringList()
-		ob.numunary = ob.numbinary = 0
-		ob.maxfanout = 1
 		ob.logprob = True
 		ob.bitpar = False
 		ob.models = {}
 		ob.altweightsfile = ob.ruletuples = None
-		# read file
-		with open(filename, 'rb') as inp:
-			data = inp.read()
-			buflen = inp.tell()
-		ptr = <char *>data
+		fileno = os.open(filename, os.O_RDONLY)
+		try:
+			buf = mmap.mmap(fileno, 0, access=mmap.ACCESS_COPY)
+		finally:
+			os.close(fileno)
+		result = getbufptr(buf, &ptr, &size, &buffer)
+		if result != 0:
+			raise ValueError('could not get buffer from mmap.')
+		PyBuffer_Release(&buffer)
 		header = <uint64_t *>ptr
-		idx = 4 * sizeof(uint64_t)
-		ob.nonterminals = header[0]
-		ob.fanout.push_back(0)
-		ob.fanout.resize(ob.nonterminals, 1)
-		# copy freq mass
-		ob.numrules = header[1]
-		ob.freqmass.resize(ob.nonterminals)
-		memcpy(&ob.freqmass[0], &ptr[idx], ob.freqmass.size() * sizeof(Prob))
-		idx += ob.freqmass.size() * sizeof(Prob)
-		# copy bylhs; change prob to freq
-		ob._bylhs.resize(ob.numrules)
-		ob.rulecounts.resize(ob.numrules)
-		memcpy(&ob._bylhs[0], &ptr[idx], ob.numrules * sizeof(ProbRule))
-		idx += ob.numrules * sizeof(ProbRule)
-		for n in range(ob.numrules):
-			ob.rulecounts[ob._bylhs[n].no] = ob._bylhs[n].prob
-			ob._bylhs[n].prob = fabs(log(ob._bylhs[n].prob
-					/ ob.freqmass[ob._bylhs[n].lhs]))
-			ob.fanout[ob._bylhs[n].lhs] = bit_popcount(
-					<uint64_t>ob._bylhs[n].lengths)
-			if ob.fanout[ob._bylhs[n].lhs] > ob.maxfanout:
-				ob.maxfanout = ob.fanout[ob._bylhs[n].lhs]
-			if ob._bylhs[n].rhs2:
-				ob._lbinary.push_back(ob._bylhs[n])
-				ob._rbinary.push_back(ob._bylhs[n])
-				ob.numbinary += 1
-			elif ob._bylhs[n].rhs1:
-				ob._unary.push_back(ob._bylhs[n])
-				ob.numunary += 1
-		assert ob.numrules == ob.numunary + ob.numbinary
-		# sentinel rules
-		cur.lhs = cur.rhs1 = cur.rhs2 = cur.prob = cur.lengths = cur.args = 0
-		ob._bylhs.push_back(cur)
-		ob._unary.push_back(cur)
-		ob._lbinary.push_back(cur)
-		ob._rbinary.push_back(cur)
-		# copy lexical rules
-		ob.lexical.resize(header[2])
-		ob.lexcounts.resize(header[2])
-		memcpy(&ob.lexical[0], &ptr[idx], header[2] * sizeof(LexicalRule))
-		idx += header[2] * sizeof(LexicalRule)
-		for n in range(ob.lexical.size()):
-			ob.lexcounts[n] = ob.lexical[n].prob
-			ob.lexical[n].prob = fabs(log(ob.lexical[n].prob
-					/ ob.freqmass[ob.lexical[n].lhs]))
-		# copy labels
-		ob.tolabel.ob.resize(header[0])
-		ob.toid.ob.reserve(header[0])
-		for n in range(header[0]):
-			ob.tolabel.ob[n] = string(&ptr[idx])
+		if (<size_t>size < BINFILEHEADER * sizeof(uint64_t)
+				or memcmp(ptr, <char *>BINFILEMAGIC, sizeof(uint64_t)) != 0
+				or header[1] != BINFILEVERSION
+				or header[BINFILEHEADER - 1] != <uint64_t>size):
+			buf.close()
+			raise ValueError('%r is not a grammar file with format '
+					'version %d; recreate it.' % (filename, BINFILEVERSION))
+		ob._state = buf  # keep mapping alive
+		ob.nonterminals = nts = header[2]
+		ob.numrules = header[3]
+		ob.numunary = header[4]
+		ob.numbinary = header[5]
+		ob.numlex = header[6]
+		ob.numwords = header[7]
+		ob.maxfanout = header[8]
+		offsets = &header[10]
+		ob.freqmass.resize(nts)
+		memcpy(&ob.freqmass[0], &ptr[offsets[0]], nts * sizeof(Prob))
+		ob.fanout.resize(nts)
+		memcpy(&ob.fanout[0], &ptr[offsets[1]], nts * sizeof(uint8_t))
+		ob.rulecounts = <Prob *>&ptr[offsets[2]]
+		ruleindex = <uint64_t *>&ptr[offsets[7]]
+		readruleindex(ob.bylhs, <ProbRule *>&ptr[offsets[3]],
+				ruleindex, nts)
+		readruleindex(ob.unary, <ProbRule *>&ptr[offsets[4]],
+				&ruleindex[nts], nts)
+		readruleindex(ob.lbinary, <ProbRule *>&ptr[offsets[5]],
+				&ruleindex[2 * nts], nts)
+		readruleindex(ob.rbinary, <ProbRule *>&ptr[offsets[6]],
+				&ruleindex[3 * nts], nts)
+		ob.revrulemap = <uint32_t *>&ptr[offsets[8]]
+		ob.lexcounts = <Prob *>&ptr[offsets[9]]
+		ob.lexical = <LexicalRule *>&ptr[offsets[10]]
+		lexlhs = <uint32_t *>&ptr[offsets[11]]
+		for n in range(header[9]):
+			ob.lexicallhs.insert(lexlhs[n])
+		# labels
+		stroffsets = <uint64_t *>&ptr[offsets[12]]
+		ob.tolabel.ob.resize(nts)
+		ob.toid.ob.reserve(nts)
+		for n in range(nts):
+			ob.tolabel.ob[n] = string(
+					&ptr[offsets[12] + stroffsets[n]],
+					stroffsets[n + 1] - stroffsets[n] - 1)
 			ob.toid.ob[ob.tolabel.ob[n]] = n
-			idx += ob.tolabel.ob[n].size() + 1
+		# words and their lexical rules
+		ob.wordtable = &ptr[offsets[13]]
+		ob.lexruleoffsets = <uint64_t *>&ptr[offsets[14]]
+		ob.lexrulenos = <uint32_t *>&ob.lexruleoffsets[ob.numwords + 1]
+		ob.tblabelmapping = pickle.loads(
+				ptr[offsets[15]:header[BINFILEHEADER - 1]])
 		ob.start = ob.tolabel[1]
-		# copy words
-		for n in range(header[3]):
-			word = string(&ptr[idx])
-			idx += word.size() + 1
-			words.push_back(word)
-		ob.lexicalbyword.reserve(header[3])
-		for n in range(header[3]):
-			numlexrules = (<uint32_t *>&ptr[idx])[0]
-			idx += sizeof(uint32_t)
-			word = words[n]
-			ob.lexicalbyword[word].reserve(numlexrules)
-			for _ in range(numlexrules):
-				lexruleno = (<uint32_t *>&ptr[idx])[0]
-				idx += sizeof(uint32_t)
-				ob.lexicalbyword[word].push_back(lexruleno)
-				ob.lexicallhs.insert(ob.lexical[lexruleno].lhs)
 		ob.currentmodel = 'default'
+		# NB: rulenos is built on demand by _buildrulenos()
+		return ob
+
+	cdef _setpointers(self):
+		"""Point to the vectors with counts, lexical rules, and rule order."""
+		self.rulecounts = self._rulecounts.data()
+		self.lexcounts = self._lexcounts.data()
+		self.lexical = self._lexical.data()
+		self.numlex = self._lexical.size()
+		self.revrulemap = self._revrulemap.data()
+
+	cdef _copymapped(self):
+		"""Copy the sections of a grammar loaded with frombinfile().
+
+		Replaces the pointers to the mapped file with vectors, so that rules
+		can be added; the file is no longer used afterwards."""
+		cdef uint32_t *lexrules
+		cdef size_t numlexrules = 0
+		cdef string word
+		if self._state is None:
+			return
+		copyrules(self._bylhs, self.bylhs[0], self.numrules)
+		copyrules(self._unary, self.unary[0], self.numunary)
+		copyrules(self._lbinary, self.lbinary[0], self.numbinary)
+		copyrules(self._rbinary, self.rbinary[0], self.numbinary)
+		self._rulecounts.assign(self.rulecounts,
+				self.rulecounts + self.numrules)
+		self._revrulemap.assign(self.revrulemap,
+				self.revrulemap + self.numrules)
+		self._lexcounts.assign(self.lexcounts, self.lexcounts + self.numlex)
+		self._lexical.assign(self.lexical, self.lexical + self.numlex)
+		for word in self._words():
+			lexrules = self.lexrules(word, &numlexrules)
+			self.lexicalbyword[word].assign(lexrules, lexrules + numlexrules)
+		self.bylhs[0] = &(self._bylhs[0])
+		self.unary[0] = &(self._unary[0])
+		self.lbinary[0] = &(self._lbinary[0])
+		self.rbinary[0] = &(self._rbinary[0])
+		# rules are already sorted; only build the indices
+		self._indexrules(self.bylhs, 0, 0, self.numrules)
+		self._indexrules(self.unary, 1, 2, self.numunary)
+		self._indexrules(self.lbinary, 1, 3, self.numbinary)
+		self._indexrules(self.rbinary, 2, 3, self.numbinary)
+		self._setpointers()
+		self.wordtable = NULL
+		self.lexruleoffsets = NULL
+		self.lexrulenos = NULL
+		self.numwords = 0
+		self._state = None
 
-		ob.bylhs.resize(ob.nonterminals)
-		ob.unary.resize(ob.nonterminals)
-		ob.lbinary.resize(ob.nonterminals)
-		ob.rbinary.resize(ob.nonterminals)
-		ob.bylhs[0] = &(ob._bylhs[0])
-		ob.unary[0] = &(ob._unary[0])
-		ob.lbinary[0] = &(ob._lbinary[0])
-		ob.rbinary[0] = &(ob._rbinary[0])
-
-		ob._indexrules(ob.bylhs, 0, 0, ob.numrules)  # already sorted
-		ob._indexrules(ob.unary, 1, 2, 0)
-		ob._indexrules(ob.lbinary, 1, 3, 0)
-		ob._indexrules(ob.rbinary, 2, 3, 0)
-
-		ob.revrulemap.resize(ob.numrules)
-		for n in range(ob.numrules):
-			ob.revrulemap[ob._bylhs[n].no] = n
-		ob.rulenos.reserve(ob.numrules)
-		for n in range(ob.numrules):
-			cur = ob._bylhs[n]
+	cdef uint32_t *lexrules(self, string word, size_t *numrules):
+		"""Return the numbers of the lexical rules for word, sorted by lhs.
+
+		Sets ``numrules``; returns NULL if the word is not in the lexicon."""
+		cdef uint64_t *stroffsets = <uint64_t *>self.wordtable
+		cdef size_t lo = 0, hi = self.numwords, mid, length
+		cdef int cmp
+		numrules[0] = 0
+		if self.wordtable is NULL:
+			it = self.lexicalbyword.find(word)
+			if it == self.lexicalbyword.end():
+				return NULL
+			numrules[0] = dereference(it).second.size()
+			return dereference(it).second.data()
+		while lo < hi:  # binary search in the sorted table of words
+			mid = (lo + hi) // 2
+			length = stroffsets[mid + 1] - stroffsets[mid] - 1
+			cmp = memcmp(word.c_str(), &self.wordtable[stroffsets[mid]],
+					min(word.size(), length))
+			if cmp == 0 and word.size() != length:
+				cmp = -1 if word.size() < length else 1
+			if cmp < 0:
+				hi = mid
+			elif cmp > 0:
+				lo = mid + 1
+			else:
+				numrules[0] = (self.lexruleoffsets[mid + 1]
+						- self.lexruleoffsets[mid])
+				return &self.lexrulenos[self.lexruleoffsets[mid]]
+		return NULL
+
+	cdef list _words(self):
+		"""Return the sorted list of words in the lexicon, as bytes."""
+		cdef uint64_t *stroffsets = <uint64_t *>self.wordtable
+		cdef size_t n
+		if self.wordtable is NULL:
+			return sorted([it.first for it in self.lexicalbyword])
+		return [self.wordtable[stroffsets[n]:stroffsets[n + 1] - 1]
+				for n in range(self.numwords)]
+
+	cdef _buildrulenos(self):
+		"""Build the index of rules to rule numbers, if not up to date."""
+		cdef ProbRule cur
+		cdef Rule key
+		cdef size_t n
+		if self.rulenos.size() == self.numrules:
+			return
+		self.rulenos.reserve(self.numrules)
+		for n in range(self.numrules):
+			cur = self.bylhs[0][n]
 			key.lhs, key.rhs1, key.rhs2 = cur.lhs, cur.rhs1, cur.rhs2
 			key.args, key.lengths = cur.args, cur.lengths
-			ob.rulenos[key] = cur.no
-
-		ob.tblabelmapping = pickle.loads(data[idx:])
-		return ob
+			self.rulenos[key] = cur.no
 
 	def addrules(self, bytes rules, bytes lexicon, backtransform=None,
 			init=False):
@@ -318,6 +458,8 @@ cdef class Grammar:
 		cdef int orignumbinary = self.numbinary
 		cdef int orignumunary = self.numunary
 		cdef int orignumlabels = self.tolabel.ob.size()
+		self._copymapped()
+		self._buildrulenos()
 		if self._bylhs.size():  # drop sentinel rules
 			self._bylhs.pop_back()
 			self._unary.pop_back()
@@ -340,9 +482,9 @@ cdef class Grammar:
 			for n in range(self.numunary):
 				self._unary[n].prob = fabs(log(self._unary[n].prob
 						/ self.freqmass[self._unary[n].lhs]))
-			for n in range(self.lexical.size()):
-				self.lexical[n].prob = fabs(log(self.lexical[n].prob
-						/ self.freqmass[self.lexical[n].lhs]))
+			for n in range(self._lexical.size()):
+				self._lexical[n].prob = fabs(log(self._lexical[n].prob
+						/ self.freqmass[self._lexical[n].lhs]))
 			self.currentmodel = 'default'
 
 		# store all non-lexical rules in a contiguous array
@@ -371,9 +513,10 @@ cdef class Grammar:
 
 		# indexing requires sorting; this map gives the new index
 		# given an original rule number (useful with the rulestr method).
-		self.revrulemap.resize(self.numrules)
+		self._revrulemap.resize(self.numrules)
 		for n in range(self.numrules):
-			self.revrulemap[self._bylhs[n].no] = n
+			self._revrulemap[self._bylhs[n].no] = n
+		self._setpointers()
 
 		if not init:  # updating of these weights not supported
 			self.models = {}
@@ -531,7 +674,7 @@ cdef class Grammar:
 				self.rulenos[key] = n
 				cur.no = n
 				cur.prob = w  # fabs(log(w))
-				self.rulecounts.push_back(w)
+				self._rulecounts.push_back(w)
 				self._bylhs.push_back(cur)
 				if backtransform is not None and lineno < len(backtransform):
 					# new fragments come AFTER rules without fragments,
@@ -552,7 +695,7 @@ cdef class Grammar:
 				n += 1
 			else:  # update weight of existing rule
 				m = dereference(it1).second
-				self.rulecounts[m] += w
+				self._rulecounts[m] += w
 			self.freqmass[cur.lhs] += w
 			lineno += 1
 
@@ -629,28 +772,28 @@ cdef class Grammar:
 				found = False
 				if it1 != self.lexicalbyword.end():
 					for lexruleno in dereference(it1).second:
-						if self.lexical[lexruleno].lhs == lexrule.lhs:
+						if self._lexical[lexruleno].lhs == lexrule.lhs:
 							# update weight
-							self.lexcounts[lexruleno] += w
+							self._lexcounts[lexruleno] += w
 							found = True
 							break
 				if not found:
-					lexruleno = self.lexical.size()
+					lexruleno = self._lexical.size()
 					lexrule.prob = w  # fabs(log(w))
-					self.lexcounts.push_back(w)
-					self.lexical.push_back(lexrule)
+					self._lexcounts.push_back(w)
+					self._lexical.push_back(lexrule)
 					self.lexicallhs.insert(lexrule.lhs)
 					self.lexicalbyword[word].push_back(lexruleno)
 				self.freqmass[lexrule.lhs] += w
 			first = self.lexicalbyword[word].begin()
 			m = self.lexicalbyword[word].size()
 			# sort new rules for this word
-			stdsort(first + orignumrules, first + m, LexCmp(self.lexical))
+			stdsort(first + orignumrules, first + m, LexCmp(self._lexical))
 			# merge sorted new rules with existing sorted rules
 			inplace_merge(
 					first, first + orignumrules, first + m,
-					LexCmp(self.lexical))
-		if self.lexical.size() == 0:
+					LexCmp(self._lexical))
+		if self._lexical.size() == 0:
 			raise ValueError('no lexical rules found.')
 
 	cdef _indexrules(Grammar self, vector[ProbRule *]& dest, int idx,
@@ -709,37 +852,37 @@ cdef class Grammar:
 		cdef int n
 		cdef Prob *tmp
 		cdef Prob [:] ob
-		cdef size_t numweights = self.numrules + self.lexical.size()
+		cdef size_t numweights = self.numrules + self.numlex
 		if self.currentmodel == name and self.logprob == logprob:
 			return
 		if name == 'default':  # normalize
 			if logprob:
 				for n in range(self.numrules):
-					self._bylhs[n].prob = fabs(log(
-							self.rulecounts[self._bylhs[n].no]
-							/ self.freqmass[self._bylhs[n].lhs]))
-				for n in range(self.lexical.size()):
+					self.bylhs[0][n].prob = fabs(log(
+							self.rulecounts[self.bylhs[0][n].no]
+							/ self.freqmass[self.bylhs[0][n].lhs]))
+				for n in range(self.numlex):
 					self.lexical[n].prob = fabs(log(self.lexcounts[n]
 							/ self.freqmass[self.lexical[n].lhs]))
 			else:
 				for n in range(self.numrules):
-					self._bylhs[n].prob = (
-							self.rulecounts[self._bylhs[n].no]
-							/ self.freqmass[self._bylhs[n].lhs])
-				for n in range(self.lexical.size()):
+					self.bylhs[0][n].prob = (
+							self.rulecounts[self.bylhs[0][n].no]
+							/ self.freqmass[self.bylhs[0][n].lhs])
+				for n in range(self.numlex):
 					self.lexical[n].prob = (self.lexcounts[n]
 							/ self.freqmass[self.lexical[n].lhs])
 			# instead of copying weights from bylhs, could compute them
 			# again, but number of lookups is the same.
 			for n in range(self.numbinary):
-				self._lbinary[n].prob = self._bylhs[
-						self.revrulemap[self._lbinary[n].no]].prob
+				self.lbinary[0][n].prob = self.bylhs[0][
+						self.revrulemap[self.lbinary[0][n].no]].prob
 			for n in range(self.numbinary):
-				self._rbinary[n].prob = self._bylhs[
-						self.revrulemap[self._rbinary[n].no]].prob
+				self.rbinary[0][n].prob = self.bylhs[0][
+						self.revrulemap[self.rbinary[0][n].no]].prob
 			for n in range(self.numunary):
-				self._unary[n].prob = self._bylhs[
-						self.revrulemap[self._unary[n].no]].prob
+				self.unary[0][n].prob = self.bylhs[0][
+						self.revrulemap[self.unary[0][n].no]].prob
 		else:
 			if self.models is None and self.altweightsfile:
 				self.models = np.load(self.altweightsfile)  # FIXME: keep open?
@@ -747,18 +890,18 @@ cdef class Grammar:
 			if len(model) != <signed>numweights:
 				raise ValueError('length mismatch: %d grammar rules, '
 						'%d weights given.' % (
-						self.numrules + self.lexical.size(), len(model)))
+						self.numrules + self.numlex, len(model)))
 			ob = np.abs(np.log(model)) if logprob else model
 			tmp = &(ob[0])
 			for n in range(self.numrules):
-				self._bylhs[n].prob = tmp[self._bylhs[n].no]
+				self.bylhs[0][n].prob = tmp[self.bylhs[0][n].no]
 			for n in range(self.numbinary):
-				self._lbinary[n].prob = tmp[self._lbinary[n].no]
+				self.lbinary[0][n].prob = tmp[self.lbinary[0][n].no]
 			for n in range(self.numbinary):
-				self._rbinary[n].prob = tmp[self._rbinary[n].no]
+				self.rbinary[0][n].prob = tmp[self.rbinary[0][n].no]
 			for n in range(self.numunary):
-				self._unary[n].prob = tmp[self._unary[n].no]
-			for n in range(self.lexical.size()):
+				self.unary[0][n].prob = tmp[self.unary[0][n].no]
+			for n in range(self.numlex):
 				self.lexical[n].prob = tmp[self.numrules + n]
 		self.logprob = logprob
 		self.currentmodel = name
@@ -782,15 +925,15 @@ cdef class Grammar:
 		cdef ProbRule *rule
 		cdef LexicalRule lexrule
 		cdef uint32_t n, maxlabel = 0
-		cdef size_t numweights = self.numrules + self.lexical.size()
+		cdef size_t numweights = self.numrules + self.numlex
 		cdef list weights = [[] for _ in range(self.nonterminals)]
 		cdef Prob [:] tmp
 		if self.currentmodel == 'default':
 			tmp = clone(dblarray, numweights, False)
 			for n in range(self.numrules):
 				tmp[n] = (self.rulecounts[n]
-						/ self.freqmass[self._bylhs[self.revrulemap[n]].lhs])
-			for n in range(self.lexical.size()):
+						/ self.freqmass[self.bylhs[0][self.revrulemap[n]].lhs])
+			for n in range(self.numlex):
 				tmp[self.numrules + n] = (self.lexcounts[n]
 						/ self.freqmass[self.lexical[n].lhs])
 		else:
@@ -798,10 +941,10 @@ cdef class Grammar:
 		# We could be strict about separating POS tags and phrasal categories,
 		# but Negra contains at least one tag (--) used for both.
 		for n in range(self.numrules):
-			rule = &(self._bylhs[n])
+			rule = &(self.bylhs[0][n])
 			weights[rule.lhs].append(tmp[rule.no])
 		n = self.numrules
-		for lexrule in self.lexical:
+		for lexrule in self.lexical[:self.numlex]:
 			weights[lexrule.lhs].append(tmp[n])
 			n += 1
 		maxdiff = epsilon
@@ -929,8 +1072,9 @@ cdef class Grammar:
 		cdef ProbRule *rule
 		cdef Rule key
 		cdef list rulemapping = [array('L') for _ in range(coarse.numrules)]
+		coarse._buildrulenos()
 		for n in range(self.numrules):
-			rule = &(self._bylhs[n])
+			rule = &(self.bylhs[0][n])
 			# this could work, but only if mapping[..] is never 0.
 			# key.lhs = self.mapping[rule.lhs]
 			# key.rhs1 = self.mapping[rule.rhs1]
@@ -949,9 +1093,57 @@ cdef class Grammar:
 		else:
 			self.rulemapping = rulemapping
 
+	def mappingtofile(self, filename, key=''):
+		"""Store label and rule mappings in a file for faster loading.
+
+		Stores the mappings produced by :py:meth:`getmapping` and
+		:py:meth:`getrulemapping` as arrays in an uncompressed ``.npz`` file.
+
+		:param key: a string identifying the grammars and parameters with
+			which the mappings were constructed; the same key has to be
+			passed when loading."""
+		cdef dict arrays = dict(key=np.array(key),
+				mapping=labelstoarray(self.mapping),
+				selfmapping=labelstoarray(self.selfmapping))
+		arrays['splitmappingoffsets'], arrays['splitmapping'] = nestedtoarrays(
+				self.splitmapping)
+		arrays['revmapoffsets'], arrays['revmap'] = nestedtoarrays(
+				self.revmap)
+		for name in ('rulemapping', 'selfrulemapping'):
+			if getattr(self, name) is not None:
+				arrays[name + 'offsets'], arrays[name] = rulestoarrays(
+						getattr(self, name))
+		with open(filename, 'wb') as out:
+			np.savez(out, **arrays)
+
+	def mappingfromfile(self, filename, key=''):
+		"""Load label and rule mappings stored with :py:meth:`mappingtofile`.
+
+		:raises ValueError: if the file was stored with a different key or
+			does not match the labels of this grammar; recreate as needed."""
+		data = np.load(filename)
+		if 'key' not in data.files or str(data['key']) != key:
+			raise ValueError('%r does not contain mappings for this grammar '
+					'and these parameters; recreate it.' % filename)
+		if (len(data['mapping']) not in (0, self.nonterminals)
+				or len(data['selfmapping']) not in (0, self.nonterminals)):
+			raise ValueError('%r: number of labels does not match grammar.'
+					% filename)
+		arraytolabels(data['mapping'], self.mapping)
+		arraytolabels(data['selfmapping'], self.selfmapping)
+		arraystonested(data['splitmappingoffsets'], data['splitmapping'],
+				self.splitmapping)
+		arraystonested(data['revmapoffsets'], data['revmap'], self.revmap)
+		self.rulemapping = (arraystorules(data['rulemappingoffsets'],
+				data['rulemapping']) if 'rulemapping' in data.files else None)
+		self.selfrulemapping = (arraystorules(
+				data['selfrulemappingoffsets'], data['selfrulemapping'])
+				if 'selfrulemapping' in data.files else None)
+
 	cpdef noderuleno(self, node):
 		"""Get rule no given a node of a continuous tree."""
 		cdef Rule key
+		self._buildrulenos()
 		key.lhs = self.toid.ob[node.label.encode('utf8')]
 		key.rhs1 = self.toid.ob[node[0].label.encode('utf8')]
 		if len(node) > 1:
@@ -967,6 +1159,7 @@ cdef class Grammar:
 		cdef Rule key
 		cdef bytes lhs = r[0].encode('utf8')
 		cdef bytes rhs1 = r[1].encode('utf8')
+		self._buildrulenos()
 		key.lhs, key.rhs1 = self.toid.ob[lhs], self.toid.ob[rhs1]
 		key.rhs2 = self.toid.ob[r[2].encode('utf8')] if len(r) > 2 else 0
 		getyf(yf, &key.args, &key.lengths)
@@ -983,7 +1176,7 @@ cdef class Grammar:
 		cdef ProbRule rule
 		if not 0 <= n < self.numrules:
 			raise ValueError('Out of range: %s' % n)
-		rule = self._bylhs[n]
+		rule = self.bylhs[0][n]
 		left = '%.4f %s => %s%s' % (
 			exp(-rule.prob) if self.logprob else rule.prob,
 			self.tolabel[rule.lhs], self.tolabel[rule.rhs1],
@@ -1014,7 +1207,7 @@ cdef class Grammar:
 
 	def getwords(self):
 		"""Return words in lexicon as list."""
-		return [x.first.decode('utf8') for x in self.lexicalbyword]
+		return [word.decode('utf8') for word in self._words()]
 
 	def getlabels(self):
 		"""Return grammar labels as list."""
@@ -1022,22 +1215,27 @@ cdef class Grammar:
 
 	def getlexprobs(self, str word):
 		"""Return the list of probabilities of rules for a word."""
-		it = self.lexicalbyword.find(word.encode('utf8'))
-		if it == self.lexicalbyword.end():
-			return []
-		return [self.lexical[n].prob for n in dereference(it).second]
+		cdef size_t numlexrules = 0
+		cdef uint32_t *lexrules = self.lexrules(
+				word.encode('utf8'), &numlexrules)
+		return [self.lexical[n].prob for n in lexrules[:numlexrules]]
 
 	def __str__(self):
+		cdef uint32_t *lexrules
+		cdef size_t m, numlexrules = 0
 		rules = '\n'.join(filter(None,
 			[self.rulestr(n) for n in range(self.numrules)]))
-		lexical = '\n'.join(['%.2f %s => %s' % (
-				exp(-self.lexical[n].prob) if self.logprob
-				else self.lexical[n].prob,
-				self.tolabel[self.lexical[n].lhs],
-				word.decode('utf8'))
-			for word in sorted([x.first for x in self.lexicalbyword])
-			for n in sorted([y for y in self.lexicalbyword[word]],
-			key=lambda n: self.lexical[n].lhs)])
+		lexical = []
+		for word in self._words():
+			lexrules = self.lexrules(word, &numlexrules)
+			for m in range(numlexrules):
+				n = lexrules[m]
+				lexical.append('%.2f %s => %s' % (
+						exp(-self.lexical[n].prob) if self.logprob
+						else self.lexical[n].prob,
+						self.tolabel[self.lexical[n].lhs],
+						word.decode('utf8')))
+		lexical = '\n'.join(lexical)
 		labels = ', '.join(['%s=%d %d' % (
 				a, self.toid[a], self.fanout[self.toid[a]])
 				for a in sorted(self.toid)])
@@ -1054,6 +1252,115 @@ cdef class Grammar:
 				self.start, self.altweightsfile or self.models))
 
 
+cdef labelstoarray(vector[Label]& vec):
+	"""Copy a vector of labels to a new array."""
+	cdef uint32_t[:] view
+	result = np.empty(vec.size(), dtype=np.uint32)
+	if vec.size():
+		view = result
+		memcpy(&view[0], &vec[0], vec.size() * sizeof(Label))
+	return result
+
+
+cdef arraytolabels(uint32_t[:] arr, vector[Label]& vec):
+	"""Replace the contents of a vector of labels with an array."""
+	vec.resize(arr.shape[0])
+	if arr.shape[0]:
+		memcpy(&vec[0], &arr[0], arr.shape[0] * sizeof(Label))
+
+
+cdef nestedtoarrays(vector[vector[Label]]& vec):
+	"""Flatten a vector of vectors of labels to arrays of offsets and labels.
+
+	The labels of ``vec[n]`` are ``labels[offsets[n]:offsets[n + 1]]``."""
+	cdef uint64_t[:] offsets
+	cdef uint32_t[:] labels
+	cdef size_t n, total = 0
+	offsetsarr = np.zeros(vec.size() + 1, dtype=np.uint64)
+	offsets = offsetsarr
+	for n in range(vec.size()):
+		total += vec[n].size()
+		offsets[n + 1] = total
+	labelsarr = np.empty(total, dtype=np.uint32)
+	labels = labelsarr
+	for n in range(vec.size()):
+		if vec[n].size():
+			memcpy(&labels[offsets[n]], &vec[n][0],
+					vec[n].size() * sizeof(Label))
+	return offsetsarr, labelsarr
+
+
+cdef arraystonested(uint64_t[:] offsets, uint32_t[:] labels,
+		vector[vector[Label]]& vec):
+	"""Inverse of nestedtoarrays(); replaces the contents of vec."""
+	cdef size_t n
+	vec.clear()
+	vec.resize(offsets.shape[0] - 1)
+	for n in range(vec.size()):
+		if offsets[n + 1] > offsets[n]:
+			vec[n].resize(offsets[n + 1] - offsets[n])
+			memcpy(&vec[n][0], &labels[offsets[n]],
+					vec[n].size() * sizeof(Label))
+
+
+cdef rulestoarrays(list rulemapping):
+	"""Flatten a list of arrays of rule numbers to offsets and rule numbers."""
+	cdef array rulenos = array('L')
+	offsets = np.zeros(len(rulemapping) + 1, dtype=np.uint64)
+	offsets[1:] = np.cumsum([len(a) for a in rulemapping])
+	for a in rulemapping:
+		rulenos.extend(a)
+	return offsets, (np.frombuffer(rulenos, dtype='L') if len(rulenos)
+			else np.empty(0, dtype='L'))
+
+
+cdef list arraystorules(offsets, rulenos):
+	"""Inverse of rulestoarrays()."""
+	cdef list result = []
+	cdef array tmp
+	for n in range(len(offsets) - 1):
+		tmp = array('L')
+		tmp.frombytes(rulenos[offsets[n]:offsets[n + 1]].tobytes())
+		result.append(tmp)
+	return result
+
+
+cdef inline void copyrules(vector[ProbRule]& dest, ProbRule *src, size_t n):
+	"""Copy an array of n rules followed by a sentinel rule to dest."""
+	dest.assign(src, src + n + 1)
+
+
+cdef inline void writeruleindex(uint64_t *dest, vector[ProbRule *]& index,
+		size_t n):
+	"""Store the index of the first rule for each of n labels."""
+	cdef size_t m
+	for m in range(n):
+		dest[m] = index[m] - index[0]
+
+
+cdef inline void readruleindex(vector[ProbRule *]& dest, ProbRule *rules,
+		uint64_t *index, size_t n):
+	"""Inverse of writeruleindex(); point to the first rule of each label."""
+	cdef size_t m
+	dest.resize(n)
+	for m in range(n):
+		dest[m] = &rules[index[m]]
+
+
+cdef inline void writestringtable(char *ptr, list strings):
+	"""Write offsets of strings followed by the NUL-terminated strings.
+
+	Offsets are relative to ``ptr``; there is a final offset to the end."""
+	cdef uint64_t *offsets = <uint64_t *>ptr
+	cdef size_t n, idx = (len(strings) + 1) * sizeof(uint64_t)
+	cdef bytes a
+	for n, a in enumerate(strings):
+		offsets[n] = idx
+		memcpy(&ptr[idx], <char *>a, len(a) + 1)
+		idx += len(a) + 1
+	offsets[len(strings)] = idx
+
+
 cdef inline Prob convertweight(const char *weight):
 	"""Convert weight to float/double; weight may be a fraction '1/2'
 	(returns only first part of fraction), decimal float '0.5',
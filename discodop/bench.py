@@ -0,0 +1,317 @@
+"""Benchmark parsing throughput and latency across grammars.
+
+Trains small, reproducible grammars on the sample treebanks of the
+distribution and parses a fixed set of sentences with each parsing mode."""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import tempfile
+import resource
+import multiprocessing
+from collections import OrderedDict
+from getopt import gnu_getopt, GetoptError
+import numpy as np
+from . import __version__
+
+SHORTUSAGE = '''\
+usage: discodop bench [options]
+or:    discodop bench --compare <old.json> <new.json>'''
+
+# corpora: name => (filename relative to source directory, format)
+CORPORA = OrderedDict([
+		('alpinosample', ('alpinosample.export', 'export')),
+		('t1', ('tests/t1.mrg', 'bracket')),
+		])
+
+# coarse stages shared by the benchmarks below
+PCFGSTAGE = dict(name='pcfg', mode='pcfg', split=True, markorigin=True)
+PLCFRSSTAGE = dict(name='plcfrs', mode='plcfrs', m=10)
+
+# benchmarks: name => list of stages; the last stage is the one of interest.
+BENCHMARKS = OrderedDict([
+		('pcfg', [PCFGSTAGE]),
+		('plcfrs', [PLCFRSSTAGE]),
+		('dop-rerank', [PLCFRSSTAGE, dict(name='doprerank',
+			mode='dop-rerank', prune='plcfrs', dop='reduction', k=10)]),
+		('mc-rerank', [PLCFRSSTAGE, dict(name='mcrerank',
+			mode='mc-rerank', prune='plcfrs', k=10)]),
+		('2dop', [PCFGSTAGE, dict(name='2dop', mode='plcfrs',
+			prune='pcfg', splitprune=True, dop='doubledop', k=50, m=1000)]),
+		('dopreduction', [PCFGSTAGE, dict(name='dopred', mode='plcfrs',
+			prune='pcfg', splitprune=True, dop='reduction', k=50, m=1000)]),
+		])
+
+
+def corpuspath(corpus):
+	"""Return path of one of the predefined corpora."""
+	filename = CORPORA[corpus][0]
+	basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	for path in (filename, os.path.join(basedir, filename)):
+		if os.path.exists(path):
+			return path
+	raise ValueError('corpus %r not found; run from the source directory of '
+			'disco-dop.' % filename)
+
+
+def peakrss():
+	"""Return the peak resident set size of this process in kilobytes."""
+	result = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == 'darwin':  # reported in bytes instead of kilobytes
+		result //= 1024
+	return result
+
+
+def latencystats(latencies):
+	"""Summarize a sequence of latencies in seconds.
+
+	>>> sorted(latencystats([1, 2, 3, 4]).items())  # doctest: +ELLIPSIS
+	[('max', 4.0), ('mean', 2.5), ('p50', 2.5), ('p90', 3.7...), ...]"""
+	latencies = np.array(latencies, dtype=float)
+	p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+	return OrderedDict([('mean', float(latencies.mean())), ('p50', float(p50)),
+			('p90', float(p90)), ('p99', float(p99)),
+			('max', float(latencies.max()))])
+
+
+def trainbenchmark(corpus, name, resultdir):
+	"""Train the grammars of a benchmark on a corpus and store them.
+
+	:param corpus: a key of ``CORPORA``.
+	:param name: a key of ``BENCHMARKS``.
+	:param resultdir: an existing directory in which the parameters, grammars
+		and test sentences are stored, cf. :py:func:`loadparser`.
+	:returns: a dictionary with the training time and the peak memory usage
+		of the process."""
+	from .parser import readparam
+	from .runexp import loadtraincorpus, dobinarization, getgrammars
+	fmt = CORPORA[corpus][1]
+	params = dict(stages=BENCHMARKS[name], corpusfmt=fmt,
+			traincorpus=dict(path=corpuspath(corpus), maxwords=40,
+				numsents=1000),
+			testcorpus=dict(path=corpuspath(corpus)),
+			binarization=dict(method='default', h=1, v=1),
+			evalparam=None, verbosity=0, numproc=1)
+	with io.open(os.path.join(resultdir, 'params.prm'), 'w',
+			encoding='utf8') as out:
+		out.write(u',\n'.join('%s=%r' % a for a in params.items()))
+	prm = readparam(os.path.join(resultdir, 'params.prm'))
+	prm.update(resultdir=resultdir)
+	begin = time.time()
+	trees, sents, tagged = loadtraincorpus(
+			prm.corpusfmt, prm.traincorpus, prm.binarization, prm.punct,
+			prm.functions, prm.morphology, prm.removeempty,
+			prm.ensureroot, prm.transformations,
+			prm.relationalrealizational, resultdir)
+	getgrammars(dobinarization(trees, sents, prm.binarization,
+				prm.relationalrealizational),
+			sents, prm.stages, prm.traincorpus.maxwords, resultdir,
+			prm.numproc, None, trees[0].label)
+	with io.open(os.path.join(resultdir, 'bench.json'), 'w',
+			encoding='utf8') as out:
+		out.write(json.dumps(dict(top=trees[0].label, sents=tagged)))
+	return OrderedDict([('traintime', time.time() - begin),
+			('trainrss', peakrss())])
+
+
+def loadparser(resultdir):
+	"""Load the parser of a benchmark trained in ``resultdir``.
+
+	:returns: a tuple ``(parser, sents)`` with a
+		:py:class:`discodop.parser.Parser` object and the test sentences as
+		lists of ``(word, tag)`` tuples."""
+	from .parser import Parser, readparam, readgrammars
+	with io.open(os.path.join(resultdir, 'bench.json'),
+			encoding='utf8') as inp:
+		data = json.load(inp)
+	prm = readparam(os.path.join(resultdir, 'params.prm'))
+	prm.update(resultdir=resultdir)
+	readgrammars(resultdir, prm.stages, prm.postagging, prm.transformations,
+			top=data['top'])
+	return Parser(prm), data['sents']
+
+
+def parsebenchmark(resultdir, repeat=3):
+	"""Load a trained benchmark and time parsing of its sentences.
+
+	The training sentences are parsed; since the corpora are small, latencies
+	are dominated by the complexity of the grammars and parsing modes.
+
+	:param repeat: number of times to parse the sentences of the corpus.
+	:returns: a dictionary with the results of parsing and the peak memory
+		usage of the process after loading the grammars, and after parsing."""
+	parser, tagged = loadparser(resultdir)
+	loadrss = peakrss()
+	latencies, noparse = [], 0
+	for _ in range(repeat):
+		for sent in tagged:
+			words = [word for word, _ in sent]
+			tags = [tag for _, tag in sent]
+			begin = time.time()
+			results = list(parser.parse(words, tags=tags))
+			latencies.append(time.time() - begin)
+			noparse += results[-1].noparse
+	total = sum(latencies)
+	numwords = repeat * sum(len(sent) for sent in tagged)
+	return OrderedDict([
+			('stages', [stage.name for stage in parser.stages]),
+			('sentences', len(latencies)),
+			('words', numwords),
+			('noparse', noparse),
+			('parsetime', total),
+			('sentspersec', len(latencies) / total if total else 0.0),
+			('wordspersec', numwords / total if total else 0.0),
+			('latency', latencystats(latencies)),
+			('loadrss', loadrss),
+			('parserss', peakrss()),
+			])
+
+
+def _benchmarkworker(func, args):
+	"""Wrapper to run a phase of a benchmark in a worker process."""
+	logging.getLogger().setLevel(logging.WARNING)
+	return func(*args)
+
+
+def inprocess(func, *args):
+	"""Call ``func(*args)`` in a fresh process and return its result."""
+	pool = multiprocessing.Pool(processes=1)
+	try:
+		return pool.apply(_benchmarkworker, (func, args))
+	finally:
+		pool.terminate()
+		pool.join()
+
+
+def runbenchmark(corpus, name, repeat=3):
+	"""Train the grammars of a benchmark on a corpus and time parsing.
+
+	Training and parsing are each done in a fresh process, such that the peak
+	memory usage of parsing (``parserss``, which includes loading the
+	grammars, ``loadrss``) is measured separately from that of training
+	(``trainrss``).
+
+	:param corpus: a key of ``CORPORA``.
+	:param name: a key of ``BENCHMARKS``.
+	:param repeat: number of times to parse the sentences of the corpus.
+	:returns: a dictionary with the results of the benchmark."""
+	resultdir = tempfile.mkdtemp(prefix='discodop-bench-')
+	try:
+		train = inprocess(trainbenchmark, corpus, name, resultdir)
+		parse = inprocess(parsebenchmark, resultdir, repeat)
+	finally:
+		shutil.rmtree(resultdir)
+	result = OrderedDict([('corpus', corpus), ('mode', name)])
+	result.update(parse)
+	result.update(train)
+	return result
+
+
+def runbenchmarks(corpora, names, repeat=3):
+	"""Run benchmarks, each in fresh processes.
+
+	:returns: a dictionary with information on the environment and a list of
+		results as returned by :py:func:`runbenchmark`."""
+	results = []
+	for corpus in corpora:
+		for name in names:
+			results.append(runbenchmark(corpus, name, repeat))
+			logging.info('%s', formatresult(results[-1]))
+	return OrderedDict([
+			('version', __version__),
+			('python', platform.python_version()),
+			('platform', platform.platform()),
+			('date', time.strftime('%Y-%m-%d %H:%M:%S')),
+			('repeat', repeat),
+			('results', results),
+			])
+
+
+def formatresult(result):
+	"""Return a one-line summary of the result of a benchmark."""
+	return ('%-12s %-12s %8.2f sents/s  p50 %.4fs  p90 %.4fs  p99 %.4fs  '
+			'parse RSS %d KB%s' % (result['corpus'], result['mode'],
+			result['sentspersec'], result['latency']['p50'],
+			result['latency']['p90'], result['latency']['p99'],
+			result['parserss'], '  (%d no parse)' % result['noparse']
+				if result['noparse'] else ''))
+
+
+def compare(old, new):
+	"""Compare two sets of benchmark results; return a multi-line string.
+
+	Reports relative changes in throughput, median latency, and peak memory
+	of parsing for the benchmarks present in both sets of results."""
+	oldresults = {(a['corpus'], a['mode']): a for a in old['results']}
+	result = ['%s => %s' % (old['version'], new['version'])]
+	for b in new['results']:
+		a = oldresults.get((b['corpus'], b['mode']))
+		if a is None:
+			continue
+		result.append('%-12s %-12s sents/s %+7.1f%%  p50 %+7.1f%%  '
+				'parse RSS %+7.1f%%' % (b['corpus'], b['mode'],
+				relchange(a['sentspersec'], b['sentspersec']),
+				relchange(a['latency']['p50'], b['latency']['p50']),
+				relchange(a['parserss'], b['parserss'])))
+	return '\n'.join(result)
+
+
+def relchange(old, new):
+	"""Return relative change in percent.
+
+	>>> relchange(2, 3)
+	50.0"""
+	return 100.0 * (new - old) / old if old else 0.0
+
+
+def main():
+	"""Command line interface for benchmarks."""
+	try:
+		opts, args = gnu_getopt(sys.argv[2:], '', [
+				'corpora=', 'modes=', 'repeat=', 'output=', 'compare'])
+	except GetoptError as err:
+		print('error:', err, file=sys.stderr)
+		print(SHORTUSAGE)
+		sys.exit(2)
+	opts = dict(opts)
+	if '--compare' in opts:
+		if len(args) != 2:
+			print('error: expected two result files', file=sys.stderr)
+			print(SHORTUSAGE)
+			sys.exit(2)
+		with io.open(args[0], encoding='utf8') as inp:
+			old = json.load(inp)
+		with io.open(args[1], encoding='utf8') as inp:
+			new = json.load(inp)
+		print(compare(old, new))
+		return
+	elif args:
+		print('error: unexpected arguments', file=sys.stderr)
+		print(SHORTUSAGE)
+		sys.exit(2)
+	corpora = opts.get('--corpora', ','.join(CORPORA)).split(',')
+	names = opts.get('--modes', ','.join(BENCHMARKS)).split(',')
+	for corpus in corpora:
+		if corpus not in CORPORA:
+			raise ValueError('unknown corpus %r; choices: %s' % (
+					corpus, ', '.join(CORPORA)))
+	for name in names:
+		if name not in BENCHMARKS:
+			raise ValueError('unknown mode %r; choices: %s' % (
+					name, ', '.join(BENCHMARKS)))
+	logging.basicConfig(level=logging.INFO, format='%(message)s')
+	result = runbenchmarks(corpora, names, int(opts.get('--repeat', 3)))
+	if '--output' in opts:
+		with io.open(opts['--output'], 'w', encoding='utf8') as out:
+			out.write(json.dumps(result, indent=2) + u'\n')
+	else:
+		print(json.dumps(result, indent=2))
+
+
+__all__ = ['runbenchmark', 'runbenchmarks', 'trainbenchmark',
+		'parsebenchmark', 'loadparser', 'inprocess', 'latencystats',
+		'compare', 'formatresult', 'corpuspath', 'peakrss', 'relchange']
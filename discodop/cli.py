@@ -14,6 +14,7 @@ COMMANDS = {
 		'parser': 'Simple command line parser.',
 		'demos': 'Show some demonstrations of formalisms encoded in LCFRS.',
 		'gen': 'Generate sentences from a PLCFRS.',
+		'bench': 'Benchmark parsing throughput and latency.',
 	}
 
 
@@ -3,17 +3,19 @@ from __future__ import print_function
 from libcpp.vector cimport vector
 from libcpp.utility cimport pair
 from libcpp.algorithm cimport sort
+from libc.math cimport log, log1p, exp, HUGE_VAL as INFINITY
 import re
+import warnings
 from .tree import Tree
 from .treetransforms import mergediscnodes, unbinarize, fanout, addbitsets
 from .containers cimport (Grammar, Chart, Edge, RankedEdge, LexicalRule,
-		Label, ItemNo, compactcellidx, CFGtoSmallChartItem,
+		Label, ItemNo, Prob, compactcellidx, CFGtoSmallChartItem,
 		CFGtoFatChartItem, SmallChartItem, FatChartItem, Whitelist)
 from .bit cimport nextset, nextunset, anextset, anextunset
 from .pcfg cimport CFGChart, DenseCFGChart, SparseCFGChart, CFGItem
 from .plcfrs cimport SmallLCFRSChart, FatLCFRSChart
-from .kbest import lazykbest
-from .kbest cimport collectitems, getderiv
+from .kbest import lazykbest, iterkbest
+from .kbest cimport KBest, getkbest, collectitems, getderiv
 from roaringbitmap import RoaringBitmap
 import numpy as np
 
@@ -75,6 +77,7 @@ def prunechart(Chart coarsechart, Grammar fine, k,
 		:blocked: ``label not in whitelist[span]``
 	"""
 	cdef Whitelist whitelist = Whitelist()
+	cdef KBest kbest
 	cdef vector[ItemNo] items
 	cdef SmallChartItem sitem
 	cdef FatChartItem fitem
@@ -86,8 +89,6 @@ def prunechart(Chart coarsechart, Grammar fine, k,
 		raise ValueError('need to call fine.getmapping(coarse, ...).')
 	# prune coarse chart and collect items
 	if require and k >= 1:
-		lazykbest(coarsechart, k, derivs=False)
-		root = coarsechart.root()
 		require1 = []
 		for strlabel, indices in require:
 			matchingitems = getmatchingitems(coarsechart, strlabel, indices)
@@ -95,25 +96,19 @@ def prunechart(Chart coarsechart, Grammar fine, k,
 				raise ValueError('could not fulfill constraint '
 						'(item not in chart): %r %r' % (strlabel, indices))
 			require1.append(set(matchingitems))
-		derivs = RoaringBitmap()
-		for n in range(coarsechart.rankededges[root].size()):
-			itemset = set()
-			collectitems(
-					root, coarsechart.rankededges[root][n].first,
-					coarsechart, itemset)
-			if not any(itemset.isdisjoint(matchingitems)
-					for matchingitems in require1):
-				derivs.add(n)
 		itemset = RoaringBitmap()
-		for n in derivs:
-			collectitems(
-					root, coarsechart.rankededges[root][n].first,
-					coarsechart, itemset)
+		numderivs = numselected = 0
+		for _, _, derivitems in iterkbest(coarsechart, k, items=True):
+			numderivs += 1
+			if not any(derivitems.isdisjoint(matchingitems)
+					for matchingitems in require1):
+				itemset.update(derivitems)
+				numselected += 1
 		items = [n for n in itemset]
 		msg = 'applied \'required\' constraints; %d of %d derivations left' % (
-				len(derivs), coarsechart.rankededges[root].size())
+				numselected, numderivs)
 	elif 0 < k < 1:  # threshold on posterior probabilities
-		items, msg = posteriorthreshold(coarsechart, k)
+		msg = _posteriorthreshold(coarsechart, k, items)
 	elif k == 0:  # only drop items not part of a full derivation
 		coarsechart.filter()
 		items = [n for n in range(coarsechart.parseforest.size())
@@ -121,13 +116,16 @@ def prunechart(Chart coarsechart, Grammar fine, k,
 		msg = ('coarse items before pruning: %d; after filter: %d'
 				% (coarsechart.numitems(), len(items)))
 	elif k >= 1:  # construct a list of the k-best chart items to prune with
-		lazykbest(coarsechart, k, derivs=False)
-		items = [n for n in range(coarsechart.rankededges.size())
-				if coarsechart.rankededges[n].size() != 0]
+		kbest = getkbest(coarsechart, k)
+		numderivs = kbest.extend(k)
+		itemset = RoaringBitmap()
+		for n in range(numderivs):
+			collectitems(kbest.root, kbest.derivs[n].first, coarsechart,
+					itemset)
+		items = [n for n in itemset]
 		msg = ('coarse items before pruning: %d; after: %d, '
 				'based on %d/%d derivations' % (
-				coarsechart.numitems(), len(items),
-				min(coarsechart.rankededges[coarsechart.root()].size(), k), k))
+				coarsechart.numitems(), len(items), numderivs, k))
 	else:
 		raise ValueError('invalid value for k parameter.')
 	if block:
@@ -166,6 +164,7 @@ def prunechart(Chart coarsechart, Grammar fine, k,
 				whitelist.small[label].insert(sitem)
 	whitelist.mapping = &(fine.mapping[0])
 	whitelist.splitmapping = &(fine.splitmapping[0])
+	whitelist.numitems = items.size()
 	return whitelist, msg
 
 
@@ -181,101 +180,117 @@ def getmatchingitems(Chart chart, str strlabel, indices):
 def posteriorthreshold(Chart chart, double threshold):
 	"""Prune labeled spans from chart below given posterior threshold.
 
-	:returns: dictionary of remaining items."""
-	cdef ItemNo itemidx
+	:returns: a tuple ``(items, msg)`` with a list of the remaining items."""
+	cdef vector[ItemNo] items
+	msg = _posteriorthreshold(chart, threshold, items)
+	return [item for item in items], msg
+
+
+cdef _posteriorthreshold(Chart chart, double threshold,
+		vector[ItemNo]& items):
+	"""Collect items with posterior probability > threshold in ``items``."""
+	cdef ItemNo n, item
+	cdef Prob sentprob, logthreshold = -log(threshold)
+	cdef size_t numitems = chart.numitems(), numfiltered = 0
 	if not 0 < threshold < 1:
 		raise ValueError('expected posterior threshold k with 0 < k < 1.')
 	if not chart.inside.size():
-		origlogprob = chart.grammar.logprob
-		chart.grammar.switch(chart.grammar.currentmodel, logprob=False)
-		getinside(chart)
-		getoutside(chart)
-		chart.grammar.switch(chart.grammar.currentmodel, logprob=origlogprob)
+		insideoutside(chart)
 	sentprob = chart.inside[chart.root()]
-	threshold *= sentprob
-	if not sentprob:
-		raise ValueError('sentence has zero posterior prob.: %g' % sentprob)
-	posterior = [itemidx for itemidx
-			in range(chart.inside.size())
-			if chart.inside[itemidx] * chart.outside[itemidx] > threshold]
-
-	unfiltered = chart.numitems()
-	numitems = 0
-	for itemidx in range(1, chart.numitems() + 1):
-		numitems += chart.outside[itemidx] != 0.0
-	numremain = len(posterior)
-	msg = ('coarse items before pruning=%d; filtered: %d;'
-			' pruned: %d; sentprob=%g' % (
-			unfiltered, numitems, numremain, sentprob))
-	return posterior, msg
+	if sentprob == INFINITY:
+		raise ValueError('sentence has zero posterior prob.')
+	for n in range(1, numitems + 1):
+		item = chart.getitemidx(n)
+		if chart.outside[item] != INFINITY:
+			numfiltered += 1
+			if (chart.inside[item] + chart.outside[item] - sentprob
+					< logthreshold):
+				items.push_back(item)
+	return ('coarse items before pruning=%d; filtered: %d;'
+			' pruned: %d; log sentprob=%g' % (
+			numitems, numfiltered, items.size(), -sentprob))
 
 
-def getinside(Chart chart):
-	"""Compute inside probabilities for a chart given its parse forest."""
-	# this needs to be bottom up, so need order in which items were added
-	# currently separate list, chart.itemsinorder
-	# NB: sorting items by length is not enough,
-	# unaries have to be in the right order...
-
-	# choices for probs:
-	# - normal => underflow (current)
-	# - logprobs => loss of precision w/addition
-	# - normal, scaled => how?
+def insideoutside(Chart chart):
+	"""Compute inside and outside probabilities given the parse forest.
+
+	The results are stored in ``chart.inside`` and ``chart.outside`` as
+	negative log probabilities, to avoid underflow; the weights of the
+	grammar are used as they are, without switching models. Items are
+	visited in the order in which they were added to the chart, which is a
+	topological order: bottom-up for inside and top-down for outside
+	probabilities."""
 	cdef ItemNo n, item, leftitem, rightitem
 	cdef Edge edge
-	cdef double prob
-	chart.inside.resize(chart.probs.size(), 0.0)
-
-	# traverse items in bottom-up order
-	for n in range(1, chart.numitems() + 1):
+	cdef Prob prob, outsideprob
+	cdef bint logprob = chart.grammar.logprob
+	cdef size_t numitems = chart.numitems()
+	chart.inside.assign(chart.probs.size(), INFINITY)
+	chart.outside.assign(chart.probs.size(), INFINITY)
+	for n in range(1, numitems + 1):
 		item = chart.getitemidx(n)
 		for edge in chart.parseforest[item]:
 			if edge.rule is NULL:
-				prob = chart.lexprob(item, edge)
-			elif edge.rule.rhs2 == 0:
-				leftitem = chart._left(item, edge)
-				prob = (edge.rule.prob
-						* chart.inside[leftitem])
+				prob = -log(chart.lexprob(item, edge))
 			else:
-				leftitem = chart._left(item, edge)
-				rightitem = chart._right(item, edge)
-				prob = (edge.rule.prob
-						* chart.inside[leftitem]
-						* chart.inside[rightitem])
-			# chart.addprob(item, prob)
-			chart.inside[item] += prob
-
-
-def getoutside(Chart chart):
-	"""Compute outside probabilities for a chart given its parse forest."""
-	cdef ItemNo n, item, leftitem, rightitem
-	cdef Edge edge
-	cdef double outsideprob
-	# cdef double sentprob = chart.inside[chart.root()]
-	# traverse items in top-down order
-	chart.outside.resize(chart.probs.size(), 0.0)
-	chart.outside[chart.root()] = 1.0
-	for n in range(chart.numitems(), 0, -1):
+				prob = edge.rule.prob if logprob else -log(edge.rule.prob)
+				prob += chart.inside[chart._left(item, edge)]
+				if edge.rule.rhs2 != 0:
+					prob += chart.inside[chart._right(item, edge)]
+			chart.inside[item] = logprobadd(chart.inside[item], prob)
+	chart.outside[chart.root()] = 0.0
+	for n in range(numitems, 0, -1):
 		item = chart.getitemidx(n)
-		# can we define outside[item] simply as sentprob - inside[item] ?
-		# chart.outside[item] = sentprob - chart.inside[item]
+		outsideprob = chart.outside[item]
+		if outsideprob == INFINITY:  # not part of a complete derivation
+			continue
 		for edge in chart.parseforest[item]:
 			if edge.rule is NULL:
-				pass
-			elif edge.rule.rhs2 == 0:
-				leftitem = chart._left(item, edge)
-				chart.outside[leftitem] += (edge.rule.prob
-						* chart.outside[item])
+				continue
+			prob = outsideprob + (edge.rule.prob if logprob
+					else -log(edge.rule.prob))
+			leftitem = chart._left(item, edge)
+			if edge.rule.rhs2 == 0:
+				chart.outside[leftitem] = logprobadd(
+						chart.outside[leftitem], prob)
 			else:
-				leftitem = chart._left(item, edge)
 				rightitem = chart._right(item, edge)
-				outsideprob = chart.outside[item]
-				chart.outside[leftitem] += (edge.rule.prob
-						* chart.inside[rightitem]
-						* outsideprob)
-				chart.outside[rightitem] += (edge.rule.prob
-						* chart.inside[leftitem]
-						* outsideprob)
+				chart.outside[leftitem] = logprobadd(
+						chart.outside[leftitem], prob + chart.inside[rightitem])
+				chart.outside[rightitem] = logprobadd(
+						chart.outside[rightitem], prob + chart.inside[leftitem])
+
+
+def getinside(Chart chart):
+	"""Deprecated; use :py:func:`insideoutside`.
+
+	Unlike before, ``chart.inside`` will contain negative log probabilities,
+	and outside probabilities are computed as well."""
+	warnings.warn('getinside() is deprecated; use insideoutside().',
+			DeprecationWarning, stacklevel=2)
+	insideoutside(chart)
+
+
+def getoutside(Chart chart):
+	"""Deprecated; use :py:func:`insideoutside`.
+
+	Unlike before, ``chart.outside`` will contain negative log
+	probabilities; inside probabilities are computed if necessary."""
+	warnings.warn('getoutside() is deprecated; use insideoutside().',
+			DeprecationWarning, stacklevel=2)
+	if not chart.outside.size():
+		insideoutside(chart)
+
+
+cdef inline Prob logprobadd(Prob a, Prob b):
+	"""Add two probabilities given as negative log probabilities."""
+	if a == INFINITY:
+		return b
+	elif b == INFINITY:
+		return a
+	elif a < b:
+		return a - log1p(exp(a - b))
+	return b - log1p(exp(b - a))
 
 
 def doctftest(coarse, fine, sent, tree, k, split, verbose=False):
@@ -422,4 +437,5 @@ def test():
 			doctftest(coarse, fine, sent, tree, k, split, verbose=False)
 		print("time elapsed", clock() - begin, "s")
 
-__all__ = ['prunechart', 'posteriorthreshold', 'getinside', 'getoutside']
+__all__ = ['prunechart', 'posteriorthreshold', 'insideoutside', 'getinside',
+		'getoutside']
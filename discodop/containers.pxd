@@ -191,7 +191,7 @@ cdef extern from "_containers.h" nogil:
 		LexCmp(vector[LexicalRule]& v)
 		bool operator()(uint32_t a, uint32_t b)
 	cdef cppclass LexLabelCmp:
-		LexLabelCmp(vector[LexicalRule]& v)
+		LexLabelCmp(LexicalRule *v)
 		bool operator()(uint32_t a, Label b)
 	cdef union Position:
 		short mid
@@ -536,17 +536,29 @@ cdef class Grammar:
 	cdef vector[ProbRule *] unary
 	cdef vector[ProbRule *] lbinary
 	cdef vector[ProbRule *] rbinary
-	cdef vector[Prob] rulecounts, lexcounts, freqmass
+	cdef vector[Prob] _rulecounts, _lexcounts, freqmass
+	cdef Prob *rulecounts
+	cdef Prob *lexcounts
 	cdef RuleHashMap[uint32_t] rulenos
-	cdef vector[LexicalRule] lexical
+	cdef vector[LexicalRule] _lexical
+	cdef LexicalRule *lexical
+	cdef size_t numlex
 	cdef sparse_hash_map[string, vector[uint32_t]] lexicalbyword
+	# with frombinfile(): sorted table of words and their lexical rules,
+	# in the memory mapped file; used instead of lexicalbyword.
+	cdef char *wordtable
+	cdef uint64_t *lexruleoffsets
+	cdef uint32_t *lexrulenos
+	cdef size_t numwords
+	cdef object _state
 	cdef sparse_hash_set[uint32_t] lexicallhs
 	cdef readonly list backtransform
 	cdef vector[uint64_t] mask
 	cdef vector[uint8_t] fanout
 	cdef StringList tolabel
 	cdef StringIntDict toid
-	cdef vector[uint32_t] revrulemap
+	cdef vector[uint32_t] _revrulemap
+	cdef uint32_t *revrulemap
 	cdef vector[Label] mapping
 	cdef vector[Label] selfmapping
 	cdef vector[vector[Label]] splitmapping
@@ -564,6 +576,11 @@ cdef class Grammar:
 	#
 	cdef _indexrules(self, vector[ProbRule *]& dest, int idx, int filterlen,
 			int orignumrules)
+	cdef _buildrulenos(self)
+	cdef _setpointers(self)
+	cdef _copymapped(self)
+	cdef uint32_t *lexrules(self, string word, size_t *numrules)
+	cdef list _words(self)
 	cpdef rulestr(self, int n)
 	cpdef noderuleno(self, node)
 	cpdef getruleno(self, tuple r, tuple yf)
@@ -584,6 +601,11 @@ cdef class Chart:
 	# cdef vector[string] derivations  # corresponds to rankededges[chart.root()]
 	# list of (str, float); corresponds to rankededges[chart.root()]:
 	cdef readonly list derivations
+	cdef object kbest  # state of k-best enumeration; cf. kbest.KBest
+	# the number of derivations at the start of rankededges[root()] that
+	# are k-best derivations in the order enumerated by kbest; should be
+	# reset to 0 when rankededges[root()] is modified otherwise.
+	cdef size_t numkbest
 	cdef Grammar grammar
 	cdef readonly list sent
 	cdef short lensent
@@ -608,6 +630,7 @@ cdef class Chart:
 
 @cython.final
 cdef class Whitelist:
+	cdef readonly size_t numitems  # number of coarse items selected
 	cdef vector[sparse_hash_set[Label]] cfg  # span -> set of labels
 	# cdef vector[vector[Label]] cfg  # span -> sorted array of fine labels
 	# cdef vector[btree_set[Label]] cfg  # span -> set of fine labels
@@ -723,7 +746,7 @@ cdef class FixedVocabulary(Vocabulary):
 
 # defined here because circular import.
 cdef inline size_t cellidx(short start, short end, short lensent,
-		Label nonterminals):
+		Label nonterminals) nogil:
 	"""Return an index for a regular three dimensional array.
 
 	``chart[start][end][0] => chart[idx]`` """
@@ -731,7 +754,7 @@ cdef inline size_t cellidx(short start, short end, short lensent,
 
 
 cdef inline size_t compactcellidx(short start, short end, short lensent,
-		Label nonterminals):
+		Label nonterminals) nogil:
 	"""Return an index to a triangular array, given start < end.
 	The result of this function is the index to chart[start][end][0]."""
 	return nonterminals * (lensent * start
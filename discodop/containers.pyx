@@ -118,17 +118,19 @@ cdef class Chart:
 		"""Return lexical rule number given a lexical edge."""
 		cdef Label label = self.label(itemidx)
 		cdef string word = self.sent[self.lexidx(edge)].encode('utf8')
-		it = self.grammar.lexicalbyword.find(word)
-		if it == self.grammar.lexicalbyword.end():
+		cdef size_t numlexrules = 0
+		cdef uint32_t *lexrules = self.grammar.lexrules(word, &numlexrules)
+		cdef uint32_t *it
+		if lexrules is NULL:
 			raise ValueError('unknown word: %r' % word)
 		# do binary search among rules for word for rule with given lhs
-		it2 = lower_bound(
-				dereference(it).second.begin(),
-				dereference(it).second.end(),
+		it = lower_bound(
+				lexrules,
+				lexrules + numlexrules,
 				label,
 				LexLabelCmp(self.grammar.lexical))
-		if it2 != dereference(it).second.end():
-			n = dereference(it2)
+		if it != lexrules + numlexrules:
+			n = dereference(it)
 			if self.grammar.lexical[n].lhs == label:
 				return n
 		raise ValueError('no lexical rule found for %r, %r' % (label, word))
@@ -203,9 +205,9 @@ cdef class Chart:
 					('vitprob=%g' % (
 						exp(-self.subtreeprob(item)) if self.logprob
 						else self.subtreeprob(item))).ljust(17),
-					((' ins=%g' % self.inside[item]).ljust(14)
+					((' ins=%g' % exp(-self.inside[item])).ljust(14)
 						if self.inside.size() else ''),
-					((' out=%g' % self.outside[item]).ljust(14)
+					((' out=%g' % exp(-self.outside[item])).ljust(14)
 						if self.outside.size() else ''))))
 			for edge in self.parseforest[item]:
 				result.append('\t=> %s' % self.edgestr(item, edge))
@@ -227,17 +229,114 @@ cdef class Chart:
 					m += 1
 		return '\n'.join(result)
 
+	def reset(self, Grammar grammar, list sent, start=None, logprob=True,
+			viterbi=True, itemsestimate=None):
+		"""Clear chart and re-initialize it for a new sentence.
+
+		Memory allocated for a previous sentence is kept for reuse; accepts
+		the same arguments as the constructor; cf. :py:class:`ChartPool`."""
+		raise NotImplementedError
+
+	def clear(self):
+		"""Remove all items and edges but keep allocated memory for reuse.
+
+		The chart should be re-initialized by calling ``reset()`` before
+		it is used again; cf. :py:class:`ChartPool`."""
+		self.probs.clear()
+		self.inside.clear()
+		self.outside.clear()
+		self.parseforest.clear()
+		self.rankededges.clear()
+		self.derivations = None
+		self.kbest = None
+		self.numkbest = 0
+		self.sent = None
+
+	def nbytes(self):
+		"""Return an estimate of the number of bytes allocated by chart."""
+		return ((self.probs.capacity() + self.inside.capacity()
+				+ self.outside.capacity()) * sizeof(Prob)
+				+ self.parseforest.capacity() * sizeof(vector[Edge])
+				+ sum([self.parseforest[n].capacity() * sizeof(Edge)
+					for n in range(self.parseforest.size())])
+				+ self.rankededges.capacity()
+					* sizeof(vector[pair[RankedEdge, Prob]]))
+
+	def numedges(self):
+		"""Return the number of edges in the chart."""
+		return sum([self.parseforest[self.getitemidx(n)].size()
+				for n in range(1, self.numitems() + 1)])
+
 	def stats(self):
 		"""Return a short string with counts of items, edges."""
-		return 'items %d, edges %d' % (
-				self.numitems(),
-				sum([self.parseforest[self.getitemidx(n)].size()
-					for n in range(1, self.numitems() + 1)]))
+		return 'items %d, edges %d' % (self.numitems(), self.numedges())
 		# more stats:
 		# labels: len({self.label(item) for item in range(1, self.numitems() + 1)}),
 		# spans: ...
 
 
+class ChartPool(object):
+	"""A pool of charts of parsed sentences, to be reused for other sentences.
+
+	Released charts are cleared but keep the memory allocated for their
+	arrays; when a chart is requested, a released chart of the same type,
+	grammar, and sentence length (rounded up to a power of two) is reset
+	instead of allocating a new chart, so that its arrays are close to the
+	size that is needed.
+
+	:param maxbytes: the maximum number of bytes retained by the charts in
+		the pool; released charts that do not fit are discarded."""
+
+	def __init__(self, maxbytes=256 * 1024 * 1024):
+		self.maxbytes = maxbytes
+		self.retained = 0
+		# (type of chart, grammar, length bucket) => list of charts
+		self.free = {}
+
+	def get(self, cls, Grammar grammar, list sent, *args, **kwds):
+		"""Return ``cls(grammar, sent, *args, **kwds)``, reusing a chart."""
+		charts = self.free.get((cls, grammar, len(sent).bit_length()))
+		if not charts:
+			return cls(grammar, sent, *args, **kwds)
+		chart = charts.pop()
+		self.retained -= chart.nbytes()
+		chart.reset(grammar, sent, *args, **kwds)
+		return chart
+
+	def release(self, Chart chart):
+		"""Return a chart that is no longer used to the pool."""
+		if chart is None:
+			return
+		key = (type(chart), chart.grammar, len(chart.sent).bit_length())
+		chart.clear()
+		size = chart.nbytes()
+		if self.retained + size <= self.maxbytes:
+			self.free.setdefault(key, []).append(chart)
+			self.retained += size
+
+	def clear(self):
+		"""Discard all charts in the pool."""
+		self.free.clear()
+		self.retained = 0
+
+	def __len__(self):
+		return sum(len(a) for a in self.free.values())
+
+	def __repr__(self):
+		return '%s(%d charts, %d bytes)' % (self.__class__.__name__,
+				len(self), self.retained)
+
+
+@cython.final
+cdef class Whitelist:
+	"""The items of a coarse chart that are allowed in a finer chart.
+
+	Produced by :py:func:`discodop.coarsetofine.prunechart`; ``numitems`` is
+	the number of coarse items that were selected."""
+	def __repr__(self):
+		return '%s(%d items)' % (self.__class__.__name__, self.numitems)
+
+
 cdef void _filtersubtree(Chart chart, item, set items):
 	"""Recursively collect items that lead to a complete derivation."""
 	cdef Edge edge
@@ -433,6 +532,21 @@ cdef class Ctrees:
 				if self.nodes[m].left < 0}
 		return [sent.get(m, None) for m in range(max(sent) + 1)]
 
+	def nodetable(self, int n, Vocabulary vocab):
+		"""Return the nodes of given tree in preorder, without binarization.
+
+		:returns: a list of tuples ``(label, parent, idx)``, where ``label`` is
+			the label of a node or a word, ``parent`` is the index of its
+			parent in the list (-1 for the root), and ``idx`` is the index of
+			a word in the sentence (-1 for other nodes). Intermediate nodes
+			introduced by binarization are left out."""
+		cdef list result = []
+		if n < 0 or n >= self.len:
+			raise IndexError
+		gettable(result, &(self.nodes[self.trees[n].offset]), vocab,
+				self.trees[n].root, -1)
+		return result
+
 	def printrepr(self, int n, Vocabulary vocab):
 		"""Print repr of a tree for debugging purposes."""
 		tree = self.extract(n, vocab, disc=True)
@@ -786,6 +900,21 @@ cdef class Vocabulary:
 				prodno * sizeof(Rule)])
 		return rule.args != 0 and rule.lengths == 0
 
+	def labelprods(self):
+		"""Return the productions of each label and word.
+
+		:returns: a tuple of dictionaries ``(labels, words)``, mapping each
+			label to the IDs of productions with that label as left-hand
+			side, and each word to the IDs of lexical productions with that
+			word."""
+		cdef dict labels = {}, words = {}
+		cdef int n
+		for n in range(self.prodbuf.len // sizeof(Rule)):
+			labels.setdefault(self.getlabel(n), []).append(n)
+			if self.islexical(n):
+				words.setdefault(self.getword(n), []).append(n)
+		return labels, words
+
 	def prodrepr(self, int prodno):
 		cdef Rule *rule
 		cdef int fanout, n, m = 0
@@ -1005,6 +1134,24 @@ cdef inline gettree(list result, Node *tree, Vocabulary vocab, int i,
 	result.append(')')
 
 
+cdef gettable(list result, Node *tree, Vocabulary vocab, int i, int parent):
+	"""Collect the nodes of a tree in preorder; cf. Ctrees.nodetable().
+
+	:param i: node number to start with.
+	:param parent: index in ``result`` of the parent of node ``i``."""
+	cdef str label = vocab.getlabel(tree[i].prod)
+	if '|<' not in label:  # skip intermediate nodes of binarization
+		result.append((label, parent, -1))
+		parent = len(result) - 1
+	if tree[i].left >= 0:
+		gettable(result, tree, vocab, tree[i].left, parent)
+		if tree[i].right >= 0:
+			gettable(result, tree, vocab, tree[i].right, parent)
+	else:
+		result.append((vocab.getword(tree[i].prod) or '', parent,
+				termidx(tree[i].left)))
+
+
 cdef inline int getbufptr(
 		object obj, char ** ptr, Py_ssize_t * size, Py_buffer * buf):
 	"""Get a pointer from bytes/buffer object ``obj``.
@@ -1021,4 +1168,5 @@ cdef inline int getbufptr(
 	return result
 
 
-__all__ = ['Grammar', 'Chart', 'Ctrees', 'Vocabulary', 'FixedVocabulary']
+__all__ = ['Grammar', 'Chart', 'ChartPool', 'Ctrees', 'Vocabulary',
+		'FixedVocabulary']
@@ -15,6 +15,7 @@ from bisect import bisect_right
 from operator import itemgetter, attrgetter
 from itertools import count
 from functools import partial
+from string import Formatter
 from collections import defaultdict
 from . import plcfrs, _fragments
 from .tree import (Tree, ParentedTree, ImmutableTree, writediscbrackettree,
@@ -29,7 +30,8 @@ from .bit import pyintnextset, pyintbitcount
 cimport cython
 from cython.operator cimport dereference
 from libc.string cimport memset
-from libc.stdint cimport uint64_t
+from libc.stdio cimport sprintf
+from libc.stdint cimport uint32_t, uint64_t
 from libc.math cimport HUGE_VAL as INFINITY
 from libcpp.string cimport string
 from libcpp.vector cimport vector
@@ -61,6 +63,19 @@ REMOVESTATESPLITS = re.compile(
 
 cdef str NONCONSTLABEL = ''
 cdef str NEGATIVECONSTLABEL = '-#-'
+FORMATTER = Formatter()
+cdef uint64_t HASHBASE = 1099511628211ULL
+cdef uint64_t HASHBASE2 = 6364136223846793005ULL
+
+cdef struct StrHash:  # two independent polynomial hashes of a string s
+	uint64_t h
+	uint64_t p  # HASHBASE ** len(s)
+	uint64_t h2  # with HASHBASE2; detects collisions of h
+	uint64_t p2
+
+cdef struct FragPart:  # literal string of a fragment template, followed by
+	StrHash lit  # a substitution site with this index, if child >= 0.
+	int child
 
 cpdef getderivations(Chart chart, int k, derivstrings=True):
 	"""Get *k*-best derivations from chart.
@@ -74,8 +89,9 @@ cpdef getderivations(Chart chart, int k, derivstrings=True):
 			is a string; or list of ``None`` if ``derivstrings==False``
 		:chart.rankededges[chart.root()]: corresponding list of RankedEdge
 			objects for the derivations in ``chart.derivations``.
+
+	Derivations already explored in this chart, e.g., for pruning, are reused.
 	"""
-	chart.rankededges.clear()
 	chart.derivations = lazykbest(chart, k, derivs=derivstrings)
 
 
@@ -146,6 +162,17 @@ cpdef marginalize(method, Chart chart, list sent=None, list tags=None,
 		return sldop_simple(sldop_n, chart)
 	elif method == 'mcp':
 		return maxconstituentsparse(chart, mcplambda, mcplabels)
+	elif (mpd or method == 'mpp') and not ostag:
+		result = marginalizetrees(chart, mpd)
+		if result is not None:
+			results, msg = result
+			return applyconstraints(results, msg, require, block)
+		# a hash collision was detected; fall back to derivation strings
+		if dopreduction and chart.derivations is None:
+			chart.derivations = []
+			for entry in chart.rankededges[root]:
+				chart.derivations.append((getderiv(
+						root, entry.first, chart).decode('utf8'), entry.second))
 	elif method == 'shortest':
 		# filter out all derivations which are not shortest
 		if not dopreduction:
@@ -157,6 +184,7 @@ cpdef marginalize(method, Chart chart, list sent=None, list tags=None,
 				if entry.second == maxprob:
 					entries.push_back(entry)
 			chart.rankededges[root] = entries
+			chart.numkbest = 0
 		elif chart.derivations:
 			_, maxprob = min(chart.derivations, key=itemgetter(1))
 			chart.derivations = [(deriv, prob)
@@ -273,6 +301,11 @@ cpdef marginalize(method, Chart chart, list sent=None, list tags=None,
 			len(chart.derivations) if dopreduction
 				else chart.rankededges[root].size(),
 			len(mpdtrees) or len(derivlen) or mpptrees.size())
+	return applyconstraints(results, msg, require, block)
+
+
+cdef applyconstraints(list results, str msg, set require, set block):
+	"""Filter parse trees of ``marginalize()`` on constraints."""
 	if require or block:
 		results = [(treestr, score, frags) for treestr, score, frags in results
 				if testconstraints(treestr, require, block)]
@@ -280,6 +313,210 @@ cpdef marginalize(method, Chart chart, list sent=None, list tags=None,
 	return results, msg
 
 
+cdef marginalizetrees(Chart chart, bint mpd):
+	"""Marginalize the k-best derivations of chart without derivation strings.
+
+	The parse tree of each derivation is identified by a hash of the string
+	that would be produced by ``getderiv()`` or ``recoverfragments()``,
+	computed directly from the RankedEdges. Strings are only rendered for one
+	derivation of each distinct parse tree.
+
+	:param mpd: if True, select the most probable derivation of each parse
+		tree; otherwise, sum the probabilities of its derivations (MPP).
+	:returns: ``(parses, msg)``; cf. ``marginalize()``. Returns ``None``
+		when two different parse trees get the same hash, which is detected
+		with a second, independent hash."""
+	cdef list backtransform = chart.grammar.backtransform
+	cdef bint dopreduction = backtransform is None
+	cdef sparse_hash_map[uint64_t, vector[Prob]] mpptrees
+	cdef sparse_hash_map[uint64_t, Prob] mpdtrees
+	cdef sparse_hash_map[uint64_t, size_t] derivs  # tree => derivation no.
+	cdef sparse_hash_map[uint64_t, uint64_t] checks  # tree => second hash
+	cdef sparse_hash_map[Label, StrHash] labels
+	cdef sparse_hash_map[uint32_t, vector[FragPart]] templates
+	cdef pair[RankedEdge, Prob] entry
+	cdef StrHash tree
+	cdef ItemNo root = chart.root()
+	cdef size_t n
+	# as REMOVEIDS is applied in marginalize(); for MPD, nodes from the
+	# interior of fragments are kept distinct.
+	cdef str repl = '@1' if mpd else ''
+	for n in range(chart.rankededges[root].size()):
+		entry = chart.rankededges[root][n]
+		if dopreduction:
+			tree = treehash(root, entry.first, chart, repl, labels)
+		else:
+			try:
+				tree = fraghash(root, entry.first, chart, backtransform,
+						templates, labels)
+			except IndexError:
+				continue
+		if derivs.count(tree.h) == 0:
+			derivs[tree.h] = n
+			checks[tree.h] = tree.h2
+			mpdtrees[tree.h] = entry.second
+		elif checks[tree.h] != tree.h2:
+			return None
+		elif mpd and entry.second < mpdtrees[tree.h]:
+			mpdtrees[tree.h] = entry.second
+			derivs[tree.h] = n
+		if not mpd:
+			mpptrees[tree.h].push_back(-entry.second)
+	results = []
+	for it in derivs:
+		entry = chart.rankededges[root][it.second]
+		if dopreduction:
+			deriv = getderiv(root, entry.first, chart).decode('utf8')
+			treestr = REMOVEIDS.sub('', deriv)
+			frags = fragmentsinderiv_str(deriv, chart, backtransform)
+		else:
+			treestr = recoverfragments(root, entry.first, chart, backtransform)
+			frags = fragmentsinderiv_re(root, entry.first, chart, backtransform)
+		results.append((treestr, exp(-mpdtrees[it.first]) if mpd
+				else logprobsum(mpptrees[it.first]), frags))
+	msg = '%d derivations, %d parsetrees' % (
+			chart.rankededges[root].size(), derivs.size())
+	return results, msg
+
+
+cdef StrHash treehash(ItemNo v, RankedEdge& deriv, Chart chart, str repl,
+		sparse_hash_map[Label, StrHash]& labels) except *:
+	"""Hash the tree of a derivation as rendered by ``getderiv()``.
+
+	IDs in labels are replaced by ``repl``, as with ``REMOVEIDS``."""
+	cdef StrHash result = labelhash(chart, chart.label(v), REMOVEIDS, repl,
+			labels)
+	cdef ItemNo item
+	if deriv.edge.rule is NULL:
+		return hashconcat(result, hashterminal(chart.lexidx(deriv.edge)))
+	item = chart.left(v, deriv)
+	result = hashconcat(result, treehash(item,
+			chart.rankededges[item][deriv.left].first, chart, repl, labels))
+	if deriv.right != -1:
+		item = chart.right(v, deriv)
+		result = hashconcat(result, strhash(' '))
+		result = hashconcat(result, treehash(item,
+				chart.rankededges[item][deriv.right].first, chart, repl,
+				labels))
+	return hashconcat(result, strhash(')'))
+
+
+cdef StrHash fraghash(ItemNo v, RankedEdge deriv, Chart chart,
+		list backtransform,
+		sparse_hash_map[uint32_t, vector[FragPart]]& templates,
+		sparse_hash_map[Label, StrHash]& labels) except *:
+	"""Hash the tree of a derivation as rendered by ``recoverfragments()``.
+
+	:param templates: cache of parsed templates from ``backtransform``."""
+	cdef RankedEdge child
+	cdef vector[ItemNo] childitems
+	cdef vector[int] childranks
+	cdef vector[FragPart] parts
+	cdef FragPart part
+	cdef StrHash result
+	cdef uint32_t ruleno
+	cdef int n
+	result.h, result.p, result.h2, result.p2 = 0, 1, 0, 1
+	if deriv.edge.rule is NULL:
+		return hashconcat(
+				labelhash(chart, chart.label(v), REMOVEWORDTAGS, '', labels),
+				hashterminal(chart.lexidx(deriv.edge)))
+	ruleno = deriv.edge.rule.no
+	if templates.count(ruleno) == 0:
+		templates[ruleno] = parsetemplate(backtransform[ruleno])
+	parts = templates[ruleno]
+	# collect children; cf. recoverfragments_()
+	if deriv.edge.rule.rhs2:
+		while chart.grammar.selfmapping[deriv.edge.rule.rhs1] == 0:
+			childitems.push_back(chart.right(v, deriv))
+			childranks.push_back(deriv.right)
+			v = chart.left(v, deriv)
+			deriv = chart.rankededges[v][deriv.left].first
+		if deriv.edge.rule.rhs2:
+			childitems.push_back(chart.right(v, deriv))
+			childranks.push_back(deriv.right)
+	elif chart.grammar.selfmapping[deriv.edge.rule.rhs1] == 0:
+		v = chart.left(v, deriv)
+		deriv = chart.rankededges[v][deriv.left].first
+	childitems.push_back(chart.left(v, deriv))
+	childranks.push_back(deriv.left)
+	# substitute hashes of children in template; children are numbered from
+	# the left, while childitems is in reverse order.
+	for part in parts:
+		result = hashconcat(result, part.lit)
+		if part.child < 0:
+			continue
+		elif part.child >= <int>childitems.size():
+			raise IndexError('template %r of rule %d has more substitution '
+					'sites than children' % (backtransform[ruleno], ruleno))
+		n = childitems.size() - 1 - part.child
+		v = childitems[n]
+		child = chart.rankededges[v][childranks[n]].first
+		result = hashconcat(result, fraghash(v, child, chart, backtransform,
+				templates, labels))
+	return result
+
+
+cdef vector[FragPart] parsetemplate(str frag) except *:
+	"""Split a fragment template of Double-DOP into literals and sites."""
+	cdef vector[FragPart] result
+	cdef FragPart part
+	for literal, field, _, _ in FORMATTER.parse(frag):
+		part.lit = strhash(REMOVEWORDTAGS.sub('', literal))
+		part.child = -1 if field is None else int(field)
+		result.push_back(part)
+	return result
+
+
+cdef StrHash labelhash(Chart chart, Label label, regex, str repl,
+		sparse_hash_map[Label, StrHash]& cache) except *:
+	"""Hash of ``'(%s ' % label``, after substituting ``regex`` in label."""
+	cdef sparse_hash_map[Label, StrHash].iterator it = cache.find(label)
+	cdef StrHash result
+	if it != cache.end():
+		return dereference(it).second
+	result = strhash('(%s ' % regex.sub(repl, chart.grammar.tolabel[label]))
+	cache[label] = result
+	return result
+
+
+cdef StrHash hashterminal(int idx):
+	"""Hash of ``'%d)' % idx``."""
+	cdef char buf[16]
+	cdef int length = sprintf(buf, '%d)', idx)
+	return byteshash(<unsigned char *>buf, length)
+
+
+cdef StrHash strhash(str s) except *:
+	"""Polynomial hashes of the UTF-8 encoding of a string.
+
+	Can be combined with hashconcat()."""
+	cdef bytes encoded = s.encode('utf8')
+	return byteshash(<unsigned char *>encoded, len(encoded))
+
+
+cdef inline StrHash byteshash(unsigned char *buf, int length):
+	"""Polynomial hashes of a sequence of bytes."""
+	cdef StrHash result
+	cdef int n
+	result.h, result.p, result.h2, result.p2 = 0, 1, 0, 1
+	for n in range(length):
+		result.h = result.h * HASHBASE + buf[n]
+		result.p *= HASHBASE
+		result.h2 = result.h2 * HASHBASE2 + buf[n]
+		result.p2 *= HASHBASE2
+	return result
+
+
+cdef inline StrHash hashconcat(StrHash a, StrHash b):
+	"""Return the hashes of the concatenation of the strings of a and b."""
+	a.h = a.h * b.p + b.h
+	a.p *= b.p
+	a.h2 = a.h2 * b.p2 + b.h2
+	a.p2 *= b.p2
+	return a
+
+
 def testconstraints(treestr, require, block):
 	"""Test whether tree satisfies constraints of required/blocked sets of
 	labeled spans."""
@@ -915,6 +1152,8 @@ def dopparseprob(tree, sent, Grammar coarse, Grammar fine):
 	cdef dict cell  # chart[bitset] = cell; cell[label] = prob
 	cdef ProbRule *rule
 	cdef LexicalRule lexrule
+	cdef uint32_t *lexrules
+	cdef size_t numlexrules = 0
 	cdef object n  # pyint
 	cdef str pos
 	if not fine.logprob:
@@ -927,11 +1166,11 @@ def dopparseprob(tree, sent, Grammar coarse, Grammar fine):
 	for n, pos in tree.pos():
 		word = sent[n]
 		chart[1 << n] = cell = {}
-		it = fine.lexicalbyword.find(word.encode('utf8'))
-		if it == fine.lexicalbyword.end():
+		lexrules = fine.lexrules(word.encode('utf8'), &numlexrules)
+		if lexrules is NULL:
 			cell[fine.toid[pos]] = -0.0
 			continue
-		for lexruleno in dereference(it).second:
+		for lexruleno in lexrules[:numlexrules]:
 			lexrule = fine.lexical[lexruleno]
 			if (fine.tolabel[lexrule.lhs] == pos
 					or fine.tolabel[lexrule.lhs].startswith(pos + '@')):
@@ -9,6 +9,7 @@ The latter ported almost directly from rparse
 (except for sign reversal of log probs)."""
 
 from __future__ import print_function
+import multiprocessing
 from math import exp
 import numpy as np
 from .util import PyAgenda
@@ -25,9 +26,12 @@ from .containers cimport (SmallChartItemAgenda, Agenda, Chart, Grammar,
 cdef extern from "<cmath>" namespace "std" nogil:
 	bint isfinite(double v)
 	bint isnan(double v)
+	float nextafter(float x, float y)
 
 include "constants.pxi"
 
+OUTSIDELRARGS = None  # arguments for computing estimates in worker process
+
 
 cdef class Item:
 	"""Item class used in agenda for computing the outside LR estimate."""
@@ -70,7 +74,7 @@ cdef inline Item new_Item(int state, int length, int lr, int gaps):
 	return item
 
 
-cdef inline double getoutside(double [:, :, :, :] outside,
+cdef inline double getoutside(float [:, :, :, :] outside,
 		uint32_t maxlen, uint32_t slen, Label label, uint64_t vec):
 	"""Query for outside estimate.
 
@@ -100,7 +104,7 @@ def simpleinside(Grammar grammar, uint32_t maxlen, double [:, :] insidescores):
 	cdef size_t i
 	cdef uint64_t vec
 	cdef LexicalRule lexrule
-	for lexrule in grammar.lexical:
+	for lexrule in grammar.lexical[:grammar.numlex]:
 		agenda.setifbetter(SmallChartItem(lexrule.lhs, 1), lexrule.prob)
 	while not agenda.empty():
 		entry = agenda.pop()
@@ -159,7 +163,7 @@ def inside(Grammar grammar, uint32_t maxlen, dict insidescores):
 	cdef pair[SmallChartItem, double] entry
 	cdef size_t i
 	cdef LexicalRule lexrule
-	for lexrule in grammar.lexical:
+	for lexrule in grammar.lexical[:grammar.numlex]:
 		agenda.setifbetter(SmallChartItem(lexrule.lhs, 1), lexrule.prob)
 	while not agenda.empty():
 		entry = agenda.pop()
@@ -233,8 +237,14 @@ cdef inline uint64_t insideconcat(uint64_t a, uint64_t b, ProbRule rule,
 
 
 def outsidelr(Grammar grammar, double [:, :] insidescores,
-		uint32_t maxlen, Label goal, double [:, :, :, :] outside):
-	"""Compute the outside SX simple LR estimate in top down fashion."""
+		uint32_t maxlen, Label goal, float [:, :, :, :] outside,
+		lengths=None):
+	"""Compute the outside SX simple LR estimate in top down fashion.
+
+	:param lengths: if given, only compute the estimates for sentences of
+		these lengths; i.e., the entries ``outside[:, length, lr, gaps]``
+		with ``length + lr + gaps`` in ``lengths``. The entries for different
+		sentence lengths do not depend on each other."""
 	cdef Item I
 	cdef ProbRule rule
 	cdef double x, insidescore, current, score
@@ -244,7 +254,7 @@ def outsidelr(Grammar grammar, double [:, :] insidescores,
 	cdef bint stopaddleft, stopaddright
 	agenda = PyAgenda()
 
-	for n in range(1, maxlen + 1):
+	for n in (range(1, maxlen + 1) if lengths is None else lengths):
 		agenda[new_Item(goal, n, 0, 0)] = 0.0
 		outside[goal, n, 0, 0] = 0.0
 	print("initialized")
@@ -265,7 +275,8 @@ def outsidelr(Grammar grammar, double [:, :] insidescores,
 				if score < outside[rule.rhs1, I.length, I.lr, I.gaps]:
 					agenda[new_Item(rule.rhs1, I.length, I.lr, I.gaps)
 							] = score
-					outside[rule.rhs1, I.length, I.lr, I.gaps] = score
+					outside[rule.rhs1, I.length, I.lr, I.gaps] = rounddown(
+							score)
 				i += 1
 				rule = grammar.bylhs[I.state][i]
 				continue
@@ -299,7 +310,8 @@ def outsidelr(Grammar grammar, double [:, :] insidescores,
 							if score < current:
 								agenda[new_Item(rule.rhs1, lenA, lr, ga)
 										] = score
-								outside[rule.rhs1, lenA, lr, ga] = score
+								outside[rule.rhs1, lenA, lr, ga] = rounddown(
+										score)
 
 			# X -> B A
 			addgaps = addright = 0
@@ -332,28 +344,109 @@ def outsidelr(Grammar grammar, double [:, :] insidescores,
 							if score < current:
 								agenda[new_Item(rule.rhs2, lenA, lr, ga)
 										] = score
-								outside[rule.rhs2, lenA, lr, ga] = score
+								outside[rule.rhs2, lenA, lr, ga] = rounddown(
+										score)
 			i += 1
 			rule = grammar.bylhs[I.state][i]
 		# end while rule.lhs == I.state:
 	# end while agenda:
 
 
-def getestimates(Grammar grammar, uint32_t maxlen, str rootlabel):
-	"""Compute table of outside SX simple LR estimates for a PLCFRS."""
+def getestimates(Grammar grammar, uint32_t maxlen, str rootlabel,
+		filename=None, numproc=1):
+	"""Compute table of outside SX simple LR estimates for a PLCFRS.
+
+	:param filename: if given, the table is stored in this ``.npy`` file,
+		and a memory-mapped array is returned; this avoids keeping the
+		table in memory.
+	:param numproc: the number of processes with which the estimates for
+		different sentence lengths are computed in parallel. ``None`` means
+		use all available CPUs. Without ``filename``, the processes write
+		to an array in shared memory.
+	:returns: an array with estimates in single precision, cf.
+		:py:func:`tosingle`."""
 	cdef Label goal = grammar.toid[rootlabel]
+	shape = (grammar.nonterminals, ) + 3 * (maxlen + 1, )
 	print("allocating outside matrix:",
-		(8 * grammar.nonterminals * (maxlen + 1) * (maxlen + 1)
+		(4 * grammar.nonterminals * (maxlen + 1) * (maxlen + 1)
 			* (maxlen + 1) / 1024 ** 2), 'MB')
 	insidescores = np.empty((grammar.nonterminals, (maxlen + 1)), dtype='d')
-	outside = np.empty((grammar.nonterminals, ) + 3 * (maxlen + 1, ), dtype='d')
 	insidescores[...] = np.NAN
-	outside[...] = np.inf
 	print("getting inside estimates")
 	simpleinside(grammar, maxlen, insidescores)
+	if filename is not None:
+		outside = np.lib.format.open_memmap(
+				filename, mode='w+', dtype=np.float32, shape=shape)
+		target = filename
+	elif numproc == 1:
+		outside = np.empty(shape, dtype=np.float32)
+	else:
+		target = multiprocessing.RawArray('f', int(np.prod(shape)))
+		outside = np.frombuffer(target, dtype=np.float32).reshape(shape)
+	outside[...] = np.inf
 	print("getting outside estimates")
-	outsidelr(grammar, insidescores, maxlen, goal, outside)
-	return outside
+	if numproc == 1:
+		outsidelr(grammar, insidescores, maxlen, goal, outside)
+	else:
+		if filename is not None:
+			outside.flush()
+		pool = multiprocessing.Pool(processes=numproc,
+				initializer=initoutsidelr,
+				initargs=(grammar, insidescores, maxlen, goal, target, shape))
+		try:
+			# longest sentences first, since these take the most time
+			pool.map(outsidelrworker, range(maxlen, 0, -1), chunksize=1)
+		finally:
+			pool.terminate()
+			pool.join()
+	if filename is None:
+		return outside
+	del outside  # flush to disk
+	return np.load(filename, mmap_mode='c')
+
+
+def initoutsidelr(grammar, insidescores, maxlen, goal, target, shape):
+	"""Set arguments for computing outside estimates in a worker process.
+
+	:param target: the filename of a ``.npy`` file, or an array in shared
+		memory, to which the estimates are written."""
+	global OUTSIDELRARGS
+	if isinstance(target, str):
+		outside = np.load(target, mmap_mode='r+')
+	else:
+		outside = np.frombuffer(target, dtype=np.float32).reshape(shape)
+	OUTSIDELRARGS = (grammar, insidescores, maxlen, goal, outside)
+
+
+def outsidelrworker(length):
+	"""Compute the outside estimates for one sentence length."""
+	grammar, insidescores, maxlen, goal, outside = OUTSIDELRARGS
+	outsidelr(grammar, insidescores, maxlen, goal, outside, (length, ))
+	if isinstance(outside, np.memmap):
+		outside.flush()
+
+
+def tosingle(outside):
+	"""Convert estimates to single precision, rounding towards -inf.
+
+	Since the estimates are negative log probabilities, rounding down ensures
+	that the estimates remain admissible; i.e., optimistic.
+
+	>>> x = np.array([0.1, 1.0, np.inf])
+	>>> bool((tosingle(x) <= x).all())
+	True"""
+	result = outside.astype(np.float32)
+	mask = result > outside
+	result[mask] = np.nextafter(result[mask], np.float32(-np.inf))
+	return result
+
+
+cdef inline float rounddown(double x):
+	"""Convert to single precision, rounding towards -inf; cf. tosingle()."""
+	cdef float result = <float>x
+	if result > x:
+		result = nextafter(result, -INFINITY)
+	return result
 
 
 cdef inline double getpcfgoutside(dict outsidescores,
@@ -410,7 +503,7 @@ cdef pcfginsidesx(Grammar grammar, uint32_t maxlen):
 	cdef double x
 	cdef list insidescores = [{} for _ in range(maxlen + 1)]
 	cdef LexicalRule lexrule
-	for lexrule in grammar.lexical:
+	for lexrule in grammar.lexical[:grammar.numlex]:
 		agenda.setifbetter(SmallChartItem(lexrule.lhs, 1), lexrule.prob)
 	while not agenda.empty():
 		entry = agenda.pop()
@@ -460,8 +553,8 @@ cdef pcfgoutsidesx(Grammar grammar, list insidescores, Label goal,
 	cdef double x, insidescore, current, score
 	cdef int state, left, right
 	cdef size_t i, sibsize
-	cdef double [:, :, :, :] outside = np.empty(
-			(grammar.nonterminals, maxlen + 1, maxlen + 1, 1), dtype='d')
+	cdef float [:, :, :, :] outside = np.empty(
+			(grammar.nonterminals, maxlen + 1, maxlen + 1, 1), dtype=np.float32)
 	outside[...] = np.inf
 
 	agenda = PyAgenda()
@@ -481,7 +574,7 @@ cdef pcfgoutsidesx(Grammar grammar, list insidescores, Label goal,
 				score = rule.prob + x
 				if score < outside[rule.rhs1, left, right, 0]:
 					agenda[(rule.rhs1, left, right)] = score
-					outside[rule.rhs1, left, right, 0] = score
+					outside[rule.rhs1, left, right, 0] = rounddown(score)
 				i += 1
 				rule = grammar.bylhs[state][i]
 				continue
@@ -493,7 +586,8 @@ cdef pcfgoutsidesx(Grammar grammar, list insidescores, Label goal,
 				current = outside[rule.rhs1, left, right + sibsize, 0]
 				if score < current:
 					agenda[(rule.rhs1, left, right + sibsize)] = score
-					outside[rule.rhs1, left, right + sibsize, 0] = score
+					outside[rule.rhs1, left, right + sibsize, 0] = rounddown(
+							score)
 
 			# item is on the right: X -> B A
 			for sibsize in range(1, maxlen - left - right):
@@ -502,7 +596,8 @@ cdef pcfgoutsidesx(Grammar grammar, list insidescores, Label goal,
 				current = outside[rule.rhs2, left + sibsize, right, 0]
 				if score < current:
 					agenda[(rule.rhs2, left + sibsize, right)] = score
-					outside[rule.rhs2, left + sibsize, right, 0] = score
+					outside[rule.rhs2, left + sibsize, right, 0] = rounddown(
+							score)
 
 			i += 1
 			rule = grammar.bylhs[state][i]
@@ -573,7 +668,8 @@ cdef pcfginsidesxrec(Grammar grammar, list insidescores, Label state,
 		return 0 if state == 0 else INFINITY
 	it = grammar.lexicallhs.find(state)
 	if span == 1 and it != grammar.lexicallhs.end():
-		score = min([lexrule.prob for lexrule in grammar.lexical
+		score = min([lexrule.prob for lexrule
+				in grammar.lexical[:grammar.numlex]
 				if lexrule.lhs == state])  # FIXME: slow
 	else:
 		score = INFINITY
@@ -711,7 +807,8 @@ cpdef testestimates(Grammar grammar, uint32_t maxlen, str rootlabel):
 	# 			exp(-insidescores[goal, a]))
 
 	print("getting outside")
-	outside = np.empty((grammar.nonterminals, ) + 3 * (maxlen + 1, ), dtype='d')
+	outside = np.empty((grammar.nonterminals, ) + 3 * (maxlen + 1, ),
+			dtype=np.float32)
 	outside[...] = np.inf
 	outsidelr(grammar, insidescores, maxlen, goal, outside)
 	# print(outside)
@@ -807,4 +904,4 @@ def test():
 	print('items avoided:', chart.numitems() - estchart.numitems())
 
 __all__ = ['Item', 'getestimates', 'getpcfgestimates', 'inside', 'outsidelr',
-		'simpleinside']
+		'simpleinside', 'tosingle']
@@ -9,18 +9,22 @@ distance, unlabeled dependencies), as well as facilities for error analysis.
 # pylint: disable=cell-var-from-loop
 import io
 import sys
+import multiprocessing
+from array import array
 from getopt import gnu_getopt, GetoptError
 from decimal import Decimal, InvalidOperation
 from collections import defaultdict, Counter  # == multiset
-from itertools import count, zip_longest
+from itertools import count, chain, zip_longest
 from . import grammar
 from .tree import Tree, DrawTree, isdisc, bitfanout
 from .treebank import READERS, dependencies, handlefunctions
 from .treetransforms import getbits
 from .treebanktransforms import functions
 from .treedist import treedist, newtreedist
+from .util import workerfunc, boundedimap
 
 SHORTUSAGE = 'Usage: discodop eval <gold> <parses> [param] [options]'
+WORKERPARAM = None  # evaluation parameters of a worker process
 
 HEADER = (
 		'   Sentence                 Matched   Brackets            Corr POS\n'
@@ -31,18 +35,26 @@ HEADER = (
 class Evaluator(object):
 	"""Incremental evaluator for syntactic trees."""
 
-	def __init__(self, param, keylen=8):
+	def __init__(self, param, keylen=8, compact=False):
 		"""Initialize evaluator object with given parameters.
 
 		:param param: a dictionary of parameters, as read by ``readparam``.
 		:param keylen: the length of the longest sentence ID, for padding
-			purposes."""
+			purposes.
+		:param compact: if True, collect scores with
+			:py:class:`CompactEvalAccumulator`, which uses less memory."""
 		self.param = param
 		self.keylen = keylen
-		self.acc = EvalAccumulator(param['DISC_ONLY'])
+		if compact:
+			self.acc = CompactEvalAccumulator(param['DISC_ONLY'],
+					breakdowns=param['LABELED'] and param['DEBUG'] != -1)
+		else:
+			self.acc = EvalAccumulator(param['DISC_ONLY'])
 		self.acc40 = None
 		if param['CUTOFF_LEN'] is not None:
-			self.acc40 = EvalAccumulator(param['DISC_ONLY'])
+			self.acc40 = (CompactEvalAccumulator(param['DISC_ONLY'],
+					breakdowns=False) if compact
+					else EvalAccumulator(param['DISC_ONLY']))
 		if param['DEBUG'] >= 1:
 			print('Parameters:')
 			for a in param:
@@ -58,7 +70,14 @@ class Evaluator(object):
 		:param gtree, ctree: ParentedTree objects (will be modified in-place)
 		:param gsent, csent: lists of tokens.
 		:returns: a ``TreePairResult`` object."""
-		treepair = TreePairResult(n, gtree, gsent, ctree, csent, self.param)
+		return self.addpair(
+				TreePairResult(n, gtree, gsent, ctree, csent, self.param))
+
+	def addpair(self, treepair):
+		"""Add a ``TreePairResult`` object to the evaluation.
+
+		Useful when the result was computed in another process; cf.
+		:py:meth:`add`."""
 		self.acc.add(treepair)
 		if (self.param['CUTOFF_LEN'] is not None
 				and treepair.lengpos <= self.param['CUTOFF_LEN']):
@@ -77,10 +96,10 @@ class Evaluator(object):
 		limit = 10 if self.param['DEBUG'] <= 0 else None
 		self.rulebreakdowns(limit)
 		self.catbreakdown(limit)
-		if self.acc.candfun:
+		if self.acc.hasfunctions():
 			self.funcbreakdown(limit)
 		try:
-			acc = accuracy(self.acc.goldpos, self.acc.candpos)
+			acc = self.acc.tagaccuracy()
 		except InvalidOperation:
 			pass
 		else:
@@ -90,33 +109,19 @@ class Evaluator(object):
 
 	def rulebreakdowns(self, limit=10):
 		"""Print breakdowns for the most frequent rule mismatches."""
-		acc = self.acc
-		# NB: unary nodes not handled properly
-		gmismatch = {(n, indices): rule
-					for n, indices, rule in acc.goldrule - acc.candrule}
-		wrong = Counter((rule, gmismatch[n, indices]) for n, indices, rule
-				in acc.candrule - acc.goldrule
-				if pyintbitcount(indices) > 1 and (n, indices) in gmismatch)
+		wrong, candonly, goldonly = self.acc.rulemismatches()
 		print('\n Rewrite rule mismatches (for given span)')
 		print('   count   cand / gold rules')
-		for (crule, grule), cnt in wrong.most_common(limit):
+		for (crule, grule), cnt in mostcommon(wrong, limit):
 			print(' %7d  %s' % (cnt, grammar.printrule(*crule)))
 			print(' %7s  %s' % (' ', grammar.printrule(*grule)))
-		gspans = {(n, indices) for n, indices, _ in acc.goldrule}
-		wrong = Counter(rule for n, indices, rule
-				in acc.candrule - acc.goldrule
-				if pyintbitcount(indices) > 1 and (n, indices) not in gspans)
 		print('\n Rewrite rules (span not in gold trees)')
 		print('   count   rule in candidate parses')
-		for crule, cnt in wrong.most_common(limit):
+		for crule, cnt in mostcommon(candonly, limit):
 			print(' %7d  %s' % (cnt, grammar.printrule(*crule)))
-		cspans = {(n, indices) for n, indices, _ in acc.candrule}
-		wrong = Counter(rule for n, indices, rule
-				in acc.goldrule - acc.candrule
-				if pyintbitcount(indices) > 1 and (n, indices) not in cspans)
 		print('\n Rewrite rules (span missing from candidate parses)')
 		print('   count   rule in gold standard set')
-		for grule, cnt in wrong.most_common(limit):
+		for grule, cnt in mostcommon(goldonly, limit):
 			print(' %7d  %s' % (cnt, grammar.printrule(*grule)))
 
 	def catbreakdown(self, limit=10):
@@ -125,12 +130,8 @@ class Evaluator(object):
 		print('\n Attachment errors (correct labeled bracketing, wrong parent)')
 		print('  label     cand     gold    count')
 		print(' ' + 33 * '_')
-		gmismatch = dict(acc.goldbatt - acc.candbatt)
-		wrong = Counter((label, cparent, gmismatch[n, label, indices])
-					for (n, label, indices), cparent
-					in acc.candbatt - acc.goldbatt
-					if (n, label, indices) in gmismatch)
-		for (cat, gparent, cparent), cnt in wrong.most_common(limit):
+		for (cat, gparent, cparent), cnt in mostcommon(acc.attachmenterrors(),
+				limit):
 			print('%s  %s  %s  %7d' % (cat.rjust(7), gparent.rjust(7),
 					cparent.rjust(7), cnt))
 		print('\n Category Statistics (%s categories / errors)' % (
@@ -138,28 +139,18 @@ class Evaluator(object):
 		print('  label  % gold  recall    prec.     F1',
 				'          cand gold       count')
 		print(' ' + 38 * '_' + 8 * ' ' + 24 * '_')
-		gmismatch = {(n, indices): label
-					for n, (label, indices) in acc.goldb - acc.candb}
-		wrong = Counter((label, gmismatch[n, indices])
-					for n, (label, indices) in acc.candb - acc.goldb
-					if (n, indices) in gmismatch)
-		freqcats = sorted(set(acc.goldbcat) | set(acc.candbcat),
-				key=lambda x: len(acc.goldbcat[x]), reverse=True)
+		counts = acc.catcounts()
+		numgold, _ = acc.numbrackets()
+		freqcats = sorted(counts, key=lambda x: (-counts[x][0], x))
 		for cat, mismatch in zip_longest(freqcats[:limit],
-				wrong.most_common(limit)):
+				mostcommon(acc.labelconfusions(), limit)):
 			if cat is None:
 				print(39 * ' ', end='')
 			else:
-				print('%s  %6.2f  %s  %s  %s' % (
-					cat.rjust(7),
-					100 * sum(acc.goldbcat[cat].values()) / len(acc.goldb),
-					nozerodiv(lambda: recall(
-							acc.goldbcat[cat], acc.candbcat[cat])),
-					nozerodiv(lambda: precision(
-							acc.goldbcat[cat], acc.candbcat[cat])),
-					nozerodiv(lambda: f_measure(
-							acc.goldbcat[cat], acc.candbcat[cat])),
-					), end='')
+				_, gold, cand, matched = counts[cat]
+				print('%s  %6.2f  %s  %s  %s' % ((cat.rjust(7),
+						100 * gold / numgold) + tuple(nozerodiv(lambda: a)
+							for a in prfscores(gold, cand, matched))), end='')
 			if mismatch is not None:
 				print('       %s %7d' % (' '.join((mismatch[0][0].rjust(8),
 						mismatch[0][1].ljust(8))), mismatch[1]), end='')
@@ -173,29 +164,19 @@ class Evaluator(object):
 		print('  func.  % gold  recall    prec.     F1',
 				'          cand gold       count')
 		print(' ' + 38 * '_' + 8 * ' ' + 24 * '_')
-		gmismatch = {(n, span): tag
-					for n, (span, tag) in acc.goldfun - acc.candfun}
-		wrong = Counter((tag, gmismatch[n, span])
-					for n, (span, tag) in acc.candfun - acc.goldfun
-					if (n, span) in gmismatch)
-		freqcats = sorted(set(acc.goldbfunc) | set(acc.candbfunc),
-				key=lambda x: len(acc.goldbfunc[x]), reverse=True)
+		counts = acc.funccounts()
+		numgold = acc.numfunctions()
+		freqcats = sorted(counts, key=lambda x: (-counts[x][0], x))
 		for cat, mismatch in zip_longest(freqcats[:limit],
-				wrong.most_common(limit)):
+				mostcommon(acc.functionconfusions(), limit)):
 			if cat is None:
 				print(39 * ' ', end='')
 			else:
-				print('%s  %s  %s  %s  %s' % (
-					cat.rjust(7),
-					nozerodiv(lambda: sum(acc.goldbfunc[cat].values())
-							/ len(acc.goldfun)),
-					nozerodiv(lambda: recall(
-							acc.goldbfunc[cat], acc.candbfunc[cat])),
-					nozerodiv(lambda: precision(
-							acc.goldbfunc[cat], acc.candbfunc[cat])),
-					nozerodiv(lambda: f_measure(
-							acc.goldbfunc[cat], acc.candbfunc[cat])),
-					), end='')
+				_, gold, cand, matched = counts[cat]
+				print('%s  %s  %s  %s  %s' % ((cat.rjust(7),
+						nozerodiv(lambda: gold / numgold)) + tuple(
+							nozerodiv(lambda: a)
+							for a in prfscores(gold, cand, matched))), end='')
 			if mismatch is not None:
 				print('       %s %7d' % (' '.join((mismatch[0][0].rjust(8),
 						mismatch[0][1].ljust(8))), mismatch[1]), end='')
@@ -209,26 +190,19 @@ class Evaluator(object):
 		print('\n    tag  % gold  recall   prec.      F1',
 				'          cand gold   count')
 		print(' ' + 38 * '_' + 12 * ' ' + 20 * '_')
-		tags = Counter(acc.goldpos)
-		wrong = Counter((c, g) for c, g
-				in zip(acc.candpos, acc.goldpos) if c != g)
-		for tag, mismatch in zip_longest(tags.most_common(limit),
-				wrong.most_common(limit)):
+		counts = acc.tagcounts()
+		tags = Counter({tag: gold for tag, (gold, _, _) in counts.items()
+				if gold})
+		numgold = sum(tags.values())
+		for tag, mismatch in zip_longest(mostcommon(tags, limit),
+				mostcommon(acc.tagconfusions(), limit)):
 			if tag is None:
 				print(''.rjust(40), end='')
 			else:
-				# only one tag per index may occur, but multiset is required by
-				# metrics
-				goldtag = Counter(n for n, t in enumerate(acc.goldpos)
-						if t == tag[0])
-				candtag = Counter(n for n, t in enumerate(acc.candpos)
-						if t == tag[0])
-				print('%s  %6.2f  %6.2f  %6.2f  %6.2f' % (
-						tag[0].rjust(7),
-						100 * len(goldtag) / len(acc.goldpos),
-						100 * recall(goldtag, candtag),
-						100 * precision(goldtag, candtag),
-						100 * f_measure(goldtag, candtag)), end='')
+				gold, cand, matched = counts[tag[0]]
+				print('%s  %6.2f  %6.2f  %6.2f  %6.2f' % ((tag[0].rjust(7),
+						100 * gold / numgold) + tuple(100 * a for a
+							in prfscores(gold, cand, matched))), end='')
 			if mismatch is not None:
 				print('       %s %7d' % (' '.join((mismatch[0][0].rjust(8),
 						mismatch[0][1].ljust(8))).rjust(12), mismatch[1]),
@@ -239,10 +213,8 @@ class Evaluator(object):
 		""":returns: a string with an overview of scores for all sentences."""
 		acc = self.acc
 		acc40 = self.acc40
-		discbrackets = sum(1 for _, (_, a) in acc.candb.elements()
-				if bitfanout(a) > 1)
-		gdiscbrackets = sum(1 for _, (_, a) in acc.goldb.elements()
-				if bitfanout(a) > 1)
+		gdiscbrackets, discbrackets = acc.numdiscbrackets()
+		goldbrackets, candbrackets = acc.numbrackets()
 
 		if acc.maxlenseen <= self.param['CUTOFF_LEN']:
 			msg = ['%s' % ' Summary (ALL) '.center(35, '_'),
@@ -250,41 +222,37 @@ class Evaluator(object):
 				'longest sentence:          %6d' % (acc.maxlenseen)]
 			if gdiscbrackets or discbrackets:
 				msg.extend(['gold brackets (disc.):     %6d (%d)' % (
-							len(acc.goldb), gdiscbrackets),
+							goldbrackets, gdiscbrackets),
 						'cand. brackets (disc.):    %6d (%d)' % (
-							len(acc.candb), discbrackets)])
+							candbrackets, discbrackets)])
 			else:
-				msg.extend(['gold brackets:             %6d' % len(acc.goldb),
-					'cand. brackets:            %6d' % len(acc.candb)])
+				msg.extend(['gold brackets:             %6d' % goldbrackets,
+					'cand. brackets:            %6d' % candbrackets])
 			msg.extend([
-					'labeled recall:            %s' % (
-						nozerodiv(lambda: recall(acc.goldb, acc.candb))),
-					'labeled precision:         %s' % (
-						nozerodiv(lambda: precision(acc.goldb, acc.candb))),
-					'labeled f-measure:         %s' % (
-						nozerodiv(lambda: f_measure(acc.goldb, acc.candb))),
-					'exact match:               %s' % (
-						nozerodiv(lambda: acc.exact / acc.sentcount))])
+					'labeled recall:            %s' % nozerodiv(acc.recall),
+					'labeled precision:         %s' % nozerodiv(
+						acc.precision),
+					'labeled f-measure:         %s' % nozerodiv(acc.fmeasure),
+					'exact match:               %s' % nozerodiv(
+						acc.exactmatch)])
 			if self.param['LA']:
 				msg.append('leaf-ancestor:             %s' % (
-						nozerodiv(lambda: mean(acc.lascores))))
+						nozerodiv(acc.leafancestor)))
 			if self.param['TED']:
 				msg.append('tree-dist (Dice micro avg) %s' % (
-						nozerodiv(lambda: 1 - acc.dicenoms / acc.dicedenoms)))
+						nozerodiv(acc.treedist)))
 			if self.param['DEP']:
 				msg.append('unlabeled dependencies:    %s' % (
-						nozerodiv(lambda: accuracy(acc.golddep, acc.canddep))))
-			if acc.candfun:
+						nozerodiv(acc.depaccuracy)))
+			if acc.hasfunctions():
 				msg.append('function tags:             %s' %
-						nozerodiv(lambda: f_measure(acc.goldfun, acc.candfun)))
+						nozerodiv(acc.funcscore))
 			msg.append('pos accuracy:              %s' % (
-					nozerodiv(lambda: accuracy(acc.goldpos, acc.candpos))))
+					nozerodiv(acc.tagaccuracy)))
 			return '\n'.join(msg)
 
-		discbrackets40 = sum(1 for _, (_, a) in acc40.candb.elements()
-				if bitfanout(a) > 1)
-		gdiscbrackets40 = sum(1 for _, (_, a) in acc40.goldb.elements()
-				if bitfanout(a) > 1)
+		gdiscbrackets40, discbrackets40 = acc40.numdiscbrackets()
+		goldbrackets40, candbrackets40 = acc40.numbrackets()
 		msg = ['%s <= %d ______ ALL' % (
 				' Summary '.center(27, '_'), self.param['CUTOFF_LEN']),
 			'number of sentences:       %6d     %6d' % (
@@ -292,47 +260,37 @@ class Evaluator(object):
 			'longest sentence:          %6d     %6d' % (
 					acc40.maxlenseen, acc.maxlenseen),
 			'gold brackets:             %6d     %6d' % (
-					len(acc40.goldb), len(acc.goldb)),
+					goldbrackets40, goldbrackets),
 			'cand. brackets:            %6d     %6d' % (
-					len(acc40.candb), len(acc.candb))]
+					candbrackets40, candbrackets)]
 		if gdiscbrackets or discbrackets:
 			msg.extend(['disc. gold brackets:       %6d     %6d' % (
 					gdiscbrackets40, gdiscbrackets),
 					'disc. cand. brackets:      %6d     %6d' % (
 					discbrackets40, discbrackets)])
 		msg.extend(['labeled recall:            %s     %s' % (
-				nozerodiv(lambda: recall(acc40.goldb, acc40.candb)),
-				nozerodiv(lambda: recall(acc.goldb, acc.candb))),
+				nozerodiv(acc40.recall), nozerodiv(acc.recall)),
 			'labeled precision:         %s     %s' % (
-				nozerodiv(lambda: precision(acc40.goldb, acc40.candb)),
-				nozerodiv(lambda: precision(acc.goldb, acc.candb))),
+				nozerodiv(acc40.precision), nozerodiv(acc.precision)),
 			'labeled f-measure:         %s     %s' % (
-				nozerodiv(lambda: f_measure(acc40.goldb, acc40.candb)),
-				nozerodiv(lambda: f_measure(acc.goldb, acc.candb))),
+				nozerodiv(acc40.fmeasure), nozerodiv(acc.fmeasure)),
 			'exact match:               %s     %s' % (
-				nozerodiv(lambda: acc40.exact / acc40.sentcount),
-				nozerodiv(lambda: acc.exact / acc.sentcount))])
+				nozerodiv(acc40.exactmatch), nozerodiv(acc.exactmatch))])
 		if self.param['LA']:
 			msg.append('leaf-ancestor:             %s     %s' % (
-				nozerodiv(lambda: mean(acc40.lascores)),
-				nozerodiv(lambda: mean(acc.lascores))))
+				nozerodiv(acc40.leafancestor), nozerodiv(acc.leafancestor)))
 		if self.param['TED']:
 			msg.append('tree-dist (Dice micro avg) %s     %s' % (
-				nozerodiv(lambda: (1 - acc40.dicenoms / acc40.dicedenoms)),
-				nozerodiv(lambda: (1 - acc.dicenoms / acc.dicedenoms))))
+				nozerodiv(acc40.treedist), nozerodiv(acc.treedist)))
 		if self.param['DEP']:
-			msg.append('unlabeled dependencies:    %s     %s  (%d / %d)' % (
-					nozerodiv(lambda: accuracy(acc40.golddep, acc40.canddep)),
-					nozerodiv(lambda: accuracy(acc.golddep, acc.canddep)),
-					sum(a[0] == a[1] for a in zip(acc.golddep, acc.canddep)),
-					len(acc.golddep)))
-		if acc.candfun:
+			msg.append('unlabeled dependencies:    %s     %s  (%d / %d)' % ((
+					nozerodiv(acc40.depaccuracy), nozerodiv(acc.depaccuracy))
+					+ acc.numdeps()))
+		if acc.hasfunctions():
 			msg.append('function tags:             %s     %s' % (
-					nozerodiv(lambda: f_measure(acc40.goldfun, acc40.candfun)),
-					nozerodiv(lambda: f_measure(acc.goldfun, acc.candfun))))
+					nozerodiv(acc40.funcscore), nozerodiv(acc.funcscore)))
 		msg.append('pos accuracy:              %s     %s' % (
-				nozerodiv(lambda: accuracy(acc40.goldpos, acc40.candpos)),
-				nozerodiv(lambda: accuracy(acc.goldpos, acc.candpos))))
+				nozerodiv(acc40.tagaccuracy), nozerodiv(acc.tagaccuracy)))
 		return '\n'.join(msg)
 
 
@@ -593,19 +551,402 @@ class EvalAccumulator(object):
 
 	def scores(self):
 		"""Return a dictionary with running scores for all added sentences."""
-		return dict(lr=nozerodiv(lambda: recall(self.goldb, self.candb)),
-				lp=nozerodiv(lambda: precision(self.goldb, self.candb)),
-				lf=nozerodiv(lambda: f_measure(self.goldb, self.candb)),
-				ex=nozerodiv(lambda: self.exact / self.sentcount),
-				tag=nozerodiv(lambda: accuracy(self.goldpos, self.candpos)),
-				fun=nozerodiv(lambda: f_measure(self.goldfun, self.candfun)))
+		return dict(lr=nozerodiv(self.recall), lp=nozerodiv(self.precision),
+				lf=nozerodiv(self.fmeasure), ex=nozerodiv(self.exactmatch),
+				tag=nozerodiv(self.tagaccuracy), fun=nozerodiv(self.funcscore))
+
+	def recall(self):
+		"""Labeled recall of brackets."""
+		return recall(self.goldb, self.candb)
+
+	def precision(self):
+		"""Labeled precision of brackets."""
+		return precision(self.goldb, self.candb)
+
+	def fmeasure(self):
+		"""Labeled F-measure of brackets."""
+		return f_measure(self.goldb, self.candb)
+
+	def exactmatch(self):
+		"""Fraction of sentences with exactly matching brackets."""
+		return self.exact / self.sentcount
+
+	def leafancestor(self):
+		"""Mean leaf-ancestor score."""
+		return mean(self.lascores)
+
+	def treedist(self):
+		"""Tree-edit distance score (Dice micro average)."""
+		return 1 - self.dicenoms / self.dicedenoms
+
+	def depaccuracy(self):
+		"""Unlabeled dependency accuracy."""
+		return accuracy(self.golddep, self.canddep)
+
+	def funcscore(self):
+		"""F-measure of function tags."""
+		return f_measure(self.goldfun, self.candfun)
+
+	def tagaccuracy(self):
+		"""POS tagging accuracy."""
+		return accuracy(self.goldpos, self.candpos)
+
+	def hasfunctions(self):
+		"""Return True if candidate trees have function tags."""
+		return bool(self.candfun)
+
+	def numbrackets(self):
+		"""Return the number of distinct gold and candidate brackets."""
+		return len(self.goldb), len(self.candb)
+
+	def numdiscbrackets(self):
+		"""Return the number of discontinuous gold and candidate brackets."""
+		return (sum(1 for _, (_, a) in self.goldb.elements()
+					if bitfanout(a) > 1),
+				sum(1 for _, (_, a) in self.candb.elements()
+					if bitfanout(a) > 1))
+
+	def numfunctions(self):
+		"""Return the number of distinct gold function tags."""
+		return len(self.goldfun)
+
+	def numdeps(self):
+		"""Return the number of correct dependencies and gold dependencies."""
+		return (sum(a == b for a, b in zip(self.golddep, self.canddep)),
+				len(self.golddep))
+
+	def catcounts(self):
+		"""Return counts of brackets per label.
+
+		:returns: a dictionary of the form ``{label: (distinct, gold, cand,
+			matched)}``, with the number of distinct gold brackets and the
+			number of gold, candidate, and matching brackets."""
+		return {cat: (len(self.goldbcat[cat]),
+					sum(self.goldbcat[cat].values()),
+					sum(self.candbcat[cat].values()),
+					sum((self.goldbcat[cat] & self.candbcat[cat]).values()))
+				for cat in set(self.goldbcat) | set(self.candbcat)}
+
+	def funccounts(self):
+		"""Return counts of function tags; cf. :py:meth:`catcounts`."""
+		return {tag: (len(self.goldbfunc[tag]),
+					sum(self.goldbfunc[tag].values()),
+					sum(self.candbfunc[tag].values()),
+					sum((self.goldbfunc[tag] & self.candbfunc[tag]).values()))
+				for tag in set(self.goldbfunc) | set(self.candbfunc)}
+
+	def tagcounts(self):
+		"""Return counts of POS tags.
+
+		:returns: a dictionary of the form ``{tag: (gold, cand, matched)}``."""
+		gold, cand = Counter(self.goldpos), Counter(self.candpos)
+		matched = Counter(a for a, b in zip(self.goldpos, self.candpos)
+				if a == b)
+		return {tag: (gold[tag], cand[tag], matched[tag])
+				for tag in set(gold) | set(cand)}
+
+	def rulemismatches(self):
+		"""Return Counters of rule mismatches.
+
+		:returns: a tuple with a Counter of ``(candrule, goldrule)`` pairs of
+			spans in both the gold and candidate trees, and Counters of rules
+			whose spans only appear in the candidate and the gold trees,
+			respectively."""
+		# NB: unary nodes not handled properly
+		gmismatch = {(n, indices): rule
+					for n, indices, rule in self.goldrule - self.candrule}
+		wrong = Counter((rule, gmismatch[n, indices]) for n, indices, rule
+				in self.candrule - self.goldrule
+				if pyintbitcount(indices) > 1 and (n, indices) in gmismatch)
+		gspans = {(n, indices) for n, indices, _ in self.goldrule}
+		candonly = Counter(rule for n, indices, rule
+				in self.candrule - self.goldrule
+				if pyintbitcount(indices) > 1 and (n, indices) not in gspans)
+		cspans = {(n, indices) for n, indices, _ in self.candrule}
+		goldonly = Counter(rule for n, indices, rule
+				in self.goldrule - self.candrule
+				if pyintbitcount(indices) > 1 and (n, indices) not in cspans)
+		return wrong, candonly, goldonly
+
+	def attachmenterrors(self):
+		"""Return a Counter of ``(label, cparent, gparent)`` tuples.
+
+		Counts correct labeled bracketings with a different parent."""
+		gmismatch = dict(self.goldbatt - self.candbatt)
+		return Counter((label, cparent, gmismatch[n, label, indices])
+					for (n, label, indices), cparent
+					in self.candbatt - self.goldbatt
+					if (n, label, indices) in gmismatch)
+
+	def labelconfusions(self):
+		"""Return a Counter of ``(candlabel, goldlabel)`` pairs.
+
+		Counts brackets with correct spans but a different label."""
+		gmismatch = {(n, indices): label
+					for n, (label, indices) in self.goldb - self.candb}
+		return Counter((label, gmismatch[n, indices])
+					for n, (label, indices) in self.candb - self.goldb
+					if (n, indices) in gmismatch)
+
+	def functionconfusions(self):
+		"""Return a Counter of ``(candtag, goldtag)`` pairs."""
+		gmismatch = {(n, span): tag
+					for n, (span, tag) in self.goldfun - self.candfun}
+		return Counter((tag, gmismatch[n, span])
+					for n, (span, tag) in self.candfun - self.goldfun
+					if (n, span) in gmismatch)
+
+	def tagconfusions(self):
+		"""Return a Counter of ``(candtag, goldtag)`` pairs."""
+		return Counter((c, g) for c, g
+				in zip(self.candpos, self.goldpos) if c != g)
+
+
+class CompactEvalAccumulator(EvalAccumulator):
+	"""Collect scores of evaluation as integer counts.
+
+	Instead of storing each bracket, the number of gold, candidate, and
+	matching brackets of each sentence is stored in arrays; the counts for the
+	breakdowns are aggregated per interned label. Gives the same scores as
+	``EvalAccumulator``, but memory usage does not grow with the number of
+	brackets, which makes it suitable for large corpora."""
+
+	def __init__(self, disconly=False, breakdowns=True):
+		""":param disconly: if True, only collect discontinuous bracketings.
+		:param breakdowns: if False, do not collect the counts needed for
+			breakdowns by rules, labels, and tags."""
+		self.disconly = disconly
+		self.breakdowns = breakdowns
+		self.maxlenseen = self.sentcount = self.exact = 0
+		self.dicenoms, self.dicedenoms = Decimal(0), Decimal(0)
+		self.lasum, self.lacount = Decimal(0), 0
+		# number of gold, candidate, and matching brackets per sentence
+		self.goldb, self.candb = array('L'), array('L')
+		self.matchb = array('L')
+		self.numgoldb = self.numcandb = 0  # distinct brackets
+		self.golddisc = self.canddisc = 0
+		self.goldfun = self.candfun = self.matchfun = self.numgoldfun = 0
+		self.goldpos = self.candpos = self.matchpos = 0
+		self.golddep = self.canddep = self.matchdep = 0
+		# counts per label (distinct gold, gold, cand, matched)
+		self.cats = LabelCounts(4)
+		self.funcs = LabelCounts(4)
+		self.tags = LabelCounts(3)  # gold, cand, matched
+		self.rulewrong, self.rulecand = Counter(), Counter()
+		self.rulegold = Counter()
+		self.attachments, self.labelconf = Counter(), Counter()
+		self.funcconf, self.tagconf = Counter(), Counter()
+
+	def add(self, pair):
+		"""Add scores from given TreePairResult object."""
+		if not self.disconly or pair.cbrack or pair.gbrack:
+			self.sentcount += 1
+			if pair.cbrack == pair.gbrack:
+				self.exact += 1
+		self.maxlenseen = max(self.maxlenseen, pair.lengpos)
+		matchb = pair.gbrack & pair.cbrack
+		self.goldb.append(sum(pair.gbrack.values()))
+		self.candb.append(sum(pair.cbrack.values()))
+		self.matchb.append(sum(matchb.values()))
+		self.numgoldb += len(pair.gbrack)
+		self.numcandb += len(pair.cbrack)
+		self.golddisc += sum(cnt for (_, a), cnt in pair.gbrack.items()
+				if bitfanout(a) > 1)
+		self.canddisc += sum(cnt for (_, a), cnt in pair.cbrack.items()
+				if bitfanout(a) > 1)
+		matchfun = pair.goldfun & pair.candfun
+		self.goldfun += sum(pair.goldfun.values())
+		self.candfun += sum(pair.candfun.values())
+		self.matchfun += sum(matchfun.values())
+		self.numgoldfun += len(pair.goldfun)
+		self.goldpos += len(pair.gpos)
+		self.candpos += len(pair.cpos)
+		self.matchpos += sum(a == b for a, b in zip(pair.gpos, pair.cpos))
+		if pair.lascore is not None:
+			self.lasum += pair.lascore
+			self.lacount += 1
+		if pair.ted is not None:
+			self.dicenoms += pair.ted
+			self.dicedenoms += pair.denom
+		if pair.gdep is not None:
+			self.golddep += len(pair.gdep)
+			self.canddep += len(pair.cdep)
+			self.matchdep += sum(a == b for a, b in zip(pair.gdep, pair.cdep))
+		if self.breakdowns:
+			self._addbreakdowns(pair, matchb, matchfun)
+
+	def _addbreakdowns(self, pair, matchb, matchfun):
+		"""Aggregate the counts for breakdowns of a single sentence."""
+		for (label, _), cnt in pair.gbrack.items():
+			self.cats.add(label, 0, 1)
+			self.cats.add(label, 1, cnt)
+		for (label, _), cnt in pair.cbrack.items():
+			self.cats.add(label, 2, cnt)
+		for (label, _), cnt in matchb.items():
+			self.cats.add(label, 3, cnt)
+		for (_, tag), cnt in pair.goldfun.items():
+			self.funcs.add(tag, 0, 1)
+			self.funcs.add(tag, 1, cnt)
+		for (_, tag), cnt in pair.candfun.items():
+			self.funcs.add(tag, 2, cnt)
+		for (_, tag), cnt in matchfun.items():
+			self.funcs.add(tag, 3, cnt)
+		for g, c in zip(pair.gpos, pair.cpos):
+			self.tags.add(g, 0)
+			self.tags.add(c, 1)
+			if g == c:
+				self.tags.add(g, 2)
+			else:
+				self.tagconf[c, g] += 1
+		# mismatches are determined per sentence; cf. EvalAccumulator
+		goldrule, candrule = pair.grule - pair.crule, pair.crule - pair.grule
+		gmismatch = {indices: rule for indices, rule in goldrule}
+		gspans = {indices for indices, _ in pair.grule}
+		cspans = {indices for indices, _ in pair.crule}
+		for indices, rule in candrule:
+			if pyintbitcount(indices) > 1:
+				if indices in gmismatch:
+					self.rulewrong[rule, gmismatch[indices]] += 1
+				if indices not in gspans:
+					self.rulecand[rule] += 1
+		for indices, rule in goldrule:
+			if pyintbitcount(indices) > 1 and indices not in cspans:
+				self.rulegold[rule] += 1
+		goldbatt, candbatt = set(pair.pgbrack), set(pair.pcbrack)
+		gmismatch = dict(goldbatt - candbatt)
+		self.attachments.update((label, cparent, gmismatch[label, indices])
+				for (label, indices), cparent in candbatt - goldbatt
+				if (label, indices) in gmismatch)
+		gmismatch = {indices: label
+				for label, indices in pair.gbrack - pair.cbrack}
+		self.labelconf.update((label, gmismatch[indices])
+				for label, indices in pair.cbrack - pair.gbrack
+				if indices in gmismatch)
+		gmismatch = {span: tag for span, tag in pair.goldfun - pair.candfun}
+		self.funcconf.update((tag, gmismatch[span])
+				for span, tag in pair.candfun - pair.goldfun
+				if span in gmismatch)
+
+	def recall(self):
+		"""Labeled recall of brackets."""
+		return prfscores(sum(self.goldb), sum(self.candb), sum(self.matchb))[0]
+
+	def precision(self):
+		"""Labeled precision of brackets."""
+		return prfscores(sum(self.goldb), sum(self.candb), sum(self.matchb))[1]
+
+	def fmeasure(self):
+		"""Labeled F-measure of brackets."""
+		return prfscores(sum(self.goldb), sum(self.candb), sum(self.matchb))[2]
+
+	def exactmatch(self):
+		"""Fraction of sentences with exactly matching brackets."""
+		return Decimal(self.exact) / self.sentcount
+
+	def leafancestor(self):
+		"""Mean leaf-ancestor score."""
+		if not self.lacount:
+			return Decimal('NaN')
+		return self.lasum / self.lacount
+
+	def depaccuracy(self):
+		"""Unlabeled dependency accuracy."""
+		if self.golddep != self.canddep:
+			raise ValueError('Sequences must have the same length.')
+		return Decimal(self.matchdep) / self.golddep
+
+	def funcscore(self):
+		"""F-measure of function tags."""
+		return prfscores(self.goldfun, self.candfun, self.matchfun)[2]
+
+	def tagaccuracy(self):
+		"""POS tagging accuracy."""
+		if self.goldpos != self.candpos:
+			raise ValueError('Sequences must have the same length.')
+		return Decimal(self.matchpos) / self.goldpos
+
+	def hasfunctions(self):
+		"""Return True if candidate trees have function tags."""
+		return self.candfun > 0
+
+	def numbrackets(self):
+		"""Return the number of distinct gold and candidate brackets."""
+		return self.numgoldb, self.numcandb
+
+	def numdiscbrackets(self):
+		"""Return the number of discontinuous gold and candidate brackets."""
+		return self.golddisc, self.canddisc
+
+	def numfunctions(self):
+		"""Return the number of distinct gold function tags."""
+		return self.numgoldfun
+
+	def numdeps(self):
+		"""Return the number of correct dependencies and gold dependencies."""
+		return self.matchdep, self.golddep
+
+	def catcounts(self):
+		"""Return counts of brackets per label; cf. EvalAccumulator."""
+		return self.cats.todict()
+
+	def funccounts(self):
+		"""Return counts of function tags; cf. EvalAccumulator."""
+		return self.funcs.todict()
+
+	def tagcounts(self):
+		"""Return counts of POS tags; cf. EvalAccumulator."""
+		return self.tags.todict()
+
+	def rulemismatches(self):
+		"""Return Counters of rule mismatches; cf. EvalAccumulator."""
+		return self.rulewrong, self.rulecand, self.rulegold
+
+	def attachmenterrors(self):
+		"""Return a Counter of ``(label, cparent, gparent)`` tuples."""
+		return self.attachments
+
+	def labelconfusions(self):
+		"""Return a Counter of ``(candlabel, goldlabel)`` pairs."""
+		return self.labelconf
+
+	def functionconfusions(self):
+		"""Return a Counter of ``(candtag, goldtag)`` pairs."""
+		return self.funcconf
+
+	def tagconfusions(self):
+		"""Return a Counter of ``(candtag, goldtag)`` pairs."""
+		return self.tagconf
+
+
+class LabelCounts(object):
+	"""Integer counts for a fixed number of fields of interned labels."""
+
+	def __init__(self, numfields):
+		self.labelids = {}
+		self.counts = [array('L') for _ in range(numfields)]
+
+	def add(self, label, field, cnt=1):
+		"""Add ``cnt`` to the given field of a label."""
+		try:
+			n = self.labelids[label]
+		except KeyError:
+			n = self.labelids[label] = len(self.labelids)
+			for a in self.counts:
+				a.append(0)
+		self.counts[field][n] += cnt
+
+	def todict(self):
+		"""Return a dictionary with a tuple of counts for each label."""
+		return {label: tuple(a[n] for a in self.counts)
+				for label, n in self.labelids.items()}
 
 
 def main():
 	"""Command line interface for evaluation."""
 	flags = {'help', 'verbose', 'debug', 'disconly', 'ted', 'la'}
 	options = {'goldenc=', 'parsesenc=', 'goldfmt=', 'parsesfmt=', 'fmt=',
-			'cutofflen=', 'headrules=', 'functions=', 'morphology='}
+			'cutofflen=', 'headrules=', 'functions=', 'morphology=',
+			'numproc='}
 	try:
 		opts, args = gnu_getopt(sys.argv[2:], 'h', flags | options)
 	except GetoptError as err:
@@ -641,21 +982,96 @@ def main():
 			functions=opts.get('--functions', 'remove'),
 			morphology=opts.get('--morphology'),
 			headrules=opts.get('--headrules'))
-	goldtrees, goldsents = gold.trees(), gold.sents()
-	candtrees, candsents = parses.trees(), parses.sents()
-	if not goldtrees:
-		raise ValueError('no trees in gold file')
-	if not candtrees:
+	numproc = int(opts.get('--numproc', 1))
+	if numproc > 1:
+		evaluator = parallelevaluate(gold, parses, param, numproc,
+				goldfile, parsesfile)
+	else:
+		goldtrees, goldsents = gold.trees(), gold.sents()
+		candtrees, candsents = parses.trees(), parses.sents()
+		if not goldtrees:
+			raise ValueError('no trees in gold file')
+		if not candtrees:
+			raise ValueError('no trees in parses file')
+		if param['DEBUG'] >= 2:
+			print('gold:', goldfile)
+			print('parses:', parsesfile, '\n')
+		evaluator = Evaluator(param, max(len(str(key)) for key in candtrees),
+				compact=True)
+		for n, ctree in candtrees.items():
+			evaluator.add(n, goldtrees[n], goldsents[n], ctree, candsents[n])
+	if param['LABELED'] and param['DEBUG'] != -1:
+		evaluator.breakdowns()
+	print(evaluator.summary())
+
+
+def parallelevaluate(gold, parses, param, numproc, goldfile='',
+		parsesfile='', chunksize=100):
+	"""Evaluate trees read incrementally, using multiple processes.
+
+	Gives the same results and output as evaluating the trees sequentially
+	with :py:meth:`Evaluator.add`; the trees are compared in worker processes
+	and added to the evaluation in the original order.
+
+	:param gold, parses: corpus reader objects.
+	:param numproc: the number of worker processes.
+	:returns: an :py:class:`Evaluator` object with the results."""
+	keylen = 8
+	if param['DEBUG'] >= 1:  # only used for printing
+		keylen = max((len(str(key)) for key, _ in parses._read_blocks()),
+				default=0)
+	pairs = alignedtrees(gold, parses)
+	try:
+		first = next(pairs)
+	except StopIteration:
 		raise ValueError('no trees in parses file')
 	if param['DEBUG'] >= 2:
 		print('gold:', goldfile)
 		print('parses:', parsesfile, '\n')
-	evaluator = Evaluator(param, max(len(str(key)) for key in candtrees))
-	for n, ctree in candtrees.items():
-		evaluator.add(n, goldtrees[n], goldsents[n], ctree, candsents[n])
-	if param['LABELED'] and param['DEBUG'] != -1:
-		evaluator.breakdowns()
-	print(evaluator.summary())
+	evaluator = Evaluator(param, keylen, compact=True)
+	pool = multiprocessing.Pool(processes=numproc, initializer=initworker,
+			initargs=(param, ))
+	try:
+		for treepair in boundedimap(pool, mpworker,
+				chain([first], pairs), chunksize):
+			evaluator.addpair(treepair)
+	finally:
+		pool.terminate()
+	return evaluator
+
+
+def alignedtrees(gold, parses):
+	"""Read pairs of gold and candidate trees incrementally.
+
+	:param gold, parses: corpus reader objects; the sentences in ``parses``
+		should occur in the same order as in ``gold``, but sentences of
+		``gold`` may be missing from ``parses``.
+	:returns: an iterator over tuples
+		``(key, goldtree, goldsent, candtree, candsent)``."""
+	golditems = gold.itertrees()
+	for n, citem in parses.itertrees():
+		for m, gitem in golditems:
+			if m == n:
+				break
+		else:
+			raise ValueError('sentence %r not in gold file, or not in the '
+					'same order as in the gold file.' % n)
+		yield n, gitem.tree, gitem.sent, citem.tree, citem.sent
+
+
+def initworker(param):
+	"""Set evaluation parameters for a worker process."""
+	global WORKERPARAM
+	WORKERPARAM = param
+
+
+@workerfunc
+def mpworker(args):
+	"""Compare a pair of trees in a worker process.
+
+	:param args: a tuple ``(key, goldtree, goldsent, candtree, candsent)``.
+	:returns: a ``TreePairResult`` object."""
+	return TreePairResult(*args, param=WORKERPARAM)
 
 
 def readparam(filename):
@@ -967,6 +1383,22 @@ def f_measure(reference, candidate, alpha=Decimal(0.5)):
 	return Decimal(1) / (alpha / p + (1 - alpha) / r)
 
 
+def prfscores(gold, cand, matched, alpha=Decimal(0.5)):
+	"""Get recall, precision, and F-measure from counts of brackets.
+
+	Gives the same results as :py:func:`recall`, :py:func:`precision`, and
+	:py:func:`f_measure` for multisets with ``gold`` and ``cand`` elements, of
+	which ``matched`` are in common.
+
+	>>> [float(a) for a in prfscores(4, 4, 3)]
+	[0.75, 0.75, 0.75]"""
+	r = Decimal(matched) / gold if gold else Decimal('NaN')
+	p = Decimal(matched) / cand if cand else Decimal('NaN')
+	if p == 0 or r == 0:
+		return r, p, Decimal('NaN')
+	return r, p, Decimal(1) / (alpha / p + (1 - alpha) / r)
+
+
 def accuracy(reference, candidate):
 	"""Compute fraction of equivalent pairs in two sequences.
 
@@ -1028,6 +1460,14 @@ def intervals(bitset):
 		yield start, prev
 
 
+def mostcommon(counter, limit=None):
+	"""Like ``Counter.most_common()``, but break ties by key.
+
+	>>> mostcommon(Counter('abcb'), 2)
+	[('b', 2), ('a', 1)]"""
+	return sorted(counter.items(), key=lambda x: (-x[1], x[0]))[:limit]
+
+
 def nozerodiv(func):
 	"""Return ``func()`` as 6-character string but catch zero division."""
 	try:
@@ -1075,9 +1515,11 @@ def pyintbitcount(a):
 	return cnt
 
 
-__all__ = ['Evaluator', 'TreePairResult', 'EvalAccumulator', 'main',
-		'readparam', 'transitiveclosure', 'alignsent', 'transform',
-		'parentedbracketings', 'bracketings', 'bracketing', 'strbracketings',
-		'leafancestorpaths', 'pathscore', 'leafancestor', 'treedisteval',
-		'recall', 'precision', 'f_measure', 'accuracy', 'harmean', 'mean',
-		'intervals', 'nozerodiv', 'editdistance', 'pyintbitcount']
+__all__ = ['Evaluator', 'TreePairResult', 'EvalAccumulator',
+		'CompactEvalAccumulator', 'LabelCounts', 'main', 'parallelevaluate',
+		'alignedtrees', 'readparam',
+		'transitiveclosure', 'alignsent', 'transform', 'parentedbracketings',
+		'bracketings', 'bracketing', 'strbracketings', 'leafancestorpaths',
+		'pathscore', 'leafancestor', 'treedisteval', 'recall', 'precision',
+		'f_measure', 'prfscores', 'accuracy', 'harmean', 'mean', 'intervals',
+		'mostcommon', 'nozerodiv', 'editdistance', 'pyintbitcount']
@@ -10,5 +10,17 @@ from .plcfrs cimport LCFRSChart, SmallLCFRSChart, FatLCFRSChart
 
 ctypedef sparse_hash_map[ItemNo, RankedEdgeAgenda[Prob]] agendas_type
 
+cdef class KBest:
+	cdef Chart chart
+	cdef agendas_type cand
+	cdef RankedEdgeSet explored
+	cdef vector[pair[RankedEdge, Prob]] rootedges  # all derivations of root
+	cdef vector[pair[RankedEdge, Prob]] derivs  # valid, complete derivations
+	cdef ItemNo root
+	cdef int k1
+	cdef bint exhausted
+	cdef int extend(self, int k) except -1
+
+cdef KBest getkbest(Chart chart, int k)
 cdef string getderiv(ItemNo v, RankedEdge ej, Chart chart)
 cdef collectitems(ItemNo v, RankedEdge& ej, Chart chart, itemset)
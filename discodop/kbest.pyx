@@ -134,13 +134,12 @@ cdef inline Prob getprob(Chart chart, ItemNo v, RankedEdge& ej) except -1:
 	return prob
 
 
-cdef int explorederivation(ItemNo v, RankedEdge& ej, Chart chart,
-		RankedEdgeSet& explored, int depthlimit) except -2:
+cdef int explorederivation(ItemNo v, RankedEdge& ej, KBest kbest,
+		int depthlimit) except -2:
 	"""Traverse derivation to ensure all 1-best RankedEdges are present.
 
 	:returns: True when ``ej`` is a valid, complete derivation."""
-	cdef pair[RankedEdge, Prob] entry
-	cdef RankedEdgeAgenda[Prob] tmp
+	cdef Chart chart = kbest.chart
 	if depthlimit <= 0:  # to prevent cycles
 		return False
 	if ej.edge.rule is NULL:
@@ -150,30 +149,26 @@ cdef int explorederivation(ItemNo v, RankedEdge& ej, Chart chart,
 		if not chart.rankededges[leftitem].size():
 			assert ej.left == 0, '%d-best edge for %s of left item missing' % (
 						ej.left, chart.itemstr(v))
-			tmp = getcandidates(chart, leftitem, 1)
-			if tmp.size() < 1:
+			lazykthbest(leftitem, 1, kbest.k1, kbest.cand, chart,
+					kbest.explored, MAX_DEPTH)
+			if chart.rankededges[leftitem].size() < 1:
 				abort()
-			entry = tmp.pop()
-			chart.rankededges[leftitem].push_back(entry)
-			explored.insert(entry.first)
 		if not explorederivation(leftitem,
 				chart.rankededges[leftitem][ej.left].first,
-				chart, explored, depthlimit - 1):
+				kbest, depthlimit - 1):
 			return False
 	if ej.right != -1:
 		rightitem = chart.right(v, ej)
 		if not chart.rankededges[rightitem].size():
 			assert ej.right == 0, (('%d-best edge for right child '
 					'of %s missing') % (ej.right, chart.itemstr(v)))
-			tmp = getcandidates(chart, rightitem, 1)
-			if tmp.size() < 1:
+			lazykthbest(rightitem, 1, kbest.k1, kbest.cand, chart,
+					kbest.explored, MAX_DEPTH)
+			if chart.rankededges[rightitem].size() < 1:
 				abort()
-			entry = tmp.pop()
-			chart.rankededges[rightitem].push_back(entry)
-			explored.insert(entry.first)
 		return explorederivation(rightitem,
 				chart.rankededges[rightitem][ej.right].first,
-				chart, explored, depthlimit - 1)
+				kbest, depthlimit - 1)
 	return True
 
 
@@ -234,36 +229,126 @@ cdef collectitems(ItemNo v, RankedEdge& ej, Chart chart, itemset):
 		collectitems(rightitem, ej1, chart, itemset)
 
 
+cdef class KBest:
+	"""The state of an incremental enumeration of k-best derivations.
+
+	Kept with the chart, so that the derivations explored for one purpose,
+	e.g., pruning, are reused for another, e.g., disambiguation, instead of
+	starting over. The valid, complete derivations explored so far are stored
+	in ``chart.rankededges[chart.root()]``; cf. :py:func:`getkbest`."""
+
+	def __init__(self, Chart chart, int k):
+		"""Prepare the enumeration of at most ``k`` derivations of chart.
+
+		:param k: the maximum number of derivations that will be
+			enumerated; determines the number of candidates kept for each
+			item."""
+		self.chart = chart
+		self.root = chart.root()
+		self.k1 = k
+		self.exhausted = False
+		chart.rankededges.clear()
+		chart.rankededges.resize(chart.parseforest.size())
+		chart.numkbest = 0
+
+	cdef int extend(self, int k) except -1:
+		"""Explore derivations until ``k`` valid derivations are available.
+
+		:returns: the number of valid derivations; less than ``k`` when the
+			derivations of the chart are exhausted."""
+		cdef pair[RankedEdge, Prob] entry
+		cdef size_t n, m, i
+		# explore with all derivations of root in place, including the ones
+		# that explorederivation() rejects.
+		self.chart.rankededges[self.root].swap(self.rootedges)
+		while <int>self.derivs.size() < k and not self.exhausted:
+			n = self.chart.rankededges[self.root].size()
+			lazykthbest(self.root, n + k - self.derivs.size(), self.k1,
+					self.cand, self.chart, self.explored, MAX_DEPTH)
+			m = self.chart.rankededges[self.root].size()
+			self.exhausted = m < n + k - self.derivs.size()
+			for i in range(n, m):
+				entry = self.chart.rankededges[self.root][i]
+				if explorederivation(self.root, entry.first, self, MAX_DEPTH):
+					self.derivs.push_back(entry)
+		self.chart.rankededges[self.root].swap(self.rootedges)
+		# chart.rankededges[root] may have been truncated or filtered by
+		# others; keep the part that is known to be as enumerated.
+		n = min(self.chart.numkbest,
+				self.chart.rankededges[self.root].size())
+		if n < self.chart.rankededges[self.root].size():
+			self.chart.rankededges[self.root].resize(n)
+		for i in range(n, self.derivs.size()):
+			self.chart.rankededges[self.root].push_back(self.derivs[i])
+		self.chart.numkbest = self.derivs.size()
+		return self.derivs.size()
+
+	def itemset(self, int n):
+		"""Return the set of item numbers in the *n*-th derivation."""
+		result = set()
+		collectitems(self.root, self.derivs[n].first, self.chart, result)
+		return result
+
+
+cdef KBest getkbest(Chart chart, int k):
+	"""Return the state of k-best enumeration for ``chart``.
+
+	The existing state is reused if it allows enumerating ``k``
+	derivations."""
+	cdef KBest kbest = chart.kbest
+	if chart.root() not in chart:
+		raise ValueError('kbest: no complete derivation in chart')
+	if (kbest is None or kbest.k1 < k
+			or chart.rankededges.size() != chart.parseforest.size()):
+		kbest = KBest(chart, k)
+		chart.kbest = kbest
+	return kbest
+
+
 def lazykbest(Chart chart, int k, bint derivs=True):
 	"""Wrapper function to run ``lazykthbest``.
 
 	Produces the ranked chart, as well as derivations as strings (when
 	``derivs`` is True). ``chart.parseforest`` should be a monotone hypergraph;
 	should be acyclic unless probabilities resolve the cycles (maybe nonzero
-	weights for unary productions are sufficient?).
+	weights for unary productions are sufficient?). Derivations explored by
+	earlier calls on the same chart are reused.
 
 	:param k: the number of derivations to enumerate."""
-	cdef agendas_type cand
-	cdef RankedEdgeSet explored
+	cdef KBest kbest = getkbest(chart, k)
+	cdef ItemNo root = kbest.root
 	cdef pair[RankedEdge, Prob] entry
-	cdef vector[pair[RankedEdge, Prob]] tmp
-	cdef ItemNo root = chart.root()
-	cdef int n = 0
-	if root not in chart:
-		raise ValueError('kbest: no complete derivation in chart')
-	chart.rankededges.clear()
-	chart.rankededges.resize(chart.parseforest.size())
-	lazykthbest(root, k, k, cand, chart, explored, MAX_DEPTH)
-	for entry in chart.rankededges[root]:
-		if explorederivation(root, entry.first, chart, explored, MAX_DEPTH):
-			tmp.push_back(entry)
-		n += 1
-		if n >= k:
-			break
-	chart.rankededges[root] = tmp
+	kbest.extend(k)
+	while <int>chart.rankededges[root].size() > k:
+		chart.rankededges[root].pop_back()
+	chart.numkbest = min(chart.numkbest, chart.rankededges[root].size())
 	if derivs:
 		return [(getderiv(root, entry.first, chart).decode('utf8'),
 				entry.second) for entry in chart.rankededges[root]]
 	return None
 
-__all__ = ['lazykbest']
+
+def iterkbest(Chart chart, int k, bint items=False):
+	"""Lazily enumerate the *k*-best derivations of a chart, best first.
+
+	Derivations are only explored when requested, so a consumer that stops
+	early does not pay for the rest. The explored derivations are kept with
+	the chart, and reused by later calls, e.g., of :py:func:`lazykbest`.
+
+	:param k: the maximum number of derivations to enumerate.
+	:param items: whether to include the set of item numbers in each
+		derivation.
+	:yields: tuples ``(n, prob)``, or ``(n, prob, itemset)`` if ``items`` is
+		True, where ``n`` is the index of the derivation in
+		``chart.rankededges[chart.root()]``."""
+	cdef KBest kbest = getkbest(chart, k)
+	cdef int n
+	for n in range(k):
+		if kbest.extend(n + 1) <= n:
+			break
+		if items:
+			yield n, kbest.derivs[n].second, kbest.itemset(n)
+		else:
+			yield n, kbest.derivs[n].second
+
+__all__ = ['KBest', 'lazykbest', 'iterkbest']
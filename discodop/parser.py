@@ -8,18 +8,24 @@ import sys
 import gzip
 import json
 import time
+import sqlite3
+import hashlib
 import logging
+import threading
 import traceback
+import socketserver
 import multiprocessing
 from math import exp, log
 from heapq import nlargest
+from bisect import bisect_left, bisect_right
 from getopt import gnu_getopt, GetoptError
 from operator import itemgetter
+from collections import OrderedDict
 import pickle
 import numpy as np
 from . import plcfrs, pcfg, disambiguation
 from . import grammar, treetransforms, treebanktransforms
-from .containers import Grammar, Vocabulary, Ctrees
+from .containers import Grammar, Vocabulary, Ctrees, ChartPool
 from .coarsetofine import prunechart
 from .tree import ParentedTree, escape, ptbescape
 from .eval import alignsent
@@ -28,13 +34,15 @@ from .treebank import writetree, handlefunctions
 from .heads import saveheads, readheadrules, applyheadrules
 from .punctuation import punctprune, applypunct
 from .functiontags import applyfunctionclassifier
-from .util import workerfunc, openread
+from .util import workerfunc, openread, boundedimap, scheduledimap, \
+		utilization
 from .treetransforms import binarizetree, binarize, splitdiscnodes
 from .grammar import UniqueIDs
 
 SHORTUSAGE = '''
 usage: discodop parser [options] <grammar/> [input [output]]
-or:    discodop parser --simple [options] <rules> <lexicon> [input [output]]'''
+or:    discodop parser --simple [options] <rules> <lexicon> [input [output]]
+or:    discodop parser --serve [--socket=<path>] [options] <grammar/>'''
 
 DEFAULTS = dict(
 	# two-level keys:
@@ -113,6 +121,13 @@ DEFAULTSTAGE = dict(
 		mcplabels=None,  # optionally, set of labels to optimize for with mcp
 		beam_beta=1.0,  # beam pruning factor, between 0 and 1; 1 to disable.
 		beam_delta=40,  # maximum span length to which beam_beta is applied
+		# per-sentence budgets; when exceeded, parsing with this stage is
+		# aborted, and the result of the last successful stage is used.
+		timeout=0,  # maximum wall clock time in seconds; 0 to disable.
+		maxitems=0,  # maximum number of chart items; 0 to disable.
+		maxagenda=0,  # maximum agenda size (plcfrs only); 0 to disable.
+		numthreads=1,  # threads to fill the cells of a span (pcfg only)
+		cky='grammarloop',  # pcfg only; choices: grammarloop, rulematrix
 		# deprecated options
 		kbest=True, sample=False, binarized=True,
 		iterate=False, complement=False,
@@ -152,10 +167,19 @@ class Parser(object):
 		:py:func:`parser.readparam()`.
 	:param funcclassifier: optionally, a function tag classifier trained by
 		:py:func:`functiontags.trainfunctionclassifier`.
+	:param cache: optionally, a :py:class:`ParseCache` object; results for
+		sentences that have been parsed before are taken from it.
+
+	Charts are obtained from and returned to ``self.chartpool``, a
+	:py:class:`discodop.containers.ChartPool`, so that their memory is
+	reused across sentences.
 	"""
 
-	def __init__(self, prm, funcclassifier=None, loadtrees=False):
+	def __init__(self, prm, funcclassifier=None, loadtrees=False,
+			cache=None):
 		self.prm = prm
+		self.cache = cache
+		self.chartpool = ChartPool()
 		self.stages = prm.stages
 		self.transformations = prm.transformations
 		self.binarization = prm.binarization
@@ -177,6 +201,15 @@ class Parser(object):
 					model = stage.estimator
 			if stage.mode != 'mc-rerank':
 				stage.grammar.switch(model, logprob=True)
+			stage.rulematrix = None
+			if stage.mode == 'pcfg' and stage.cky == 'rulematrix':
+				# the rule matrix only applies to the dense chart
+				if stage.grammar.nonterminals < 20000:
+					stage.rulematrix = pcfg.RuleMatrix(stage.grammar)
+				else:
+					logging.warning("%s: cky='rulematrix' ignored; only "
+							'applies with less than 20,000 non-terminals.',
+							stage.name)
 			if prm.verbosity >= 3:
 				print(stage.name)
 				print(stage.grammar)
@@ -243,6 +276,18 @@ class Parser(object):
 		"""Parse a sentence and perform postprocessing.
 
 		Yields a dictionary from parse trees to probabilities for each stage.
+		When a stage fails or exceeds its budget (cf. the stage parameters
+		``timeout``, ``maxitems``, ``maxagenda``), the result of the last
+		successful stage or a dummy parse is returned instead, and the key
+		``fallback`` of the result describes the reason; otherwise it is None.
+		The key ``metrics`` of the result is a dictionary with the CPU time in
+		seconds spent on each step (``prune``, ``parse``, ``kbest``,
+		``marginalize``, ``postprocess``, ``total``), whether the result was
+		taken from the cache (``cached``; in that case ``total`` and
+		``elapsedtime`` are the time of the lookup), and, when available, the
+		number of chart ``items`` and ``edges``, the number of items in the
+		pruning ``whitelist``, and the memory used by the chart
+		(``chartbytes``).
 
 		:param sent: a sequence of tokens.
 		:param tags: optionally, a list of POS tags as strings to be given
@@ -255,6 +300,63 @@ class Parser(object):
 			For example, ``('NP', [0, 1, 2])``.
 		:param block: optionally, a list of tuples ``(label, indices)``;
 			these labeled spans will be pruned."""
+		state = self._prepare(sent, tags, root, goldtree, require, block)
+		if state.cached is not None:
+			for result in state.cached:
+				yield result
+			return
+		# parse with each coarse-to-fine stage
+		try:
+			for n, stage in enumerate(self.stages):
+				result = self._parsestage(n, stage, state)
+				state.results.append(result)
+				yield result
+		finally:
+			self._finish(state)
+
+	def parsebatch(self, sents, tags=None, root=None, require=None,
+			block=None):
+		"""Parse a batch of sentences, one stage at a time.
+
+		All sentences are parsed with a stage before moving on to the next
+		stage, in order of length, such that the grammar of each stage and
+		allocations for sentences of similar length can be reused.
+
+		:param sents: a sequence of sentences, each a sequence of tokens.
+		:param tags: optionally, a sequence with for each sentence a list of
+			POS tags or None.
+		:param require, block: optionally, sequences with for each sentence
+			a list of constraints; cf. :py:meth:`parse`.
+		:returns: a generator yielding for each sentence, in the original
+			order, the list of results for each stage as yielded by
+			:py:meth:`parse`."""
+		states = [self._prepare(sent, tags[n] if tags else None, root, None,
+				require[n] if require else (), block[n] if block else ())
+				for n, sent in enumerate(sents)]
+		pending = sorted((state for state in states if state.cached is None),
+				key=lambda state: len(state.sent))
+		try:
+			for n, stage in enumerate(self.stages):
+				for state in pending:
+					state.results.append(self._parsestage(n, stage, state))
+				# release charts not needed for pruning by remaining stages
+				needed = {a.prune for a in self.stages[n + 1:]}
+				for state in pending:
+					for name in list(state.charts):
+						if name not in needed:
+							self.chartpool.release(state.charts.pop(name))
+			for state in states:
+				if state.cached is not None:
+					yield state.cached
+				else:
+					self._finish(state)
+					yield state.results
+		finally:  # also when parsing fails or the generator is closed
+			for state in pending:
+				self._finish(state)
+
+	def _prepare(self, sent, tags, root, goldtree, require, block):
+		"""Preprocess a sentence and return the state for parsing it."""
 		if 'PUNCT-PRUNE' in (self.transformations or ()):
 			origsent = sent[:]
 			punctprune(None, sent)
@@ -272,6 +374,18 @@ class Parser(object):
 					self.postagging.lexicon, self.postagging.sigs))
 		if tags is not None:
 			tags = list(tags)
+		key = cached = None
+		if self.cache is not None and goldtree is None:
+			begin = time.clock()
+			key = self.cache.key(sent, tags, root, require, block)
+			cached = self.cache.get(key)
+			if cached is not None:
+				elapsedtime = time.clock() - begin
+				for result in cached:
+					result.elapsedtime = elapsedtime
+					result.metrics = dict.fromkeys(('prune', 'parse',
+							'kbest', 'marginalize', 'postprocess'), 0.0)
+					result.metrics.update(total=elapsedtime, cached=True)
 
 		if goldtree is not None:
 			# reproduce preprocessing so that gold items can be counted
@@ -284,208 +398,273 @@ class Parser(object):
 					self.relationalrealizational)
 			treetransforms.addfanoutmarkers(goldtree)
 
-		charts = {}  # stage.name => chart
-		prevparsetrees = {}  # stage.name => parsetrees
-		chart = lastsuccessfulparse = None
-		totalgolditems = 0
-		# parse with each coarse-to-fine stage
-		for n, stage in enumerate(self.stages):
-			begin = time.clock()
-			noparse = False
-			parsetrees = fragments = None
-			golditems = 0
-			msg = '%s:\t' % stage.name.upper()
-			model = 'default'
-			if stage.dop:
-				if stage.objective == 'shortest':
-					model = 'shortest'
-				elif stage.estimator != 'rfe':
-					model = stage.estimator
-			if stage.mode != 'mc-rerank':
-				stage.grammar.switch(model, logprob=True)
+		return DictObj(sent=sent, xsent=xsent, tags=tags, root=root,
+				goldtree=goldtree, require=require, block=block,
+				key=key, cached=cached, results=[],
+				charts={},  # stage.name => chart
+				prevparsetrees={},  # stage.name => parsetrees
+				lastsuccessfulparse=None, totalgolditems=0)
 
-			# do parsing; if CTF pruning enabled, require parent stage to
-			# be successful.
-			splitprune = False
-			if sent and (not stage.prune or charts[stage.prune]):
-				prevn = 0
-				if stage.prune:
-					prevn = [a.name for a in self.stages].index(stage.prune)
-					if not stage.split and self.stages[prevn].split:
-						splitprune = True
-				tree = goldtree
-				if goldtree is not None and self.stages[prevn].split:
-					tree = treetransforms.splitdiscnodes(
-							goldtree.copy(True), self.stages[prevn].markorigin)
-				if n > 0 and stage.prune and stage.mode not in (
-						'dop-rerank', 'mc-rerank'):
-					beginprune = time.clock()
-					whitelist, msg1 = prunechart(
-							charts[stage.prune], stage.grammar, stage.k,
-							splitprune, self.stages[prevn].markorigin,
-							stage.mode.startswith('pcfg'),
-							set(require or ()), set(block or ()))
-					msg += '%s; %gs\n\t' % (msg1, time.clock() - beginprune)
-				else:
-					whitelist = None
-				if not sent:
-					pass
-				elif stage.mode == 'pcfg':
-					chart, msg1 = pcfg.parse(
-							sent, stage.grammar, tags=tags, start=root,
-							whitelist=whitelist if stage.prune else None,
-							beam_beta=-log(stage.beam_beta),
-							beam_delta=stage.beam_delta,
-							itemsestimate=estimateitems(
-								sent, stage.prune, stage.mode, stage.dop),
-							postagging=self.postagging)
-				elif stage.mode == 'plcfrs':
-					chart, msg1 = plcfrs.parse(
-							sent, stage.grammar, tags=tags, start=root,
-							exhaustive=stage.dop or (
-								n + 1 != len(self.stages)
-								and self.stages[n + 1].prune),
-							whitelist=whitelist,
-							splitprune=splitprune,
-							markorigin=self.stages[prevn].markorigin,
-							estimates=(stage.estimates, stage.outside)
-								if stage.estimates in ('SX', 'SXlrgaps')
-								else None,
-							beam_beta=-log(stage.beam_beta),
-							beam_delta=stage.beam_delta,
-							itemsestimate=estimateitems(
-								sent, stage.prune, stage.mode, stage.dop),
-							postagging=self.postagging)
-				elif stage.mode == 'dop-rerank':
-					if prevparsetrees[stage.prune]:
-						parsetrees, msg1 = disambiguation.doprerank(
-								prevparsetrees[stage.prune], sent, stage.k,
-								self.stages[prevn].grammar, stage.grammar)
-				elif stage.mode == 'mc-rerank':
-					if prevparsetrees[stage.prune]:
-						parsetrees, msg1 = disambiguation.mcrerank(
-								prevparsetrees[stage.prune], sent, stage.k,
-								stage.grammar.trees1, stage.grammar.vocab)
-				else:
-					raise ValueError('unknown mode specified: %s' % stage.mode)
-				if n > 0 and stage.prune and stage.mode not in (
-						'dop-rerank', 'mc-rerank') and goldtree is not None:
-					# count number of gold bracketings in pruned chart.
-					for node in tree.subtrees():
-						# test whether node is part of *whitelist*
-						if chart.itemid(node.label, node.leaves(), whitelist):
-							fanout = re.search('_([0-9]+)$',
-									node.label)
-							golditems += (int(fanout.group(1))
-									if fanout and not stage.split
-									else 1)
-					msg1 += (';\n\t%d/%d gold items remain after '
-							'pruning' % (golditems, totalgolditems))
-				msg += '%s\n\t' % msg1
-				if (n > 0 and stage.prune and not chart and not noparse
-						and stage.split == self.stages[prevn].split):
-					logging.error('ERROR: expected successful parse;\n'
-							'sent: %s\nstage %d: %s',
-							' '.join(sent), n, stage.name)
-					# raise ValueError('ERROR: expected successful parse. '
-					# 		'sent %s, %s.' % (nsent, stage.name))
-			numitems = chart.numitems() if hasattr(chart, 'numitems') else 0
-
-			if self.verbosity >= 3 and chart:
-				print('sent: %s\nstage: %s' % (' '.join(sent), stage.name))
-			if self.verbosity >= 4:
-				print('chart:\n%s' % chart)
-			# do disambiguation of resulting parse forest
-			if (sent and chart and stage.mode not in ('dop-rerank', 'mc-rerank')
-					and not (self.relationalrealizational and stage.split)):
-				begindisamb = time.clock()
-				disambiguation.getderivations(
-						chart, stage.m,
-						derivstrings=stage.dop not in ('doubledop', 'dop1')
-								or stage.objective == 'mcp'
-								or self.verbosity >= 3)
-				if self.verbosity >= 3:
-					print('%d-best derivations:\n%s' % (
-						min(stage.m, 100),
-						'\n'.join('%d. %s %s' % (n + 1,
-							('subtrees=%d' % abs(int(prob / log(0.5))))
-							if stage.objective == 'shortest'
-							else ('p=%g' % exp(-prob)), deriv)
-						for n, (deriv, prob) in enumerate(
-							chart.derivations[:100]))))
-					print('sum of probabilities: %g\n' % sum(exp(-prob)
-							for _, prob in chart.derivations[:100]))
-				if stage.objective == 'shortest':
-					stage.grammar.switch('default'
-							if stage.estimator == 'rfe'
-							else stage.estimator, True)
-				parsetrees, msg1 = disambiguation.marginalize(
-						stage.objective if stage.dop else 'mpd',
-						chart, sent=sent, tags=tags,
-						k=stage.m, sldop_n=stage.sldop_n,
-						mcplambda=stage.mcplambda,
-						mcplabels=stage.mcplabels,
-						ostag=stage.dop == 'ostag',
-						require=set(require or ()),
-						block=set(block or ()))
-				msg += 'disambiguation: %s, %gs\n\t' % (
-						msg1, time.clock() - begindisamb)
-				if self.verbosity >= 3:
-					besttrees = nlargest(
-							100, parsetrees, key=itemgetter(1))
-					print('100-best parse trees:\n%s' % '\n'.join(
-							'%d. %s %s' % (n + 1, probstr(prob), treestr)
-							for n, (treestr, prob, _)
-							in enumerate(besttrees)))
-					print('sum of probabilities: %g\n' %
-							sum((prob[1]
-								if isinstance(prob, tuple) else prob)
-								for _, prob, _ in besttrees))
-				if not stage.prune and tree is not None:
-					totalgolditems = sum(1 for node in tree.subtrees())
-					golditems = sum(
-							1 for node in tree.subtrees()
-							if chart.itemid(node.label, node.leaves()))
-					msg += ('%d/%d gold items in derivations\n\t' % (
-							golditems, totalgolditems))
-			if stage.name in (stage.prune for stage in self.stages):
-				charts[stage.name] = chart
-				prevparsetrees[stage.name] = parsetrees
-
-			# postprocess, yield result
-			if parsetrees:
-				resultstr = ''
-				try:
-					resultstr, prob, fragments = max(
-							parsetrees, key=itemgetter(1))
-					parsetree, noparse = self.postprocess(resultstr, xsent, n)
-					if not all(a for a in parsetree.subtrees()):
-						raise ValueError('empty nodes in tree: %s' % parsetree)
-					if len(parsetree.leaves()) != len(sent):
-						raise ValueError('leaves missing. original tree: %s\n'
-							'postprocessed: %r' % (resultstr, parsetree))
-				except Exception:  # pylint: disable=W0703
-					logging.error("something's amiss. %s\n%s", resultstr,
-							''.join(traceback.format_exception(*sys.exc_info())))
-					parsetree, prob, noparse = self.noparse(
-							stage, xsent, tags, lastsuccessfulparse, n)
-				else:
-					lastsuccessfulparse = resultstr
-				msg += probstr(prob) + ' '
+	def _parsestage(self, n, stage, state):
+		"""Parse a sentence with the n-th stage and return its result."""
+		sent, xsent, tags = state.sent, state.xsent, state.tags
+		root, goldtree = state.root, state.goldtree
+		require, block = state.require, state.block
+		charts, prevparsetrees = state.charts, state.prevparsetrees
+		lastsuccessfulparse = state.lastsuccessfulparse
+		chart = None
+		totalgolditems = state.totalgolditems
+		begin = time.clock()
+		metrics = dict.fromkeys(('prune', 'parse', 'kbest', 'marginalize',
+				'postprocess'), 0.0)
+		metrics['cached'] = False
+		noparse = False
+		parsetrees = fragments = fallback = None
+		golditems = 0
+		msg = '%s:\t' % stage.name.upper()
+		model = 'default'
+		if stage.dop:
+			if stage.objective == 'shortest':
+				model = 'shortest'
+			elif stage.estimator != 'rfe':
+				model = stage.estimator
+		if stage.mode != 'mc-rerank':
+			stage.grammar.switch(model, logprob=True)
+
+		# do parsing; if CTF pruning enabled, require parent stage to
+		# be successful.
+		splitprune = False
+		if sent and (not stage.prune or charts[stage.prune]):
+			prevn = 0
+			if stage.prune:
+				prevn = [a.name for a in self.stages].index(stage.prune)
+				if not stage.split and self.stages[prevn].split:
+					splitprune = True
+			tree = goldtree
+			if goldtree is not None and self.stages[prevn].split:
+				tree = treetransforms.splitdiscnodes(
+						goldtree.copy(True), self.stages[prevn].markorigin)
+			if n > 0 and stage.prune and stage.mode not in (
+					'dop-rerank', 'mc-rerank'):
+				beginprune = time.clock()
+				whitelist, msg1 = prunechart(
+						charts[stage.prune], stage.grammar, stage.k,
+						splitprune, self.stages[prevn].markorigin,
+						stage.mode.startswith('pcfg'),
+						set(require or ()), set(block or ()))
+				metrics['prune'] = time.clock() - beginprune
+				metrics['whitelist'] = whitelist.numitems
+				msg += '%s; %gs\n\t' % (msg1, metrics['prune'])
 			else:
-				fragments = None
+				whitelist = None
+			beginparse = time.clock()
+			if not sent:
+				pass
+			elif stage.mode == 'pcfg':
+				chart, msg1 = pcfg.parse(
+						sent, stage.grammar, tags=tags, start=root,
+						whitelist=whitelist if stage.prune else None,
+						beam_beta=-log(stage.beam_beta),
+						beam_delta=stage.beam_delta,
+						itemsestimate=estimateitems(
+							sent, stage.prune, stage.mode, stage.dop),
+						postagging=self.postagging,
+						timeout=stage.timeout, maxitems=stage.maxitems,
+						pool=self.chartpool, numthreads=stage.numthreads,
+						rulematrix=stage.rulematrix)
+				if chart is None:
+					fallback = msg1
+			elif stage.mode == 'plcfrs':
+				chart, msg1 = plcfrs.parse(
+						sent, stage.grammar, tags=tags, start=root,
+						exhaustive=stage.dop or (
+							n + 1 != len(self.stages)
+							and self.stages[n + 1].prune),
+						whitelist=whitelist,
+						splitprune=splitprune,
+						markorigin=self.stages[prevn].markorigin,
+						estimates=(stage.estimates, stage.outside)
+							if stage.estimates in ('SX', 'SXlrgaps')
+							else None,
+						beam_beta=-log(stage.beam_beta),
+						beam_delta=stage.beam_delta,
+						itemsestimate=estimateitems(
+							sent, stage.prune, stage.mode, stage.dop),
+						postagging=self.postagging,
+						timeout=stage.timeout, maxitems=stage.maxitems,
+						maxagenda=stage.maxagenda, pool=self.chartpool)
+				if chart is None:
+					fallback = msg1
+			elif stage.mode == 'dop-rerank':
+				if prevparsetrees[stage.prune]:
+					parsetrees, msg1 = disambiguation.doprerank(
+							prevparsetrees[stage.prune], sent, stage.k,
+							self.stages[prevn].grammar, stage.grammar)
+			elif stage.mode == 'mc-rerank':
+				if prevparsetrees[stage.prune]:
+					parsetrees, msg1 = disambiguation.mcrerank(
+							prevparsetrees[stage.prune], sent, stage.k,
+							stage.grammar.trees1, stage.grammar.vocab)
+			else:
+				raise ValueError('unknown mode specified: %s' % stage.mode)
+			metrics['parse'] = time.clock() - beginparse
+			if (n > 0 and stage.prune and stage.mode not in (
+					'dop-rerank', 'mc-rerank') and goldtree is not None
+					and chart is not None):
+				# count number of gold bracketings in pruned chart.
+				for node in tree.subtrees():
+					# test whether node is part of *whitelist*
+					if chart.itemid(node.label, node.leaves(), whitelist):
+						fanout = re.search('_([0-9]+)$',
+								node.label)
+						golditems += (int(fanout.group(1))
+								if fanout and not stage.split
+								else 1)
+				msg1 += (';\n\t%d/%d gold items remain after '
+						'pruning' % (golditems, totalgolditems))
+			msg += '%s\n\t' % msg1
+			if (n > 0 and stage.prune and not chart and not noparse
+					and fallback is None
+					and stage.split == self.stages[prevn].split):
+				logging.error('ERROR: expected successful parse;\n'
+						'sent: %s\nstage %d: %s',
+						' '.join(sent), n, stage.name)
+				# raise ValueError('ERROR: expected successful parse. '
+				# 		'sent %s, %s.' % (nsent, stage.name))
+		elif sent:
+			fallback = 'no parse with %s' % stage.prune
+		numitems = chart.numitems() if hasattr(chart, 'numitems') else 0
+		if chart is not None:
+			metrics.update(items=numitems, edges=chart.numedges(),
+					chartbytes=chart.nbytes())
+
+		if self.verbosity >= 3 and chart:
+			print('sent: %s\nstage: %s' % (' '.join(sent), stage.name))
+		if self.verbosity >= 4:
+			print('chart:\n%s' % chart)
+		# do disambiguation of resulting parse forest
+		if (sent and chart and stage.mode not in ('dop-rerank', 'mc-rerank')
+				and not (self.relationalrealizational and stage.split)):
+			begindisamb = time.clock()
+			# mpp and mpd are computed without derivation strings
+			disambiguation.getderivations(
+					chart, stage.m,
+					derivstrings=stage.dop == 'ostag'
+							or stage.objective == 'mcp'
+							or self.verbosity >= 3
+							or (stage.dop == 'reduction' and stage.objective
+								not in ('mpp', 'mpd')))
+			metrics['kbest'] = time.clock() - begindisamb
+			if self.verbosity >= 3:
+				print('%d-best derivations:\n%s' % (
+					min(stage.m, 100),
+					'\n'.join('%d. %s %s' % (n + 1,
+						('subtrees=%d' % abs(int(prob / log(0.5))))
+						if stage.objective == 'shortest'
+						else ('p=%g' % exp(-prob)), deriv)
+					for n, (deriv, prob) in enumerate(
+						chart.derivations[:100]))))
+				print('sum of probabilities: %g\n' % sum(exp(-prob)
+						for _, prob in chart.derivations[:100]))
+			if stage.objective == 'shortest':
+				stage.grammar.switch('default'
+						if stage.estimator == 'rfe'
+						else stage.estimator, True)
+			beginmarg = time.clock()
+			parsetrees, msg1 = disambiguation.marginalize(
+					stage.objective if stage.dop else 'mpd',
+					chart, sent=sent, tags=tags,
+					k=stage.m, sldop_n=stage.sldop_n,
+					mcplambda=stage.mcplambda,
+					mcplabels=stage.mcplabels,
+					ostag=stage.dop == 'ostag',
+					require=set(require or ()),
+					block=set(block or ()))
+			metrics['marginalize'] = time.clock() - beginmarg
+			msg += 'disambiguation: %s, %gs\n\t' % (
+					msg1, time.clock() - begindisamb)
+			if self.verbosity >= 3:
+				besttrees = nlargest(
+						100, parsetrees, key=itemgetter(1))
+				print('100-best parse trees:\n%s' % '\n'.join(
+						'%d. %s %s' % (n + 1, probstr(prob), treestr)
+						for n, (treestr, prob, _)
+						in enumerate(besttrees)))
+				print('sum of probabilities: %g\n' %
+						sum((prob[1]
+							if isinstance(prob, tuple) else prob)
+							for _, prob, _ in besttrees))
+			if not stage.prune and tree is not None:
+				totalgolditems = sum(1 for node in tree.subtrees())
+				golditems = sum(
+						1 for node in tree.subtrees()
+						if chart.itemid(node.label, node.leaves()))
+				msg += ('%d/%d gold items in derivations\n\t' % (
+						golditems, totalgolditems))
+		if stage.name in (stage.prune for stage in self.stages):
+			charts[stage.name] = chart
+			prevparsetrees[stage.name] = parsetrees
+		else:
+			self.chartpool.release(chart)
+
+		# postprocess, yield result
+		beginpost = time.clock()
+		if parsetrees:
+			resultstr = ''
+			try:
+				resultstr, prob, fragments = max(
+						parsetrees, key=itemgetter(1))
+				parsetree, noparse = self.postprocess(resultstr, xsent, n)
+				if not all(a for a in parsetree.subtrees()):
+					raise ValueError('empty nodes in tree: %s' % parsetree)
+				if len(parsetree.leaves()) != len(sent):
+					raise ValueError('leaves missing. original tree: %s\n'
+						'postprocessed: %r' % (resultstr, parsetree))
+			except Exception:  # pylint: disable=W0703
+				logging.error("something's amiss. %s\n%s", resultstr,
+						''.join(traceback.format_exception(*sys.exc_info())))
 				parsetree, prob, noparse = self.noparse(
 						stage, xsent, tags, lastsuccessfulparse, n)
-				parsetrees = [(lastsuccessfulparse or str(parsetree),
-						prob, None)]
-			elapsedtime = time.clock() - begin
-			msg += '%.2fs cpu time elapsed\n' % (elapsedtime)
-			yield DictObj(name=stage.name, parsetree=parsetree, prob=prob,
-					parsetrees=parsetrees, fragments=fragments,
-					noparse=noparse, elapsedtime=elapsedtime,
-					numitems=numitems, golditems=golditems,
-					totalgolditems=totalgolditems, msg=msg)
-		del charts, prevparsetrees
+				fallback = 'postprocessing failed'
+			else:
+				lastsuccessfulparse = resultstr
+			msg += probstr(prob) + ' '
+		else:
+			fragments = None
+			parsetree, prob, noparse = self.noparse(
+					stage, xsent, tags, lastsuccessfulparse, n)
+			if fallback is None:
+				fallback = 'no parse'
+			msg += 'fallback: %s\n\t' % ('previous stage'
+					if lastsuccessfulparse is not None
+					else 'default parse')
+			parsetrees = [(lastsuccessfulparse or str(parsetree),
+					prob, None)]
+		elapsedtime = time.clock() - begin
+		metrics.update(postprocess=time.clock() - beginpost,
+				total=elapsedtime)
+		msg += '%.2fs cpu time elapsed\n' % (elapsedtime)
+		state.update(lastsuccessfulparse=lastsuccessfulparse,
+				totalgolditems=totalgolditems)
+		return DictObj(name=stage.name, parsetree=parsetree, prob=prob,
+				parsetrees=parsetrees, fragments=fragments,
+				noparse=noparse, elapsedtime=elapsedtime,
+				numitems=numitems, golditems=golditems,
+				totalgolditems=totalgolditems, fallback=fallback,
+				metrics=metrics, msg=msg)
+
+	def _finish(self, state):
+		"""Release charts of a parsed sentence and store results in cache.
+
+		Results are only stored when all stages have been parsed; calling
+		this method again has no effect."""
+		for chart in state.charts.values():
+			self.chartpool.release(chart)
+		state.charts.clear()
+		state.prevparsetrees.clear()
+		if state.key is not None and len(state.results) == len(self.stages):
+			self.cache.put(state.key, state.results)
+		state.key = None
 
 	def postprocess(self, treestr, sent, stage):
 		"""Take parse tree and apply postprocessing."""
@@ -612,6 +791,9 @@ class Parser(object):
 			orignumlabels = stage.grammar.nonterminals
 			stage.grammar.addrules(
 					rules.encode('utf8'), lex.encode('utf8'), backtransform)
+			if stage.rulematrix is not None:
+				stage.rulematrix = (pcfg.RuleMatrix(stage.grammar)
+						if stage.grammar.nonterminals < 20000 else None)
 			if stage.dop:
 				if stage.dop in ('doubledop', 'dop1'):
 					# recoverfragments() relies on this mapping to identify
@@ -642,14 +824,156 @@ class Parser(object):
 						markorigin=prm.stages[prevn].markorigin,
 						mapping=stage.mapping,
 						startidx=orignumlabels)
+		if self.cache is not None:  # cached results are no longer valid
+			self.cache.clear(hashlib.sha1(('%s+%d' % (
+					self.cache.fingerprint, self.ctrees.len)).encode('utf8')
+					).hexdigest())
+
+
+class ParseCache(object):
+	"""A cache of parse results, keyed on sentences and constraints.
+
+	Consists of an in-memory tier with the ``maxsize`` most recently used
+	entries, and optionally an on-disk tier (an SQLite database), which may
+	be shared by several processes and runs.
+
+	:param fingerprint: a string identifying the parser configuration and
+		grammars, cf. :py:func:`fingerprint`; only entries with the same
+		fingerprint are used.
+	:param maxsize: the maximum number of entries kept in memory.
+	:param filename: if given, the filename of the on-disk tier; created if
+		it does not exist."""
+
+	def __init__(self, fingerprint, maxsize=1000, filename=None):
+		self.fingerprint = fingerprint
+		self.maxsize = maxsize
+		self.filename = filename
+		self.hits = self.misses = 0
+		self.lru = OrderedDict()  # key => pickled list of results
+		self.lock = threading.Lock()
+		self.conn = self.pid = None
+
+	def key(self, sent, tags=None, root=None, require=(), block=()):
+		"""Return a key for a tokenized sentence and its constraints."""
+		return hashlib.sha1(repr((self.fingerprint, tuple(sent),
+				None if tags is None else tuple(tags), root,
+				sorted(require or ()), sorted(block or ()))
+				).encode('utf8')).hexdigest()
+
+	def db(self):
+		"""Return connection to on-disk tier; opened anew in each process."""
+		if self.filename is None:
+			return None
+		if self.conn is None or self.pid != os.getpid():
+			self.conn = sqlite3.connect(
+					self.filename, timeout=60, check_same_thread=False)
+			self.conn.execute('CREATE TABLE IF NOT EXISTS parses '
+					'(key TEXT PRIMARY KEY, value BLOB)')
+			self.conn.commit()
+			self.pid = os.getpid()
+		return self.conn
+
+	def get(self, key):
+		"""Return list of results for each stage, or None if not cached."""
+		with self.lock:
+			value = self.lru.get(key)
+			if value is not None:
+				self.lru.move_to_end(key)
+			elif self.filename is not None:
+				row = self.db().execute(
+						'SELECT value FROM parses WHERE key = ?',
+						(key, )).fetchone()
+				if row is not None:
+					value = self.lru[key] = bytes(row[0])
+					self._evict()
+			if value is None:
+				self.misses += 1
+				return None
+			self.hits += 1
+		return pickle.loads(value)
+
+	def put(self, key, results):
+		"""Store list of results for each stage."""
+		value = pickle.dumps(results, protocol=-1)
+		with self.lock:
+			self.lru[key] = value
+			self._evict()
+			if self.filename is not None:
+				conn = self.db()
+				conn.execute('INSERT OR REPLACE INTO parses VALUES (?, ?)',
+						(key, sqlite3.Binary(value)))
+				conn.commit()
+
+	def _evict(self):
+		while len(self.lru) > self.maxsize:
+			self.lru.popitem(last=False)
+
+	def clear(self, fingerprint):
+		"""Empty in-memory tier and switch to a new fingerprint."""
+		with self.lock:
+			self.lru.clear()
+			self.fingerprint = fingerprint
+
+	def __repr__(self):
+		return '%s(%d entries, %d hits, %d misses)' % (
+				self.__class__.__name__, len(self.lru),
+				self.hits, self.misses)
+
+
+def fingerprint(prm, filenames=()):
+	"""Return a digest identifying a parser configuration and its grammars.
+
+	:param prm: a DictObj with parameters; the stage parameters and other
+		options with simple values are included.
+	:param filenames: grammar files; their names, sizes, and modification
+		times are included."""
+	def simple(obj):
+		"""Filter dictionaries to keys with values that have a stable repr."""
+		if isinstance(obj, DictObj):
+			obj = vars(obj)
+		if isinstance(obj, dict):
+			return sorted((key, simple(value)) for key, value in obj.items()
+					if simple(value) is not NotImplemented)
+		elif isinstance(obj, (list, tuple)):
+			return [simple(a) for a in obj]
+		elif obj is None or isinstance(obj, (str, int, float)):
+			return obj
+		return NotImplemented
+
+	digest = hashlib.sha1()
+	for key in ('stages', 'transformations', 'binarization', 'postagging',
+			'relationalrealizational', 'punct', 'functions', 'morphology'):
+		digest.update(repr((key, simple(getattr(prm, key, None)))
+				).encode('utf8'))
+	for filename in filenames:
+		stat = os.stat(filename)
+		digest.update(repr((os.path.abspath(filename), stat.st_size,
+				stat.st_mtime)).encode('utf8'))
+	return digest.hexdigest()
+
+
+def grammarfiles(resultdir, stages):
+	"""Return the names of existing files read by :py:func:`readgrammars`."""
+	filenames = ['%s/%s' % (resultdir, a)
+			for a in ('params.prm', 'mapping.json.gz', 'closedclasswords.txt')]
+	for stage in stages:
+		filenames.extend('%s/%s.%s' % (resultdir, stage.name, a) for a in (
+				'rules.gz', 'lex.gz', 'probs.npz', 'backtransform.gz',
+				'outside.npy', 'outside.npz', 'train.pickle.gz'))
+	return [a for a in filenames if os.path.exists(a)]
 
 
 def readgrammars(resultdir, stages, postagging=None,
-		transformations=None, top='ROOT', cache=False):
+		transformations=None, top='ROOT', cache=False, cachemappings=True):
 	"""Read the grammars from a previous experiment.
 
 	Expects a directory ``resultdir`` which contains the relevant grammars and
-	the parameter file ``params.prm``, as produced by ``runexp``."""
+	the parameter file ``params.prm``, as produced by ``runexp``.
+
+	:param cache: store grammars in a binary format for faster loading.
+	:param cachemappings: store the mappings of labels and rules between
+		grammars in ``resultdir``, and reuse them when the grammar files and
+		stage parameters are unchanged."""
 	if os.path.exists('%s/mapping.json.gz' % resultdir):
 		mappings = json.load(openread('%s/mapping.json.gz' % resultdir))
 		for stage, mapping in zip(stages, mappings):
@@ -676,10 +1000,15 @@ def readgrammars(resultdir, stages, postagging=None,
 			if stage.dop in ('doubledop', 'dop1'):
 				backtransform = openread('%s/%s.backtransform.gz' % (
 						resultdir, stage.name)).read().splitlines()
+			gram = None
 			if cache and os.path.exists('%s/%s.g' % (resultdir, stage.name)):
-				gram = Grammar.frombinfile('%s/%s.g' % (resultdir, stage.name),
-						rules, lexicon, backtransform=backtransform)
-			else:
+				try:
+					gram = Grammar.frombinfile(
+							'%s/%s.g' % (resultdir, stage.name),
+							rules, lexicon, backtransform=backtransform)
+				except ValueError as err:  # e.g., older format; recreate
+					logging.warning('%s', err)
+			if gram is None:
 				gram = Grammar(rules, lexicon, start=top, altweights=probsfile,
 						backtransform=backtransform)
 				if cache:
@@ -689,55 +1018,42 @@ def readgrammars(resultdir, stages, postagging=None,
 		if stage.mode == 'mc-rerank':
 			gram = pickle.loads(gzip.open('%s/%s.train.pickle.gz' % (
 					resultdir, stage.name), 'rb').read())
-		elif stage.dop:
-			if stage.estimates is not None:
+		else:
+			prevstage = stages[prevn] if n and stage.prune else None
+			mappingfile = '%s/%s.mapping.npz' % (resultdir, stage.name)
+			key = loaded = None
+			if cachemappings:
+				key = fingerprint(DictObj(stages=[stage, prevstage]),
+						grammarfiles(resultdir, [stage]
+							+ ([prevstage] if prevstage else [])))
+			if cachemappings and os.path.exists(mappingfile):
+				try:
+					gram.mappingfromfile(mappingfile, key)
+					loaded = True
+				except ValueError as err:  # e.g., other grammar; recreate
+					logging.info('%s', err)
+			if not loaded:
+				getmappings(gram, stage, prevstage)
+				if cachemappings:
+					try:
+						gram.mappingtofile(mappingfile, key)
+					except (IOError, OSError) as err:  # e.g., read-only
+						logging.warning('%s', err)
+			if stage.dop and stage.estimates is not None:
 				raise ValueError('not supported')
-			if stage.dop in ('doubledop', 'dop1'):
-				# recoverfragments() relies on this mapping to identify
-				# binarization nodes. treeparsing() relies on this as well.
-				_ = gram.getmapping(
-						None, neverblockre=re.compile('.+}<'), debug=False)
-				if n and stage.prune:
-					_ = gram.getmapping(stages[prevn].grammar,
-						striplabelre=re.compile('@.+$'),
-						neverblockre=re.compile('^#[0-9]+|.+}<'),
-						splitprune=not stage.split and stages[prevn].split,
-						markorigin=stages[prevn].markorigin,
-						mapping=stage.mapping, debug=False)
-			else:  # dop reduction
-				if n and stage.prune:
-					_ = gram.getmapping(stages[prevn].grammar,
-						striplabelre=re.compile(r'@[-0-9]+(?:\$\[.*\])?$'),
-						neverblockre=re.compile(stage.neverblockre)
-							if stage.neverblockre else None,
-						splitprune=not stage.split and stages[prevn].split,
-						markorigin=stages[prevn].markorigin,
-						mapping=stage.mapping, debug=False)
-					if stage.mode == 'dop-rerank':
-						gram.getrulemapping(stages[prevn].grammar,
-								re.compile(r'@[-0-9]+\b'))
-				if stage.objective == 'sl-dop':  # needed for treeparsing()
-					_ = gram.getmapping(
-							None, striplabelre=re.compile(r'@[-0-9]+\b'),
-							debug=False)
-					# only need rulemapping for dop reduction,
-					# defaults to 1-1 mapping otherwise.
-					gram.getrulemapping(gram, re.compile(r'@[-0-9]+\b'))
-		else:  # not stage.dop
-			if n and stage.prune:
-				_ = gram.getmapping(stages[prevn].grammar,
-					neverblockre=re.compile(stage.neverblockre)
-						if stage.neverblockre else None,
-					splitprune=not stage.split and stages[prevn].split,
-					markorigin=stages[prevn].markorigin,
-					mapping=stage.mapping, debug=False)
-			if stage.estimates in ('SX', 'SXlrgaps'):
+			elif stage.estimates in ('SX', 'SXlrgaps'):
 				if stage.estimates == 'SX' and gram.maxfanout != 1:
 					raise ValueError('SX estimate requires PCFG.')
 				if stage.mode != 'plcfrs':
 					raise ValueError('estimates require parser w/agenda.')
-				outside = np.load('%s/%s.outside.npz' % (
-						resultdir, stage.name))['outside']
+				filename = '%s/%s.outside' % (resultdir, stage.name)
+				if os.path.exists(filename + '.npy'):
+					# memory-mapped; pages are shared between processes.
+					outside = np.load(filename + '.npy', mmap_mode='c')
+				else:  # older format with estimates in double precision
+					from . import estimates
+					outside = estimates.tosingle(
+							np.load(filename + '.npz')['outside'])
 				logging.info('loaded %s estimates', stage.estimates)
 			elif stage.estimates:
 				raise ValueError('unrecognized value; specify SX or SXlrgaps.')
@@ -757,6 +1073,51 @@ def readgrammars(resultdir, stages, postagging=None,
 				None, None, resultdir + '/compounds.txt')
 
 
+def getmappings(gram, stage, prevstage=None):
+	"""Construct the label and rule mappings needed to parse with a stage.
+
+	:param gram: the grammar of ``stage``.
+	:param prevstage: the stage used for pruning, if any."""
+	if stage.dop in ('doubledop', 'dop1'):
+		# recoverfragments() relies on this mapping to identify
+		# binarization nodes. treeparsing() relies on this as well.
+		_ = gram.getmapping(
+				None, neverblockre=re.compile('.+}<'), debug=False)
+		if prevstage is not None:
+			_ = gram.getmapping(prevstage.grammar,
+				striplabelre=re.compile('@.+$'),
+				neverblockre=re.compile('^#[0-9]+|.+}<'),
+				splitprune=not stage.split and prevstage.split,
+				markorigin=prevstage.markorigin,
+				mapping=stage.mapping, debug=False)
+	elif stage.dop:  # dop reduction
+		if prevstage is not None:
+			_ = gram.getmapping(prevstage.grammar,
+				striplabelre=re.compile(r'@[-0-9]+(?:\$\[.*\])?$'),
+				neverblockre=re.compile(stage.neverblockre)
+					if stage.neverblockre else None,
+				splitprune=not stage.split and prevstage.split,
+				markorigin=prevstage.markorigin,
+				mapping=stage.mapping, debug=False)
+			if stage.mode == 'dop-rerank':
+				gram.getrulemapping(prevstage.grammar,
+						re.compile(r'@[-0-9]+\b'))
+		if stage.objective == 'sl-dop':  # needed for treeparsing()
+			_ = gram.getmapping(
+					None, striplabelre=re.compile(r'@[-0-9]+\b'),
+					debug=False)
+			# only need rulemapping for dop reduction,
+			# defaults to 1-1 mapping otherwise.
+			gram.getrulemapping(gram, re.compile(r'@[-0-9]+\b'))
+	elif prevstage is not None:
+		_ = gram.getmapping(prevstage.grammar,
+			neverblockre=re.compile(stage.neverblockre)
+				if stage.neverblockre else None,
+			splitprune=not stage.split and prevstage.split,
+			markorigin=prevstage.markorigin,
+			mapping=stage.mapping, debug=False)
+
+
 def probstr(prob):
 	"""Render probability / number of subtrees as string."""
 	if isinstance(prob, tuple):
@@ -779,6 +1140,21 @@ def estimateitems(sent, prune, mode, dop):
 	return beta * len(sent) ** 2
 
 
+def estimatecost(sent, stages):
+	"""Estimate the relative cost of parsing a sentence with given stages.
+
+	For each stage, the number of items from :py:func:`estimateitems` is
+	multiplied by the sentence length raised to the maximum fan-out of the
+	grammar (i.e., cubic time for a PCFG); used to schedule long sentences
+	first."""
+	cost = 0
+	for stage in stages:
+		if stage.mode in ('pcfg', 'plcfrs'):
+			cost += estimateitems(sent, stage.prune, stage.mode,
+					stage.dop) * len(sent) ** stage.grammar.maxfanout
+	return cost
+
+
 def readparam(filename):
 	"""Parse a parameter file.
 
@@ -814,6 +1190,16 @@ def readparam(filename):
 		if stage.mode not in (
 				'plcfrs', 'pcfg', 'dop-rerank', 'mc-rerank'):
 			raise ValueError('unrecognized mode argument: %r.' % stage.mode)
+		if stage.cky not in ('grammarloop', 'rulematrix'):
+			raise ValueError('unrecognized cky argument: %r.' % stage.cky)
+		if stage.numthreads > 1 and (stage.mode != 'pcfg' or stage.prune
+				or stage.cky != 'grammarloop'):
+			raise ValueError('numthreads only applies to stages with '
+					"mode='pcfg', without pruning, and with "
+					"cky='grammarloop'.")
+		if stage.cky == 'rulematrix' and stage.prune:
+			raise ValueError("cky='rulematrix' only applies to stages "
+					'without pruning.')
 		if n == 0 and stage.prune:
 			raise ValueError('need previous stage to prune, '
 					'but this stage is first.')
@@ -882,53 +1268,95 @@ def mpworker(args):
 
 
 def worker(args):
-	"""Parse a single sentence."""
-	key, line = args
+	"""Parse a single sentence.
+
+	:param args: a tuple ``(key, line)`` or ``(key, line, opts)``, where
+		``opts`` is a dict with options for this sentence overriding those
+		given to :py:func:`initworker`; recognized keys are ``numparses``,
+		``fmt``, ``printprob``, ``usetags``, ``require``, and ``block``.
+	:returns: a tuple ``(output, noparse, sec, msg, metrics)``, where
+		``metrics`` is a list with a dictionary for each stage, cf. the
+		``metrics`` of the results of :py:meth:`Parser.parse`."""
+	key, line = args[:2]
+	opts = args[2] if len(args) > 2 else {}
+	numparses = opts.get('numparses', PARAMS.numparses)
+	fmt = opts.get('fmt', PARAMS.fmt)
+	printprob = opts.get('printprob', PARAMS.printprob)
 	line = line.strip()
 	if not line:
-		return '', True, 0, ''
+		return '', True, 0, '', []
 	begin = time.clock()
 	sent = line.split(' ')
 	tags = None
-	if PARAMS.usetags:
+	if opts.get('usetags', PARAMS.usetags):
 		sent, tags = zip(*(a.rsplit('/', 1) for a in sent))
 	msg = 'parsing %s: %s' % (key, ' '.join(sent))
-	result = list(PARAMS.parser.parse(sent, tags=tags))[-1]
+	results = list(PARAMS.parser.parse(sent, tags=tags,
+			require=opts.get('require', ()), block=opts.get('block', ())))
+	result = results[-1]
 	output = ''
 	if result.noparse:
 		msg += '\nNo parse for "%s"' % ' '.join(sent)
-		if PARAMS.printprob:
+		if printprob:
 			output += 'prob=%.16g\n' % result.prob
 		output += writetree(
 				result.parsetree, sent,
-				key if PARAMS.numparses == 1 else ('%s-1' % key),
-				PARAMS.fmt, morphology=PARAMS.morphology,
+				key if numparses == 1 else ('%s-1' % key),
+				fmt, morphology=PARAMS.morphology,
 				comment=('prob=%.16g' % result.prob)
-					if PARAMS.printprob else None)
+					if printprob else None)
 	else:
 		tmp = []
 		for k, (tree, prob, _) in enumerate(nlargest(
-				PARAMS.numparses, result.parsetrees, key=itemgetter(1))):
+				numparses, result.parsetrees, key=itemgetter(1))):
 			tree, _ = PARAMS.parser.postprocess(tree, sent, -1)
-			if 'bracket' in PARAMS.fmt:
+			if 'bracket' in fmt:
 				handlefunctions('add', tree)
 			tmp.append(writetree(
 					tree, sent,
-					key if PARAMS.numparses == 1 else ('%s-%d' % (key, k)),
-					PARAMS.fmt, morphology=PARAMS.morphology,
+					key if numparses == 1 else ('%s-%d' % (key, k)),
+					fmt, morphology=PARAMS.morphology,
 					comment=('prob=%.16g' % prob)
-						if PARAMS.printprob else None))
+						if printprob else None))
 		output += ''.join(tmp)
 	sec = time.clock() - begin
 	msg += '\n%g s' % sec
-	return output, result.noparse, sec, msg
+	metrics = [dict(id=key, len=len(sent), stage=a.name, **a.metrics)
+			for a in results]
+	return output, result.noparse, sec, msg, metrics
 
 
 def doparsing(parser, infile, out, printprob, oneline, usetags, numparses,
-		numproc, fmt, morphology, sentid):
-	"""Parse sentences from file and write results to file, log to stdout."""
-	times = []
-	unparsed = 0
+		numproc, fmt, morphology, sentid, chunksize=1, window=None,
+		longestfirst=0, metricsfile=None):
+	"""Parse sentences from file and write results to file, log to stdout.
+
+	Input is read and results are written incrementally; with multiple
+	processes, at most ``window`` chunks of ``chunksize`` sentences are
+	parsed or waiting to be written at any time (default: twice the number
+	of processes), so memory use is independent of the size of the input.
+
+	:param longestfirst: if nonzero, with multiple processes, read ahead
+		this many sentences and dispatch the sentences read ahead in order
+		of decreasing estimated cost (cf. :py:func:`estimatecost` and
+		:py:func:`discodop.util.scheduledimap`); results are still written in
+		input order. Sentences are sent in chunks of ``chunksize``; the
+		number of sentences in flight is bounded by ``longestfirst``, so
+		``window`` cannot be combined with this option. A report of the
+		utilization of each worker is printed at the end.
+	:param metricsfile: if given, a filename to which the metrics of each
+		stage for each sentence are appended as JSON lines. A summary of the
+		metrics is printed at the end in any case."""
+	if longestfirst and window is not None:
+		raise ValueError('window cannot be combined with longestfirst; '
+				'the sentences read ahead are bounded by longestfirst.')
+	numsents = totaltime = unparsed = 0
+	stats = {}
+	summary = MetricsSummary()
+	metricsout = None
+	if metricsfile is not None:
+		metricsout = io.open(metricsfile, 'a', encoding='utf8')
+	begin = time.time()
 	if not oneline:
 		infile = readinputbitparstyle(infile)
 	if sentid:
@@ -937,33 +1365,305 @@ def doparsing(parser, infile, out, printprob, oneline, usetags, numparses,
 		infile = enumerate((line for line in infile if line.strip()), 1)
 	if numproc == 1:
 		initworker(parser, printprob, usetags, numparses, fmt, morphology)
-		mymap, myworker = map, worker
+		results = map(worker, infile)
 	else:
 		pool = multiprocessing.Pool(
 				processes=numproc, initializer=initworker,
 				initargs=(parser, printprob, usetags, numparses, fmt,
 					morphology))
-		mymap, myworker = pool.map, mpworker
-	for output, noparse, sec, msg in mymap(myworker, infile):
+		if longestfirst:
+			results = scheduledimap(pool, mpworker, infile,
+					lambda item: estimatecost(
+						item[1].split(' '), parser.stages),
+					longestfirst, chunksize, stats=stats)
+		else:
+			results = boundedimap(pool, mpworker, infile, chunksize, window)
+	for output, noparse, sec, msg, metrics in results:
 		if output:
 			print(msg, file=sys.stderr)
 			out.write(output)
 			if noparse:
 				unparsed += 1
-			times.append(sec)
+			numsents += 1
+			totaltime += sec
+			for a in metrics:
+				summary.add(a)
+			if metricsout is not None:
+				metricsout.writelines(json.dumps(a) + '\n' for a in metrics)
 			sys.stderr.flush()
 			out.flush()
-	print('average time per sentence', sum(times) / len(times),
+	if numproc != 1:
+		pool.terminate()
+		pool.join()
+	if stats:
+		print(utilization(stats, time.time() - begin), file=sys.stderr)
+	if metricsout is not None:
+		metricsout.close()
+	if summary.bystage:
+		print(summary, file=sys.stderr)
+	print('average time per sentence', totaltime / (numsents or 1),
 			'\nunparsed sentences:', unparsed,
 			'\nfinished',
 			file=sys.stderr)
 	out.close()
 
 
+class MetricsSummary(object):
+	"""Running aggregates of the metrics of parsed sentences, for each stage.
+
+	Only sums, maxima and histograms are kept, so memory use does not grow
+	with the number of sentences. Percentiles of the time per sentence are
+	estimated from a histogram with ten bins per decade; i.e., a reported
+	percentile is an upper bound that is at most 26% too high."""
+	steps = ('prune', 'parse', 'kbest', 'marginalize', 'postprocess')
+	# upper bounds of the histogram bins for percentiles: 0.1ms to 1000s
+	bins = [10 ** (n / 10.0) for n in range(-40, 31)]
+	# upper bounds of the histogram bins that are reported
+	coarsebins = [0.001, 0.01, 0.1, 1, 10]
+
+	def __init__(self):
+		self.bystage = OrderedDict()
+
+	def add(self, metrics):
+		"""Add the metrics of a stage for a sentence.
+
+		:param metrics: a dictionary with the key ``stage`` and the metrics
+			of that stage, as returned by :py:func:`worker`."""
+		agg = self.bystage.get(metrics['stage'])
+		if agg is None:
+			agg = self.bystage[metrics['stage']] = dict(
+					count=0, total=0.0, maxtotal=0.0,
+					steps=dict.fromkeys(self.steps, 0.0),
+					charts=0, items=0, maxitems=0, maxchartbytes=0,
+					histogram=[0] * (len(self.bins) + 1),
+					coarse=[0] * (len(self.coarsebins) + 1))
+		total = metrics['total']
+		agg['count'] += 1
+		agg['total'] += total
+		agg['maxtotal'] = max(agg['maxtotal'], total)
+		for key in self.steps:
+			agg['steps'][key] += metrics[key]
+		if 'items' in metrics:
+			agg['charts'] += 1
+			agg['items'] += metrics['items']
+			agg['maxitems'] = max(agg['maxitems'], metrics['items'])
+			agg['maxchartbytes'] = max(
+					agg['maxchartbytes'], metrics['chartbytes'])
+		agg['histogram'][bisect_left(self.bins, total)] += 1
+		agg['coarse'][bisect_right(self.coarsebins, total)] += 1
+
+	def percentile(self, stage, q):
+		"""Estimate the q-th percentile of the time per sentence of stage."""
+		agg = self.bystage[stage]
+		target, cumulative = q / 100.0 * agg['count'], 0
+		for n, count in enumerate(agg['histogram']):
+			cumulative += count
+			if count and cumulative >= target:
+				break
+		return min(self.bins[n] if n < len(self.bins) else agg['maxtotal'],
+				agg['maxtotal'])
+
+	def __str__(self):
+		result = []
+		for stage, agg in self.bystage.items():
+			result.append('%s: %d sentences; time per sentence: mean %.4fs, '
+					'median %.4fs, 90%% %.4fs, 99%% %.4fs, max %.4fs' % (
+					stage, agg['count'], agg['total'] / agg['count'],
+					self.percentile(stage, 50), self.percentile(stage, 90),
+					self.percentile(stage, 99), agg['maxtotal']))
+			result.append('\tmean time per step: %s' % ', '.join(
+					'%s %.4fs' % (key, agg['steps'][key] / agg['count'])
+					for key in self.steps))
+			if agg['charts']:
+				result.append('\tchart items: mean %d, max %d; '
+						'peak chart memory: %d bytes' % (
+						agg['items'] / agg['charts'], agg['maxitems'],
+						agg['maxchartbytes']))
+			result.append('\ttime histogram: %s' % ', '.join(
+					'<%gs: %d' % (high, count) for high, count
+					in zip(self.coarsebins, agg['coarse']))
+					+ ', >=%gs: %d' % (self.coarsebins[-1], agg['coarse'][-1]))
+		return '\n'.join(result)
+
+
+def summarizemetrics(metrics):
+	"""Summarize metrics of each stage with percentiles and a histogram.
+
+	:param metrics: a sequence of dictionaries with the metrics of a stage for
+		a sentence, as returned by :py:func:`worker`.
+	:returns: a multi-line string; cf. :py:class:`MetricsSummary`."""
+	summary = MetricsSummary()
+	for a in metrics:
+		summary.add(a)
+	return str(summary)
+
+
+def parserequest(line, n):
+	"""Decode a request for the parser server.
+
+	:param line: either a JSON object with the sentence under the key
+		``sent`` and optionally an ``id`` and options for :py:func:`worker`
+		(where ``prob`` and ``tags`` are accepted for ``printprob`` and
+		``usetags``), or a plain line with a sentence.
+	:param n: the default sentence ID.
+	:returns: a tuple ``(key, sent, opts)`` suitable for :py:func:`worker`.
+
+	>>> parserequest('{"id": 7, "sent": "a b", "require": [["NP", [0]]]}', 1)
+	(7, 'a b', {'require': (('NP', (0,)),)})
+	>>> parserequest('Why not ?', 2)
+	(2, 'Why not ?', {})"""
+	if not line.lstrip().startswith('{'):
+		return n, line, {}
+	request = json.loads(line)
+	if 'sent' not in request:
+		raise ValueError('request has no "sent" key.')
+	opts = {}
+	for key, optkey in (('numparses', 'numparses'), ('fmt', 'fmt'),
+			('prob', 'printprob'), ('tags', 'usetags')):
+		if key in request:
+			opts[optkey] = request[key]
+	for key in ('require', 'block'):
+		if request.get(key):
+			opts[key] = tuple((label, tuple(indices))
+					for label, indices in request[key])
+	return request.get('id', n), request['sent'], opts
+
+
+def requestid(line, n):
+	"""Return the ID of a request, or ``n`` if it has none or is invalid."""
+	try:
+		request = json.loads(line)
+		return request.get('id', n)
+	except (ValueError, AttributeError):
+		return n
+
+
+def serverequest(line, n, pool=None, lock=None):
+	"""Parse a single request for the server; return response as JSON.
+
+	:param pool: if given, the request is parsed by a worker of this pool.
+	:param lock: if given, acquired while parsing in this process."""
+	try:
+		key, sent, opts = parserequest(line, n)
+		if pool is not None:
+			output, noparse, sec, msg, metrics = pool.apply(
+					mpworker, ((key, sent, opts), ))
+		elif lock is not None:
+			with lock:
+				output, noparse, sec, msg, metrics = worker(
+						(key, sent, opts))
+		else:
+			output, noparse, sec, msg, metrics = worker((key, sent, opts))
+	except Exception as err:  # pylint: disable=broad-except
+		return json.dumps(dict(id=requestid(line, n), error=str(err)))
+	return json.dumps(dict(id=key, output=output, noparse=noparse,
+			elapsedtime=sec, msg=msg, metrics=metrics))
+
+
+@workerfunc
+def mpserverequest(args):
+	"""Handle a request ``(n, line)`` (multiprocessing wrapper)."""
+	n, line = args
+	return serverequest(line, n)
+
+
+class ParserRequestHandler(socketserver.StreamRequestHandler):
+	"""Handle a connection to the parser server; one request per line."""
+
+	def handle(self):
+		for n, line in enumerate(self.rfile, 1):
+			line = line.decode('utf8').strip()
+			if not line:
+				continue
+			response = serverequest(
+					line, n, self.server.pool, self.server.lock)
+			self.wfile.write(response.encode('utf8') + b'\n')
+			self.wfile.flush()
+
+
+class ParserServer(socketserver.ThreadingMixIn,
+		socketserver.UnixStreamServer):
+	"""A server which handles each connection in a separate thread."""
+	daemon_threads = True
+
+
+def serve(parser, socketpath, numproc, printprob, usetags, numparses,
+		fmt, morphology):
+	"""Serve parse requests with a parser which is loaded once.
+
+	Requests are read from a Unix domain socket ``socketpath``, or from
+	standard input if it is ``None``. Each request is a line as accepted by
+	:py:func:`parserequest`, e.g.::
+
+		{"id": 1, "sent": "Why did the chicken cross the road ?",
+			"numparses": 2, "fmt": "bracket", "require": [["NP", [2, 3]]]}
+
+	Each response is a line with a JSON object with the following keys:
+
+	:id: the ID of the request, or its line number if it has no ID.
+	:output: the parse trees in the requested format, as a string.
+	:noparse: ``true`` if the parser failed and ``output`` contains a
+		fallback parse.
+	:elapsedtime: CPU time in seconds spent on the request.
+	:msg: a log message with details on each stage.
+	:metrics: a list with an object for each stage with the keys ``id``,
+		``len`` (number of tokens), ``stage`` (name of the stage), and the
+		CPU time in seconds of ``prune``, ``parse``, ``kbest``,
+		``marginalize``, ``postprocess`` and ``total``, and ``cached``,
+		which is ``true`` if the result was taken from the cache; when
+		available, also the number of chart ``items`` and ``edges``, the
+		number of items in the pruning ``whitelist``, and the memory used by
+		the chart in bytes (``chartbytes``).
+
+	When the request could not be handled, the response has only the keys
+	``id`` and ``error``, with an error message. The worker processes are
+	forked after the grammars have been loaded, so that they share the
+	grammars copy-on-write; they persist for the lifetime of the server.
+	Requests from standard input are distributed over the workers as they
+	are read; responses are written in the order of the requests."""
+	initworker(parser, printprob, usetags, numparses, fmt, morphology)
+	pool = None
+	if numproc != 1:
+		pool = multiprocessing.Pool(
+				processes=numproc, initializer=initworker,
+				initargs=(parser, printprob, usetags, numparses, fmt,
+					morphology))
+	lock = threading.Lock()
+	try:
+		if socketpath is None:
+			lines = ((n, line.strip()) for n, line in enumerate(sys.stdin, 1)
+					if line.strip())
+			if pool is None:
+				responses = (serverequest(line, n) for n, line in lines)
+			else:  # pipeline requests; responses are in order of input
+				responses = pool.imap(mpserverequest, lines)
+			for response in responses:
+				print(response, flush=True)
+		else:
+			if os.path.exists(socketpath):
+				os.unlink(socketpath)
+			server = ParserServer(socketpath, ParserRequestHandler)
+			server.pool, server.lock = pool, lock
+			print('listening on %s' % socketpath, file=sys.stderr)
+			try:
+				server.serve_forever()
+			except KeyboardInterrupt:
+				pass
+			finally:
+				server.server_close()
+				os.unlink(socketpath)
+	finally:
+		if pool is not None:
+			pool.terminate()
+			pool.join()
+
+
 def main():
 	"""Handle command line arguments."""
-	flags = 'help prob tags sentid simple'.split()
-	options = flags + 'obj= bt= numproc= fmt= verbosity='.split()
+	flags = 'help prob tags sentid simple serve'.split()
+	options = flags + ('obj= bt= numproc= fmt= verbosity= socket= '
+			'chunksize= window= longestfirst= cache= cachefile= '
+			'metrics=').split()
 	try:
 		opts, args = gnu_getopt(sys.argv[2:], 'hb:s:m:x', options)
 	except GetoptError as err:
@@ -1017,6 +1717,7 @@ def main():
 				relationalrealizational=None)
 		parser = Parser(prm)
 		morph = None
+		filenames = args[:2] + ([opts['--bt']] if opts.get('--bt') else [])
 		del args[:2]
 	else:
 		directory = args[0]
@@ -1029,14 +1730,30 @@ def main():
 		params.update(verbosity=int(opts.get('--verbosity', params.verbosity)))
 		parser = Parser(params)
 		morph = params.morphology
+		filenames = grammarfiles(directory, params.stages)
 		del args[:1]
+	if '--cache' in opts or '--cachefile' in opts:
+		parser.cache = ParseCache(fingerprint(parser.prm, filenames),
+				int(opts.get('--cache', 1000)), opts.get('--cachefile'))
+	if '--serve' in opts:
+		serve(parser, opts.get('--socket'), int(opts.get('--numproc', 1)),
+				prob, tags, numparses, opts.get('--fmt', 'discbracket'),
+				morph)
+		return
 	with openread(args[0] if len(args) >= 1 else '-') as infile:
 		with io.open(args[1] if len(args) == 2 and args[1] != '-'
 				else sys.stdout.fileno(), 'w', encoding='utf8') as out:
 			doparsing(parser, infile, out, prob, oneline, tags, numparses,
 					int(opts.get('--numproc', 1)),
-					opts.get('--fmt', 'discbracket'), morph, sentid)
+					opts.get('--fmt', 'discbracket'), morph, sentid,
+					chunksize=int(opts.get('--chunksize', 1)),
+					window=int(opts['--window']) if '--window' in opts
+						else None,
+					longestfirst=int(opts.get('--longestfirst', 0)),
+					metricsfile=opts.get('--metrics'))
 
 
 __all__ = ['DictObj', 'Parser', 'doparsing', 'initworker', 'probstr',
-		'readgrammars', 'readinputbitparstyle', 'readparam']
+		'readgrammars', 'readinputbitparstyle', 'readparam', 'parserequest',
+		'serve', 'estimatecost', 'ParseCache', 'fingerprint', 'grammarfiles',
+		'getmappings', 'MetricsSummary', 'summarizemetrics']
@@ -13,7 +13,7 @@ cdef extern from "<cmath>" namespace "std" nogil:
 	bint isfinite(double v)
 	bint isinf(double v)
 
-cdef extern from "macros.h":
+cdef extern from "macros.h" nogil:
 	uint64_t TESTBIT(uint64_t a[], int b)
 
 
@@ -47,6 +47,16 @@ cdef union CFGItem:
 	SparseCFGItem st
 
 
+@cython.final
+cdef class RuleMatrix:
+	cdef Grammar grammar
+	cdef size_t numbinary
+	cdef vector[ProbRule *] rules  # binary rules grouped by (rhs1, rhs2)
+	cdef vector[uint32_t] byrhs1  # rhs1 => index of its first pair
+	cdef vector[Label] pairrhs2  # pair => rhs2
+	cdef vector[uint32_t] pairstart  # pair => index of its first rule
+
+
 cdef class CFGChart(Chart):
 	cdef vector[uint64_t] items
 	cdef vector[Prob] beambuckets
@@ -2,16 +2,20 @@
 from __future__ import print_function
 import re
 import sys
+import warnings
 import subprocess
 from os import unlink
 from math import exp, log as pylog
 from itertools import count
+from time import time as walltime
 import numpy as np
 from .tree import Tree
 from .util import which
 
 cimport cython
 from cython.operator cimport postincrement, dereference
+from cython.parallel cimport prange
+from libcpp.algorithm cimport sort
 from libc.math cimport HUGE_VAL as INFINITY
 include "constants.pxi"
 
@@ -24,13 +28,72 @@ cdef inline uint64_t cellstruct(Idx start, Idx end):
 	return result.dt
 
 
+@cython.final
+cdef class RuleMatrix:
+	"""The binary rules of a PCFG grouped by their pair of children.
+
+	Rules with the same right-hand side ``(rhs1, rhs2)`` are stored
+	contiguously, so that the probabilities of two children only need to be
+	combined once for all rules with that pair. Points to the rules of
+	``grammar``; changing the weights of the grammar is fine, but after
+	adding rules, a new matrix should be created.
+
+	:param grammar: a ``Grammar`` object with a PCFG."""
+	def __init__(self, Grammar grammar):
+		cdef ProbRule *rule
+		cdef Label rhs1
+		cdef uint32_t n
+		self.grammar = grammar
+		self.numbinary = grammar.numbinary
+		self.byrhs1.push_back(0)  # label 0 is not used
+		for rhs1 in range(1, grammar.nonterminals):
+			self.byrhs1.push_back(self.pairrhs2.size())
+			n = 0
+			rule = &(grammar.lbinary[rhs1][n])
+			order = []
+			while rule.rhs1 == rhs1:
+				order.append((rule.rhs2, n))
+				n += 1
+				rule = &(grammar.lbinary[rhs1][n])
+			for rhs2, m in sorted(order):
+				if (self.pairrhs2.size() == self.byrhs1[rhs1]
+						or self.pairrhs2.back() != rhs2):
+					self.pairrhs2.push_back(rhs2)
+					self.pairstart.push_back(self.rules.size())
+				self.rules.push_back(&(grammar.lbinary[rhs1][m]))
+		self.byrhs1.push_back(self.pairrhs2.size())
+		self.pairstart.push_back(self.rules.size())
+
+	def matches(self, Grammar grammar):
+		"""Test whether this matrix can be used with grammar."""
+		return grammar is self.grammar and grammar.numbinary == self.numbinary
+
+	def __reduce__(self):
+		return RuleMatrix, (self.grammar, )
+
+	def __repr__(self):
+		return '%s(%d rules, %d pairs of children)' % (
+				self.__class__.__name__, self.rules.size(),
+				self.pairrhs2.size())
+
+
 cdef class CFGChart(Chart):
 	"""A Chart for context-free grammars (CFG).
 
 	An item is a triple ``(start, end, label)``."""
 	def __init__(self, Grammar grammar, list sent,
-			start=None, logprob=True, viterbi=True):
-		raise NotImplementedError
+			start=None, logprob=True, viterbi=True, itemsestimate=None):
+		self.reset(grammar, sent, start, logprob, viterbi, itemsestimate)
+
+	def clear(self):
+		super(CFGChart, self).clear()
+		self.items.clear()
+		self.beambuckets.clear()
+
+	def nbytes(self):
+		return (super(CFGChart, self).nbytes()
+				+ self.items.capacity() * sizeof(uint64_t)
+				+ self.beambuckets.capacity() * sizeof(Prob))
 
 	cdef Label label(self, ItemNo itemidx):
 		raise NotImplementedError
@@ -49,8 +112,9 @@ cdef class DenseCFGChart(CFGChart):
 	mid <= end`` and ``label`` can be addressed. Whether it is feasible to use
 	this chart depends on the grammar constant, specifically the number of
 	non-terminal labels (and to a lesser extent the sentence length)."""
-	def __init__(self, Grammar grammar, list sent,
-			start=None, logprob=True, viterbi=True):
+	def reset(self, Grammar grammar, list sent,
+			start=None, logprob=True, viterbi=True, itemsestimate=None):
+		self.clear()
 		self.grammar = grammar
 		self.sent = sent
 		self.lensent = len(sent)
@@ -218,9 +282,10 @@ cdef class DenseCFGChart(CFGChart):
 @cython.final
 cdef class SparseCFGChart(CFGChart):
 	"""A CFG chart which uses a hash table suitable for large grammars."""
-	def __init__(self, Grammar grammar, list sent,
+	def reset(self, Grammar grammar, list sent,
 			start=None, logprob=True, viterbi=True, itemsestimate=None):
 		cdef uint64_t sentinel = cellstruct(0, 0)
+		self.clear()
 		self.grammar = grammar
 		self.sent = sent
 		self.lensent = len(sent)
@@ -239,6 +304,10 @@ cdef class SparseCFGChart(CFGChart):
 	def root(self):
 		return self.itemindex[cellstruct(0, self.lensent) + self.start]
 
+	def clear(self):
+		super(SparseCFGChart, self).clear()
+		self.itemindex.clear_no_resize()
+
 	cdef void addedge(self, uint64_t item, Idx mid, ProbRule *rule):
 		"""Add new edge to parse forest."""
 		cdef ItemNo itemidx = self.itemindex[item]
@@ -367,7 +436,8 @@ cdef class SparseCFGChart(CFGChart):
 
 def parse(sent, Grammar grammar, tags=None, start=None, whitelist=None,
 		Prob beam_beta=0.0, int beam_delta=50, itemsestimate=None,
-		postagging=None):
+		postagging=None, double timeout=0, size_t maxitems=0, pool=None,
+		int numthreads=1, RuleMatrix rulematrix=None):
 	"""PCFG parsing using CKY.
 
 	:param sent: A sequence of tokens that will be parsed.
@@ -389,27 +459,92 @@ def parse(sent, Grammar grammar, tags=None, start=None, whitelist=None,
 		Should be a negative log probability. Pass ``0.0`` to disable.
 	:param beam_delta: the maximum span length to which beam search is applied.
 	:param itemsestimate: the number of chart items to pre-allocate.
+	:param timeout, maxitems: if nonzero, abort parsing when more than
+		``timeout`` seconds of wall clock time have elapsed, or when the
+		number of chart items exceeds ``maxitems``. In that case the result
+		is ``(None, msg)``, with the limit that was exceeded in ``msg``, and
+		a chart obtained from ``pool`` is released to it.
+	:param pool: optionally, a :py:class:`discodop.containers.ChartPool`
+		from which the chart is obtained.
+	:param numthreads: if greater than 1, apply binary rules to the cells of
+		each span length in parallel with this number of threads. Only
+		applies to the dense chart, i.e., without whitelist and with
+		less than 20,000 non-terminals; otherwise a ``RuntimeWarning`` is
+		issued and a single thread is used. Requires compilation with
+		OpenMP.
+	:param rulematrix: optionally, a :py:class:`RuleMatrix` for ``grammar``;
+		apply binary rules by combining the items of two cells, with rules
+		grouped by their pair of children, instead of iterating over all
+		rules. Only applies to the dense chart; otherwise a
+		``RuntimeWarning`` is issued and the rule matrix is not used.
+		Cannot be combined with ``numthreads``.
 	"""
 	if grammar.maxfanout != 1:
 		raise ValueError('Not a PCFG! fanout: %d' % grammar.maxfanout)
 	if not grammar.logprob:
 		raise ValueError('Expected grammar with log probabilities.')
+	if numthreads > 1 and rulematrix is not None:
+		raise ValueError('numthreads cannot be combined with rulematrix.')
+	if numthreads > 1 and (
+			whitelist is not None or grammar.nonterminals >= 20000):
+		warnings.warn('numthreads ignored; only applies without whitelist '
+				'and with less than 20,000 non-terminals.', RuntimeWarning)
+	if rulematrix is not None and (
+			whitelist is not None or grammar.nonterminals >= 20000):
+		warnings.warn('rulematrix ignored; only applies without whitelist '
+				'and with less than 20,000 non-terminals.', RuntimeWarning)
 	if whitelist is None and grammar.nonterminals < 20000:
-		chart = DenseCFGChart(grammar, sent, start)
-		return parse_grammarloop[DenseCFGChart](
-				sent, <DenseCFGChart>chart, tags, beam_beta, beam_delta,
-				postagging)
-	chart = SparseCFGChart(grammar, sent, start, itemsestimate=itemsestimate)
-	if whitelist is None:
-		return parse_grammarloop[SparseCFGChart](
-				sent, <SparseCFGChart>chart, tags, beam_beta, beam_delta,
-				postagging)
-	return parse_leftchildloop(
-			sent, chart, tags, whitelist, beam_beta, beam_delta, postagging)
+		if pool is None:
+			chart = DenseCFGChart(grammar, sent, start)
+		else:
+			chart = pool.get(DenseCFGChart, grammar, sent, start)
+		if rulematrix is not None:
+			if not rulematrix.matches(grammar):
+				raise ValueError('rule matrix does not match grammar.')
+			result = parse_rulematrix(
+					sent, <DenseCFGChart>chart, rulematrix, tags, beam_beta,
+					beam_delta, postagging, timeout, maxitems)
+		elif numthreads > 1:
+			result = parse_parallel(
+					sent, <DenseCFGChart>chart, tags, beam_beta, beam_delta,
+					postagging, timeout, maxitems, numthreads)
+		else:
+			result = parse_grammarloop[DenseCFGChart](
+					sent, <DenseCFGChart>chart, tags, beam_beta, beam_delta,
+					postagging, timeout, maxitems)
+	else:
+		if pool is None:
+			chart = SparseCFGChart(grammar, sent, start,
+					itemsestimate=itemsestimate)
+		else:
+			chart = pool.get(SparseCFGChart, grammar, sent, start,
+					itemsestimate=itemsestimate)
+		if whitelist is None:
+			result = parse_grammarloop[SparseCFGChart](
+					sent, <SparseCFGChart>chart, tags, beam_beta, beam_delta,
+					postagging, timeout, maxitems)
+		else:
+			result = parse_leftchildloop(
+					sent, chart, tags, whitelist, beam_beta, beam_delta,
+					postagging, timeout, maxitems)
+	if result[0] is None and pool is not None:
+		pool.release(chart)  # parsing was aborted; the chart is not returned
+	return result
+
+
+cdef checkbudget(size_t numitems, double deadline, double timeout,
+		size_t maxitems):
+	"""Return a description of the limit that has been exceeded, or None."""
+	if maxitems and numitems > maxitems:
+		return 'maxitems=%d' % maxitems
+	elif deadline and walltime() > deadline:
+		return 'timeout=%gs' % timeout
+	return None
 
 
 cdef parse_grammarloop(sent, CFGChart_fused chart, tags,
-		Prob beam_beta, int beam_delta, postagging):
+		Prob beam_beta, int beam_delta, postagging,
+		double timeout, size_t maxitems):
 	"""A CKY parser modeled after Bodenstab's 'fast grammar loop'."""
 	cdef:
 		Grammar grammar = chart.grammar
@@ -425,6 +560,8 @@ cdef parse_grammarloop(sent, CFGChart_fused chart, tags,
 		ItemNo lastidx
 		size_t nts = grammar.nonterminals
 		bint usemask = grammar.mask.size() != 0
+		double deadline = walltime() + timeout if timeout else 0
+		object exceeded = None  # description of exceeded limit, if any
 	# Create matrices to track minima and maxima for binary splits.
 	n = (lensent + 1) * nts + 1
 	midfilter.minleft.resize(n, -1)
@@ -497,14 +634,266 @@ cdef parse_grammarloop(sent, CFGChart_fused chart, tags,
 
 			applyunaryrules[CFGChart_fused](chart, left, right, cell, lastidx,
 					unaryagenda, &midfilter, &blocked, None)
+			if maxitems or deadline:
+				exceeded = checkbudget(
+						chart.items.size(), deadline, timeout, maxitems)
+				if exceeded is not None:
+					break
+		if exceeded is not None:
+			break
+
+	msg = '%s%s, blocked %s' % (
+			'' if chart else 'no parse; ', chart.stats(), blocked)
+	if exceeded is not None:
+		return None, 'exceeded %s; %s' % (exceeded, msg)
+	return chart, msg
+
+
+cdef parse_rulematrix(sent, DenseCFGChart chart, RuleMatrix matrix, tags,
+		Prob beam_beta, int beam_delta, postagging,
+		double timeout, size_t maxitems):
+	"""A CKY parser that combines the items of two cells with a RuleMatrix.
+
+	For each split point, each item in the left cell is combined with the
+	items in the right cell for which there are rules; the probabilities of
+	the two children are added once for all rules with those children, and
+	only pairs of children which are both in the chart are considered."""
+	cdef:
+		Grammar grammar = chart.grammar
+		Agenda[Label, Prob] unaryagenda
+		vector[size_t] cellindex  # compact cell idx => itemidx
+		ProbRule *rule
+		Prob leftprob, pairprob, beam
+		Label rhs1
+		uint32_t p, r
+		uint64_t item, leftitem, leftcell, rightcell, cell, blocked = 0
+		ItemNo leftitemidx, lastidx
+		short left, right, mid, span, lensent = len(sent)
+		size_t ccell, nts = grammar.nonterminals
+		bint usemask = grammar.mask.size() != 0
+		double deadline = walltime() + timeout if timeout else 0
+		object exceeded = None  # description of exceeded limit, if any
+	cellindex.resize(compactcellidx(lensent - 1, lensent, lensent, 1) + 2, 0)
+	if beam_beta:
+		chart.beambuckets.resize(
+				compactcellidx(lensent - 1, lensent, lensent, 1) + 1,
+				INFINITY)
+	# assign POS tags
+	covered, msg = populatepos[DenseCFGChart](chart, sent, tags,
+			unaryagenda, None, &blocked, NULL, &cellindex, postagging)
+	if not covered:
+		return chart, msg
+
+	for span in range(2, lensent + 1):
+		beam = beam_beta if span <= beam_delta else 0.0
+		# constituents from left to right
+		for left in range(lensent - span + 1):
+			right = left + span
+			cell = cellidx(left, right, lensent, nts)
+			ccell = compactcellidx(left, right, lensent, 1)
+			cellindex[ccell] = lastidx = chart.items.size()
+			for mid in range(left + 1, right):
+				leftcell = cellidx(left, mid, lensent, nts)
+				rightcell = cellidx(mid, right, lensent, nts)
+				# the items of a cell are contiguous
+				leftitemidx = cellindex[compactcellidx(left, mid, lensent, 1)]
+				while leftitemidx < lastidx:
+					leftitem = chart.items[leftitemidx]
+					if leftitem - leftitem % nts != leftcell:
+						break
+					leftitemidx += 1
+					rhs1 = leftitem % nts
+					leftprob = chart._subtreeprob(leftitem)
+					for p in range(matrix.byrhs1[rhs1],
+							matrix.byrhs1[rhs1 + 1]):
+						pairprob = chart._subtreeprob(
+								rightcell + matrix.pairrhs2[p])
+						if isinf(pairprob):
+							continue
+						pairprob += leftprob
+						for r in range(matrix.pairstart[p],
+								matrix.pairstart[p + 1]):
+							rule = matrix.rules[r]
+							if usemask and TESTBIT(
+									&(grammar.mask[0]), rule.no):
+								continue
+							item = cell + rule.lhs
+							if chart.updateprob(
+									item, pairprob + rule.prob, beam):
+								chart.addedge(item, mid, rule)
+							else:
+								blocked += 1
+			# same order of items as parse_grammarloop
+			sort(chart.items.begin() + lastidx, chart.items.end())
+			applyunaryrules[DenseCFGChart](chart, left, right, cell, lastidx,
+					unaryagenda, NULL, &blocked, None)
+			if maxitems or deadline:
+				exceeded = checkbudget(
+						chart.items.size(), deadline, timeout, maxitems)
+				if exceeded is not None:
+					break
+		if exceeded is not None:
+			break
+
+	msg = '%s%s, blocked %s' % (
+			'' if chart else 'no parse; ', chart.stats(), blocked)
+	if exceeded is not None:
+		return None, 'exceeded %s; %s' % (exceeded, msg)
+	return chart, msg
+
+
+cdef parse_parallel(sent, DenseCFGChart chart, tags,
+		Prob beam_beta, int beam_delta, postagging,
+		double timeout, size_t maxitems, int numthreads):
+	"""A CKY parser that fills the cells of each span length in parallel.
+
+	The cells of a given span length only depend on cells of shorter spans,
+	so binary rules can be applied to them by multiple threads without the
+	GIL. Each cell collects its new items in a separate buffer; afterwards,
+	the items are added to the chart and unary rules are applied, in the
+	same order as ``parse_grammarloop``."""
+	cdef:
+		Grammar grammar = chart.grammar
+		Agenda[Label, Prob] unaryagenda
+		MidFilter midfilter
+		vector[vector[uint64_t]] newitems
+		vector[uint64_t] cellblocked
+		ProbRule **bylhs = &(grammar.bylhs[0])
+		uint64_t *mask = NULL
+		Prob *probs = &(chart.probs[0])
+		vector[Edge] *parseforest = &(chart.parseforest[0])
+		Prob *beambuckets = NULL
+		Prob beam
+		short left, right, span, lensent = len(sent)
+		uint64_t item, cell, blocked = 0
+		ItemNo lastidx
+		size_t n, nts = grammar.nonterminals
+		double deadline = walltime() + timeout if timeout else 0
+		object exceeded = None  # description of exceeded limit, if any
+	n = (lensent + 1) * nts + 1
+	midfilter.minleft.resize(n, -1)
+	midfilter.maxright.resize(n, -1)
+	midfilter.maxleft.resize(n, lensent + 1)
+	midfilter.minright.resize(n, lensent + 1)
+	if grammar.mask.size() != 0:
+		mask = &(grammar.mask[0])
+	if beam_beta:
+		chart.beambuckets.resize(
+				compactcellidx(lensent - 1, lensent, lensent, 1) + 1,
+				INFINITY)
+		beambuckets = &(chart.beambuckets[0])
+	# assign POS tags
+	covered, msg = populatepos[DenseCFGChart](chart, sent, tags,
+			unaryagenda, None, &blocked, &midfilter, NULL, postagging)
+	if not covered:
+		return chart, msg
+
+	newitems.resize(lensent)
+	cellblocked.resize(lensent)
+	for span in range(2, lensent + 1):
+		beam = beam_beta if span <= beam_delta else 0.0
+		# apply all binary rules, in parallel
+		with nogil:
+			for left in prange(lensent - span + 1, num_threads=numthreads,
+					schedule='dynamic'):
+				newitems[left].clear()
+				cellblocked[left] = 0
+				fillcell(left, left + span, lensent, nts, bylhs, mask,
+						&midfilter, probs, parseforest, beambuckets, beam,
+						&(newitems[left]), &(cellblocked[left]))
+		# constituents from left to right
+		for left in range(lensent - span + 1):
+			right = left + span
+			cell = cellidx(left, right, lensent, nts)
+			lastidx = chart.items.size()
+			for item in newitems[left]:
+				chart.items.push_back(item)
+				updatemidfilter(midfilter, left, right, item % nts, nts)
+			blocked += cellblocked[left]
+			applyunaryrules[DenseCFGChart](chart, left, right, cell, lastidx,
+					unaryagenda, &midfilter, &blocked, None)
+		if maxitems or deadline:
+			exceeded = checkbudget(
+					chart.items.size(), deadline, timeout, maxitems)
+			if exceeded is not None:
+				break
 
 	msg = '%s%s, blocked %s' % (
 			'' if chart else 'no parse; ', chart.stats(), blocked)
+	if exceeded is not None:
+		return None, 'exceeded %s; %s' % (exceeded, msg)
 	return chart, msg
 
 
+cdef void fillcell(short left, short right, short lensent, size_t nts,
+		ProbRule **bylhs, uint64_t *mask, MidFilter *midfilter, Prob *probs,
+		vector[Edge] *parseforest, Prob *beambuckets, Prob beam,
+		vector[uint64_t] *newitems, uint64_t *blocked) nogil:
+	"""Apply binary rules to a cell of a dense chart, without the GIL.
+
+	Only writes to the items of this cell; new items are appended to
+	``newitems``, while the mid point filter is not updated. Equivalent to
+	the binary rule loop and ``DenseCFGChart.updateprob``."""
+	cdef:
+		ProbRule *rule
+		Edge edge
+		short mid, narrowl, narrowr, widel, wider, minmid, maxmid
+		Prob prevprob, prob
+		Label lhs
+		uint32_t n
+		uint64_t item, leftitem, rightitem
+		uint64_t cell = cellidx(left, right, lensent, nts)
+		size_t ccell = compactcellidx(left, right, lensent, 1)
+	for lhs in range(1, nts):
+		n = 0
+		rule = &(bylhs[lhs][n])
+		item = lhs + cell
+		prevprob = probs[item]
+		while rule.lhs == lhs:
+			narrowr = midfilter.minright[left * nts + rule.rhs1]
+			narrowl = midfilter.minleft[right * nts + rule.rhs2]
+			if (rule.rhs2 == 0 or narrowr >= right or narrowl < narrowr
+					or (mask is not NULL and TESTBIT(mask, rule.no))):
+				n += 1
+				rule = &(bylhs[lhs][n])
+				continue
+			widel = midfilter.maxleft[right * nts + rule.rhs2]
+			minmid = narrowr if narrowr > widel else widel
+			wider = midfilter.maxright[left * nts + rule.rhs1]
+			maxmid = wider if wider < narrowl else narrowl
+			for mid in range(minmid, maxmid + 1):
+				leftitem = rule.rhs1 + cellidx(left, mid, lensent, nts)
+				rightitem = rule.rhs2 + cellidx(mid, right, lensent, nts)
+				prob = probs[leftitem]
+				if isinf(prob):
+					continue
+				prob += probs[rightitem]
+				if not isfinite(prob):
+					continue
+				prob += rule.prob
+				if beam:
+					if prob > beambuckets[ccell]:  # outside of beam
+						blocked[0] += 1
+						continue
+					elif prob + beam < beambuckets[ccell]:  # shrink beam
+						beambuckets[ccell] = prob + beam
+						probs[item] = prob
+					elif prob < probs[item]:
+						probs[item] = prob
+				elif prob < probs[item]:
+					probs[item] = prob
+				edge.rule = rule
+				edge.pos.lvec = mid
+				parseforest[item].push_back(edge)
+			n += 1
+			rule = &(bylhs[lhs][n])
+		if isinf(prevprob) and isfinite(probs[item]):
+			newitems.push_back(item)
+
+
 cdef parse_leftchildloop(sent, SparseCFGChart chart, tags,
-		Whitelist whitelist, Prob beam_beta, int beam_delta, postagging):
+		Whitelist whitelist, Prob beam_beta, int beam_delta, postagging,
+		double timeout, size_t maxitems):
 	"""A CKY parser that iterates over items in chart and compatible rules."""
 	cdef:
 		Grammar grammar = chart.grammar
@@ -520,6 +909,8 @@ cdef parse_leftchildloop(sent, SparseCFGChart chart, tags,
 		short left, right, mid, span, lensent = len(sent)
 		CFGItem li
 		bint usemask = grammar.mask.size() != 0
+		double deadline = walltime() + timeout if timeout else 0
+		object exceeded = None  # description of exceeded limit, if any
 	cellindex.resize(compactcellidx(lensent - 1, lensent, lensent, 1) + 2, 0)
 	if beam_beta:
 		chart.beambuckets.resize(
@@ -576,8 +967,17 @@ cdef parse_leftchildloop(sent, SparseCFGChart chart, tags,
 			applyunaryrules(chart, left, right, cell, lastidx, unaryagenda,
 					NULL, &blocked, whitelist)
 			cellindex[ccell + 1] = chart.items.size()
+			if maxitems or deadline:
+				exceeded = checkbudget(
+						chart.items.size(), deadline, timeout, maxitems)
+				if exceeded is not None:
+					break
+		if exceeded is not None:
+			break
 	msg = '%s%s, blocked %s' % (
 			'' if chart else 'no parse; ', chart.stats(), blocked)
+	if exceeded is not None:
+		return None, 'exceeded %s; %s' % (exceeded, msg)
 	return chart, msg
 
 
@@ -599,6 +999,8 @@ cdef populatepos(CFGChart_fused chart, sent, tags,
 		ItemNo lastidx
 		uint64_t cell, ccell = 0
 		uint32_t n
+		uint32_t *lexrules = NULL
+		size_t numlexrules = 0
 		short left, right, lensent = len(sent)
 		Prob openclassfactor = 0.001
 	for left, word in enumerate(sent):
@@ -617,10 +1019,11 @@ cdef populatepos(CFGChart_fused chart, sent, tags,
 		if cellindex is not NULL:
 			cellindex[0][ccell] = lastidx
 		recognized = False
-		it = grammar.lexicalbyword.find(word.encode('utf8'))
-		if it == grammar.lexicalbyword.end():
-			it = grammar.lexicalbyword.find(word.lower().encode('utf8'))
-		if it != grammar.lexicalbyword.end():
+		lexrules = grammar.lexrules(word.encode('utf8'), &numlexrules)
+		if lexrules is NULL:
+			lexrules = grammar.lexrules(
+					word.lower().encode('utf8'), &numlexrules)
+		if lexrules is not NULL:
 			if (postagging and tag is None
 					and not word.startswith('_UNK')
 					and postagging.method == 'unknownword'
@@ -629,7 +1032,7 @@ cdef populatepos(CFGChart_fused chart, sent, tags,
 				reserveprob = -pylog(1 - openclassfactor)
 			else:
 				reserveprob = 0
-			for n in dereference(it).second:
+			for n in lexrules[:numlexrules]:
 				lexrule = grammar.lexical[n]
 				if (whitelist is not None and whitelist.mapping[lexrule.lhs]
 						and whitelist.cfg[ccell].count(
@@ -651,9 +1054,9 @@ cdef populatepos(CFGChart_fused chart, sent, tags,
 				and word not in postagging.closedclasswords):
 			# add tags associated with signature, scale probabilities
 			sig = postagging.unknownwordfun(word, left, postagging.lexicon)
-			it = grammar.lexicalbyword.find(sig.encode('utf8'))
-			if it != grammar.lexicalbyword.end():
-				for n in dereference(it).second:
+			lexrules = grammar.lexrules(sig.encode('utf8'), &numlexrules)
+			if lexrules is not NULL:
+				for n in lexrules[:numlexrules]:
 					lexrule = grammar.lexical[n]
 					# avoid POS tag already considered above
 					if isfinite(chart._subtreeprob(cell + lexrule.lhs)):
@@ -682,7 +1085,7 @@ cdef populatepos(CFGChart_fused chart, sent, tags,
 					if midfilter is not NULL:
 						updatemidfilter(midfilter[0], left, right, lhs, nts)
 		if not recognized:
-			if tag is None and it == grammar.lexicalbyword.end():
+			if tag is None and lexrules is NULL:
 				return False, ('no parse: no gold POS tag given '
 						'and word %r not in lexicon' % word)
 			elif tag is not None and tag not in grammar.toid:
@@ -824,4 +1227,5 @@ def test():
 	cfg2 = Grammar(rules, start='S')
 	testsent('astronomers saw stars with telescopes', cfg2, 2)
 
-__all__ = ['CFGChart', 'DenseCFGChart', 'SparseCFGChart', 'parse']
+__all__ = ['CFGChart', 'DenseCFGChart', 'SparseCFGChart', 'RuleMatrix',
+		'parse']
@@ -27,6 +27,10 @@ ctypedef fused LCFRSItem_fused:
 	FatChartItem
 
 cdef class LCFRSChart(Chart):
+	cdef vector[vector[ItemNo]] bylabel  # label => popped items
+	cdef vector[Label] touched  # labels for which bylabel is not empty
+	cdef size_t bylabelbytes  # memory allocated for the lists in bylabel
+	cdef void addsibling(self, Label label, ItemNo itemidx)
 	cdef void addlexedge(self, ItemNo itemidx, short wordidx)
 	cdef void updateprob(self, ItemNo itemidx, Prob prob)
 	cdef void addprob(self, ItemNo itemidx, Prob prob)
@@ -5,9 +5,10 @@ from __future__ import print_function
 import re
 import logging
 import numpy as np
+from time import time as walltime
 from math import exp, log as pylog
 cimport cython
-from cython.operator cimport postincrement, dereference
+from cython.operator cimport dereference
 from libc.math cimport HUGE_VAL as INFINITY
 include "constants.pxi"
 
@@ -17,16 +18,52 @@ cdef FatChartItem FATNONE = FatChartItem(0)
 cdef FatChartItem FATCOMPONENT = FatChartItem(0)
 
 cdef class LCFRSChart(Chart):
-	"""A chart for LCFRS grammars. An item is a ChartItem object."""
+	"""A chart for LCFRS grammars. An item is a ChartItem object.
+
+	Besides an index of items, the chart keeps for each label a list of the
+	items with that label that have been popped from the agenda
+	(``bylabel``), from which siblings for binary rules are taken."""
 	def __init__(self, Grammar grammar, list sent,
 			start=None, logprob=True, viterbi=True,
 			itemsestimate=None):
+		self.reset(grammar, sent, start, logprob, viterbi, itemsestimate)
+
+	def reset(self, Grammar grammar, list sent,
+			start=None, logprob=True, viterbi=True,
+			itemsestimate=None):
+		self.clear()
 		self.grammar = grammar
 		self.sent = sent
 		self.lensent = len(sent)
 		self.start = grammar.toid[grammar.start if start is None else start]
 		self.logprob = logprob
 		self.viterbi = viterbi
+		if self.bylabel.size() < grammar.nonterminals:
+			self.bylabel.resize(grammar.nonterminals)
+
+	def clear(self):
+		cdef Label label
+		super(LCFRSChart, self).clear()
+		# only empty the lists that were used; keeps their capacity.
+		for label in self.touched:
+			self.bylabel[label].clear()
+		self.touched.clear()
+
+	def nbytes(self):
+		return (super(LCFRSChart, self).nbytes()
+				+ self.bylabel.capacity() * sizeof(vector[ItemNo])
+				+ self.touched.capacity() * sizeof(Label)
+				+ self.bylabelbytes)
+
+	cdef void addsibling(self, Label label, ItemNo itemidx):
+		"""Make a popped item available as a sibling for binary rules."""
+		cdef size_t capacity = self.bylabel[label].capacity()
+		if self.bylabel[label].empty():
+			self.touched.push_back(label)
+		self.bylabel[label].push_back(itemidx)
+		if self.bylabel[label].capacity() != capacity:
+			self.bylabelbytes += (self.bylabel[label].capacity()
+					- capacity) * sizeof(ItemNo)
 
 	cdef void addlexedge(self, ItemNo itemidx, short wordidx):
 		"""Add lexical edge."""
@@ -55,11 +92,11 @@ cdef class LCFRSChart(Chart):
 @cython.final
 cdef class SmallLCFRSChart(LCFRSChart):
 	"""For sentences that fit into a single machine word."""
-	def __init__(self, Grammar grammar, list sent,
+	def reset(self, Grammar grammar, list sent,
 			start=None, logprob=True, viterbi=True,
 			itemsestimate=None):
 		cdef SmallChartItem tmp = SmallChartItem(0, 0)
-		super(SmallLCFRSChart, self).__init__(
+		super(SmallLCFRSChart, self).reset(
 				grammar, sent, start, logprob, viterbi)
 		if itemsestimate is not None:
 			self.items.reserve(itemsestimate)
@@ -71,6 +108,16 @@ cdef class SmallLCFRSChart(LCFRSChart):
 		self.itemindex[tmp] = 0
 		self.probs.push_back(INFINITY)
 
+	def clear(self):
+		super(SmallLCFRSChart, self).clear()
+		self.items.clear()
+		self.itemindex.clear()
+		self.beambuckets.clear()
+
+	def nbytes(self):
+		return (super(SmallLCFRSChart, self).nbytes()
+				+ self.items.capacity() * sizeof(SmallChartItem))
+
 	cdef void addedge(self, ItemNo itemidx, ItemNo leftitemidx,
 			SmallChartItem& left, ProbRule *rule):
 		"""Add new edge."""
@@ -160,12 +207,12 @@ cdef class SmallLCFRSChart(LCFRSChart):
 @cython.final
 cdef class FatLCFRSChart(LCFRSChart):
 	"""LCFRS chart that supports longer sentences."""
-	def __init__(self, Grammar grammar, list sent,
+	def reset(self, Grammar grammar, list sent,
 			start=None, logprob=True, viterbi=True,
 			itemsestimate=None):
-		super(FatLCFRSChart, self).__init__(
-				grammar, sent, start, logprob, viterbi)
 		cdef FatChartItem tmp = FatChartItem(0)
+		super(FatLCFRSChart, self).reset(
+				grammar, sent, start, logprob, viterbi)
 		if itemsestimate is not None:
 			self.items.reserve(itemsestimate)
 			# NB: self.itemindex does not support reserve
@@ -175,6 +222,16 @@ cdef class FatLCFRSChart(LCFRSChart):
 		self.itemindex[tmp] = 0  # sentinel
 		self.probs.push_back(INFINITY)
 
+	def clear(self):
+		super(FatLCFRSChart, self).clear()
+		self.items.clear()
+		self.itemindex.clear()
+		self.beambuckets.clear()
+
+	def nbytes(self):
+		return (super(FatLCFRSChart, self).nbytes()
+				+ self.items.capacity() * sizeof(FatChartItem))
+
 	cdef void addedge(self, ItemNo itemidx, ItemNo leftitemidx,
 			FatChartItem& left, ProbRule *rule):
 		"""Add new edge and update viterbi probability."""
@@ -278,7 +335,8 @@ def parse(sent, Grammar grammar, tags=None, bint exhaustive=True,
 		start=None, Whitelist whitelist=None, bint splitprune=False,
 		bint markorigin=False, estimates=None,
 		Prob beam_beta=0.0, int beam_delta=50, itemsestimate=None,
-		postagging=None):
+		postagging=None, double timeout=0, size_t maxitems=0,
+		size_t maxagenda=0, pool=None):
 	"""Parse sentence and produce a chart.
 
 	:param sent: A sequence of tokens that will be parsed.
@@ -310,42 +368,65 @@ def parse(sent, Grammar grammar, tags=None, bint exhaustive=True,
 		Should be a negative log probability. Pass ``0.0`` to disable.
 	:param beam_delta: the maximum span length to which beam search is applied.
 	:param itemsestimate: the number of chart items to pre-allocate.
+	:param timeout, maxitems, maxagenda: if nonzero, abort parsing when more
+		than ``timeout`` seconds of wall clock time have elapsed, or when the
+		number of chart items or the size of the agenda exceeds the given
+		maximum. In that case the result is ``(None, msg)``, with the limit
+		that was exceeded in ``msg``, and a chart obtained from ``pool`` is
+		released to it.
+	:param pool: optionally, a :py:class:`discodop.containers.ChartPool`
+		from which the chart is obtained.
 	"""
 	if <unsigned>len(sent) < sizeof(COMPONENT.vec) * 8:
-		chart = SmallLCFRSChart(grammar, list(sent), start,
-			itemsestimate=itemsestimate)
-		return parse_main[SmallLCFRSChart, SmallChartItem](
+		if pool is None:
+			chart = SmallLCFRSChart(grammar, list(sent), start,
+				itemsestimate=itemsestimate)
+		else:
+			chart = pool.get(SmallLCFRSChart, grammar, list(sent), start,
+				itemsestimate=itemsestimate)
+		result = parse_main[SmallLCFRSChart, SmallChartItem](
 				<SmallLCFRSChart>chart,
 				<SmallChartItem>(<SmallLCFRSChart>chart)._root(),
 				sent, grammar, tags, exhaustive, whitelist,
 				splitprune, markorigin, estimates, beam_beta, beam_delta,
-				postagging)
-	chart = FatLCFRSChart(grammar, list(sent), start,
-			itemsestimate=itemsestimate)
-	return parse_main[FatLCFRSChart, FatChartItem](
-			<FatLCFRSChart>chart, <FatChartItem>(<FatLCFRSChart>chart)._root(),
-			sent, grammar, tags, exhaustive, whitelist,
-			splitprune, markorigin, estimates, beam_beta, beam_delta,
-			postagging)
+				postagging, timeout, maxitems, maxagenda)
+	else:
+		if pool is None:
+			chart = FatLCFRSChart(grammar, list(sent), start,
+					itemsestimate=itemsestimate)
+		else:
+			chart = pool.get(FatLCFRSChart, grammar, list(sent), start,
+					itemsestimate=itemsestimate)
+		result = parse_main[FatLCFRSChart, FatChartItem](
+				<FatLCFRSChart>chart,
+				<FatChartItem>(<FatLCFRSChart>chart)._root(),
+				sent, grammar, tags, exhaustive, whitelist,
+				splitprune, markorigin, estimates, beam_beta, beam_delta,
+				postagging, timeout, maxitems, maxagenda)
+	if result[0] is None and pool is not None:
+		pool.release(chart)  # parsing was aborted; the chart is not returned
+	return result
 
 
 cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
 		Grammar grammar, tags, bint exhaustive, Whitelist whitelist,
 		bint splitprune, bint markorigin, estimates,
-		Prob beam_beta, int beam_delta, postagging):
+		Prob beam_beta, int beam_delta, postagging,
+		double timeout, size_t maxitems, size_t maxagenda):
 	cdef:
 		Agenda[ItemNo, pair[Prob, Prob]] agenda  # prioritized items to explore
 		pair[ItemNo, pair[Prob, Prob]] entry
-		vector[ItemNo] sibvec
 		ProbRule *rule
-		LCFRSItem_fused item, sib, newitem, tmpitem
-		double [:, :, :, :] outside = None  # outside estimates, if provided
+		LCFRSItem_fused item, sib, newitem
+		float [:, :, :, :] outside = None  # outside estimates, if provided
 		Prob siblingprob, score, prob, newprob
 		short lensent = len(sent), estimatetype = 0
 		int length = 1, left = 0, right = 0, gaps = 0
 		ItemNo itemidx, sibidx
-		size_t blocked = 0, maxA = 0, n
+		size_t blocked = 0, maxA = 0, n, m, numsibs, popped = 0
+		double deadline = walltime() + timeout if timeout else 0
 		bint usemask = grammar.mask.size() != 0
+		object exceeded = None  # description of exceeded limit, if any
 	# avoid generating code for spurious fused type combinations
 	if ((LCFRSItem_fused is SmallChartItem
 			and LCFRSChart_fused is FatLCFRSChart)
@@ -357,10 +438,8 @@ cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
 		estimatetype = {'SX': SX, 'SXlrgaps': SXlrgaps}[estimatetypestr]
 	if LCFRSItem_fused is SmallChartItem:
 		newitem = SmallChartItem(0, 0)
-		tmpitem = SmallChartItem(0, 0)
 	elif LCFRSItem_fused is FatChartItem:
 		newitem = FatChartItem(0)
-		tmpitem = FatChartItem(0)
 	agenda.reserve(1024)
 
 	# assign POS tags
@@ -376,6 +455,9 @@ cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
 		itemidx = entry.first
 		prob = entry.second.second
 		item = chart.items[itemidx]
+		# first time this item is popped; make it available as sibling.
+		if chart.probs[itemidx] == INFINITY:
+			chart.addsibling(item.label, itemidx)
 		# store viterbi probability; cannot do this when this item is added to
 		# the agenda because that would give rise to duplicate edges.
 		chart.updateprob(itemidx, prob)
@@ -442,18 +524,12 @@ cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
 				# 	continue
 				elif usemask and TESTBIT(&(grammar.mask[0]), rule.no):
 					continue
-				tmpitem.label = rule.rhs1
-				itemidxit = chart.itemindex.lower_bound(tmpitem)
-				sibvec.clear()
-				while (itemidxit != chart.itemindex.end()
-						and dereference(itemidxit).first.label == rule.rhs1):
-					sib = dereference(itemidxit).first
-					sibidx = dereference(itemidxit).second
-					sibvec.push_back(sibidx)
-					postincrement(itemidxit)
-				for sibidx in sibvec:
+				# siblings are items with this label that have been popped;
+				# iterate by index to avoid copying the vector.
+				numsibs = chart.bylabel[rule.rhs1].size()
+				for m in range(numsibs):
+					sibidx = chart.bylabel[rule.rhs1][m]
 					sib = chart.items[sibidx]
-					postincrement(itemidxit)
 					if concat[LCFRSItem_fused](rule, &sib, &item):
 						newitem.label = rule.lhs
 						combine_item[LCFRSItem_fused](&newitem, &sib, &item)
@@ -506,16 +582,11 @@ cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
 				# 	continue
 				elif usemask and TESTBIT(&(grammar.mask[0]), rule.no):
 					continue
-				tmpitem.label = rule.rhs2
-				itemidxit = chart.itemindex.lower_bound(tmpitem)
-				sibvec.clear()
-				while (itemidxit != chart.itemindex.end()
-						and dereference(itemidxit).first.label == rule.rhs2):
-					sib = dereference(itemidxit).first
-					sibidx = dereference(itemidxit).second
-					sibvec.push_back(sibidx)
-					postincrement(itemidxit)
-				for sibidx in sibvec:
+				# siblings are items with this label that have been popped;
+				# iterate by index to avoid copying the vector.
+				numsibs = chart.bylabel[rule.rhs2].size()
+				for m in range(numsibs):
+					sibidx = chart.bylabel[rule.rhs2][m]
 					sib = chart.items[sibidx]
 					if concat[LCFRSItem_fused](rule, &item, &sib):
 						newitem.label = rule.lhs
@@ -562,8 +633,19 @@ cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
 							blocked += 1
 		if agenda.size() > maxA:
 			maxA = agenda.size()
+		popped += 1
+		if maxagenda and agenda.size() > maxagenda:
+			exceeded = 'maxagenda=%d' % maxagenda
+		elif maxitems and chart.items.size() > maxitems:
+			exceeded = 'maxitems=%d' % maxitems
+		elif deadline and popped % 1024 == 0 and walltime() > deadline:
+			exceeded = 'timeout=%gs' % timeout
+		if exceeded is not None:
+			break
 	msg = ('%s, blocked %d, agenda max %d, now %d' % (
 			chart.stats(), blocked, maxA, agenda.size()))
+	if exceeded is not None:
+		return None, 'exceeded %s; %s' % (exceeded, msg)
 	if not chart:
 		return chart, 'no parse; ' + msg
 	return chart, msg
@@ -652,11 +734,13 @@ cdef populatepos(Grammar grammar,
 	cdef:
 		LexicalRule lexrule
 		LCFRSItem_fused newitem
-		double [:, :, :, :] outside = None  # outside estimates, if provided
+		float [:, :, :, :] outside = None  # outside estimates, if provided
 		Prob score
 		short wordidx, lensent = len(sent), estimatetype = 0
 		int length = 1, left = 0, right = 0, gaps = 0
 		Label lhs
+		uint32_t *lexrules = NULL
+		size_t numlexrules = 0
 		bint recognized
 		Prob openclassfactor = 0.001
 	if estimates is not None:
@@ -684,10 +768,11 @@ cdef populatepos(Grammar grammar,
 			left = wordidx
 			gaps = 0
 			right = lensent - 1 - wordidx
-		it = grammar.lexicalbyword.find(word.encode('utf8'))
-		if it == grammar.lexicalbyword.end():
-			it = grammar.lexicalbyword.find(word.lower().encode('utf8'))
-		if it != grammar.lexicalbyword.end():
+		lexrules = grammar.lexrules(word.encode('utf8'), &numlexrules)
+		if lexrules is NULL:
+			lexrules = grammar.lexrules(
+					word.lower().encode('utf8'), &numlexrules)
+		if lexrules is not NULL:
 			if (postagging and tag is None
 					and not word.startswith('_UNK')
 					and postagging.method == 'unknownword'
@@ -696,7 +781,7 @@ cdef populatepos(Grammar grammar,
 				reserveprob = -pylog(1 - openclassfactor)
 			else:
 				reserveprob = 0
-			for n in dereference(it).second:
+			for n in lexrules[:numlexrules]:
 				lexrule = grammar.lexical[n]
 				if not tag or tagre.match(grammar.tolabel[lexrule.lhs]):
 					score = lexrule.prob
@@ -734,9 +819,9 @@ cdef populatepos(Grammar grammar,
 				and word not in postagging.closedclasswords):
 			# add tags associated with signature, scale probabilities
 			sig = postagging.unknownwordfun(word, wordidx, postagging.lexicon)
-			it = grammar.lexicalbyword.find(sig.encode('utf8'))
-			if it != grammar.lexicalbyword.end():
-				for n in dereference(it).second:
+			lexrules = grammar.lexrules(sig.encode('utf8'), &numlexrules)
+			if lexrules is not NULL:
+				for n in lexrules[:numlexrules]:
 					lexrule = grammar.lexical[n]
 					newitem.label = lexrule.lhs
 					if LCFRSItem_fused is SmallChartItem:
@@ -787,7 +872,7 @@ cdef populatepos(Grammar grammar,
 					else:
 						raise ValueError('tag %r is blocked.' % tag)
 		if not recognized:
-			if tag is None and it == grammar.lexicalbyword.end():
+			if tag is None and lexrules is NULL:
 				return False, ('no parse: no gold POS tag given '
 						'and word %r not in lexicon' % word)
 			elif tag is not None and tag not in grammar.toid:
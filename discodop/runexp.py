@@ -21,7 +21,7 @@ from . import eval as evalmod
 from . import (__version__, treebank, treebanktransforms, treetransforms,
 		grammar, lexicon, parser, estimates)
 from .treetransforms import binarizetree
-from .util import workerfunc
+from .util import workerfunc, scheduledimap, utilization
 from .containers import Grammar
 
 INTERNALPARAMS = None
@@ -516,16 +516,17 @@ def getgrammars(trees, sents, stages, testmaxwords, resultdir,
 				raise ValueError('estimates require parser w/agenda.')
 			begin = time.clock()
 			logging.info('computing %s estimates', stage.estimates)
+			filename = '%s/%s.outside.npy' % (resultdir, stage.name)
 			if stage.estimates == 'SX':
 				outside = estimates.getpcfgestimates(
 						gram, testmaxwords, trees[0].label)
+				np.save(filename, outside)
 			elif stage.estimates == 'SXlrgaps':
 				outside = estimates.getestimates(
-						gram, testmaxwords, trees[0].label)
+						gram, testmaxwords, trees[0].label,
+						filename=filename, numproc=numproc)
 			logging.info('estimates done. cpu time elapsed: %gs',
 					time.clock() - begin)
-			np.savez_compressed('%s/%s.outside.npz' % (
-					resultdir, stage.name), outside=outside)
 			logging.info('saved %s estimates', stage.estimates)
 		elif stage.estimates:
 			raise ValueError('unrecognized value; specify SX or SXlrgaps.')
@@ -555,15 +556,22 @@ def doparsing(**kwds):
 				golditems=dict.fromkeys(params.testset, 0),
 				totalgolditems=dict.fromkeys(params.testset, 0),
 				elapsedtime=dict.fromkeys(params.testset),
+				metrics=dict.fromkeys(params.testset),
 				evaluator=evalmod.Evaluator(params.evalparam), noparse=0)
+	stats = {}
+	begin = time.time()
 	if params.numproc == 1:
 		initworker(params)
 		dowork = (worker(a) for a in params.testset.items())
 	else:
 		pool = multiprocessing.Pool(processes=params.numproc,
 				initializer=initworker, initargs=(params,))
-		dowork = pool.imap_unordered(
-				mpworker, params.testset.items())
+		# dispatch the longest sentences first, to avoid a long sentence
+		# keeping a single worker busy at the end.
+		dowork = scheduledimap(pool, mpworker, params.testset.items(),
+				lambda item: parser.estimatecost(
+					[w for w, _ in item[1][0]], params.parser.stages),
+				len(params.testset), ordered=False, stats=stats)
 	logging.info('going to parse %d sentences.', len(params.testset))
 	# main parse loop over each sentence in test corpus
 	for nsent, data in enumerate(dowork, 1):
@@ -597,6 +605,7 @@ def doparsing(**kwds):
 			results[n].golditems[sentid] = result.golditems
 			results[n].totalgolditems[sentid] = result.totalgolditems
 			results[n].elapsedtime[sentid] = result.elapsedtime
+			results[n].metrics[sentid] = result.metrics
 			if result.noparse:
 				results[n].noparse += 1
 
@@ -640,6 +649,11 @@ def doparsing(**kwds):
 		pool.terminate()
 		pool.join()
 		del dowork, pool
+		logging.info('worker utilization:\n%s',
+				utilization(stats, time.time() - begin))
+	logging.info('metrics per stage:\n%s', parser.summarizemetrics(
+			[dict(stage=res.name, **res.metrics[n])
+				for n in params.testset for res in results]))
 
 	writeresults(results, params)
 	return results
@@ -705,6 +719,12 @@ def writeresults(results, params):
 				+ [getattr(res, field)[n] for field in fields[3:]]
 				for n in params.testset
 					for res in results)
+	with io.open('%s/metrics.jsonl' % params.resultdir, 'w',
+			encoding='utf8') as out:
+		out.writelines(json.dumps(dict(id=n, len=len(params.testset[n][2]),
+				stage=res.name, **res.metrics[n])) + '\n'
+				for n in params.testset
+					for res in results)
 
 	logging.info('wrote results to %s/%s%s.%s', params.resultdir, category,
 			(('{%s}' % ','.join(res.name for res in results))
@@ -0,0 +1,539 @@
+"""A query engine for tree patterns in the syntax of tgrep2.
+
+Queries are matched against trees represented as tables of nodes in preorder;
+such tables are produced from indexed treebanks with
+:py:meth:`discodop.containers.Ctrees.nodetable`, or from ``Tree`` objects.
+Labels and words are both nodes, as in tgrep2. Supported syntax:
+
+- labels: ``NP``, alternatives ``NP|PP``, any node ``__``, regular
+  expressions ``/^NP/`` (searched in the label, with ``/.../i`` ignoring
+  case). A plain label also matches labels with function tags and indices
+  after a hyphen or equals sign, i.e., ``NP`` matches ``NP-SBJ-1``.
+- negated labels ``!NP``; marks ``NP=x`` and back-references ``=x``.
+- relations between the head node and other nodes; all relations of
+  ``A < B < C`` apply to ``A``; use parentheses for nested relations:
+  ``A < (B < C)``. Relations may be negated (``A !< B``), combined with
+  ``|`` (or), and grouped with brackets: ``A [< B | < C] $ D``.
+- macros ``@NAME``, defined as ``@ NAME pattern;``.
+
+The relations are those of tgrep2::
+
+	A < B, A > B      A is the parent / a child of B.
+	A <N B, A >N B    B is the Nth child of A / A is the Nth child of B;
+	                  negative numbers count from the last child.
+	A <, B, A >, B    first child (synonymous with <1, >1).
+	A <- B, A >- B    last child (also <` and >`; synonymous with <-1, >-1).
+	A <: B, A >: B    B is the only child of A / A is the only child of B.
+	A << B, A >> B    A dominates B / A is dominated by B.
+	A <<, B, A >>, B  left-most descendant; A <<` B, A >>` B right-most.
+	A <<: B, A >>: B  single path of descent.
+	A . B, A , B      A immediately precedes / follows B.
+	A .. B, A ,, B    A precedes / follows B.
+	A $ B             A is a sister of B (and A != B).
+	A $. B, A $, B    A is a sister of and immediately precedes / follows B.
+	A $.. B, A $,, B  A is a sister of and precedes / follows B.
+	A = B             A is also matched by B.
+"""
+import re
+from .tree import Tree
+
+# a label does not start with a character that can start a relation
+LABEL = r'(?:\\.|[^\s()\[\]!|&;<>=$.,/@\\])(?:\\.|[^\s()\[\]!|&;<>=\\])*'
+TOKENRE = re.compile(r'''\s*(?:
+		(?P<regex>/(?:\\.|[^/\\])*/i?)
+		|(?P<rel><<[,`:]?|>>[,`:]?|<-?[0-9]+|>-?[0-9]+|<[,`:-]?|>[,`:-]?
+			|\$\.\.|\$,,|\$[.,]?|\.\.|,,|[.,]|=(?=\s))
+		|(?P<name>=[^\s()\[\]!|&;<>=]+)
+		|(?P<macro>@[^\s()\[\]!|&;<>=]+)
+		|(?P<label>%s(?:\|%s)*)
+		|(?P<punct>[()\[\]!|&])
+		)''' % (LABEL, LABEL), re.VERBOSE)
+MACRORE = re.compile(r'@\s*(\S+)\s+(.*)', re.DOTALL)
+BASECATRE = re.compile(r'^([^-=]+)[-=]')
+ALTRE = re.compile(r'(?<!\\)\|')
+UNESCAPERE = re.compile(r'\\(.)')
+# normalize relations with a child index to (relation, index)
+CHILDRELATIONS = {'<,': ('<N', 1), '<-': ('<N', -1), '<`': ('<N', -1),
+		'>,': ('>N', 1), '>-': ('>N', -1), '>`': ('>N', -1)}
+
+
+class NodeTable(object):
+	"""A tree as a table of nodes in preorder.
+
+	:param nodes: a sequence of tuples ``(label, parent, idx)``, as returned by
+		:py:meth:`discodop.containers.Ctrees.nodetable`; ``label`` is a
+		label or a word, ``parent`` is the index of the parent node (-1 for the
+		root), and ``idx`` is the sentence index of a word (-1 for other
+		nodes)."""
+
+	def __init__(self, nodes):
+		numnodes = len(nodes)
+		self.labels = [a[0] for a in nodes]
+		self.parent = [a[1] for a in nodes]
+		self.idx = [a[2] for a in nodes]
+		self.children = [[] for _ in nodes]
+		# the descendants of node i are the nodes i + 1 ... end[i] - 1
+		self.end = list(range(1, numnodes + 1))
+		# the first and last sentence index dominated by each node
+		self.first = [a if a >= 0 else numnodes for a in self.idx]
+		self.last = list(self.idx)
+		self.nodes = None
+		for i in range(1, numnodes):
+			self.children[self.parent[i]].append(i)
+		for i in range(numnodes - 1, 0, -1):
+			j = self.parent[i]
+			self.end[j] = max(self.end[j], self.end[i])
+			self.first[j] = min(self.first[j], self.first[i])
+			self.last[j] = max(self.last[j], self.last[i])
+
+	@classmethod
+	def fromtree(cls, tree, sent):
+		"""Create a table from a Tree with integer indices as leaves.
+
+		The attribute ``nodes`` maps each row of the table to the
+		corresponding Tree object or leaf index."""
+		nodes, objects = [], []
+		agenda = [(tree, -1)]
+		while agenda:
+			node, parent = agenda.pop()
+			objects.append(node)
+			if isinstance(node, Tree):
+				nodes.append((node.label, parent, -1))
+				agenda.extend((child, len(nodes) - 1)
+						for child in reversed(node))
+			else:
+				nodes.append((sent[node] or '', parent, node))
+		result = cls(nodes)
+		result.nodes = objects
+		return result
+
+	def __len__(self):
+		return len(self.labels)
+
+	def leaves(self, i=0):
+		"""Return the sentence indices of the words dominated by node ``i``."""
+		return [self.idx[j] for j in range(i, self.end[i])
+				if self.idx[j] >= 0]
+
+	def sent(self):
+		"""Return the words of the sentence as a list."""
+		result = [None] * (max(self.idx) + 1)
+		for label, idx in zip(self.labels, self.idx):
+			if idx >= 0:
+				result[idx] = label
+		return result
+
+	def tostring(self, i=0, disc=False):
+		"""Return the subtree at node ``i`` in (disc)bracket format.
+
+		>>> NodeTable.fromtree(*(Tree('(S (NP 0) (VP 1))'), ['I', 'ran'])
+		... 	).tostring()
+		'(S (NP I) (VP ran))'"""
+		if self.idx[i] >= 0:
+			if disc:
+				return '%d=%s' % (self.idx[i], self.labels[i])
+			return self.labels[i]
+		return '(%s %s)' % (self.labels[i], ' '.join(
+				self.tostring(j, disc) for j in self.children[i]))
+
+
+class NodePattern(object):
+	"""A node in a query: a label pattern and relations to other nodes."""
+
+	__slots__ = ('labels', 'regex', 'negated', 'name', 'backref', 'expr',
+			'_cache')
+
+	def __init__(self, label=None, negated=False, backref=None):
+		self.labels = self.regex = self.name = self.expr = None
+		self.negated = negated
+		self.backref = backref
+		self._cache = {}
+		if label is None or label in ('__', '*'):
+			pass
+		elif label.startswith('/'):
+			self.regex = re.compile(label[1:label.rindex('/')],
+					re.IGNORECASE if label.endswith('/i') else 0)
+		else:
+			self.labels = frozenset(UNESCAPERE.sub(r'\1', a)
+					for a in ALTRE.split(label))
+
+	def matchlabel(self, label):
+		"""Test whether this pattern matches a given label or word."""
+		try:
+			return self._cache[label]
+		except KeyError:
+			pass
+		if self.regex is not None:
+			result = self.regex.search(label) is not None
+		elif self.labels is not None:
+			result = (label in self.labels
+					or basecategory(label) in self.labels)
+		else:
+			result = True
+		result = self._cache[label] = result != self.negated
+		return result
+
+	def isconstraint(self):
+		"""Test whether a matching node must be present in a tree."""
+		return (self.backref is None and not self.negated
+				and (self.labels is not None or self.regex is not None))
+
+
+class TgrepQuery(object):
+	"""A compiled tgrep2 query.
+
+	:param query: a query string, e.g., ``'NP < (PP < IN=x)'``.
+	:param macros: a dictionary with macros that can be used in the query as
+		``@NAME``; cf. :py:func:`parsemacros`.
+
+	>>> tree, sent = Tree('(S (NP (DT 0) (NN 1)) (VP (VB 2)))'), [
+	... 		'the', 'cat', 'sat']
+	>>> query = TgrepQuery('NP < DT=x . VP')
+	>>> [(i, marked) for i, marked in query.matches(
+	... 		NodeTable.fromtree(tree, sent))]
+	[(1, [2])]"""
+
+	def __init__(self, query, macros=None):
+		self.query = query
+		self.macros = macros or {}
+		self._tokens = self._tokenize(query, ())
+		self._pos = 0
+		self.head = self._parsenode(True)
+		if self._pos != len(self._tokens):
+			raise ValueError('unexpected %r in query: %s' % (
+					self._tokens[self._pos][1], query))
+		del self._tokens
+
+	def matches(self, table):
+		"""Yield ``(i, marked)`` for each node ``i`` matching the query.
+
+		:param table: a :py:class:`NodeTable`.
+		:returns: ``marked`` is a sorted list of the nodes marked with
+			``=name`` in the query, or ``[i]`` if there are no marks."""
+		for i in range(len(table)):
+			marks = next(self._matchnode(self.head, table, i, {}), None)
+			if marks is not None:
+				yield i, sorted(set(marks.values())) or [i]
+
+	def constraints(self):
+		"""Return the patterns of nodes that must be present in a match.
+
+		These patterns can be used to select candidate trees with an index,
+		because they are not negated and not part of a disjunction."""
+		result = []
+		agenda = [self.head]
+		while agenda:
+			pattern = agenda.pop()
+			if isinstance(pattern, NodePattern):
+				if pattern.isconstraint():
+					result.append(pattern)
+				agenda.append(pattern.expr)
+			elif pattern is None:
+				pass
+			elif pattern[0] == 'and':
+				agenda.extend(pattern[1])
+			elif pattern[0] == 'rel':
+				agenda.append(pattern[3])
+		return result
+
+	def _tokenize(self, query, seen):
+		"""Split a query into tokens and expand macros."""
+		result = []
+		pos = 0
+		query = query.strip()
+		while pos < len(query):
+			match = TOKENRE.match(query, pos)
+			if match is None or match.end() == pos:
+				raise ValueError('syntax error at position %d in query: %s' % (
+						pos, query))
+			pos = match.end()
+			kind = match.lastgroup
+			token = match.group(kind)
+			if kind == 'macro':
+				name = token[1:]
+				if name not in self.macros:
+					raise ValueError('undefined macro: %s' % token)
+				elif name in seen:
+					raise ValueError('recursive macro: %s' % token)
+				result.extend(self._tokenize(
+						self.macros[name], seen + (name, )))
+			else:
+				result.append((kind, token))
+		return result
+
+	def _peek(self):
+		"""Return the current token, or a dummy token at the end."""
+		if self._pos < len(self._tokens):
+			return self._tokens[self._pos]
+		return (None, None)
+
+	def _expect(self, token):
+		"""Consume the given punctuation token or raise an error."""
+		if self._peek() != ('punct', token):
+			raise ValueError('expected %r in query: %s' % (token, self.query))
+		self._pos += 1
+
+	def _parsenode(self, head):
+		"""Parse a node pattern.
+
+		Only the head pattern takes relations without parentheses."""
+		kind, token = self._peek()
+		if (kind, token) == ('punct', '('):
+			self._pos += 1
+			pattern = self._parsenode(True)
+			self._expect(')')
+			if head:
+				pattern.expr = conjoin(pattern.expr, self._parseor())
+			return pattern
+		negated = (kind, token) == ('punct', '!')
+		if negated:
+			self._pos += 1
+			kind, token = self._peek()
+		if kind == 'name' and not negated:
+			pattern = NodePattern(backref=token[1:])
+		elif kind in ('label', 'regex'):
+			pattern = NodePattern(token, negated)
+		else:
+			raise ValueError('expected node label instead of %r in query: %s'
+					% (token, self.query))
+		self._pos += 1
+		kind, token = self._peek()
+		if kind == 'name' and pattern.backref is None:
+			pattern.name = token[1:]
+			self._pos += 1
+		if head:
+			pattern.expr = self._parseor()
+		return pattern
+
+	def _parseor(self):
+		"""Parse relations separated by ``|``."""
+		items = [self._parseand()]
+		while self._peek() == ('punct', '|'):
+			self._pos += 1
+			items.append(self._parseand())
+			if items[-1] is None:
+				raise ValueError('expected relation after "|" in query: %s'
+						% self.query)
+		if len(items) == 1:
+			return items[0]
+		elif items[0] is None:
+			raise ValueError('expected relation before "|" in query: %s'
+					% self.query)
+		return ('or', items)
+
+	def _parseand(self):
+		"""Parse a sequence of (negated, grouped) relations."""
+		items = []
+		while True:
+			kind, token = self._peek()
+			negated = (kind, token) == ('punct', '!')
+			if negated:
+				self._pos += 1
+				kind, token = self._peek()
+			if (kind, token) == ('punct', '&') and not negated:
+				self._pos += 1
+				continue
+			elif kind == 'rel':
+				self._pos += 1
+				item = ('rel', ) + parserelation(token) + (
+						self._parsenode(False), )
+			elif (kind, token) == ('punct', '['):
+				self._pos += 1
+				item = self._parseor()
+				self._expect(']')
+			elif negated:
+				raise ValueError('expected relation after "!" in query: %s'
+						% self.query)
+			else:
+				break
+			items.append(('not', item) if negated else item)
+		if not items:
+			return None
+		elif len(items) == 1:
+			return items[0]
+		return ('and', items)
+
+	def _matchnode(self, pattern, table, i, marks):
+		"""Yield the marks for each way that ``pattern`` matches node ``i``."""
+		if pattern.backref is not None:
+			if marks.get(pattern.backref) != i:
+				return
+		elif not pattern.matchlabel(table.labels[i]):
+			return
+		if pattern.name is not None:
+			if marks.get(pattern.name, i) != i:
+				return
+			marks = dict(marks)
+			marks[pattern.name] = i
+		yield from self._matchexpr(pattern.expr, table, i, marks)
+
+	def _matchexpr(self, expr, table, i, marks):
+		"""Yield the marks for each way that node ``i`` satisfies ``expr``."""
+		if expr is None:
+			yield marks
+		elif expr[0] == 'rel':
+			_, relation, arg, target = expr
+			for j in RELATIONS[relation](table, i, arg):
+				yield from self._matchnode(target, table, j, marks)
+		elif expr[0] == 'and':
+			yield from self._matchall(expr[1], 0, table, i, marks)
+		elif expr[0] == 'or':
+			for item in expr[1]:
+				yield from self._matchexpr(item, table, i, marks)
+		elif expr[0] == 'not':
+			for _ in self._matchexpr(expr[1], table, i, marks):
+				return
+			yield marks
+
+	def _matchall(self, items, n, table, i, marks):
+		"""Yield marks for each way that node ``i`` satisfies ``items[n:]``."""
+		if n == len(items):
+			yield marks
+			return
+		for marks1 in self._matchexpr(items[n], table, i, marks):
+			yield from self._matchall(items, n + 1, table, i, marks1)
+
+
+def conjoin(expr1, expr2):
+	"""Return the conjunction of two relation expressions (or None)."""
+	if expr1 is None:
+		return expr2
+	elif expr2 is None:
+		return expr1
+	return ('and', [expr1, expr2])
+
+
+def parserelation(token):
+	"""Return the relation and optional child index of a relation token.
+
+	>>> parserelation('<'), parserelation('<-2'), parserelation('>,')
+	(('<', None), ('<N', -2), ('>N', 1))"""
+	if token in CHILDRELATIONS:
+		return CHILDRELATIONS[token]
+	elif token[1:].lstrip('-').isdigit():
+		return token[0] + 'N', int(token[1:])
+	return token, None
+
+
+def parsemacros(data):
+	"""Parse macro definitions of the form ``@ NAME pattern;``.
+
+	>>> parsemacros('@ NP /^NP/;\\n@ NPPP @NP < PP;')
+	{'NP': '/^NP/', 'NPPP': '@NP < PP'}"""
+	result = {}
+	for definition in data.split(';'):
+		if definition.strip():
+			match = MACRORE.match(definition.strip())
+			if match is None:
+				raise ValueError('invalid macro definition: %r' % definition)
+			result[match.group(1)] = match.group(2).strip()
+	return result
+
+
+def basecategory(label):
+	"""Strip function tags and indices from a label.
+
+	>>> basecategory('NP-SBJ-1'), basecategory('-NONE-'), basecategory('NP=2')
+	('NP', '-NONE-', 'NP')"""
+	match = BASECATRE.match(label)
+	return label if match is None else match.group(1)
+
+
+def _nthchild(table, i, n):
+	"""The ``n``th child of node ``i``."""
+	children = table.children[i]
+	if (0 < n <= len(children)) or (-len(children) <= n < 0):
+		return [children[n - 1 if n > 0 else n]]
+	return []
+
+
+def _ancestors(table, i):
+	"""The ancestors of node ``i``, from the parent to the root."""
+	i = table.parent[i]
+	while i >= 0:
+		yield i
+		i = table.parent[i]
+
+
+def _descendantchain(table, i, pos):
+	"""Follow the child at ``pos`` of node ``i`` downwards.
+
+	With ``pos=None``, only follow children without sisters."""
+	children = table.children[i]
+	while children and (pos is not None or len(children) == 1):
+		i = children[0 if pos is None else pos]
+		yield i
+		children = table.children[i]
+
+
+def _ancestorchain(table, i, pos):
+	"""Inverse of :py:func:`_descendantchain`."""
+	parent = table.parent[i]
+	while parent >= 0:
+		children = table.children[parent]
+		if children[0 if pos is None else pos] != i or (
+				pos is None and len(children) != 1):
+			break
+		i = parent
+		yield i
+		parent = table.parent[i]
+
+
+def _sisters(table, i, offset):
+	"""Return the sisters of node ``i`` before or after it.
+
+	With ``offset < 0``, the sisters before ``i``; with ``offset > 0``, those
+	after it; with ``abs(offset) == 1``, only the adjacent sister."""
+	if table.parent[i] < 0:
+		return []
+	sisters = table.children[table.parent[i]]
+	n = sisters.index(i)
+	if offset == 1:
+		return sisters[n + 1:n + 2]
+	elif offset == -1:
+		return sisters[max(n - 1, 0):n]
+	elif offset > 0:
+		return sisters[n + 1:]
+	elif offset < 0:
+		return sisters[:n]
+	return sisters[:n] + sisters[n + 1:]
+
+
+# relation => function(table, i, arg) returning the nodes j such that
+# (i relation j) holds.
+RELATIONS = {
+		'<': lambda t, i, _: t.children[i],
+		'>': lambda t, i, _: [t.parent[i]] if t.parent[i] >= 0 else [],
+		'<N': _nthchild,
+		'>N': lambda t, i, n: [t.parent[i]] if t.parent[i] >= 0
+			and _nthchild(t, t.parent[i], n) == [i] else [],
+		'<:': lambda t, i, _: t.children[i] if len(t.children[i]) == 1
+			else [],
+		'>:': lambda t, i, _: [t.parent[i]] if t.parent[i] >= 0
+			and len(t.children[t.parent[i]]) == 1 else [],
+		'<<': lambda t, i, _: range(i + 1, t.end[i]),
+		'>>': lambda t, i, _: _ancestors(t, i),
+		'<<,': lambda t, i, _: _descendantchain(t, i, 0),
+		'>>,': lambda t, i, _: _ancestorchain(t, i, 0),
+		'<<`': lambda t, i, _: _descendantchain(t, i, -1),
+		'>>`': lambda t, i, _: _ancestorchain(t, i, -1),
+		'<<:': lambda t, i, _: _descendantchain(t, i, None),
+		'>>:': lambda t, i, _: _ancestorchain(t, i, None),
+		'.': lambda t, i, _: [j for j in range(len(t))
+			if t.first[j] == t.last[i] + 1],
+		',': lambda t, i, _: [j for j in range(len(t))
+			if t.last[j] == t.first[i] - 1],
+		'..': lambda t, i, _: [j for j in range(len(t))
+			if t.first[j] > t.last[i]],
+		',,': lambda t, i, _: [j for j in range(len(t))
+			if t.last[j] < t.first[i]],
+		'$': lambda t, i, _: _sisters(t, i, 0),
+		'$.': lambda t, i, _: _sisters(t, i, 1),
+		'$,': lambda t, i, _: _sisters(t, i, -1),
+		'$..': lambda t, i, _: _sisters(t, i, 2),
+		'$,,': lambda t, i, _: _sisters(t, i, -2),
+		'=': lambda t, i, _: [i],
+		}
+
+__all__ = ['NodeTable', 'NodePattern', 'TgrepQuery', 'parsemacros',
+		'parserelation', 'basecategory', 'conjoin']
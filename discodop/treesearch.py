@@ -11,9 +11,16 @@ import csv
 import sys
 import mmap
 import array
+import sre_parse
+import sre_constants
+import pickle
+import sqlite3
+import hashlib
+import time
+import threading
 import concurrent.futures
 import multiprocessing
-import subprocess
+from multiprocessing.util import Finalize
 from collections import Counter, OrderedDict, namedtuple
 from itertools import islice
 try:
@@ -22,16 +29,24 @@ try:
 except ImportError:
 	RE2LIB = False
 from roaringbitmap import RoaringBitmap, MultiRoaringBitmap
-from . import treebank, _fragments
+from . import treebank, tgrep, _fragments
 from .tree import Tree, DrawTree, DiscTree, brackettree, ptbunescape
 from .treetransforms import binarize, mergediscnodes, handledisc
-from .util import which, workerfunc, openread, ANSICOLOR
+from .util import workerfunc, openread, ANSICOLOR
 from .containers import Vocabulary, FixedVocabulary, Ctrees
 
 SHORTUSAGE = '''Search through treebanks with queries.
 Usage: discodop treesearch [-e (tgrep2|frag|regex)] [-t|-s|-c] \
 <query> <treebank1>...'''
-CACHESIZE = 32767
+CACHESIZE = 64 * 1024 * 1024  # maximum size of cached results in bytes
+CACHEDISKSIZE = 1024 * 1024 * 1024  # same, for the on-disk tier
+LABELIDS = {}  # cache for _labelids()
+TGREPSUFFIX = '.tgrep'  # TgrepSearcher indexes filename.tgrep.ct, etc.
+REGEXBATCH = {}  # cache for _regex_compile_batch()
+REGEXCHUNKSIZE = 1 << 22  # bytes per job in RegexSearcher.batchcounts()
+# memory-mapped treebanks, vocabularies, and indexes loaded by this process;
+# path => (object, mtime); cf. _getmapped()
+MAPPED = {}
 GETLEAVES = re.compile(r' (?:[0-9]+=)?([^ ()]+)(?=[ )])')
 LEAFINDICES = re.compile(r' ([0-9]+)=')
 LEAFINDICESWORDS = re.compile(r' ([0-9]+)=([^ ()]+)\)')
@@ -46,12 +61,16 @@ CorpusInfo = namedtuple('CorpusInfo',
 class CorpusSearcher(object):
 	"""Abstract base class to wrap corpus files that can be queried."""
 
-	def __init__(self, files, macros=None, numproc=None):
+	def __init__(self, files, macros=None, numproc=None, cachefile=None):
 		"""
 		:param files: a sequence of filenames of corpora
 		:param macros: a filename with macros that can be used in queries.
 		:param numproc: the number of concurrent threads / processes to use;
-			pass 1 to use a single core."""
+			pass 1 to use a single core.
+		:param cachefile: if given, the filename of an SQLite database in
+			which query results are stored, cf. :py:class:`ResultCache`;
+			the results are unpickled, so the file should be in a directory
+			that only trusted users can write to."""
 		if not isinstance(files, (list, tuple, set, dict)):
 			raise ValueError('"files" argument must be a sequence.')
 		for a in files:
@@ -61,7 +80,13 @@ class CorpusSearcher(object):
 		self.files = OrderedDict.fromkeys(files)
 		self.macros = macros
 		self.numproc = numproc or cpu_count()
-		self.cache = FIFOOrederedDict(CACHESIZE)
+		macrohash = None
+		if macros:
+			with open(macros, 'rb') as inp:
+				macrohash = hashlib.sha1(inp.read()).hexdigest()
+		self.cache = ResultCache(CACHESIZE, cachefile,
+				namespace='%s %s %s' % (
+					self.__class__.__name__, macros, macrohash))
 		self.pool = concurrent.futures.ThreadPoolExecutor(self.numproc)
 		if not self.files:
 			raise ValueError('no files found: %s' % files)
@@ -173,6 +198,13 @@ class CorpusSearcher(object):
 		"""Close files and free memory."""
 		pass
 
+	def warmup(self):
+		"""Load corpora and start worker processes before the first query.
+
+		Useful for long-running applications; otherwise, this work is done
+		when the first queries are submitted."""
+		pass
+
 	def _submit(self, func, *args, **kwargs):
 		"""Submit a job to the thread/process pool."""
 		if self.numproc == 1:
@@ -207,22 +239,47 @@ class CorpusSearcher(object):
 
 
 class TgrepSearcher(CorpusSearcher):
-	"""Search a corpus with tgrep2."""
-
-	def __init__(self, files, macros=None, numproc=None):
-		def convert(filename):
-			"""Convert files not ending in .t2c.gz to tgrep2 format."""
-			if filename.endswith('.t2c.gz'):
-				return filename
-			elif not os.path.exists(filename + '.t2c.gz'):
-				subprocess.check_call(
-						args=[which('tgrep2'), '-p', filename,
-							filename + '.t2c.gz'], shell=False,
-						stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-			return filename + '.t2c.gz'
-
-		super(TgrepSearcher, self).__init__(files, macros, numproc)
-		self.files = {convert(filename): None for filename in self.files}
+	"""Search a corpus with tgrep2 queries.
+
+	Queries are evaluated in-process with :py:mod:`discodop.tgrep`; trees
+	that cannot match are skipped with the index of labels and words of the
+	treebank. Treebanks may be in bracket, discbracket, or export format.
+
+	:param macros: a file with tgrep2 macro definitions of the form
+		``@ NAME pattern;``; an occurrence of ``@NAME`` in a query is replaced
+		with ``pattern``.
+	:param inmemory: if True, keep all corpora in memory; otherwise,
+		load them from disk with each query."""
+
+	def __init__(self, files, macros=None, numproc=None, inmemory=True,
+			cachefile=None):
+		super(TgrepSearcher, self).__init__(files, macros, numproc, cachefile)
+		self.vocab, self.vocabpath, _ = _prepare_ctrees(
+				self.files, TGREPSUFFIX)
+		if inmemory:
+			for filename in self.files:
+				self.files[filename] = Ctrees.fromfile(
+						'%s%s.ct' % (filename, TGREPSUFFIX))
+		self.macros = None
+		if macros:
+			with openread(macros) as tmp:
+				self.macros = tgrep.parsemacros(tmp.read())
+		self.pool = concurrent.futures.ProcessPoolExecutor(
+				self.numproc, initializer=_initworker,
+				initargs=(list(self.files), self.vocabpath, TGREPSUFFIX))
+
+	def close(self):
+		self.pool.shutdown()
+		_detach(self.files, self.vocabpath, TGREPSUFFIX)
+		if hasattr(self.vocab, 'close'):
+			self.vocab.close()
+		for a in self.files.values():
+			if a is not None:
+				a.close()
+		self.vocab = self.files = None
+
+	def warmup(self):
+		_warmup(self, TGREPSUFFIX)
 
 	def counts(self, query, subset=None, start=None, end=None, indices=False,
 			breakdown=False):
@@ -231,41 +288,37 @@ class TgrepSearcher(CorpusSearcher):
 		subset = subset or self.files
 		result = OrderedDict()
 		jobs = {}
-		# %s the sentence number
-		fmt = r'%s\n:::\n'
+		tgrep.TgrepQuery(query, self.macros)  # raise syntax errors early
+		mode = 'breakdown' if breakdown else 'indices' if indices else 'counts'
 		for filename in subset:
 			try:
 				result[filename] = self.cache[
 						'counts', query, filename, start, end, indices,
 						breakdown]
 			except KeyError:
-				if indices:
-					jobs[self._submit(lambda x: [n for n, _
-							in self._query(query, x, fmt, start, end, None)],
-							filename)] = filename
-				elif breakdown:
-					jobs[self._submit(lambda x: Counter(match for _, match in
-							self._query(query, x, r'%s\n%m:::\n', start, end,
-							None)), filename)] = filename
-				else:
-					jobs[self._submit(lambda x: sum(1 for _
-						in self._query(query, x, fmt, start, end, None)),
-						filename)] = filename
+				jobs[self._submit(
+						_tgrep_query if self.numproc == 1 else _tgrep_query_mp,
+						query, self.macros, filename, self.vocabpath,
+						start, end, None, mode)] = filename
 		for future in self._as_completed(jobs):
 			filename = jobs[future]
+			tmp = future.result()
+			if breakdown:
+				tmp = Counter(match for _, match in tmp)
+			elif indices:
+				tmp = [sentno for sentno, _ in tmp]
+			else:
+				tmp = len(tmp)
 			self.cache['counts', query, filename, start, end, indices,
-					breakdown] = result[filename] = future.result()
+					breakdown] = result[filename] = tmp
 		return result
 
 	def trees(self, query, subset=None, start=None, end=None, maxresults=10,
 			nofunc=False, nomorph=False):
 		subset = subset or self.files
-		# %s the sentence number
-		# %w complete tree in bracket notation
-		# %m all marked nodes, or the head node if none are marked
-		fmt = r'%s\n%w\n%m:::\n'
 		result = []
 		jobs = {}
+		tgrep.TgrepQuery(query, self.macros)
 		for filename in subset:
 			try:
 				x, maxresults2 = self.cache['trees', query, filename,
@@ -273,36 +326,27 @@ class TgrepSearcher(CorpusSearcher):
 			except KeyError:
 				maxresults2 = 0
 			if not maxresults or maxresults > maxresults2:
-				jobs[self._submit(lambda x: list(self._query(
-						query, x, fmt, start, end, maxresults)),
-						filename)] = filename
+				jobs[self._submit(
+						_tgrep_query if self.numproc == 1 else _tgrep_query_mp,
+						query, self.macros, filename, self.vocabpath,
+						start, end, maxresults, 'trees')] = filename
 			else:
 				result.extend(x[:maxresults])
 		for future in self._as_completed(jobs):
 			filename = jobs[future]
 			x = []
-			for sentno, line in future.result():
-				lines = line.splitlines()
-				treestr, matches = lines[0], lines[1:]
-				treestr = filterlabels(treestr, nofunc, nomorph)
-				treestr = treestr.replace(" )", " -NONE-)")
-				for match in matches:
-					if match.startswith('('):
-						treestr = treestr.replace(match, '%s_HIGH %s' % tuple(
-								match.split(None, 1)), 1)
-					else:
-						match = ' %s)' % match
-						treestr = treestr.replace(match, '_HIGH%s' % match)
-
-				tree, sent = brackettree(treestr)
-				tree = mergediscnodes(tree)
-				high = list(tree.subtrees(lambda n: n.label.endswith("_HIGH")))
+			for sentno, (treestr, marked) in future.result():
+				tree, sent = brackettree(
+						filterlabels(treestr, nofunc, nomorph))
+				table = tgrep.NodeTable.fromtree(tree, sent)
 				tmp = {}
-				for marked in high:
-					marked.label = marked.label.rsplit("_", 1)[0]
-					for node in marked.subtrees():
-						tmp[id(node)] = node
-					tmp.update((id(a), a) for a in marked.leaves())
+				for i in marked:
+					if table.idx[i] >= 0:  # highlight preterminal of a word
+						i = table.parent[i]
+					node = table.nodes[i]
+					for a in node.subtrees():
+						tmp[id(a)] = a
+					tmp.update((id(a), a) for a in node.leaves())
 				x.append((filename, sentno, tree, sent, list(tmp.values())))
 			self.cache['trees', query, filename, start, end,
 					nofunc, nomorph] = x, maxresults
@@ -312,12 +356,9 @@ class TgrepSearcher(CorpusSearcher):
 	def sents(self, query, subset=None, start=None, end=None, maxresults=100,
 			brackets=False):
 		subset = subset or self.files
-		# %s the sentence number
-		# %w complete tree in bracket notation
-		# %m all marked nodes, or the head node if none are marked
-		fmt = r'%s\n%w\n%m:::\n'
 		result = []
 		jobs = {}
+		tgrep.TgrepQuery(query, self.macros)
 		for filename in subset:
 			try:
 				x, maxresults2 = self.cache['sents', query, filename,
@@ -325,34 +366,23 @@ class TgrepSearcher(CorpusSearcher):
 			except KeyError:
 				maxresults2 = 0
 			if not maxresults or maxresults > maxresults2:
-				jobs[self._submit(lambda x: list(self._query(
-						query, x, fmt, start, end, maxresults)),
-						filename)] = filename
+				jobs[self._submit(
+						_tgrep_query if self.numproc == 1 else _tgrep_query_mp,
+						query, self.macros, filename, self.vocabpath,
+						start, end, maxresults,
+						'brackets' if brackets else 'sents')] = filename
 			else:
 				result.extend(x[:maxresults])
 		for future in self._as_completed(jobs):
 			filename = jobs[future]
 			x = []
-			for sentno, line in future.result():
-				lines = line.splitlines()
-				sent, matches = lines[0], lines[1:]
+			for sentno, (sent, match1) in future.result():
 				if brackets:
-					match1 = matches[0]
 					match2 = ''
 				else:
-					tmp = set()
-					for match in matches:
-						idx = sent.index(match if match.startswith('(')
-								else ' %s)' % match)
-						prelen = len(' '.join(ptbunescape(token) for token
-								in GETLEAVES.findall(sent[:idx])))
-						match = (' '.join(ptbunescape(token) for token
-								in GETLEAVES.findall(match))
-								if '(' in match else ptbunescape(match))
-						tmp.update(range(prelen, prelen + len(match) + 1))
-					sent = ' '.join(ptbunescape(token)
-							for token in GETLEAVES.findall(sent))
-					match1 = tmp
+					sent = [ptbunescape(token) for token in sent]
+					match1 = charindices(sent, match1)
+					sent = ' '.join(sent)
 					match2 = set()
 				x.append((filename, sentno, sent, match1, match2))
 			self.cache['sents', query, filename,
@@ -362,88 +392,274 @@ class TgrepSearcher(CorpusSearcher):
 
 	def extract(self, filename, indices,
 			nofunc=False, nomorph=False, sents=False):
-		if not filename.endswith('.t2c.gz'):
-			filename += '.t2c.gz'
-		cmd = [which('tgrep2'),
-				'-e', '-',  # extraction mode
-				'-c', filename]
-		if sents:
-			cmd.append('-t')
-		proc = subprocess.Popen(args=cmd,
-				bufsize=0,
-				shell=False,
-				stdin=subprocess.PIPE,
-				stdout=subprocess.PIPE,
-				stderr=subprocess.PIPE)
-		out, err = proc.communicate((''.join(
-				'%d:1\n' % n for n in indices if n > 0)).encode('utf8'))
-		proc.stdout.close()
-		proc.stderr.close()
-		if proc.returncode != 0:
-			raise ValueError(err.decode('utf8'))
-		result = out.decode('utf8').splitlines()
+		if self.files[filename] is not None:
+			corpus = self.files[filename]
+		else:
+			corpus = Ctrees.fromfile('%s%s.ct' % (filename, TGREPSUFFIX))
 		if sents:
-			return result
-		return [(mergediscnodes(tree), sent)
-				for tree, sent
-				in (brackettree(filterlabels(
-					treestr, nofunc, nomorph)) for treestr in result)]
+			return [' '.join(ptbunescape(token)
+					for token in corpus.extractsent(n - 1, self.vocab))
+					for n in indices]
+		return [brackettree(filterlabels(tgrep.NodeTable(
+					corpus.nodetable(n - 1, self.vocab)).tostring(disc=True),
+					nofunc, nomorph))
+				for n in indices]
 
 	def getinfo(self, filename):
-		if filename.endswith('.t2c.gz'):
-			filename = filename[:-len('.t2c.gz')]
-		with openread(filename) as inp:
-			data = inp.read()
-		return CorpusInfo(
-				len=data.count('\n'),
-				numwords=len(GETLEAVES.findall(data)),
-				numnodes=data.count('('),
-				maxnodes=None)
-
-	@workerfunc
-	def _query(self, query, filename, fmt, start=None, end=None,
-			maxresults=None):
-		"""Run a query on a single file."""
-		cmd = [which('tgrep2'), '-a',  # print all matches for each sentence
-				# '-z',  # pretty-print search pattern on stderr
-				'-m', fmt,
-				'-c', os.path.join(filename)]
-		if self.macros:
-			cmd.append(self.macros)
-		cmd.append(query)
-		proc = subprocess.Popen(
-				args=cmd, shell=False, bufsize=0,
-				stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-		linere = re.compile(r'([0-9]+)\n(.*?):::\n', flags=re.DOTALL)
-		if start or end or maxresults:
-			start = start or 1
-			results = []
-			for n, match in enumerate(linere.finditer(
-					proc.stdout.read().decode('utf8'))):
-				m, a = int(match.group(1)), match.group(2)
-				if m < start:
-					continue
-				elif (end and m > end) or (maxresults and n >= maxresults):
-					proc.stdout.close()
-					proc.stderr.close()
-					proc.terminate()
-					return results
-				results.append((m, a))
-			if proc.wait() != 0:
-				proc.stdout.close()
-				err = proc.stderr.read().decode('utf8')
-				proc.stderr.close()
+		if self.files[filename] is not None:
+			corpus = self.files[filename]
 		else:
-			out, err = proc.communicate()
-			out = out.decode('utf8')
-			err = err.decode('utf8')
-			proc.stdout.close()
-			proc.stderr.close()
-			results = ((int(match.group(1)), match.group(2)) for match
-					in linere.finditer(out))
-		if proc.returncode != 0:
-			raise ValueError(err)
-		return results
+			corpus = Ctrees.fromfile('%s%s.ct' % (filename, TGREPSUFFIX))
+		return CorpusInfo(len=corpus.len, numwords=corpus.numwords,
+				numnodes=corpus.numnodes, maxnodes=corpus.maxnodes)
+
+
+@workerfunc
+def _tgrep_query_mp(query, macros, filename, vocabpath, start=None, end=None,
+		maxresults=None, mode='counts'):
+	"""Multiprocessing wrapper."""
+	return _tgrep_query(query, macros, filename, vocabpath, start, end,
+			maxresults, mode)
+
+
+def _tgrep_query(query, macros, filename, vocabpath, start=None, end=None,
+		maxresults=None, mode='counts'):
+	"""Run a tgrep2 query on a single file.
+
+	:param mode: one of 'counts', 'indices', 'breakdown', 'trees', 'sents',
+		or 'brackets'; determines what is returned for each match.
+	:returns: a list of tuples ``(sentno, match)``, with one tuple for each
+		node that matches the query (as with ``tgrep2 -a``)."""
+	cquery = tgrep.TgrepQuery(query, macros)
+	corpus = _getmapped('%s%s.ct' % (filename, TGREPSUFFIX), Ctrees.fromfile)
+	vocab = _getmapped(vocabpath, FixedVocabulary.fromfile)
+	start = (start or 1) - 1
+	end = min(end or corpus.len, corpus.len)
+	candidates = None
+	index = _getmapped('%s%s.labels.idx' % (filename, TGREPSUFFIX),
+			MultiRoaringBitmap.fromfile)
+	byname, bybase = _labelids(vocab, vocabpath)
+	# select trees containing nodes for each label that must be matched
+	for pattern in cquery.constraints():
+		if pattern.labels is not None:  # look up labels and base categories
+			ids = {n for label in pattern.labels
+					for n in bybase.get(label, ())}
+		else:  # match regex against each label and word
+			ids = {n for label, items in byname.items()
+					if pattern.matchlabel(label) for n in items}
+		tmp = RoaringBitmap().union(*[index.get(n) for n in ids
+				if index.get(n) is not None])
+		candidates = tmp if candidates is None else candidates & tmp
+		if not candidates:
+			break
+	if candidates is None:
+		candidates = range(start, end)
+	elif candidates:  # clamp() fails on an empty bitmap
+		candidates = candidates.clamp(start, end)
+	result = []
+	for n in candidates:
+		table = tgrep.NodeTable(corpus.nodetable(n, vocab))
+		for i, marked in cquery.matches(table):
+			if mode in ('counts', 'indices'):
+				match = None
+			elif mode == 'breakdown':
+				match = '\n'.join(table.tostring(j) for j in marked)
+			elif mode == 'trees':
+				match = table.tostring(disc=True), marked
+			elif mode == 'brackets':
+				match = table.tostring(), table.tostring(marked[0])
+			elif mode == 'sents':
+				match = table.sent(), {idx for j in marked
+						for idx in table.leaves(j)}
+			else:
+				raise ValueError('unknown mode: %r' % mode)
+			result.append((n + 1, match))
+			if maxresults and len(result) >= maxresults:
+				return result
+	return result
+
+
+def _labelids(vocab, vocabpath):
+	"""Return the positions of labels and words in a label index.
+
+	:returns: a tuple of dictionaries ``(byname, bybase)``; ``byname`` maps
+		each label and word to its positions in the index created by
+		:py:func:`_makelabelindex`; ``bybase`` maps each label and word, and
+		each base category of a label (cf. :py:func:`tgrep.basecategory`),
+		to the positions of the labels and words that a tgrep2 pattern
+		with that label matches. Binarization labels are left out, because
+		they are not part of the node tables that are matched.
+		The result is cached per process."""
+	key = vocabpath, os.stat(vocabpath).st_mtime
+	if key not in LABELIDS:
+		LABELIDS.clear()
+		byname, bybase = {}, {}
+		if vocab.labels is None:
+			vocab.makeindex()
+		numlabels = len(vocab.labels)
+		for offset, items in zip((0, numlabels), vocab.labelprods()):
+			for label in items:
+				if '|<' not in label:
+					byname.setdefault(label, []).append(
+							offset + vocab.labels[label])
+		for label, items in byname.items():
+			bybase.setdefault(label, []).extend(items)
+			base = tgrep.basecategory(label)
+			if base != label:
+				bybase.setdefault(base, []).extend(items)
+		LABELIDS[key] = byname, bybase
+	return LABELIDS[key]
+
+
+def _prepare_ctrees(files, suffix=''):
+	"""Create or load indexed treebanks and a vocabulary shared by them.
+
+	Given ``filename``, an indexed version is stored as ``filename.ct``; the
+	vocabulary is stored in the same directory as ``treesearchvocab.idx``.
+	An index of the trees containing each label and word is stored as
+	``filename.labels.idx``; cf. :py:func:`_makelabelindex`.
+
+	:param files: a sequence of filenames; the format is inferred from the
+		extension (.export, .dbr, otherwise bracket).
+	:param suffix: inserted before the extensions of the indexed files and
+		the vocabulary (e.g., ``filename.tgrep.ct``), so that searchers of
+		different kinds do not overwrite each other's files.
+	:returns: a tuple ``(vocab, vocabpath, disc)``, where ``disc`` is True
+		if any of the files may contain discontinuous trees."""
+	fmts = {filename: _treebankformat(filename) for filename in files}
+	disc = any(fmt != 'bracket' for fmt in fmts.values())
+	path = os.path.dirname(next(iter(sorted(files))))
+	vocabpath = os.path.join(path, 'treesearchvocab%s.idx' % suffix)
+	newvocab = True
+	if os.path.exists(vocabpath):
+		vocab = FixedVocabulary.fromfile(vocabpath)
+		mtime = os.stat(vocabpath).st_mtime
+		if all(os.path.exists('%s%s.ct' % (a, suffix))
+					and mtime > os.stat('%s%s.ct' % (a, suffix)).st_mtime
+					> os.stat(a).st_mtime for a in files):
+			vocab.makeindex()
+			newvocab = False
+	if newvocab:
+		vocab = Vocabulary()
+		for filename in files:
+			corpus = _fragments.readtreebank(
+					filename, vocab, fmt=fmts[filename])
+			corpus.indextrees(vocab)
+			corpus.tofile('%s%s.ct' % (filename, suffix))
+		vocab.tofile(vocabpath)
+	for filename in files:
+		indexpath = '%s%s.labels.idx' % (filename, suffix)
+		if (newvocab or not os.path.exists(indexpath)
+				or os.stat(indexpath).st_mtime
+				< os.stat('%s%s.ct' % (filename, suffix)).st_mtime):
+			_makelabelindex(filename, vocab, suffix)
+	return vocab, vocabpath, disc
+
+
+def _treebankformat(filename):
+	"""Return the format of a treebank, inferred from its extension."""
+	if filename.endswith('.t2c.gz'):
+		raise ValueError('%s: tgrep2 corpus files are not supported; '
+				'use the treebank from which it was created.' % filename)
+	return {'export': 'export', 'dbr': 'discbracket'}.get(
+			filename.rsplit('.', 1)[-1], 'bracket')
+
+
+def _makelabelindex(filename, vocab, suffix=''):
+	"""Create an index of the trees containing each label and word.
+
+	The index is a MultiRoaringBitmap stored as ``filename.labels.idx``, with
+	the trees for each label ID of ``vocab``, followed by the trees for each
+	word (with the same IDs, offset by the number of labels). An index of
+	preterminals is not needed, because it is equivalent to the index of
+	lexical productions."""
+	corpus = Ctrees.fromfile('%s%s.ct' % (filename, suffix))
+	prodindex = corpus.prodindex
+	labelprods, wordprods = vocab.labelprods()
+	numlabels = len(vocab.labels)
+	result = [None] * (2 * numlabels)
+	for offset, items in ((0, labelprods), (numlabels, wordprods)):
+		for label, prods in items.items():
+			result[offset + vocab.labels[label]] = RoaringBitmap().union(
+					*[prodindex[prod] for prod in prods
+					if prod < len(prodindex) and prodindex[prod] is not None])
+	MultiRoaringBitmap(result, filename='%s%s.labels.idx' % (filename, suffix))
+	corpus.close()
+
+
+def _labelcandidates(index, labelids, wordids, start, end):
+	"""Return the trees in an interval that contain all labels and words.
+
+	:param index: a label index as created by :py:func:`_makelabelindex`.
+	:param labelids, wordids: sequences of label IDs; -1 for unknown labels.
+	"""
+	numlabels = len(index) // 2
+	if any(a < 0 or a >= numlabels for a in labelids + wordids):
+		return RoaringBitmap()
+	return index.intersection(labelids + [numlabels + a for a in wordids],
+			start=start, stop=end) or RoaringBitmap()
+
+
+def _getmapped(path, loader):
+	"""Return the memory-mapped object for ``path``, cached in this process.
+
+	The object is shared by all queries handled by this process; the data is
+	not copied, but read from the OS page cache shared by all processes.
+
+	:param loader: a function that loads the object, e.g.,
+		``Ctrees.fromfile``; called again when the file has been modified,
+		after closing the object that it replaces."""
+	mtime = os.stat(path).st_mtime
+	if path not in MAPPED or MAPPED[path][1] != mtime:
+		if path in MAPPED:
+			MAPPED.pop(path)[0].close()
+		MAPPED[path] = loader(path), mtime
+	return MAPPED[path][0]
+
+
+def _mappedfiles(files, vocabpath, suffix=''):
+	"""Return the paths and loaders of the indexed versions of ``files``."""
+	result = [(vocabpath, FixedVocabulary.fromfile)]
+	for filename in files:
+		result.append(('%s%s.ct' % (filename, suffix), Ctrees.fromfile))
+		result.append(('%s%s.labels.idx' % (filename, suffix),
+				MultiRoaringBitmap.fromfile))
+	return result
+
+
+def _attach(files, vocabpath, suffix=''):
+	"""Load the indexed treebanks of ``files`` in this process."""
+	for path, loader in _mappedfiles(files, vocabpath, suffix):
+		_getmapped(path, loader)
+
+
+def _initworker(files, vocabpath, suffix=''):
+	"""Attach a worker process to the indexed treebanks of ``files``.
+
+	Used as the initializer of process pools; the files are detached again
+	when the worker exits, i.e., when the pool is shut down."""
+	_attach(files, vocabpath, suffix)
+	Finalize(None, _detach, args=(files, vocabpath, suffix), exitpriority=0)
+
+
+def _detach(files, vocabpath, suffix=''):
+	"""Close the indexed treebanks of ``files`` loaded by this process."""
+	for path, _ in _mappedfiles(files, vocabpath, suffix):
+		if path in MAPPED:
+			MAPPED.pop(path)[0].close()
+
+
+def _warmup(searcher, suffix=''):
+	"""Read the indexed treebanks of a searcher and start its workers."""
+	files = list(searcher.files)
+	for path, _ in _mappedfiles(files, searcher.vocabpath, suffix):
+		with open(path, 'rb') as inp:  # read file into the OS page cache
+			while inp.read(1 << 24):
+				pass
+	if searcher.numproc == 1:
+		_attach(files, searcher.vocabpath, suffix)
+	else:  # the pool starts its workers, which run _initworker()
+		searcher.pool.submit(os.getpid).result()
 
 
 class FragmentSearcher(CorpusSearcher):
@@ -464,6 +680,13 @@ class FragmentSearcher(CorpusSearcher):
 		it appears in a query.
 	:param inmemory: if True, keep all corpora in memory; otherwise,
 		load them from disk with each query.
+
+	Before matching a fragment, trees are selected that contain its
+	productions, and all of its labels and words (including those of frontier
+	nodes). The attribute ``stats`` is a Counter with the total number of
+	trees in the searched intervals (``trees``), and the number of
+	candidates that remained after the production index (``prodindex``) and
+	after the label and word index (``labelindex``).
 	"""
 
 	# TODO: allow single terminals as queries: word
@@ -473,51 +696,36 @@ class FragmentSearcher(CorpusSearcher):
 	# TODO: interpret multiple fragments in a single query as AND query,
 	#       optionally with order constraint: (NN cat) (NN dog)
 	# TODO: compiled query set, re-usable on new documents.
-	def __init__(self, files, macros=None, numproc=None, inmemory=True):
-		super(FragmentSearcher, self).__init__(files, macros, numproc)
-		self.disc = False
-		newvocab = True
-		path = os.path.dirname(next(iter(sorted(files))))
-		self.vocabpath = os.path.join(path, 'treesearchvocab.idx')
-		if os.path.exists(self.vocabpath):
-			self.vocab = FixedVocabulary.fromfile(self.vocabpath)
-			mtime = os.stat(self.vocabpath).st_mtime
-			if all(os.path.exists(a + '.ct')
-						and mtime > os.stat(a + '.ct').st_mtime
-						> os.stat(a).st_mtime for a in files):
-				self.vocab.makeindex()
-				newvocab = False
-		if newvocab:
-			self.vocab = Vocabulary()
-		for filename in self.files:
-			self.disc = self.disc or not filename.endswith('.mrg')
-			if newvocab:
-				# get format from extension
-				ext = {'export': 'export',
-						'mrg': 'bracket',
-						'dbr': 'discbracket'}
-				fmt = ext[filename.rsplit('.', 1)[1]]
-				corpus = _fragments.readtreebank(filename, self.vocab, fmt=fmt)
-				corpus.indextrees(self.vocab)
-				corpus.tofile('%s.ct' % filename)
-				newvocab = True
-			if inmemory:
+	def __init__(self, files, macros=None, numproc=None, inmemory=True,
+			cachefile=None):
+		super(FragmentSearcher, self).__init__(
+				files, macros, numproc, cachefile)
+		self.vocab, self.vocabpath, self.disc = _prepare_ctrees(self.files)
+		if inmemory:
+			for filename in self.files:
 				self.files[filename] = Ctrees.fromfile('%s.ct' % filename)
-		if newvocab:
-			self.vocab.tofile(self.vocabpath)
+		self.stats = Counter()
 		self.macros = None
 		if macros:
 			with openread(macros) as tmp:
 				self.macros = dict(line.strip().split('=', 1) for line in tmp)
-		self.pool = concurrent.futures.ProcessPoolExecutor(self.numproc)
+		self.pool = concurrent.futures.ProcessPoolExecutor(
+				self.numproc, initializer=_initworker,
+				initargs=(list(self.files), self.vocabpath))
 
 	def close(self):
+		self.pool.shutdown()
+		_detach(self.files, self.vocabpath)
 		if hasattr(self.vocab, 'close'):
 			self.vocab.close()
-		for a in self.files:
-			a.close()
+		for a in self.files.values():
+			if a is not None:
+				a.close()
 		self.vocab = self.files = None
 
+	def warmup(self):
+		_warmup(self)
+
 	def counts(self, query, subset=None, start=None, end=None, indices=False,
 			breakdown=False):
 		if breakdown:
@@ -545,16 +753,17 @@ class FragmentSearcher(CorpusSearcher):
 					result[filename] = sum(tmp)
 			except KeyError:
 				if cquery is None:
-					cquery, bitsets, maxnodes = self._parse_query(
+					cquery, bitsets, maxnodes, labelids = self._parse_query(
 							query, disc=self.disc)
 				jobs[self._submit(
 						_frag_query if self.numproc == 1 else _frag_query_mp,
 						cquery, bitsets, maxnodes, filename, self.vocabpath,
-						start, end, None, indices=indices, trees=False)
-						] = filename
+						start, end, None, indices=indices, trees=False,
+						labelids=labelids)] = filename
 		for future in self._as_completed(jobs):
 			filename = jobs[future]
-			tmp = future.result()
+			tmp, stats = future.result()
+			self.stats.update(stats)
 			self.cache['counts', query, filename, start, end, indices] = tmp
 			if indices:
 				result[filename] = [b for a in tmp for b in a]
@@ -567,15 +776,18 @@ class FragmentSearcher(CorpusSearcher):
 		jobs = {}
 		if self.macros is not None:
 			queries = [query.format(**self.macros) for query in queries]
-		cqueries, bitsets, maxnodes = self._parse_query(queries, disc=self.disc)
+		cqueries, bitsets, maxnodes, labelids = self._parse_query(
+				queries, disc=self.disc)
 		for filename in subset:
 			# NB: not using cache.
 			jobs[self._submit(_frag_query, cqueries, bitsets, maxnodes,
 					filename, self.vocabpath, start, end, None, indices=False,
-					trees=False)] = filename
+					trees=False, labelids=labelids)] = filename
 		for future in self._as_completed(jobs):
 			filename = jobs[future]
-			yield filename, future.result()
+			tmp, stats = future.result()
+			self.stats.update(stats)
+			yield filename, tmp
 
 	def trees(self, query, subset=None, start=None, end=None, maxresults=10,
 			nofunc=False, nomorph=False):
@@ -593,19 +805,21 @@ class FragmentSearcher(CorpusSearcher):
 				maxresults2 = 0
 			if not maxresults or maxresults > maxresults2:
 				if cquery is None:
-					cquery, bitsets, maxnodes = self._parse_query(
+					cquery, bitsets, maxnodes, labelids = self._parse_query(
 							query, disc=self.disc)
 				jobs[self._submit(
 						_frag_query if self.numproc == 1 else _frag_query_mp,
 						cquery, bitsets, maxnodes, filename, self.vocabpath,
-						start, end, maxresults, indices=True, trees=True)
-						] = filename
+						start, end, maxresults, indices=True, trees=True,
+						labelids=labelids)] = filename
 			else:
 				result.extend(x[:maxresults])
 		for future in self._as_completed(jobs):
 			filename = jobs[future]
 			x = []
-			for matches in future.result():
+			tmp, stats = future.result()
+			self.stats.update(stats)
+			for matches in tmp:
 				for sentno, treestr, match in matches:
 					treestr = filterlabels(treestr, nofunc, nomorph)
 					# FIXME: this highlights the whole subtree, of which
@@ -644,19 +858,21 @@ class FragmentSearcher(CorpusSearcher):
 				maxresults2 = 0
 			if not maxresults or maxresults > maxresults2:
 				if cquery is None:
-					cquery, bitsets, maxnodes = self._parse_query(
+					cquery, bitsets, maxnodes, labelids = self._parse_query(
 							query, disc=self.disc)
 				jobs[self._submit(
 						_frag_query if self.numproc == 1 else _frag_query_mp,
 						cquery, bitsets, maxnodes, filename, self.vocabpath,
-						start, end, maxresults, indices=True, trees=True)
-						] = filename
+						start, end, maxresults, indices=True, trees=True,
+						labelids=labelids)] = filename
 			else:
 				result.extend(x[:maxresults])
 		for future in self._as_completed(jobs):
 			filename = jobs[future]
 			x = []
-			for frag, matches in zip(query.splitlines(), future.result()):
+			tmp, stats = future.result()
+			self.stats.update(stats)
+			for frag, matches in zip(query.splitlines(), tmp):
 				for sentno, treestr, match in matches:
 					if brackets:
 						sent = treestr
@@ -707,12 +923,22 @@ class FragmentSearcher(CorpusSearcher):
 				numnodes=corpus.numnodes, maxnodes=corpus.maxnodes)
 
 	def _parse_query(self, query, disc=False):
-		"""Prepare fragment query."""
+		"""Prepare fragment query.
+
+		:returns: a tuple ``(queries, bitsets, maxnodes, labelids)``, where
+			``labelids`` contains for each fragment a pair of lists with the
+			IDs of its labels and words (-1 if not in the vocabulary)."""
 		if isinstance(query, list):
-			qitems = (brackettree(a) for a in query)
+			qitems = [brackettree(a) for a in query]
 		else:
-			qitems = treebank.incrementaltreereader(
-					io.StringIO(query), strict=True, robust=False)
+			qitems = list(treebank.incrementaltreereader(
+					io.StringIO(query), strict=True, robust=False))
+		labelids = [(
+				sorted({self.vocab.labels.get(node.label, -1)
+					for node in item[0].subtrees()}),
+				sorted({self.vocab.labels.get(word, -1)
+					for word in item[1] if word}))
+				for item in qitems]
 		qitems = (
 				(binarize(handledisc(item[0]) if disc else item[0], dot=True),
 				item[1]) for item in qitems)
@@ -724,31 +950,50 @@ class FragmentSearcher(CorpusSearcher):
 		_fragmentkeys, bitsets = _fragments.completebitsets(
 				queries['trees1'], self.vocab, maxnodes, disc=disc,
 				tostring=False)
-		return queries, bitsets, maxnodes
+		return queries, bitsets, maxnodes, labelids
 
 
 @workerfunc
 def _frag_query_mp(queries, bitsets, maxnodes, filename, vocabpath,
-		start=None, end=None, maxresults=None, indices=True, trees=False):
+		start=None, end=None, maxresults=None, indices=True, trees=False,
+		labelids=None):
 	"""Multiprocessing wrapper."""
 	return _frag_query(
 			queries, bitsets, maxnodes, filename, vocabpath, start, end,
-			maxresults, indices, trees)
+			maxresults, indices, trees, labelids)
 
 
 def _frag_query(queries, bitsets, maxnodes, filename, vocabpath,
-		start=None, end=None, maxresults=None, indices=True, trees=False):
-	"""Run a prepared fragment query on a single file."""
-	corpus = Ctrees.fromfile('%s.ct' % filename)
+		start=None, end=None, maxresults=None, indices=True, trees=False,
+		labelids=None):
+	"""Run a prepared fragment query on a single file.
+
+	:param labelids: if given, select candidate trees with the label index;
+		cf. :py:meth:`FragmentSearcher._parse_query`.
+	:returns: a tuple ``(results, stats)``; cf. ``FragmentSearcher.stats``.
+	"""
+	corpus = _getmapped('%s.ct' % filename, Ctrees.fromfile)
 	if start:
 		start -= 1
+	prefilter = None
+	if labelids is not None:
+		index = _getmapped('%s.labels.idx' % filename,
+				MultiRoaringBitmap.fromfile)
+		prefilter = [_labelcandidates(index, a, b, start or 0,
+				end or corpus.len) for a, b in labelids]
+	stats = []
 	results = _fragments.exactcountsslice(
 			bitsets, queries['trees1'], corpus,
 			indices=indices + trees if indices else 0,
 			maxnodes=maxnodes, start=start, end=end,
-			maxresults=maxresults)
+			maxresults=maxresults, prefilter=prefilter, stats=stats)
+	stats = Counter(
+			trees=len(bitsets) * (min(end or corpus.len, corpus.len)
+				- (start or 0)),
+			prodindex=sum(a for a, _ in stats),
+			labelindex=sum(b for _, b in stats))
 	if indices and trees:
-		vocab = FixedVocabulary.fromfile(vocabpath)
+		vocab = _getmapped(vocabpath, FixedVocabulary.fromfile)
 		results = [[(n + 1,
 					corpus.extract(n, vocab, disc=True),
 					corpus.extract(n, vocab, disc=True, node=m))
@@ -756,7 +1001,7 @@ def _frag_query(queries, bitsets, maxnodes, filename, vocabpath,
 				for b, c in results]
 	elif indices:
 		results = [[n + 1 for n in b] for b in results]
-	return results
+	return results, stats
 
 
 class RegexSearcher(CorpusSearcher):
@@ -771,8 +1016,8 @@ class RegexSearcher(CorpusSearcher):
 	:param ignorecase: ignore case in all queries."""
 
 	def __init__(self, files, macros=None, numproc=None, ignorecase=False,
-			inmemory=False):
-		super(RegexSearcher, self).__init__(files, macros, numproc)
+			inmemory=False, cachefile=None):
+		super(RegexSearcher, self).__init__(files, macros, numproc, cachefile)
 		self.macros = None
 		self.flags = re.MULTILINE
 		if ignorecase:
@@ -877,23 +1122,37 @@ class RegexSearcher(CorpusSearcher):
 		raise ValueError('not applicable with plain text corpus.')
 
 	def batchcounts(self, queries, subset=None, start=None, end=None):
-		if self.macros is None:
-			patterns = [_regex_parse_query(query, self.flags)
-					for query in queries]
-		else:
-			patterns = [_regex_parse_query(query.format(
-					**self.macros), self.flags) for query in queries]
-		chunksize = max(int(len(patterns) / (self.numproc * 4)), 1)
-		chunkedpatterns = [patterns[n:n + chunksize]
-				for n in range(0, len(patterns), chunksize)]
-		result = OrderedDict((name, [])
-				for name in subset or self.files)
+		"""Like ``counts()``, but executes multiple queries on multiple files.
+
+		Each file is split into chunks of lines that are processed in
+		parallel. A chunk is first scanned once with an automaton combining
+		all queries, which selects the queries that match in it
+		(cf. :py:class:`_MultiPattern`); each selected query is then counted
+		with a separate scan of the chunk. Queries with matches that may span
+		multiple lines are counted separately over the whole file."""
+		if self.macros is not None:
+			queries = [query.format(**self.macros) for query in queries]
+		queries = tuple(queries)
+		withinlines = [n for n, query in enumerate(queries)
+				if _regex_withinlines(query, self.flags)]
+		spanlines = sorted(set(range(len(queries))) - set(withinlines))
 		for filename in subset or self.files:
-			result = array.array('I')
-			for tmp in self._map(_regex_run_batch, chunkedpatterns,
-					filename=filename, fileno=self.fileno[filename],
-					lienidxpath=self.lineidxpath, start=start, end=end):
-				result.extend(tmp)
+			lineindex = self.lineindex[self.fileno[filename]]
+			result = array.array('I', [0]) * len(queries)
+			if start and start >= len(lineindex):
+				yield filename, result
+				continue
+			startidx = lineindex.select(start - 1 if start else 0)
+			endidx = lineindex.select(end if end is not None
+					and end < len(lineindex) else len(lineindex) - 1)
+			jobs = [(startidx, endidx, [n]) for n in spanlines]
+			if withinlines:
+				jobs.extend((a, b, withinlines) for a, b
+						in _regex_chunks(lineindex, startidx, endidx))
+			for tmp in self._map(_regex_run_batchcounts, jobs,
+					queries=queries, flags=self.flags, filename=filename):
+				for n, cnt in enumerate(tmp):
+					result[n] += cnt
 			yield filename, result
 
 	def batchsents(self, queries, subset=None, start=None, end=None,
@@ -1105,6 +1364,211 @@ def _regex_run_batch(patterns, filename, fileno, lineidxpath,
 	return result
 
 
+@workerfunc
+def _regex_run_batchcounts(job, queries, flags, filename):
+	"""Count matches of a batch of queries in a range of a single file.
+
+	:param job: a tuple ``(startidx, endidx, indices)`` with the range of
+		byte offsets to scan, and the indices of the queries to count.
+	:returns: an array with a count for each query in ``queries``."""
+	startidx, endidx, indices = job
+	result = array.array('I', [0]) * len(queries)
+	patterns, multipattern = _regex_compile_batch(
+			queries, flags, tuple(indices))
+	with open(filename, 'rb') as tmp:
+		data = mmap.mmap(tmp.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			if multipattern is not None:
+				startidx, indices = multipattern.search(
+						data, startidx, endidx)
+			for n in indices:
+				try:
+					result[n] = patterns[n].count(data, startidx, endidx)
+				except AttributeError:
+					result[n] = len(patterns[n].findall(
+							data, startidx, endidx))
+		finally:
+			data.close()
+	return result
+
+
+def _regex_compile_batch(queries, flags, indices):
+	"""Compile queries and the combined pattern for a batch; cached.
+
+	:returns: a tuple ``(patterns, multipattern)``, where ``patterns`` maps
+		indices to compiled queries, and ``multipattern`` is a
+		:py:class:`_MultiPattern` or None."""
+	if (queries, flags) not in REGEXBATCH:
+		REGEXBATCH.clear()
+		REGEXBATCH[queries, flags] = {}, {}
+	patterns, multipatterns = REGEXBATCH[queries, flags]
+	for n in indices:
+		if n not in patterns:
+			patterns[n] = _regex_parse_query(queries[n], flags)
+	if len(indices) > 1 and indices not in multipatterns:
+		multipatterns[indices] = _MultiPattern(queries, flags, indices)
+	return patterns, multipatterns.get(indices)
+
+
+class _MultiPattern(object):
+	"""A set of patterns compiled into a single automaton.
+
+	Reports which of the patterns match in a range of a text, so that only
+	those need to be counted. With ``re2.Set``, this is the exact set of
+	patterns; otherwise, a combined alternation of the patterns only finds
+	the first position at which any of the patterns matches. An alternation
+	cannot produce the counts themselves, since it reports only one of the
+	patterns at each position, and no overlapping matches.
+
+	The alternation is compiled with ``re``, so it is only used when the
+	queries are compiled with ``re`` as well; when re2 is available but
+	``re2.Set`` fails, all patterns are reported as possible matches."""
+
+	def __init__(self, queries, flags, indices):
+		self.indices = indices
+		self.patternset = self.combined = None
+		self.setindices = []  # index in set => index in queries
+		self.always = []  # patterns not supported by re2.Set
+		if RE2LIB:
+			try:
+				patternset = re2.Set.SearchSet(  # pylint: disable=no-member
+						flags | re.UNICODE)
+				for n in indices:
+					try:
+						patternset.Add(queries[n].encode('utf8'))
+					except ValueError:
+						self.always.append(n)
+					else:
+						self.setindices.append(n)
+				patternset.Compile()
+			except (AttributeError, TypeError, ValueError):
+				# the queries are compiled with re2, and an alternation
+				# compiled with re may disagree; e.g., on '.' with UTF-8.
+				self.always, self.setindices = [], []
+			else:
+				self.patternset = patternset
+			return
+		try:
+			self.combined = re.compile(b'|'.join(
+					b'(?:%s)' % queries[n].encode('utf8') for n in indices),
+					flags=flags)
+		except (re.error, OverflowError, RecursionError):
+			pass
+
+	def search(self, data, startidx, endidx):
+		"""Return a start offset and the indices of patterns that may match.
+
+		:returns: a tuple ``(offset, indices)``, where ``offset`` is the
+			offset from which the patterns in ``indices`` are to be counted;
+			no pattern has a match before this offset."""
+		if self.patternset is not None:
+			matches = self.patternset.Match(data[startidx:endidx]) or ()
+			return startidx, sorted(
+					[self.setindices[n] for n in matches] + self.always)
+		elif self.combined is not None:
+			match = self.combined.search(data, startidx, endidx)
+			if match is None:
+				return startidx, ()
+			return match.start(), self.indices
+		return startidx, self.indices
+
+
+def _regex_withinlines(query, flags):
+	r"""Test whether matches of query are non-empty and within a single line.
+
+	A query for which this is true can be counted separately on chunks of
+	lines, and combined with other queries; otherwise, or when in doubt
+	(e.g., a query with syntax specific to re2), False is returned.
+
+	>>> _regex_withinlines(r'\bcat[^\n]* dog', re.MULTILINE)
+	True
+	>>> _regex_withinlines(r'cat\s+dog', re.MULTILINE)
+	False"""
+	try:
+		parsed = sre_parse.parse(query.encode('utf8'), flags)
+	except (re.error, OverflowError, RecursionError):
+		return False
+	if parsed.getwidth()[0] == 0:
+		return False
+	state = parsed.state if hasattr(parsed, 'state') else parsed.pattern
+	return not _regex_matchesnewline(parsed, state.flags)
+
+
+def _regex_matchesnewline(parsed, flags):
+	"""Test whether a parsed pattern may match across lines.
+
+	True if the pattern may match a newline, or is otherwise not restricted
+	to a single line (e.g., a backreference)."""
+	for op, av in parsed:
+		if op is sre_constants.LITERAL:
+			if av == 10:
+				return True
+		elif op is sre_constants.NOT_LITERAL:
+			if av != 10:
+				return True
+		elif op is sre_constants.ANY:
+			if flags & re.DOTALL:
+				return True
+		elif op is sre_constants.IN:
+			negate = av and av[0][0] is sre_constants.NEGATE
+			if _regex_setmatchesnewline(av[1:] if negate else av) != negate:
+				return True
+		elif op is sre_constants.AT:
+			if av in (sre_constants.AT_BEGINNING_STRING,
+					sre_constants.AT_END_STRING) or (
+					av in (sre_constants.AT_BEGINNING, sre_constants.AT_END)
+					and not flags & re.MULTILINE):
+				return True
+		elif op is sre_constants.BRANCH:
+			if any(_regex_matchesnewline(a, flags) for a in av[1]):
+				return True
+		elif op is sre_constants.SUBPATTERN:
+			if _regex_matchesnewline(av[-1], (flags | av[1]) & ~av[2]):
+				return True
+		elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT,
+				sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+			if _regex_matchesnewline(av[-1], flags):
+				return True
+		else:  # e.g., backreferences
+			return True
+	return False
+
+
+def _regex_setmatchesnewline(items):
+	"""Test whether a character set of a parsed pattern includes newline."""
+	for op, av in items:
+		if op is sre_constants.LITERAL:
+			if av == 10:
+				return True
+		elif op is sre_constants.RANGE:
+			if av[0] <= 10 <= av[1]:
+				return True
+		elif op is sre_constants.CATEGORY:
+			if av not in (sre_constants.CATEGORY_DIGIT,
+					sre_constants.CATEGORY_NOT_SPACE,
+					sre_constants.CATEGORY_WORD,
+					sre_constants.CATEGORY_NOT_LINEBREAK):
+				return True
+		else:
+			return True
+	return False
+
+
+def _regex_chunks(lineindex, startidx, endidx, chunksize=None):
+	"""Divide a range of byte offsets into chunks at line boundaries."""
+	chunksize = chunksize or REGEXCHUNKSIZE
+	result = []
+	while endidx - startidx > chunksize:
+		# offset of first non-empty line starting after startidx + chunksize
+		nextidx = lineindex.select(lineindex.rank(startidx + chunksize))
+		if nextidx >= endidx:
+			break
+		result.append((startidx, nextidx))
+		startidx = nextidx
+	result.append((startidx, endidx))
+	return result
+
+
 def _getoffsets(lineno, lineindex, data):
 	"""Return the (start, end) byte offsets for a given 1-based line number."""
 	offset = 0
@@ -1161,6 +1625,229 @@ class FIFOOrederedDict(OrderedDict):
 		super(FIFOOrederedDict, self).__setitem__(key, value)
 
 
+class ResultCache(object):
+	"""An LRU cache of query results with a limit on their total size.
+
+	Keys are tuples of the form ``(kind, query, filename, ...)``; entries are
+	only valid as long as the modification time of ``filename`` is unchanged.
+	Values are stored pickled, with increasing sequences of sentence numbers
+	(e.g., the results of ``counts(..., indices=True)``) stored as
+	RoaringBitmaps. Optionally, an on-disk tier (an SQLite database) keeps
+	results across runs and may be shared by several processes.
+
+	:param maxbytes: the maximum total size of the pickled values kept in
+		memory; entries are evicted in least recently used order.
+		Pass 0 to disable the in-memory tier.
+	:param filename: if given, the filename of the on-disk tier; created if
+		it does not exist. Since values are unpickled, the file must be owned
+		by the current user and must not be writable by others.
+	:param namespace: a string identifying the searcher and its macros;
+		only entries with the same namespace are used from the on-disk tier.
+	:param maxdiskbytes: the maximum total size of the values in the on-disk
+		tier; entries are evicted in least recently used order.
+	"""
+
+	def __init__(self, maxbytes=CACHESIZE, filename=None, namespace='',
+			maxdiskbytes=CACHEDISKSIZE):
+		self.maxbytes = maxbytes
+		self.maxdiskbytes = maxdiskbytes
+		self.filename = filename
+		self.namespace = namespace
+		self.nbytes = self.hits = self.misses = self.evictions = 0
+		self.lru = OrderedDict()  # key => pickled value
+		self.lock = threading.Lock()
+		self.conn = self.pid = None
+
+	def key(self, key):
+		"""Add modification time of the file in a key; return disk key."""
+		try:
+			mtime = os.stat(key[2]).st_mtime
+		except (OSError, IndexError, TypeError):
+			mtime = None
+		key += (mtime, )
+		return key, hashlib.sha1(repr((self.namespace, key)).encode('utf8')
+				).hexdigest()
+
+	def db(self):
+		"""Return connection to on-disk tier; opened anew in each process."""
+		if self.filename is None:
+			return None
+		if self.conn is None or self.pid != os.getpid():
+			os.close(os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o600))
+			stat = os.stat(self.filename)
+			if (stat.st_mode & 0o022 or hasattr(os, 'getuid')
+					and stat.st_uid != os.getuid()):
+				raise ValueError('%s: cache file must be owned by the current '
+						'user and not be writable by others.' % self.filename)
+			self.conn = sqlite3.connect(
+					self.filename, timeout=60, check_same_thread=False)
+			self.conn.execute('CREATE TABLE IF NOT EXISTS results '
+					'(key TEXT PRIMARY KEY, value BLOB, atime REAL)')
+			self.conn.execute('CREATE INDEX IF NOT EXISTS resultsatime '
+					'ON results (atime)')
+			# total size of the values, kept up to date with each change;
+			# recomputed when opened, to correct for interrupted updates.
+			self.conn.execute('CREATE TABLE IF NOT EXISTS resultsmeta '
+					'(name TEXT PRIMARY KEY, value INTEGER)')
+			self.conn.execute("INSERT OR REPLACE INTO resultsmeta VALUES "
+					"('nbytes', (SELECT COALESCE(SUM(LENGTH(value)), 0) "
+					"FROM results))")
+			self.conn.commit()
+			self.pid = os.getpid()
+		return self.conn
+
+	def __getitem__(self, key):
+		key, diskkey = self.key(key)
+		with self.lock:
+			value = self.lru.get(key)
+			if value is not None:
+				self.lru.move_to_end(key)
+			elif self.filename is not None:
+				conn = self.db()
+				row = conn.execute(
+						'SELECT value FROM results WHERE key = ?',
+						(diskkey, )).fetchone()
+				if row is not None:
+					value = bytes(row[0])
+					self._store(key, value)
+					conn.execute('UPDATE results SET atime = ? WHERE key = ?',
+							(time.time(), diskkey))
+					conn.commit()
+			if value is None:
+				self.misses += 1
+				raise KeyError(key)
+			self.hits += 1
+		return _expandindices(pickle.loads(value))
+
+	def __setitem__(self, key, value):
+		if not self.maxbytes and self.filename is None:
+			return
+		key, diskkey = self.key(key)
+		value = pickle.dumps(_compactindices(value), protocol=-1)
+		with self.lock:
+			self._store(key, value)
+			if self.filename is not None:
+				conn = self.db()
+				row = conn.execute(
+						'SELECT LENGTH(value) FROM results WHERE key = ?',
+						(diskkey, )).fetchone()
+				conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+						(diskkey, sqlite3.Binary(value), time.time()))
+				self._adddiskbytes(conn, len(value) - (row[0] if row else 0))
+				self._evictdisk(conn)
+				conn.commit()
+
+	def __contains__(self, key):
+		key, diskkey = self.key(key)
+		with self.lock:
+			return key in self.lru or (self.filename is not None
+					and self.db().execute(
+						'SELECT 1 FROM results WHERE key = ?',
+						(diskkey, )).fetchone() is not None)
+
+	def __len__(self):
+		return len(self.lru)
+
+	def _store(self, key, value):
+		"""Add pickled value to in-memory tier and evict old entries."""
+		if key in self.lru:
+			self.nbytes -= len(self.lru.pop(key))
+		if len(value) > self.maxbytes:
+			return
+		self.lru[key] = value
+		self.nbytes += len(value)
+		while self.nbytes > self.maxbytes:
+			self.nbytes -= len(self.lru.popitem(last=False)[1])
+			self.evictions += 1
+
+	@staticmethod
+	def _adddiskbytes(conn, nbytes):
+		"""Update the total size of the on-disk tier; return the new total."""
+		conn.execute("UPDATE resultsmeta SET value = value + ? "
+				"WHERE name = 'nbytes'", (nbytes, ))
+		return conn.execute("SELECT value FROM resultsmeta "
+				"WHERE name = 'nbytes'").fetchone()[0]
+
+	def _evictdisk(self, conn):
+		"""Remove least recently used entries from the on-disk tier."""
+		nbytes = self._adddiskbytes(conn, 0)
+		if nbytes <= self.maxdiskbytes:
+			return
+		evict, size = [], 0
+		for diskkey, itemsize in conn.execute(
+				'SELECT key, LENGTH(value) FROM results ORDER BY atime'):
+			evict.append((diskkey, ))
+			size += itemsize
+			if nbytes - size <= self.maxdiskbytes:
+				break
+		conn.executemany('DELETE FROM results WHERE key = ?', evict)
+		self._adddiskbytes(conn, -size)
+		self.evictions += len(evict)
+
+	def clear(self):
+		"""Empty the in-memory tier."""
+		with self.lock:
+			self.lru.clear()
+			self.nbytes = 0
+
+	def __repr__(self):
+		return '%s(%d entries, %d bytes, %d hits, %d misses, %d evictions)' % (
+				self.__class__.__name__, len(self.lru), self.nbytes,
+				self.hits, self.misses, self.evictions)
+
+
+class _Indices(object):
+	"""An increasing sequence of integers stored as a RoaringBitmap.
+
+	:param typecode: the typecode if the sequence was an ``array.array``;
+		None if it was a list."""
+	__slots__ = ('bitmap', 'typecode')
+
+	def __init__(self, bitmap, typecode=None):
+		self.bitmap = bitmap
+		self.typecode = typecode
+
+	def expand(self):
+		"""Return the sequence with its original type."""
+		if self.typecode is None:
+			return list(self.bitmap)
+		return array.array(self.typecode, self.bitmap)
+
+	def __getstate__(self):
+		return (self.bitmap, self.typecode)
+
+	def __setstate__(self, state):
+		self.bitmap, self.typecode = state
+
+
+def _isindices(seq):
+	"""Test whether seq is a strictly increasing sequence of uint32s."""
+	return (isinstance(seq, (list, array.array))
+			and all(isinstance(a, int) for a in seq)
+			and (not seq or 0 <= seq[0] and seq[-1] < 1 << 32)
+			and all(a < b for a, b in zip(seq, islice(seq, 1, None))))
+
+
+def _compactindices(value):
+	"""Replace sequences of indices in a result with RoaringBitmaps."""
+	if value and _isindices(value):
+		return _Indices(RoaringBitmap(value), getattr(value, 'typecode', None))
+	elif (isinstance(value, list) and value
+			and all(_isindices(a) for a in value)):
+		return [_Indices(RoaringBitmap(a), getattr(a, 'typecode', None))
+				for a in value]
+	return value
+
+
+def _expandindices(value):
+	"""Inverse of _compactindices()."""
+	if isinstance(value, _Indices):
+		return value.expand()
+	elif isinstance(value, list) and value and isinstance(value[0], _Indices):
+		return [a.expand() for a in value]
+	return value
+
+
 def filterlabels(line, nofunc, nomorph):
 	"""Remove morphological and/or grammatical function labels from tree(s)."""
 	if nofunc:
@@ -1405,5 +2092,5 @@ def main():
 
 
 __all__ = ['CorpusSearcher', 'TgrepSearcher', 'RegexSearcher',
-		'FragmentSearcher', 'NoFuture', 'FIFOOrederedDict', 'filterlabels',
-		'cpu_count', 'charindices', 'applyhighlight']
+		'FragmentSearcher', 'NoFuture', 'FIFOOrederedDict', 'ResultCache',
+		'filterlabels', 'cpu_count', 'charindices', 'applyhighlight']
@@ -4,11 +4,14 @@ import os
 import re
 import sys
 import gzip
+import time
 import codecs
+import threading
 import traceback
 from heapq import heapify, heappush, heappop, heapreplace
 from functools import wraps
-from collections import Set, Iterable
+from itertools import islice
+from collections import Set, Iterable, deque
 
 def which(program):
 	"""Return first match for program in search path."""
@@ -33,6 +36,140 @@ def workerfunc(func):
 	return wrapper
 
 
+def boundedimap(pool, func, iterable, chunksize=1, window=None):
+	"""Ordered, lazy version of ``pool.imap`` with bounded memory usage.
+
+	Unlike ``pool.imap``, the input is only consumed as results are
+	retrieved; at most ``window`` chunks of ``chunksize`` items are in
+	flight at any time, so memory use does not grow with the input.
+
+	:param pool: a ``multiprocessing.Pool`` instance.
+	:param window: maximum number of chunks submitted to ``pool`` but not
+		yet retrieved; defaults to twice the number of processes.
+
+	>>> from multiprocessing.dummy import Pool
+	>>> with Pool(2) as pool:
+	...     list(boundedimap(pool, abs, range(0, -10, -1), 3, 2))
+	[0, 1, 2, 3, 4, 5, 6, 7, 8, 9]"""
+	if window is None:
+		window = 2 * getattr(pool, '_processes', 1)
+	items = iter(iterable)
+	pending = deque()
+	while True:
+		while len(pending) < window:
+			chunk = list(islice(items, chunksize))
+			if not chunk:
+				break
+			pending.append(pool.map_async(func, chunk, chunksize=len(chunk)))
+		if not pending:
+			return
+		yield from pending.popleft().get()
+
+
+def scheduledimap(pool, func, iterable, cost, lookahead=1000, chunksize=1,
+		ordered=True, stats=None):
+	"""Apply ``func`` in parallel, dispatching the most costly items first.
+
+	Items are sent to the pool as a single stream, in which the next item is
+	the most costly of the items read ahead, such that expensive items do
+	not end up as stragglers. The input is read ahead by at most
+	``lookahead`` items, i.e., an item is dispatched before any item that
+	comes ``lookahead`` or more items after it; at most ``lookahead +
+	chunksize`` items are dispatched and not yet yielded.
+
+	:param cost: a function returning the estimated cost of an item.
+	:param chunksize: the number of items sent to a worker at a time.
+	:param ordered: if True, results are yielded in the original order of
+		the items, as soon as all preceding results are available;
+		otherwise, results are yielded as they are completed.
+	:param stats: if a dictionary is given, it is updated with worker
+		process IDs mapped to lists ``[numitems, busytime]``; cf.
+		:py:func:`utilization`.
+
+	>>> from multiprocessing.dummy import Pool
+	>>> with Pool(2) as pool:
+	...     list(scheduledimap(pool, abs, [-1, 2, -3, 4, -5], abs, 3))
+	[1, 2, 3, 4, 5]"""
+	# dispatch() is consumed by a thread of the pool; it blocks while the
+	# results of too many items are outstanding.
+	slots = threading.Semaphore(lookahead + chunksize)
+	closed = []
+
+	def dispatch():
+		items = iter(iterable)
+		pending = {}  # index => item, for items read but not dispatched
+		heap = []  # (-cost, index) for the items in pending
+		unsent = deque()  # indices of the items in pending, in input order
+		numread = 0
+		while True:
+			while unsent and unsent[0] not in pending:
+				unsent.popleft()
+			# read ahead, without passing the oldest item by lookahead items
+			while not unsent or numread - unsent[0] < lookahead:
+				try:
+					item = next(items)
+				except StopIteration:
+					break
+				pending[numread] = item
+				heappush(heap, (-cost(item), numread))
+				unsent.append(numread)
+				numread += 1
+			if not heap:
+				return
+			_, n = heappop(heap)
+			slots.acquire()
+			if closed:
+				return
+			yield n, func, pending.pop(n)
+
+	results = {}
+	nextidx = 0
+	try:
+		for n, pid, elapsed, result in pool.imap_unordered(
+				_timedcall, dispatch(), chunksize):
+			if stats is not None:
+				workerstats = stats.setdefault(pid, [0, 0.0])
+				workerstats[0] += 1
+				workerstats[1] += elapsed
+			if not ordered:
+				slots.release()
+				yield result
+				continue
+			results[n] = result
+			while nextidx in results:
+				slots.release()
+				yield results.pop(nextidx)
+				nextidx += 1
+	finally:  # unblock dispatch() if it is waiting
+		closed.append(True)
+		for _ in range(lookahead + chunksize):
+			slots.release()
+
+
+def _timedcall(args):
+	"""Apply function to an item; return index, process ID, and time."""
+	n, func, item = args
+	begin = time.time()
+	result = func(item)
+	return n, os.getpid(), time.time() - begin, result
+
+
+def utilization(stats, elapsed):
+	"""Describe utilization of worker processes.
+
+	:param stats: a dictionary as updated by :py:func:`scheduledimap`.
+	:param elapsed: the total wall clock time in seconds.
+
+	>>> print(utilization({123: [3, 1.5], 456: [1, 2.0]}, 2.0))
+	worker 1 (pid 123): 3 items, busy 1.50s (75.0%)
+	worker 2 (pid 456): 1 items, busy 2.00s (100.0%)"""
+	return '\n'.join(
+			'worker %d (pid %d): %d items, busy %.2fs (%.1f%%)' % (
+				n, pid, numitems, busy, 100 * busy / (elapsed or 1))
+			for n, (pid, (numitems, busy))
+			in enumerate(sorted(stats.items()), 1))
+
+
 def openread(filename, encoding='utf8'):
 	"""Open stdin/text file for reading; decompress .gz files on-the-fly."""
 	if filename == '-':
@@ -387,5 +524,6 @@ ANSICOLOR = {
 		'white': 37,
 }
 
-__all__ = ['which', 'workerfunc', 'openread', 'slice_bounds',
+__all__ = ['which', 'workerfunc', 'boundedimap', 'scheduledimap',
+		'utilization', 'openread', 'slice_bounds',
 		'OrderedSet', 'ANSICOLOR']
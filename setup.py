@@ -29,6 +29,12 @@ DEBUG = '--debug' in sys.argv
 if DEBUG:
 	sys.argv.remove('--debug')
 
+# OpenMP is used for parallel CKY parsing; not available with default clang.
+OPENMP = '--without-openmp' not in sys.argv and sys.platform != 'darwin'
+OPENMPMODULES = {'discodop.pcfg'}  # only these modules use OpenMP
+if '--without-openmp' in sys.argv:
+	sys.argv.remove('--without-openmp')
+
 with open('README.rst') as inp:
 	README = inp.read()
 
@@ -104,30 +110,27 @@ if __name__ == '__main__':
 	else:
 		extra_compile_args += ['-O3', '-march=native', '-DNDEBUG']
 		extra_link_args = ['-DNDEBUG']
+
+	def extension(filename, **kwds):
+		"""Return an Extension for filename; with OpenMP if it is used."""
+		name = os.path.splitext(filename)[0].replace('/', '.')
+		openmp = ['-fopenmp'] if OPENMP and name in OPENMPMODULES else []
+		return Extension(name, sources=[filename],
+				extra_compile_args=extra_compile_args + openmp,
+				extra_link_args=extra_link_args + openmp,
+				**kwds)
+
 	if USE_CYTHON:
 		ext_modules = cythonize(
-				[Extension(
-					'*',
-					['discodop/*.pyx'],
-					extra_compile_args=extra_compile_args,
-					extra_link_args=extra_link_args,
-					language='c++',
-					# include_dirs=[...],
-					# libraries=[...],
-					# library_dirs=[...],
-					)],
+				[extension(filename, language='c++')
+					for filename in sorted(glob.glob('discodop/*.pyx'))],
 				annotate=True,
 				compiler_directives=directives,
 				language_level=3,
 				# nthreads=4,
 				)
 	else:
-		ext_modules = [Extension(
-				os.path.splitext(filename)[0].replace('/', '.'),
-				sources=[filename],
-				extra_compile_args=extra_compile_args,
-				extra_link_args=extra_link_args,
-				)
+		ext_modules = [extension(filename)
 				for filename in glob.glob('discodop/*.c')]
 	setup(
 			cmdclass=cmdclass,
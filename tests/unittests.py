@@ -16,6 +16,52 @@ from discodop.punctuation import punctraise, balancedpunctraise
 from discodop.grammar import flatten, UniqueIDs
 
 
+SAMPLE = {}  # cache for _samplegrammar()
+
+
+def _samplegrammar(split=False, dop=False):
+	"""Return sentences, binarized trees and grammar of the sample treebank.
+
+	The result is cached; tests should not modify the grammar.
+
+	:param split: whether to split discontinuous nodes (for the PCFG parser).
+	:param dop: whether to return a DOP reduction instead of a treebank
+		grammar."""
+	from discodop.grammar import treebankgrammar, dopreduction
+	from discodop.containers import Grammar
+	from discodop.treebank import NegraCorpusReader
+	from discodop.treetransforms import addfanoutmarkers
+	if (split, dop) not in SAMPLE:
+		corpus = NegraCorpusReader('alpinosample.export', punct='move')
+		sents = list(corpus.sents().values())
+		trees = [addfanoutmarkers(binarize(
+				splitdiscnodes(a.copy(True)) if split else a.copy(True),
+				horzmarkov=1)) for a in corpus.trees().values()]
+		rules = (dopreduction(trees, sents)[0] if dop
+				else treebankgrammar(trees, sents))
+		SAMPLE[split, dop] = sents, trees, Grammar(
+				rules, start=trees[0].label)
+	return SAMPLE[split, dop]
+
+
+def _sampleparser():
+	"""Return a parser with a PCFG of ``tests/t1.mrg``, and its sentences.
+
+	The result is cached; the sentences are lists of ``(word, tag)``
+	tuples."""
+	import shutil
+	import tempfile
+	from discodop.bench import trainbenchmark, loadparser
+	if 'parser' not in SAMPLE:
+		resultdir = tempfile.mkdtemp(prefix='discodop-test-')
+		try:
+			trainbenchmark('t1', 'pcfg', resultdir)
+			SAMPLE['parser'] = loadparser(resultdir)
+		finally:
+			shutil.rmtree(resultdir)
+	return SAMPLE['parser']
+
+
 class Test_treetransforms(object):
 	def test_binarize(self):
 		treestr = '(S (VP (PDS 0) (ADV 3) (VVINF 4)) (VMFIN 1) (PIS 2))'
@@ -213,6 +259,43 @@ class Test_grammar(object):
 				'(S|<VP>_2 (VP_3 (VP|<NP>_3 {0} (VP|<ADV>_2 {2} (VP|<VVPP> '
 				'{3})))) (S|<VAFIN> {1}))')
 
+	def test_binfile(self, tmpdir):
+		from discodop.containers import Grammar
+		from discodop.grammar import treebankgrammar, writegrammar
+		sents, trees, _ = _samplegrammar()
+		rules = treebankgrammar(trees, sents)
+		grammar = Grammar(rules, start='ROOT')
+		filename = str(tmpdir.join('grammar.g'))
+		grammar.tobinfile(filename)
+		grammar1 = Grammar.frombinfile(filename, None, None)
+		assert str(grammar1) == str(grammar)
+		assert grammar1.maxfanout == grammar.maxfanout
+		assert grammar1.tblabelmapping == grammar.tblabelmapping
+		prod, yf = next(r for r, _ in rules if r[0][1] != 'Epsilon')
+		assert grammar1.getruleno(prod, yf) == grammar.getruleno(prod, yf)
+		# words are looked up in the mapped file
+		for word in grammar.getwords() + ['nosuchword']:
+			assert grammar1.getlexprobs(word) == grammar.getlexprobs(word)
+		# changing weights or adding rules does not change the file
+		with open(filename, 'rb') as inp:
+			data = inp.read()
+		grammar1.switch('default', logprob=False)
+		grammar.switch('default', logprob=False)
+		assert str(grammar1) == str(grammar)
+		grammar1.addrules(*(a.encode('utf8') for a in writegrammar(rules)))
+		grammar.addrules(*(a.encode('utf8') for a in writegrammar(rules)))
+		assert str(grammar1) == str(grammar)
+		with open(filename, 'rb') as inp:
+			assert inp.read() == data
+		with open(filename, 'r+b') as out:
+			out.write(b'DISCOGRX')
+		try:
+			Grammar.frombinfile(filename, None, None)
+		except ValueError:
+			pass
+		else:
+			raise AssertionError('expected ValueError for corrupt file')
+
 
 class TestHeap(TestCase):
 	testN = 100
@@ -527,6 +610,535 @@ def test_grammar(debug=False):
 	Grammar(treebankgrammar([tree], [[str(a) for a in range(10)]]))
 
 
+def test_marginalizetrees():
+	"""Verify MPP without derivation strings against summing derivations."""
+	from math import exp
+	from discodop import plcfrs
+	from discodop.disambiguation import (getderivations, marginalize,
+			REMOVEIDS)
+	sents, _, grammar = _samplegrammar(dop=True)
+	for sent in sents:
+		chart, _ = plcfrs.parse(sent, grammar, exhaustive=True)
+		if not chart:
+			continue
+		getderivations(chart, 100, derivstrings=True)
+		expected = {}
+		for deriv, prob in chart.derivations:
+			treestr = REMOVEIDS.sub('', deriv)
+			expected[treestr] = expected.get(treestr, 0) + exp(-prob)
+		parses, _ = marginalize('mpp', chart)
+		assert len(parses) == len(expected)
+		for treestr, prob, _ in parses:
+			assert abs(prob - expected[treestr]) < 1e-9, treestr
+		expected = {}
+		for deriv, prob in chart.derivations:
+			treestr = REMOVEIDS.sub('@1', deriv)
+			expected[treestr] = max(expected.get(treestr, 0), exp(-prob))
+		parses, _ = marginalize('mpd', chart)
+		assert len(parses) == len(expected)
+		assert (sorted(round(prob, 9) for _, prob, _ in parses)
+				== sorted(round(prob, 9) for prob in expected.values()))
+
+
+def test_budget():
+	"""Verify that parsing is aborted when a budget is exceeded."""
+	from discodop import plcfrs, pcfg
+	from discodop.containers import ChartPool
+	sents, _, grammar = _samplegrammar()
+	chart, msg = plcfrs.parse(sents[0], grammar, maxitems=10 ** 9)
+	assert chart, msg
+	chart, msg = plcfrs.parse(sents[0], grammar, maxitems=1)
+	assert chart is None and msg.startswith('exceeded maxitems=1'), msg
+	chart, msg = plcfrs.parse(sents[0], grammar, maxagenda=1)
+	assert chart is None and msg.startswith('exceeded maxagenda=1'), msg
+	# the chart of an aborted parse is returned to the pool
+	pool = ChartPool()
+	pool.release(plcfrs.parse(sents[0], grammar, pool=pool)[0])
+	assert len(pool) == 1
+	chart, msg = plcfrs.parse(sents[0], grammar, maxitems=1, pool=pool)
+	assert chart is None and len(pool) == 1, msg
+	_, _, pcfggrammar = _samplegrammar(split=True)
+	pool.release(pcfg.parse(sents[0], pcfggrammar, pool=pool)[0])
+	assert len(pool) == 2
+	chart, msg = pcfg.parse(sents[0], pcfggrammar, maxitems=1, pool=pool)
+	assert chart is None and len(pool) == 2, msg
+
+
+def test_chartpool():
+	"""Verify that charts from a pool give the same results as new charts."""
+	from discodop import plcfrs
+	from discodop.containers import ChartPool
+	sents, _, grammar = _samplegrammar()
+	pool = ChartPool()
+	for sent in sents[::-1]:
+		chart1, _ = plcfrs.parse(sent, grammar)
+		chart2, _ = plcfrs.parse(sent, grammar, pool=pool)
+		assert str(chart1) == str(chart2)
+		pool.release(chart2)
+		assert pool.retained > 0
+	chart3, _ = plcfrs.parse(sents[0], grammar, pool=pool)
+	assert chart3 is chart2 and pool.retained == 0
+	# only reuse charts for the same grammar and similar sentence length
+	pool.release(chart3)
+	size = pool.retained
+	_, _, grammar2 = _samplegrammar(dop=True)
+	chart4 = pool.get(plcfrs.SmallLCFRSChart, grammar2, sents[0])
+	chart5 = pool.get(plcfrs.SmallLCFRSChart, grammar, sents[0] * 2)
+	assert chart4 is not chart3 and chart5 is not chart3 and len(pool) == 1
+	chart6 = pool.get(plcfrs.SmallLCFRSChart, grammar, sents[0])
+	assert chart6 is chart3 and chart6.nbytes() >= size and len(pool) == 0
+	pool = ChartPool(maxbytes=0)
+	pool.release(chart3)
+	assert not pool.free
+
+
+def test_plcfrskbest():
+	"""Compare the LCFRS parser with the chart layout it replaced.
+
+	The reference numbers of items and edges and the 10-best derivation
+	probabilities were obtained when siblings were taken from the ordered
+	index of items, instead of from the list of items for each label."""
+	from discodop import plcfrs
+	from discodop.containers import ChartPool
+	from discodop.kbest import lazykbest
+	sents, _, grammar = _samplegrammar(dop=True)
+	expected = [
+			(321, 697, [23.3473] * 8 + [24.0404] * 2),
+			(304, 653, [23.3473] * 2 + [24.0404] * 4 + [24.4459] * 4),
+			(951, 2457, [23.3473] + [24.0404] * 4 + [24.4459] * 2
+				+ [24.7336] * 3)]
+	pool = ChartPool()
+	for sent, (numitems, numedges, probs) in zip(sents, expected):
+		for _ in range(2):  # with a new chart, and one from the pool
+			chart, _ = plcfrs.parse(sent, grammar, pool=pool)
+			assert chart.numitems() == numitems
+			assert chart.numedges() == numedges
+			assert [round(prob, 4) for _, prob in lazykbest(chart, 10)
+					] == probs
+			pool.release(chart)
+
+
+def test_parallelcky(tmpdir):
+	"""Verify that parallel CKY gives the same chart as the serial parser."""
+	import io
+	from discodop import pcfg
+	from discodop.parser import readparam
+	sents, _, grammar = _samplegrammar(split=True)
+	for sent in sents:
+		chart1, msg1 = pcfg.parse(sent, grammar)
+		chart2, msg2 = pcfg.parse(sent, grammar, numthreads=2)
+		assert str(chart1) == str(chart2), (msg1, msg2)
+	# numthreads is rejected when it cannot be applied
+	try:
+		pcfg.parse(sents[0], grammar, numthreads=2,
+				rulematrix=pcfg.RuleMatrix(grammar))
+	except ValueError:
+		pass
+	else:
+		raise AssertionError('expected ValueError for rulematrix')
+	with io.open('tests/pcfg.prm', encoding='utf8') as inp:
+		params = inp.read()
+	for options, valid in (("mode='pcfg', numthreads=2", True),
+			("mode='pcfg', numthreads=2, cky='rulematrix'", False),
+			("mode='plcfrs', numthreads=2", False),
+			("mode='pcfg', cky='rulematrix'", True)):
+		filename = str(tmpdir.join('params.prm'))
+		with io.open(filename, 'w', encoding='utf8') as out:
+			out.write(params.replace("name='pcfg', mode='pcfg',",
+					"name='pcfg', %s," % options, 1))
+		try:
+			readparam(filename)
+		except ValueError:
+			assert not valid, options
+		else:
+			assert valid, options
+	# a stage with pruning cannot use the rule matrix
+	with io.open(filename, 'w', encoding='utf8') as out:
+		out.write(params.replace("name='mpp', mode='pcfg',",
+				"name='mpp', mode='pcfg', cky='rulematrix',", 1))
+	try:
+		readparam(filename)
+	except ValueError:
+		pass
+	else:
+		raise AssertionError("expected ValueError for cky='rulematrix'")
+
+
+def test_parallelestimates(tmpdir):
+	"""Verify that estimates computed in parallel equal serial estimates."""
+	import numpy as np
+	from discodop.estimates import getestimates
+	_, trees, grammar = _samplegrammar()
+	root = trees[0].label
+	outside1 = getestimates(grammar, 6, root)
+	outside2 = getestimates(grammar, 6, root, numproc=2)
+	outside3 = getestimates(grammar, 6, root,
+			filename=str(tmpdir.join('outside.npy')), numproc=2)
+	assert np.isfinite(outside1).any()
+	assert np.array_equal(outside1, outside2)
+	assert np.array_equal(outside1, outside3)
+
+
+def test_rulematrix():
+	"""Verify that parsing with a RuleMatrix gives the same chart."""
+	from discodop import pcfg
+	from discodop.kbest import lazykbest, iterkbest
+
+	def edges(chart):
+		"""Map each item to its sorted edges; ignores the order of edges."""
+		result = {}
+		for line in str(chart).splitlines():
+			if line.startswith('\t=> '):
+				result[item].append(line)
+			else:
+				item = line
+				result[item] = []
+		return {item: sorted(edges) for item, edges in result.items()}
+
+	def kbest(chart, k):
+		"""Return the k-best derivations, items, and probabilities.
+
+		Derivations with equal probability may be enumerated in a different
+		order, so ties with the k-th derivation are left out."""
+		derivs = lazykbest(chart, k)
+		itemsets = [sorted(items) for _, _, items
+				in iterkbest(chart, k, items=True)]
+		return sorted((prob, deriv, items) for (deriv, prob), items
+				in zip(derivs, itemsets)
+				if len(derivs) < k or prob < derivs[-1][1])
+
+	sents, _, grammar = _samplegrammar(split=True)
+	matrix = pcfg.RuleMatrix(grammar)
+	for sent in sents:
+		chart1, _ = pcfg.parse(sent, grammar)
+		chart2, _ = pcfg.parse(sent, grammar, rulematrix=matrix)
+		assert chart1.numitems() == chart2.numitems()
+		assert chart1.numedges() == chart2.numedges()
+		# the same items (with the same IDs, labels and probabilities),
+		# and the same edges (with the same children and rules)
+		assert edges(chart1) == edges(chart2)
+		assert ([prob for _, prob in lazykbest(chart1, 10)]
+				== [prob for _, prob in lazykbest(chart2, 10)])
+		result = kbest(chart1, 10)
+		assert result and result == kbest(chart2, 10)
+
+
+def test_posteriorthreshold():
+	"""Verify pruning with inside and outside probabilities in log space."""
+	import warnings
+	from discodop import pcfg
+	from discodop.coarsetofine import posteriorthreshold, getinside, \
+			getoutside
+	sents, _, grammar = _samplegrammar(split=True)
+	for sent in sents:
+		chart, _ = pcfg.parse(sent, grammar)
+		items1, _ = posteriorthreshold(chart, 1e-9)
+		items2, _ = posteriorthreshold(chart, 0.5)
+		assert chart.root() in items1 and chart.root() in items2
+		assert set(items2) <= set(items1)
+	# deprecated functions give the same results
+	chart, _ = pcfg.parse(sents[0], grammar)
+	with warnings.catch_warnings(record=True) as caught:
+		warnings.simplefilter('always')
+		getinside(chart)
+		getoutside(chart)
+	assert [a.category for a in caught] == [DeprecationWarning] * 2
+	assert posteriorthreshold(chart, 0.5) == posteriorthreshold(
+			pcfg.parse(sents[0], grammar)[0], 0.5)
+
+
+def test_iterkbest():
+	"""Verify that incremental k-best derivations equal those of one call."""
+	from discodop import pcfg
+	from discodop.kbest import lazykbest, iterkbest
+	sents, _, grammar = _samplegrammar(split=True)
+	for sent in sents:
+		chart1, _ = pcfg.parse(sent, grammar)
+		chart2, _ = pcfg.parse(sent, grammar)
+		derivs = lazykbest(chart1, 10)
+		probs = [prob for _, prob in iterkbest(chart2, 10)][:3]
+		assert probs == [prob for _, prob in derivs[:3]]
+		for _, _, items in iterkbest(chart2, 3, items=True):
+			assert chart2.root() in items
+		assert lazykbest(chart2, 10) == derivs  # extends explored derivations
+		# a bigger k after a smaller one, and a smaller k in between
+		chart3, _ = pcfg.parse(sent, grammar)
+		assert lazykbest(chart3, 3) == derivs[:3]
+		assert lazykbest(chart3, 10) == derivs
+		assert lazykbest(chart3, 5) == derivs[:5]
+		assert lazykbest(chart3, 10) == derivs
+		assert [prob for _, prob in iterkbest(chart3, 10)] == [
+				prob for _, prob in derivs]
+
+
+def test_mappingfile(tmpdir):
+	"""Verify that stored label and rule mappings are loaded correctly."""
+	from discodop.grammar import treebankgrammar
+	from discodop.containers import Grammar
+	sents, trees, coarse = _samplegrammar()
+	fine = Grammar(treebankgrammar(trees, sents), start=trees[0].label)
+	fine.getmapping(coarse, debug=False)
+	fine.getrulemapping(coarse, re.compile(r'@[-0-9]+\b'))
+	filename = str(tmpdir.join('fine.mapping.npz'))
+	fine.mappingtofile(filename, 'key1')
+	fine2 = Grammar(treebankgrammar(trees, sents), start=trees[0].label)
+	fine2.mappingfromfile(filename, 'key1')
+	assert fine2.rulemapping == fine.rulemapping
+	assert fine2.selfrulemapping is None
+	try:
+		fine2.mappingfromfile(filename, 'key2')
+	except ValueError:
+		pass
+	else:
+		raise AssertionError('expected ValueError for other key')
+
+
+def test_boundedimap():
+	"""Verify that input is only read ahead by a bounded number of items."""
+	from multiprocessing.dummy import Pool
+	from discodop.util import boundedimap
+	consumed = []
+
+	def items():
+		for n in range(100):
+			consumed.append(n)
+			yield -n
+
+	with Pool(2) as pool:
+		for n, result in enumerate(boundedimap(pool, abs, items(), 3, 2)):
+			assert result == n
+			assert len(consumed) - n <= 2 * 3  # window * chunksize
+	assert len(consumed) == 100
+
+
+def test_scheduledimap():
+	"""Verify that costly items are dispatched first, results in order."""
+	import random
+	import time
+	from multiprocessing.dummy import Pool
+	from discodop.util import scheduledimap
+	dispatched = []
+
+	def func(item):
+		dispatched.append(item)
+		time.sleep(random.random() / 1000)
+		return -item
+
+	with Pool(1) as pool:  # a single worker executes in dispatch order
+		assert list(scheduledimap(pool, func, [1, 5, 2, 4, 3, 9, 0, 8],
+				abs, 3)) == [-1, -5, -2, -4, -3, -9, 0, -8]
+	# an item is not passed by items lookahead=3 or more positions after it
+	assert dispatched == [5, 2, 1, 9, 4, 3, 8, 0]
+	items = [random.randrange(100) for _ in range(500)]
+	with Pool(4) as pool:
+		for chunksize in (1, 7):
+			for lookahead in (1, 10, 1000):
+				assert list(scheduledimap(pool, abs, items, abs,
+						lookahead, chunksize)) == items
+				assert sorted(scheduledimap(pool, abs, items, abs, lookahead,
+						chunksize, ordered=False)) == sorted(items)
+		# stopping early does not leave the pool blocked
+		assert next(scheduledimap(pool, abs, items, abs, 10)) == items[0]
+		assert pool.apply(abs, (-1, )) == 1
+
+
+def test_doparsing(tmpdir, capsys):
+	"""Verify that output is written before the next sentence is read."""
+	import io
+	import json
+	from discodop.parser import doparsing
+
+	class Output(io.StringIO):
+		def close(self):
+			pass  # keep contents after doparsing() is done
+
+	parser, sents = _sampleparser()
+	out = Output()
+	written = []
+
+	def infile():
+		for sent in sents:
+			written.append(out.getvalue().count('\n'))
+			yield ' '.join('%s/%s' % (word, tag) for word, tag in sent)
+
+	doparsing(parser, infile(), out, False, True, True, 1, 1, 'bracket',
+			None, False)
+	assert written == list(range(len(sents)))
+	assert out.getvalue().splitlines() == [
+			'(S (RIGHT (X x) (Y y)))'] * len(sents)
+	# metrics of each sentence are written to a file, and summarized
+	metricsfile = str(tmpdir.join('metrics.jsonl'))
+	capsys.readouterr()
+	doparsing(parser, ['x/X y/Y'] * 3, Output(), False, True, True, 1, 1,
+			'bracket', None, False, metricsfile=metricsfile)
+	with io.open(metricsfile, encoding='utf8') as inp:
+		metrics = [json.loads(line) for line in inp]
+	assert [(a['id'], a['len'], a['stage']) for a in metrics] == [
+			(n, 2, 'pcfg') for n in (1, 2, 3)]
+	assert all(a['total'] >= a['parse'] >= 0 and a['items'] > 0
+			for a in metrics)
+	assert 'pcfg: 3 sentences; time per sentence' in capsys.readouterr().err
+	# with multiple processes, output remains in input order
+	out = Output()
+	doparsing(parser, ['%d|x/X y/Y' % n for n in range(20)], out, False,
+			True, True, 1, 2, 'export', None, True, longestfirst=5)
+	assert re.findall(r'#BOS (\d+)', out.getvalue()) == [
+			str(n) for n in range(20)]
+	try:
+		doparsing(parser, [], out, False, True, True, 1, 2, 'export', None,
+				False, window=2, longestfirst=5)
+	except ValueError:
+		pass
+	else:
+		raise AssertionError('expected ValueError for window')
+
+
+def test_metricssummary():
+	"""Verify running aggregates of metrics against exact statistics."""
+	import math
+	from discodop.parser import MetricsSummary, summarizemetrics
+	steps = dict.fromkeys(MetricsSummary.steps, 0.0)
+	times = [0.0005 * 1.5 ** n for n in range(30)]
+	summary = MetricsSummary()
+	for n, total in enumerate(times):
+		summary.add(dict(steps, stage='pcfg', total=total, parse=total,
+				items=n, chartbytes=10 * n))
+	summary.add(dict(steps, stage='plcfrs', total=0.5))
+	agg = summary.bystage['pcfg']
+	assert agg['count'] == len(times) and agg['maxtotal'] == max(times)
+	assert abs(agg['total'] - sum(times)) < 1e-9
+	assert agg['maxitems'] == 29 and agg['maxchartbytes'] == 290
+	assert sum(agg['histogram']) == sum(agg['coarse']) == len(times)
+	for q in (50, 90, 99):
+		exact = times[int(math.ceil(q / 100 * len(times))) - 1]
+		assert exact <= summary.percentile('pcfg', q) <= exact * 10 ** 0.1
+	assert summary.percentile('plcfrs', 50) == 0.5
+	result = str(summary)
+	assert result.startswith(summarizemetrics(dict(steps, stage='pcfg',
+			total=total, parse=total, items=n, chartbytes=10 * n)
+			for n, total in enumerate(times)))
+	assert 'plcfrs: 1 sentences' in result and 'chart items' in result
+
+
+def test_parsecache(tmpdir):
+	"""Verify that cached parse results are returned as copies."""
+	from discodop.parser import ParseCache, DictObj
+	filename = str(tmpdir.join('cache.db'))
+	cache = ParseCache('fingerprint', maxsize=1, filename=filename)
+	key = cache.key(['Why', 'not', '?'], require=[('NP', (0, ))])
+	assert cache.get(key) is None
+	cache.put(key, [DictObj(name='stage1', parsetree=Tree('(S (X 0))'))])
+	result = cache.get(key)
+	assert result[0].name == 'stage1'
+	result[0].parsetree[0].label = 'Y'
+	assert cache.get(key)[0].parsetree[0].label == 'X'
+	cache.put('other', [])
+	assert list(cache.lru) == ['other']
+	# on-disk tier
+	assert ParseCache('fingerprint', filename=filename).get(key) is not None
+	assert ParseCache('other', filename=filename).get(ParseCache(
+			'other').key(['Why', 'not', '?'], require=[('NP', (0, ))])) is None
+	# results from the cache are marked as such in the metrics
+	parser, _ = _sampleparser()
+	parser.cache = ParseCache('fingerprint')
+	try:
+		result1 = list(parser.parse(['x', 'y']))[-1]
+		result2 = list(parser.parse(['x', 'y']))[-1]
+	finally:
+		parser.cache = None
+	assert not result1.metrics['cached'] and result2.metrics['cached']
+	assert result2.parsetree == result1.parsetree
+	assert result2.elapsedtime == result2.metrics['total']
+	assert result2.metrics['parse'] == 0
+
+
+def test_serve(tmpdir, capsys, monkeypatch):
+	"""Send requests to the parser server on stdin and on a socket."""
+	import io
+	import json
+	import socket
+	import threading
+	from discodop.parser import (serve, initworker, ParserServer,
+			ParserRequestHandler)
+	parser, sents = _sampleparser()
+	sent = ' '.join(word for word, _ in sents[0])
+	requests = '%s\n\nx y\n{"id": "b"}\n' % json.dumps(dict(
+			id='a', sent=sent, fmt='bracket', numparses=1))
+	monkeypatch.setattr('sys.stdin', io.StringIO(requests))
+	serve(parser, None, 1, False, False, 1, 'discbracket', None)
+	responses = [json.loads(line)
+			for line in capsys.readouterr().out.splitlines()]
+	# default IDs are line numbers
+	assert [a['id'] for a in responses] == ['a', 3, 'b']
+	assert set(responses[0]) == {'id', 'output', 'noparse', 'elapsedtime',
+			'msg', 'metrics'}
+	assert not responses[0]['noparse']
+	assert responses[0]['output'] == '(S (RIGHT (X x) (Y y)))\n'
+	metrics = responses[0]['metrics']
+	assert [a['stage'] for a in metrics] == ['pcfg']
+	assert metrics[0]['id'] == 'a' and metrics[0]['len'] == len(sents[0])
+	assert metrics[0]['total'] >= metrics[0]['parse'] >= 0
+	assert responses[1]['output'] == '(S (RIGHT (X 0=x) (Y 1=y)))\n'
+	assert set(responses[2]) == {'id', 'error'}
+	monkeypatch.setattr('sys.stdin', io.StringIO(requests * 3))
+	serve(parser, None, 2, False, False, 1, 'discbracket', None)
+	responses2 = [json.loads(line)
+			for line in capsys.readouterr().out.splitlines()]
+	assert [a['id'] for a in responses2] == ['a', 3, 'b', 'a', 7, 'b',
+			'a', 11, 'b']
+	assert [a.get('output') for a in responses2] == 3 * [
+			a.get('output') for a in responses]
+
+	socketpath = str(tmpdir.join('parser.sock'))
+	initworker(parser, False, False, 1, 'discbracket', None)
+	server = ParserServer(socketpath, ParserRequestHandler)
+	server.pool, server.lock = None, threading.Lock()
+	thread = threading.Thread(target=server.serve_forever)
+	thread.start()
+	try:
+		client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		client.connect(socketpath)
+		client.sendall(('%s\n' % sent).encode('utf8'))
+		response = json.loads(client.makefile('rb').readline().decode('utf8'))
+		client.close()
+	finally:
+		server.shutdown()
+		server.server_close()
+		thread.join()
+	assert response['id'] == 1 and not response['noparse']
+	assert response['output'] == responses[1]['output']
+	assert response['metrics'][0]['stage'] == 'pcfg'
+
+
+def test_parsebatch():
+	"""Verify that parsebatch() gives the results of parse(), and that
+	results are cached even when the generator is closed early."""
+	from discodop.parser import ParseCache
+	parser, sents = _sampleparser()
+	words = [[word for word, _ in sent] for sent in sents]
+	tags = [[tag for _, tag in sent] for sent in sents]
+	results = list(parser.parsebatch(words, tags))
+	assert len(results) == len(sents)
+	for sent, tagged, result in zip(words, tags, results):
+		expected = list(parser.parse(sent, tagged))
+		assert [a.parsetree for a in result] == [
+				a.parsetree for a in expected]
+	parser.cache = ParseCache('fingerprint')
+	try:
+		batch = parser.parsebatch(words[:2], [tags[0], None])
+		next(batch)
+		batch.close()
+		assert parser.cache.get(parser.cache.key(words[0], tags[0]))
+		assert parser.cache.get(parser.cache.key(words[1], None))
+		parser.cache.lru.clear()
+		sent = parser.parse(['x', 'y'])
+		next(sent)
+		sent.close()
+		assert parser.cache.get(parser.cache.key(['x', 'y']))
+	finally:
+		parser.cache = None
+
+
 def test_optimalbinarize():
 	"""Verify that all optimal parsing complexities are lower than or
 	equal to the complexities of right-to-left binarizations."""
@@ -595,6 +1207,40 @@ def test_eval():
 	print(evaluator.summary())
 
 
+def test_compacteval():
+	"""Verify that the compact accumulator gives the same results."""
+	from discodop.treebank import READERS
+	from discodop.eval import Evaluator, readparam
+	param = readparam(None)
+	param['LA'] = 1
+	evaluators = [Evaluator(param), Evaluator(param, compact=True)]
+	for evaluator in evaluators:
+		gold = READERS['export']('alpinosample.export')
+		parses = READERS['export']('alpinosample.export', punct='move')
+		goldtrees, goldsents = gold.trees(), gold.sents()
+		candsents = parses.sents()
+		for n, ctree in parses.trees().items():
+			evaluator.add(n, goldtrees[n], goldsents[n], ctree, candsents[n])
+	assert evaluators[0].summary() == evaluators[1].summary()
+	assert evaluators[0].acc.scores() == evaluators[1].acc.scores()
+
+
+def test_parallelevaluate():
+	"""Verify that evaluating with multiple processes gives the same results."""
+	from discodop.treebank import READERS
+	from discodop.eval import Evaluator, readparam, parallelevaluate
+	param = readparam(None)
+	gold = READERS['export']('alpinosample.export')
+	parses = READERS['export']('alpinosample.export', punct='move')
+	goldtrees, goldsents = gold.trees(), gold.sents()
+	evaluator = Evaluator(param)
+	for n, item in parses.itertrees():
+		evaluator.add(n, goldtrees[n], goldsents[n], item.tree, item.sent)
+	result = parallelevaluate(READERS['export']('alpinosample.export'),
+			READERS['export']('alpinosample.export', punct='move'), param, 2)
+	assert result.summary() == evaluator.summary()
+
+
 def test_punct():
 	"""Verify that punctuation movement does not increase fan-out."""
 	def phrasal(x):
@@ -805,6 +1451,316 @@ def test_treedraw():
 			print(drawtree.text(unicodelines=False, ansi=False), sep='\n')
 
 
+def test_resultcache(tmpdir):
+	"""Verify eviction by size, compact indices, and the on-disk tier."""
+	import array
+	from discodop.treesearch import ResultCache
+	corpus = tmpdir.join('corpus.txt')
+	corpus.write('a\nb\n')
+	filename, dbname = str(corpus), str(tmpdir.join('cache.db'))
+	cache = ResultCache(4096, dbname, namespace='test')
+	key = ('counts', 'query', filename, None, None, True)
+	try:
+		cache[key]
+	except KeyError:
+		pass
+	else:
+		raise AssertionError('expected KeyError')
+	cache[key] = list(range(70000, 71000))
+	assert cache.nbytes < 2500  # vs. 5000 bytes for a pickled list
+	assert cache[key] == list(range(70000, 71000))
+	cache['counts', 'other', filename] = [array.array('I', [1, 2, 3]), [5]]
+	assert cache['counts', 'other', filename] == [
+			array.array('I', [1, 2, 3]), [5]]
+	cache['counts', 'dupes', filename] = [3, 1, 1]
+	assert cache['counts', 'dupes', filename] == [3, 1, 1]
+	cache['trees', 'big', filename] = ['x' * 5000]
+	assert ('trees', 'big', filename) not in cache.lru
+	assert (cache.hits, cache.misses) == (3, 1)
+	for n in range(100):
+		cache['counts', str(n), filename] = 'y' * 100
+	assert cache.nbytes <= 4096 and cache.evictions > 0
+	assert ('counts', '99', filename) in cache
+	# on-disk tier; invalidated when the corpus changes
+	assert ResultCache(0, dbname, namespace='test')[key][:2] == [70000, 70001]
+	assert key not in ResultCache(0, dbname, namespace='other')
+	corpus.setmtime(corpus.mtime() + 10)
+	assert key not in ResultCache(0, dbname, namespace='test')
+	# on-disk tier is bounded; least recently used entries are evicted
+	cache = ResultCache(0, dbname, namespace='test', maxdiskbytes=1000)
+	cache['counts', 'a', filename] = 'a' * 400
+	cache['counts', 'b', filename] = 'b' * 400
+	assert cache['counts', 'a', filename] == 'a' * 400
+	cache['counts', 'c', filename] = 'c' * 400
+	assert ('counts', 'a', filename) in cache
+	assert ('counts', 'b', filename) not in cache
+	assert ('counts', 'c', filename) in cache
+
+	def disksize():
+		return [cache.conn.execute(query).fetchone()[0] for query in (
+				"SELECT value FROM resultsmeta WHERE name = 'nbytes'",
+				'SELECT SUM(LENGTH(value)) FROM results')]
+
+	# the total size is kept up to date, also when entries are replaced
+	cache['counts', 'c', filename] = 'c' * 200
+	nbytes, expected = disksize()
+	assert nbytes == expected
+	# and recomputed when the file is opened
+	cache.conn.execute('UPDATE resultsmeta SET value = 0')
+	cache.conn.commit()
+	cache = ResultCache(0, dbname, namespace='test', maxdiskbytes=1000)
+	cache['counts', 'd', filename] = 'd' * 100
+	nbytes, expected = disksize()
+	assert nbytes == expected
+	# pickled results are not loaded from a file writable by others
+	os.chmod(dbname, 0o666)
+	try:
+		ResultCache(0, dbname, namespace='test')[key]
+	except ValueError:
+		pass
+	else:
+		raise AssertionError('expected ValueError')
+
+
+def test_resultcachenamespace(tmpdir):
+	"""Verify that cached results depend on the contents of macros."""
+	from discodop.treesearch import RegexSearcher
+	corpus = tmpdir.join('corpus.txt')
+	corpus.write('a b\nb c\n')
+	macros = tmpdir.join('macros.txt')
+	macros.write('x=a\n')
+	filename, dbname = str(corpus), str(tmpdir.join('cache.db'))
+	with RegexSearcher([filename], macros=str(macros), numproc=1,
+			cachefile=dbname) as searcher:
+		assert searcher.counts('{x}')[filename] == 1
+	macros.write('x=b\n')
+	with RegexSearcher([filename], macros=str(macros), numproc=1,
+			cachefile=dbname) as searcher:
+		assert searcher.counts('{x}')[filename] == 2
+
+
+def test_fragmentsearcher(tmpdir):
+	"""Verify that the label index prunes trees without changing results."""
+	import shutil
+	from discodop.treesearch import FragmentSearcher
+	filename = str(tmpdir.join('t1.mrg'))
+	shutil.copy('tests/t1.mrg', filename)
+	searcher = FragmentSearcher([filename], numproc=1)
+	assert os.path.exists(filename + '.labels.idx')
+	assert searcher.counts('(S (RIGHT ) )')[filename] == 3
+	assert searcher.counts('(RIGHT (X x) (Y ))')[filename] == 3
+	assert searcher.counts('(S (NOSUCHLABEL ) )')[filename] == 0
+	stats = searcher.stats
+	assert stats['trees'] == 3 * 4
+	assert stats['prodindex'] >= stats['labelindex'] == 3 + 3
+	searcher.warmup()
+	assert searcher.counts('(X x)', start=2)[filename] == 3
+	searcher.close()
+
+
+def test_getmapped(tmpdir):
+	"""Verify that a modified file is reloaded and the old object closed."""
+	from discodop.treesearch import _getmapped, MAPPED
+
+	class Mapped(object):
+		closed = False
+
+		def close(self):
+			self.closed = True
+
+	filename = str(tmpdir.join('mapped'))
+	tmpdir.join('mapped').write('')
+	old = _getmapped(filename, lambda path: Mapped())
+	assert _getmapped(filename, lambda path: Mapped()) is old
+	os.utime(filename, (0, 0))
+	new = _getmapped(filename, lambda path: Mapped())
+	assert new is not old and old.closed and not new.closed
+	del MAPPED[filename]
+
+
+def test_regexbatchcounts(tmpdir):
+	"""Verify that batch counts in chunks equal counts of each query."""
+	from discodop import treesearch
+	corpus = tmpdir.join('corpus.txt')
+	corpus.write('the cat sat on the mat\n\nthe dog\ncat dog\n' * 50)
+	filename = str(corpus)
+	queries = [r'cat', r'\bthe (cat|dog)', r'^the', r'mat$', r'cat\s+dog',
+			r'(t)\1', r'x*', r'[0-9]+', r'dog(?= sat)']
+	searcher = treesearch.RegexSearcher([filename], numproc=1)
+	chunksize = treesearch.REGEXCHUNKSIZE
+	treesearch.REGEXCHUNKSIZE = 100
+	try:
+		for start, end in ((None, None), (3, 40), (140, None)):
+			lineindex = searcher.lineindex[0]
+			startidx = lineindex.select(start - 1 if start else 0)
+			endidx = lineindex.select(end or len(lineindex) - 1)
+			data = corpus.read_binary()
+			expected = [len(re.compile(query.encode('utf8'), re.MULTILINE
+					).findall(data, startidx, endidx)) for query in queries]
+			(_, result), = searcher.batchcounts(queries, start=start, end=end)
+			assert list(result) == expected, (start, end, result, expected)
+	finally:
+		treesearch.REGEXCHUNKSIZE = chunksize
+		searcher.close()
+
+
+def test_regexbatchanchored(tmpdir, monkeypatch):
+	"""Compare batch counts of anchored queries with re2.Set and without."""
+	from discodop import treesearch
+
+	class FakeSet(object):
+		"""Emulate ``re2.Set`` with ``re``; rejects lookaround as re2 does."""
+
+		def __init__(self, flags):
+			self.flags = flags & ~re.UNICODE
+			self.patterns = []
+
+		@classmethod
+		def SearchSet(cls, flags):
+			return cls(flags)
+
+		def Add(self, pattern):
+			if b'(?=' in pattern or b'(?<' in pattern:
+				raise ValueError(pattern)
+			self.patterns.append(re.compile(pattern, self.flags))
+
+		def Compile(self):
+			pass
+
+		def Match(self, data):
+			return [n for n, pattern in enumerate(self.patterns)
+					if pattern.search(data)]
+
+	corpus = tmpdir.join('corpus.txt')
+	corpus.write('the cat sat on the mat\n\nthe dog\ncat dog\n' * 50)
+	filename = str(corpus)
+	data = corpus.read_binary()
+	queries = [r'^the', r'mat$', r'^cat dog$', r'^dog', r'\bdog\b$',
+			r'(?<=^the )cat', r'^(the|cat) [a-z]+$', r'^$x']
+	searcher = treesearch.RegexSearcher([filename], numproc=1)
+	lineindex = searcher.lineindex[0]
+	monkeypatch.setattr(treesearch, 'REGEXCHUNKSIZE', 100)
+	if treesearch.RE2LIB:
+		re2 = treesearch.re2
+	else:  # queries are compiled with re instead
+		def compile(*args, **kwds):
+			raise ValueError
+
+		re2 = type('re2', (), dict(Set=FakeSet, compile=staticmethod(compile)))
+	# without re2.Set, queries are not prefiltered
+	noset = type('re2', (), dict(compile=staticmethod(re2.compile)))
+	for re2lib, module in ((False, re2), (True, re2), (True, noset)):
+		monkeypatch.setattr(treesearch, 'RE2LIB', re2lib)
+		monkeypatch.setattr(treesearch, 're2', module, raising=False)
+		monkeypatch.setattr(treesearch, 'REGEXBATCH', {})
+		for start, end in ((None, None), (3, 40), (140, None)):
+			startidx = lineindex.select(start - 1 if start else 0)
+			endidx = lineindex.select(end or len(lineindex) - 1)
+			expected = [len(re.compile(query.encode('utf8'), re.MULTILINE
+					).findall(data, startidx, endidx)) for query in queries]
+			(_, result), = searcher.batchcounts(queries, start=start, end=end)
+			assert list(result) == expected, (re2lib, start, end)
+		multipattern, = treesearch.REGEXBATCH[
+				tuple(queries), searcher.flags][1].values()
+		assert (multipattern.patternset is not None) == (
+				re2lib and module is re2)
+		assert (multipattern.combined is not None) != re2lib
+	searcher.close()
+
+
+def test_tgrep():
+	"""Match tgrep2 queries against a single tree."""
+	from discodop.tgrep import TgrepQuery, NodeTable
+	tree = Tree('(S (NP-SBJ (DT 0) (NN 1)) (VP (VB 2) (NP (PRP$ 3) (NN 4))) '
+			'(. 5))')
+	table = NodeTable.fromtree(tree, 'The cat ate its food .'.split())
+
+	def matches(query, macros=None):
+		return [table.labels[i] for i, _
+				in TgrepQuery(query, macros).matches(table)]
+
+	assert matches('NP') == ['NP-SBJ', 'NP']
+	assert matches('NP !< DT') == ['NP']
+	assert matches('NP < DT | < PRP$') == ['NP-SBJ', 'NP']
+	assert matches('NN . VP') == ['NN']
+	assert matches('NN >> VP') == ['NN']
+	assert matches('VP <- NP') == ['VP']
+	assert matches('VB $.. NP') == ['VB']
+	assert matches('S < (VP < (NP <1 PRP$))') == ['S']
+	assert matches('/^[a-z]+$/ > NN') == ['cat', 'food']
+	assert matches('@X < DT', {'X': 'NP|VP'}) == ['NP-SBJ']
+	assert matches('NP=x >> (S < =x)') == ['NP-SBJ']
+	assert [marked for _, marked in TgrepQuery('VP < NP=x < VB=y').matches(
+			table)] == [[7, 9]]
+	assert TgrepQuery('S < NP !< VP').constraints()[1].matchlabel('NP-SBJ')
+	try:
+		TgrepQuery('NP <')
+	except ValueError:
+		pass
+	else:
+		raise AssertionError('expected syntax error')
+
+
+def test_tgrepsearcher(tmpdir):
+	"""Compare TgrepSearcher with results of the tgrep2 binary."""
+	import glob
+	from discodop.treesearch import TgrepSearcher, FragmentSearcher
+	filename = str(tmpdir.join('t.mrg'))
+	with open(filename, 'w') as out:
+		out.write('(S (NP (DT The) (NN cat)) (VP (VBD sat) (PP (IN on) '
+				'(NP (DT the) (NN mat)))) (. .))\n'
+				'(S (NP (PRP It)) (VP (VBD purred)) (. .))\n')
+	# a fragment searcher on the same directory has its own vocabulary
+	fragsearcher = FragmentSearcher([filename], numproc=1)
+	searcher = TgrepSearcher([filename], numproc=1)
+	assert fragsearcher.counts('(NP (DT ) (NN ))')[filename] == 2
+	fragsearcher.close()
+	assert os.path.exists(str(tmpdir.join('treesearchvocab.tgrep.idx')))
+	assert glob.glob(str(tmpdir.join('*.mrg.ct'))) == [filename + '.ct']
+	# expected values are the output of tgrep2 -a with the old TgrepSearcher
+	assert searcher.counts('NP')[filename] == 3
+	assert searcher.counts('NP < DT')[filename] == 2
+	assert searcher.counts('NP', indices=True)[filename] == [1, 1, 2]
+	assert searcher.counts('NP', breakdown=True)[filename] == {
+			'(NP (DT The) (NN cat))': 1, '(NP (DT the) (NN mat))': 1,
+			'(NP (PRP It))': 1}
+	assert searcher.counts('VP !<< NN')[filename] == 1
+	assert searcher.counts('/^N/')[filename] == 5
+	assert searcher.counts('NOSUCHLABEL')[filename] == 0
+	treestr = ('(S (NP (DT 0) (NN 1)) (VP (VBD 2) (PP (IN 3) (NP (DT 4) '
+			'(NN 5)))) (. 6))')
+	result = searcher.trees('NN', maxresults=None)
+	assert [(sentno, str(tree), ' '.join(sent), sorted(map(str, high)))
+			for _, sentno, tree, sent, high in result] == [
+			(1, treestr, 'The cat sat on the mat .', ['(NN 1)', '1']),
+			(1, treestr, 'The cat sat on the mat .', ['(NN 5)', '5'])]
+	# tgrep2 highlighted the space before a word instead of after it
+	result = searcher.sents('NN', maxresults=None)
+	assert [(sentno, sent, ''.join(sent[n] for n in sorted(high)).split())
+			for _, sentno, sent, high, _ in result] == [
+			(1, 'The cat sat on the mat .', ['cat']),
+			(1, 'The cat sat on the mat .', ['mat'])]
+	result = searcher.sents('VBD', brackets=True)
+	assert [(sentno, high) for _, sentno, _, high, _ in result] == [
+			(1, '(VBD sat)'), (2, '(VBD purred)')]
+	assert result[1][2] == '(S (NP (PRP It)) (VP (VBD purred)) (. .))'
+	assert searcher.extract(filename, [2, 1], sents=True) == [
+			'It purred .', 'The cat sat on the mat .']
+	(tree, sent), = searcher.extract(filename, [2])
+	assert str(tree) == '(S (NP (PRP 0)) (VP (VBD 1)) (. 2))'
+	assert sent == ['It', 'purred', '.']
+	searcher.close()
+	with TgrepSearcher([filename], numproc=2) as searcher:
+		searcher.warmup()
+		assert searcher.counts('NP')[filename] == 3
+	try:
+		TgrepSearcher([filename + '.t2c.gz'], numproc=1)
+	except ValueError:
+		pass
+	else:
+		raise AssertionError('expected ValueError for .t2c.gz file')
+
+
 def test_runexp():
 	"""Run ``sample.prm``."""
 	from discodop import cli
@@ -824,3 +1780,15 @@ def test_issue51():
 			start='S')
 	chart, _msg = parse(['b'], g)
 	chart.filter()
+
+
+def test_bench():
+	"""Run a small benchmark and compare it with itself."""
+	from discodop.bench import runbenchmark, compare
+	result = runbenchmark('t1', 'pcfg', repeat=2)
+	assert result['sentences'] == 8 and result['noparse'] == 0
+	assert result['latency']['p50'] <= result['latency']['max']
+	assert result['parserss'] >= result['loadrss'] > 0
+	assert result['trainrss'] > 0
+	old = dict(version='0', results=[result])
+	assert 't1' in compare(old, dict(old, version='1'))
@@ -50,6 +50,10 @@ INDICESMAXRESULTS = 1024  # max number of results for which to obtain indices.
 	# Indices are used to display a dispersion plot.
 LANG = 'nl'  # language to use when running style(1) or ucto(1)
 CORPUS_DIR = "corpus/"
+# database with query results kept across restarts; its results are
+# unpickled, so it is kept in a private directory instead of CORPUS_DIR.
+CACHEFILE = os.path.join(os.environ.get('XDG_CACHE_HOME',
+		os.path.expanduser('~/.cache')), 'discodop', 'treesearchcache.db')
 PASSWD = None  # optionally, dict with user=>pass strings
 
 APP = Flask(__name__)
@@ -1104,19 +1108,26 @@ def getcorpus():
 	for filename in tfiles or txtfiles:
 		tokenize(filename)
 	tokfiles = sorted(glob.glob(os.path.join(CORPUS_DIR, '*.tok')))
+	if CACHEFILE:
+		os.makedirs(os.path.dirname(CACHEFILE), mode=0o700, exist_ok=True)
 	if tfiles and set(tfiles) != set(corpora.get('tgrep2', ())):
 		corpora['tgrep2'] = treesearch.TgrepSearcher(
-				tfiles, macros='static/tgrepmacros.txt', numproc=NUMPROC)
+				tfiles, macros='static/tgrepmacros.txt', numproc=NUMPROC,
+				cachefile=CACHEFILE)
+		corpora['tgrep2'].warmup()
 		log.info('tgrep2 corpus loaded.')
 	if ffiles and set(ffiles) != set(corpora.get('frag', ())):
 		corpora['frag'] = treesearch.FragmentSearcher(
 				ffiles, macros='static/fragmacros.txt',
-				inmemory=INMEMORY, numproc=1 if DEBUG else NUMPROC)
+				inmemory=INMEMORY, numproc=1 if DEBUG else NUMPROC,
+				cachefile=CACHEFILE)
+		corpora['frag'].warmup()
 		log.info('frag corpus loaded.')
 	if tokfiles and set(tokfiles) != set(corpora.get('regex', ())):
 		corpora['regex'] = treesearch.RegexSearcher(
 				tokfiles, macros='static/regexmacros.txt',
-				inmemory=INMEMORY, numproc=1 if DEBUG else NUMPROC)
+				inmemory=INMEMORY, numproc=1 if DEBUG else NUMPROC,
+				cachefile=CACHEFILE)
 		log.info('regex corpus loaded.')
 
 	assert tfiles or ffiles or tokfiles, (